@@ -4,6 +4,7 @@ from flask_wtf.csrf import CSRFProtect
 from flask_cors import CORS
 import logging
 from logging.handlers import RotatingFileHandler
+import multiprocessing
 import os
 import sys
 import subprocess
@@ -108,6 +109,50 @@ def create_app():
         app.register_blueprint(chat_bp, url_prefix='/chat')
         app.register_blueprint(tasks_bp, url_prefix='/tasks')
         
+        # Riepilogo materializzato dei ticket (hook di flush + comando di rebuild)
+        from services.ticket_summary import init_app as init_ticket_summary
+        init_ticket_summary(app)
+        
+        # Indici di ricerca testuale (articoli e ticket)
+        from services.search_index import init_app as init_search_index
+        init_search_index(app)
+        
+        # Cache della risoluzione dei QR code (invalidata alle modifiche dei ticket)
+        from services.scan_resolution import init_app as init_scan_resolution
+        init_scan_resolution(app)
+        
+        # Contatori in cache per badge e dashboard (invalidati dai cambi di stato)
+        from services.badge_counters import init_app as init_badge_counters
+        init_badge_counters(app)
+        
+        # Buffer di scrittura differita dei log di scansione (flush allo shutdown)
+        from services.audit_buffer import init_app as init_audit_buffer
+        init_audit_buffer(app)
+        
+        # Contatori di avanzamento dei task (aggiornati al flush + riconciliazione)
+        from services.task_progress import init_app as init_task_progress
+        init_task_progress(app)
+        
+        # Event bus tra i processi (event_log) e aggiornamenti in push di schermo task, notifiche e chat
+        from services.event_bus import init_app as init_event_bus
+        init_event_bus(app)
+        from services.task_screen import init_app as init_task_screen
+        init_task_screen(app)
+        from services.notification_feed import init_app as init_notification_feed
+        init_notification_feed(app)
+        
+        # Sweeper delle scadenze ticket in background
+        from services.ticket_sweeper import init_app as init_ticket_sweeper
+        init_ticket_sweeper(app)
+        
+        # Statistiche delle scansioni dei task (tabelle di rollup aggiornate in background)
+        from services.scan_analytics import init_app as init_scan_analytics
+        init_scan_analytics(app)
+        
+        # Rendering dei PDF dei DDT in un pool di processi con cache su disco
+        from services.ddt_pdf import init_app as init_ddt_pdf
+        init_ddt_pdf(app)
+        
         # Register template filters
         from services.utils import format_price, format_weight, current_time, b64encode
         
@@ -168,26 +213,22 @@ def create_app():
             def current_time():
                 return datetime.now()
             
+            def get_feed_counters():
+                """Counters of the current user from the notification feed cache (no query per render)"""
+                from services.notification_feed import get_user_counters
+                return get_user_counters(current_user)
+            
             def get_user_active_tasks_count():
                 """Get count of active tasks for current user"""
                 if not current_user.is_authenticated or current_user.is_admin:
                     return 0
-                from app.models import Task
-                return Task.query.filter(
-                    Task.assigned_to == current_user.id,
-                    Task.status.in_(['pending', 'assigned', 'in_progress'])
-                ).count()
+                return get_feed_counters()['active_tasks']
             
             def get_admin_completed_notifications_count():
                 """Get count of unread task completion notifications for admin"""
                 if not current_user.is_authenticated or not current_user.is_admin:
                     return 0
-                from app.models import TaskNotification
-                return TaskNotification.query.filter_by(
-                    user_id=current_user.id,
-                    is_read=False,
-                    notification_type='task_completed'
-                ).count()
+                return get_feed_counters()['completed']
             
             def is_task_expired(task_deadline):
                 """Check if task deadline has passed (only tomorrow counts as expired)"""
@@ -313,8 +354,16 @@ def create_app():
     
     return app
 
-# Create application instance
-app = create_app()
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+
+# Create application instance. I processi del pool PDF DDT (contesto spawn,
+# services.ddt_pdf) rieseguono questo modulo come __mp_main__: lì basta
+# un'istanza vuota per le route sotto, senza database, sweeper e thread
+if __name__ == '__mp_main__':
+    app = Flask(__name__)
+else:
+    app = create_app()
 
 @app.shell_context_processor
 def make_shell_context():
@@ -127,6 +127,40 @@ def create_app():
                 app.register_blueprint(chat_bp, url_prefix='/chat')
                 app.register_blueprint(tasks_bp, url_prefix='/tasks')
                 
+                from services.ticket_summary import init_app as init_ticket_summary
+                init_ticket_summary(app)
+                
+                from services.search_index import init_app as init_search_index
+                init_search_index(app)
+                
+                from services.scan_resolution import init_app as init_scan_resolution
+                init_scan_resolution(app)
+                
+                from services.badge_counters import init_app as init_badge_counters
+                init_badge_counters(app)
+                
+                from services.audit_buffer import init_app as init_audit_buffer
+                init_audit_buffer(app)
+                
+                from services.task_progress import init_app as init_task_progress
+                init_task_progress(app)
+                
+                from services.event_bus import init_app as init_event_bus
+                init_event_bus(app)
+                from services.task_screen import init_app as init_task_screen
+                init_task_screen(app)
+                from services.notification_feed import init_app as init_notification_feed
+                init_notification_feed(app)
+                
+                from services.ticket_sweeper import init_app as init_ticket_sweeper
+                init_ticket_sweeper(app)
+                
+                from services.scan_analytics import init_app as init_scan_analytics
+                init_scan_analytics(app)
+                
+                from services.ddt_pdf import init_app as init_ddt_pdf
+                init_ddt_pdf(app)
+                
                 # Add root route that redirects to login (missing in PyInstaller version)
                 from flask import redirect, url_for, render_template, flash
                 @app.route('/')
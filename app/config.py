@@ -188,6 +188,30 @@ def get_fatture_config_from_file():
         logger.error(f"Errore nel caricamento configurazione fatture: {str(e)}")
         return {}
 
+def get_sweeper_config_from_file():
+    """Ottiene la configurazione dello sweeper scadenze ticket dal file .config"""
+    try:
+        return config_manager.get_sweeper_config()
+    except Exception as e:
+        logger.error(f"Errore nel caricamento configurazione sweeper: {str(e)}")
+        return {'enabled': True, 'interval_minutes': 15, 'batch_size': 500}
+
+def get_audit_buffer_config_from_file():
+    """Ottiene la configurazione del buffer dei log di scansione dal file .config"""
+    try:
+        return config_manager.get_audit_buffer_config()
+    except Exception as e:
+        logger.error(f"Errore nel caricamento configurazione buffer log: {str(e)}")
+        return {'durability': 'buffered', 'flush_interval_ms': 250, 'flush_max_rows': 200, 'max_pending': 10000}
+
+def get_ddt_pdf_config_from_file():
+    """Ottiene la configurazione del rendering dei PDF dei DDT dal file .config"""
+    try:
+        return config_manager.get_ddt_pdf_config()
+    except Exception as e:
+        logger.error(f"Errore nel caricamento configurazione PDF DDT: {str(e)}")
+        return {'workers': 2, 'timeout_seconds': 60, 'cache_path': 'Cache/DDT', 'cache_max_files': 2000}
+
 # Funzioni per aggiornare le configurazioni nel file .config
 def update_company_config(company_config):
     """Aggiorna la configurazione azienda nel file .config"""
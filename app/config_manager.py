@@ -185,6 +185,32 @@ class ConfigManager:
             'include_discount': self.get_setting('FATTURE_INCLUDE_DISCOUNT', 'True').lower() == 'true'
         }
     
+    def get_sweeper_config(self):
+        """Ottiene la configurazione dello sweeper scadenze ticket"""
+        return {
+            'enabled': self.get_setting('ENABLE_TICKET_SWEEPER', 'True').lower() == 'true',
+            'interval_minutes': int(self.get_setting('TICKET_SWEEP_INTERVAL_MINUTES', 15)),
+            'batch_size': int(self.get_setting('TICKET_SWEEP_BATCH_SIZE', 500))
+        }
+    
+    def get_audit_buffer_config(self):
+        """Ottiene la configurazione del buffer di scrittura dei log di scansione"""
+        return {
+            'durability': self.get_setting('AUDIT_DURABILITY_MODE', 'buffered').lower(),
+            'flush_interval_ms': int(self.get_setting('AUDIT_FLUSH_INTERVAL_MS', 250)),
+            'flush_max_rows': int(self.get_setting('AUDIT_FLUSH_MAX_ROWS', 200)),
+            'max_pending': int(self.get_setting('AUDIT_MAX_PENDING_ROWS', 10000))
+        }
+    
+    def get_ddt_pdf_config(self):
+        """Ottiene la configurazione del rendering e della cache dei PDF dei DDT"""
+        return {
+            'workers': int(self.get_setting('DDT_PDF_WORKERS', 2)),
+            'timeout_seconds': int(self.get_setting('DDT_PDF_TIMEOUT_SECONDS', 60)),
+            'cache_path': self.get_setting('DDT_PDF_CACHE_PATH', 'Cache/DDT'),
+            'cache_max_files': int(self.get_setting('DDT_PDF_CACHE_MAX_FILES', 2000))
+        }
+    
     def update_setting(self, key, value):
         """Aggiorna un'impostazione"""
         try:
@@ -5,6 +5,7 @@ from datetime import datetime
 from sqlalchemy import create_engine
 from sqlalchemy.pool import NullPool
 from sqlalchemy.orm import foreign
+from sqlalchemy.dialects import mysql
 
 # Initialize SQLAlchemy with specific engine options to force utf8
 db = SQLAlchemy(engine_options={
@@ -102,8 +103,24 @@ class Product(db.Model):
             return "Non disponibile"
 
 
+# Stato ticket (Enviado) -> (testo, classe CSS)
+TICKET_STATUS_META = {
+    0: ("Giacenza", "warning"),
+    1: ("Processato", "success"),
+    2: ("DDT1", "info"),
+    3: ("DDT2", "secondary"),
+    4: ("Scaduto", "danger"),
+    10: ("Dentro Task", "primary"),
+}
+TICKET_STATUS_UNKNOWN = ("Sconosciuto", "dark")
+
+
 class TicketHeader(db.Model):
     __tablename__ = 'dat_ticket_cabecera'
+    __table_args__ = (
+        db.Index('ix_ticket_cabecera_fecha_id', 'Fecha', 'IdTicket'),  # keyset pagination
+        db.Index('ix_ticket_cabecera_num_fecha', 'NumTicket', 'Fecha'),  # risoluzione QR
+    )
     
     IdTicket = db.Column(db.Integer, primary_key=True)
     IdEmpresa = db.Column(db.Integer, default=1)
@@ -135,38 +152,12 @@ class TicketHeader(db.Model):
     @property
     def status_text(self):
         """Restituisce il testo dello stato del ticket"""
-        if self.Enviado == 0:
-            return "Giacenza"
-        elif self.Enviado == 1:
-            return "Processato"
-        elif self.Enviado == 2:
-            return "DDT1"
-        elif self.Enviado == 3:
-            return "DDT2"
-        elif self.Enviado == 4:
-            return "Scaduto"
-        elif self.Enviado == 10:
-            return "Dentro Task"
-        else:
-            return "Sconosciuto"
+        return TICKET_STATUS_META.get(self.Enviado, TICKET_STATUS_UNKNOWN)[0]
     
     @property
     def status_class(self):
         """Restituisce la classe CSS per lo stato del ticket"""
-        if self.Enviado == 0:
-            return "warning"  # Giacenza
-        elif self.Enviado == 1:
-            return "success"  # Processato
-        elif self.Enviado == 2:
-            return "info"     # DDT1
-        elif self.Enviado == 3:
-            return "secondary"  # DDT2
-        elif self.Enviado == 4:
-            return "danger"   # Scaduto
-        elif self.Enviado == 10:
-            return "primary"  # Task
-        else:
-            return "dark"     # Sconosciuto
+        return TICKET_STATUS_META.get(self.Enviado, TICKET_STATUS_UNKNOWN)[1]
     
     @property
     def formatted_date(self):
@@ -231,8 +222,13 @@ class User(UserMixin, db.Model):
 
 class ScanLog(db.Model):
     __tablename__ = 'scan_log'
+    __table_args__ = (
+        db.Index('ix_scan_log_timestamp_id', 'timestamp', 'id'),  # keyset pagination
+    )
     
     id = db.Column(db.Integer, primary_key=True)
+    # Id generato dall'app (services.audit_buffer), restituito al client prima dell'INSERT
+    client_id = db.Column(db.String(32), unique=True, index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
     ticket_id = db.Column(db.Integer)
     action = db.Column(db.String(20))  # 'view', 'scan', 'scan_attempt', or 'checkout'
@@ -266,6 +262,9 @@ class Company(db.Model):
 
 class AlbaranCabecera(db.Model):
     __tablename__ = 'dat_albaran_cabecera'
+    __table_args__ = (
+        db.Index('ix_albaran_cabecera_fecha_id', 'Fecha', 'IdAlbaran'),  # keyset pagination
+    )
     
     IdAlbaran = db.Column(db.BigInteger, primary_key=True, default=1)
     NumAlbaran = db.Column(db.BigInteger)
@@ -790,6 +789,9 @@ class SystemConfig(db.Model):
 class ChatMessage(db.Model):
     """Model for chat messages"""
     __tablename__ = 'chat_message'
+    __table_args__ = (
+        db.Index('ix_chat_message_timestamp_id', 'timestamp', 'id'),  # keyset pagination
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
@@ -839,6 +841,10 @@ class ChatRoom(db.Model):
 class Task(db.Model):
     """Model for task management"""
     __tablename__ = 'tasks'
+    __table_args__ = (
+        # Pagine per categoria della dashboard admin (stato + più recenti)
+        db.Index('ix_tasks_status_created_at', 'status', 'created_at'),
+    )
     
     id_task = db.Column(db.Integer, primary_key=True)
     task_number = db.Column(db.String(20), unique=True, nullable=False)  # Unique task number
@@ -891,8 +897,12 @@ class Task(db.Model):
         deadline_date = self.deadline.date()
         return deadline_date < today and self.status != 'completed'
     
-    def update_progress(self):
-        """Update the progress counters"""
+    def update_progress(self, commit=True):
+        """Recount the progress counters from task_tickets (commit=False leaves the commit to the caller).
+
+        The counters are kept up to date incrementally by services.task_progress:
+        this full recount is only needed to repair drift (reconcile_task_progress).
+        """
         completed_count = self.task_tickets.filter_by(status='completed').count()
         total_count = self.task_tickets.count()
         
@@ -909,30 +919,13 @@ class Task(db.Model):
         elif completed_count > 0:
             self.status = 'in_progress'
         
-        db.session.commit()
+        if commit:
+            db.session.commit()
     
     def generate_task_number(self):
-        """Generate a unique task number"""
-        from datetime import datetime
-        date_str = datetime.now().strftime('%Y%m%d')
-        
-        # Find the highest task number for today
-        existing_tasks = Task.query.filter(Task.task_number.like(f'TASK-{date_str}-%')).all()
-        
-        if not existing_tasks:
-            sequence = 1
-        else:
-            sequences = []
-            for task in existing_tasks:
-                try:
-                    seq_part = task.task_number.split('-')[-1]
-                    sequences.append(int(seq_part))
-                except (ValueError, IndexError):
-                    continue
-            
-            sequence = max(sequences) + 1 if sequences else 1
-        
-        return f'TASK-{date_str}-{sequence:04d}'
+        """Generate a unique task number (daily sequence, see services.sequences)"""
+        from services.sequences import next_task_number
+        return next_task_number()
     
     def __repr__(self):
         return f'<Task {self.id_task}: {self.task_number}>'
@@ -945,7 +938,9 @@ class TaskTicket(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     task_id = db.Column(db.Integer, db.ForeignKey('tasks.id_task'), nullable=False)
     ticket_id = db.Column(db.Integer, db.ForeignKey('dat_ticket_cabecera.IdTicket'), nullable=False)
-    status = db.Column(db.String(20), default='pending')  # pending, in_progress, completed, verified
+    # active_history: services.task_progress confronta il valore precedente anche
+    # quando lo stato è scaduto da un commit precedente
+    status = db.column_property(db.Column(db.String(20), default='pending'), active_history=True)  # pending, in_progress, completed, verified
     assigned_at = db.Column(db.DateTime, default=datetime.utcnow)
     started_at = db.Column(db.DateTime)
     completed_at = db.Column(db.DateTime)
@@ -974,8 +969,8 @@ class TaskTicket(db.Model):
         scanned = self.scanned_items or 0
         return total > 0 and scanned >= total
     
-    def update_scan_progress(self):
-        """Update scan progress from ticket lines"""
+    def update_scan_progress(self, commit=True):
+        """Update scan progress from ticket lines (commit=False leaves the commit to the caller)"""
         if self.ticket:
             self.total_items = self.ticket.lines.count()
             self.scanned_items = self.scan_results.filter_by(status='success').count()
@@ -988,7 +983,8 @@ class TaskTicket(db.Model):
                 self.status = 'in_progress'
                 self.started_at = datetime.utcnow()
         
-        db.session.commit()
+        if commit:
+            db.session.commit()
     
     def __repr__(self):
         return f'<TaskTicket {self.id}: Task {self.task_id} - Ticket {self.ticket_id}>'
@@ -999,6 +995,7 @@ class TaskTicketScan(db.Model):
     __tablename__ = 'task_ticket_scans'
     
     id = db.Column(db.Integer, primary_key=True)
+    client_id = db.Column(db.String(32), unique=True, index=True)  # vedi ScanLog.client_id
     task_ticket_id = db.Column(db.Integer, db.ForeignKey('task_tickets.id'), nullable=False)
     ticket_line_id = db.Column(db.Integer, db.ForeignKey('dat_ticket_linea.IdLineaTicket'))
     product_id = db.Column(db.Integer, db.ForeignKey('dat_articulo.IdArticulo'))
@@ -1066,4 +1063,237 @@ class TaskNotification(db.Model):
         db.session.commit()
     
     def __repr__(self):
-        return f'<TaskNotification {self.id}: {self.notification_type}>' 
\ No newline at end of file
+        return f'<TaskNotification {self.id}: {self.notification_type}>' 
+
+class TicketSweepRun(db.Model):
+    """Model for ticket sweeper run metrics"""
+    __tablename__ = 'ticket_sweep_runs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    trigger = db.Column(db.String(20), nullable=False)  # startup, interval, midnight, manual, cli
+    worker = db.Column(db.String(100))  # hostname:pid del processo che ha eseguito lo sweep
+    status = db.Column(db.String(20), default='success')  # success, error
+    started_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    finished_at = db.Column(db.DateTime)
+    duration_ms = db.Column(db.Integer, default=0)
+    
+    # Ticket transitions
+    expired_count = db.Column(db.Integer, default=0)  # Task -> Scaduto (Enviado 10 -> 4)
+    released_count = db.Column(db.Integer, default=0)  # Task -> Giacenza (Enviado 10 -> 0)
+    synced_count = db.Column(db.Integer, default=0)  # Ticket nuovi aggiunti a ticket_summary
+    batches = db.Column(db.Integer, default=0)
+    error_message = db.Column(db.Text)
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'trigger': self.trigger,
+            'worker': self.worker,
+            'status': self.status,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'duration_ms': self.duration_ms,
+            'expired_count': self.expired_count,
+            'released_count': self.released_count,
+            'synced_count': self.synced_count,
+            'batches': self.batches,
+            'error_message': self.error_message
+        }
+    
+    def __repr__(self):
+        return f'<TicketSweepRun {self.id}: {self.trigger} - {self.status}>'
+
+
+class TicketSummary(db.Model):
+    """Riepilogo materializzato per ticket (aggregati di dat_ticket_linea + stato).
+
+    Mantenuto incrementalmente da services.ticket_summary; ricostruibile con
+    `flask rebuild-ticket-summary`.
+    """
+    __tablename__ = 'ticket_summary'
+    __table_args__ = (
+        db.Index('ix_ticket_summary_status_expiry', 'Enviado', 'earliest_expiry'),
+    )
+    
+    IdTicket = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    Enviado = db.Column(db.Integer, default=0)
+    Fecha = db.Column(db.DateTime, index=True)
+    line_count = db.Column(db.Integer, default=0)
+    earliest_expiry = db.Column(db.DateTime)  # MIN(FechaCaducidad) delle linee
+    main_product_id = db.Column(db.Integer)  # Articolo della prima linea (IdLineaTicket minimo)
+    main_product_name = db.Column(db.String(100))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def to_dict(self):
+        return {
+            'IdTicket': self.IdTicket,
+            'Enviado': self.Enviado,
+            'Fecha': self.Fecha.isoformat() if self.Fecha else None,
+            'line_count': self.line_count,
+            'earliest_expiry': self.earliest_expiry.isoformat() if self.earliest_expiry else None,
+            'main_product_id': self.main_product_id,
+            'main_product_name': self.main_product_name,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+    
+    def __repr__(self):
+        return f'<TicketSummary {self.IdTicket}: {self.line_count} linee>'
+
+
+class CounterGeneration(db.Model):
+    """Generazione dei contatori in cache (services.badge_counters).
+
+    Incrementata nella stessa transazione delle modifiche che cambiano i
+    conteggi, così ogni processo worker sa quando ricalcolare i propri.
+    """
+    __tablename__ = 'counter_generations'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    generation = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<CounterGeneration {self.name}: {self.generation}>'
+
+
+class EventLog(db.Model):
+    """Eventi pubblicati sull'event bus (services.event_bus).
+
+    Fanno da broker tra i processi worker: ogni processo legge le righe
+    nuove e le consegna ai propri stream. L'id è anche l'id SSE usato dai
+    browser per riprendere con Last-Event-ID.
+    """
+    __tablename__ = 'event_log'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    topic = db.Column(db.String(50), nullable=False)
+    user_id = db.Column(db.Integer)  # destinatario, NULL = tutti
+    payload = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<EventLog {self.id}: {self.topic}>'
+
+
+class SequenceCounter(db.Model):
+    """Ultimo valore assegnato di una sequenza (services.sequences).
+
+    Una riga per (nome, periodo): es. ('task_number', '20250131') per la
+    numerazione giornaliera dei task, ('ddt_number', '') per i DDT.
+    """
+    __tablename__ = 'sequence_counters'
+    
+    name = db.Column(db.String(50), primary_key=True)
+    period = db.Column(db.String(20), primary_key=True, default='')
+    value = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SequenceCounter {self.name}/{self.period}: {self.value}>'
+
+
+class ScanRollup(db.Model):
+    """Scansioni dei task aggregate per ora, operatore e task (services.scan_analytics).
+
+    active_seconds/gaps sommano gli intervalli tra scansioni consecutive dello
+    stesso operatore fino alla soglia di pausa; task_id 0 = task eliminato.
+    """
+    __tablename__ = 'scan_rollups'
+    
+    bucket = db.Column(db.DateTime, primary_key=True)  # Inizio dell'ora
+    scanned_by = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    task_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    scans = db.Column(db.Integer, nullable=False, default=0)
+    success = db.Column(db.Integer, nullable=False, default=0)
+    ticket_mismatch = db.Column(db.Integer, nullable=False, default=0)
+    product_mismatch = db.Column(db.Integer, nullable=False, default=0)
+    product_not_in_ticket = db.Column(db.Integer, nullable=False, default=0)
+    other_errors = db.Column(db.Integer, nullable=False, default=0)
+    active_seconds = db.Column(db.Float, nullable=False, default=0)
+    gaps = db.Column(db.Integer, nullable=False, default=0)
+    first_scan_at = db.Column(db.DateTime)
+    last_scan_at = db.Column(db.DateTime)
+    
+    def __repr__(self):
+        return f'<ScanRollup {self.bucket} user={self.scanned_by} task={self.task_id}: {self.scans}>'
+
+
+class ScanHistogram(db.Model):
+    """Istogrammi orari per operatore: intervalli tra scansioni ('gap') e
+    tempi di completamento dei ticket ('completion'), per i percentili dei report
+    """
+    __tablename__ = 'scan_histograms'
+    
+    kind = db.Column(db.String(20), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)  # Indice della fascia (vedi GAP_BINS / COMPLETION_BINS)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    total_seconds = db.Column(db.Float, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<ScanHistogram {self.kind} {self.bucket} user={self.user_id} slot={self.slot}: {self.count}>'
+
+
+# TEXT su MySQL si ferma a 64 KB: i JSON delle bozze possono superarli
+LongText = db.Text().with_variant(mysql.LONGTEXT(), 'mysql')
+
+
+class DDTPreviewDraft(db.Model):
+    """Bozza dell'anteprima DDT di un utente (services.ddt_preview).
+
+    payload è il JSON dell'intestazione della bozza: sconti, totali e dati
+    del DDT; i ticket sono in DDTPreviewDraftTicket. version cresce a ogni
+    modifica, così ogni processo worker sa se la propria copia in cache è
+    ancora valida.
+    """
+    __tablename__ = 'ddt_preview_drafts'
+    
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False, index=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    payload = db.Column(LongText, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<DDTPreviewDraft {self.id} user={self.user_id} v{self.version}>'
+
+
+class DDTPreviewDraftTicket(db.Model):
+    """Ticket di una bozza dell'anteprima DDT (services.ddt_preview).
+
+    payload è il JSON del ticket con le linee e i prezzi già risolti; i
+    ticket manuali hanno ticket_id negativo. id conserva l'ordine di
+    inserimento.
+    """
+    __tablename__ = 'ddt_preview_draft_tickets'
+    __table_args__ = (
+        db.UniqueConstraint('draft_id', 'ticket_id', name='uq_ddt_preview_draft_ticket'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    draft_id = db.Column(db.String(32), nullable=False)  # Indicizzato dal vincolo unico
+    ticket_id = db.Column(db.BigInteger, nullable=False)
+    payload = db.Column(LongText, nullable=False)
+    
+    def __repr__(self):
+        return f'<DDTPreviewDraftTicket {self.draft_id} ticket={self.ticket_id}>'
+
+
+class TicketSearchResult(db.Model):
+    """Ticket trovati dall'indice di ricerca per una query (services.search_index).
+
+    Le ricerche che trovano troppi ticket per una lista IN (...) scrivono qui
+    gli id nella transazione del chiamante, così la sua query li legge con una
+    subquery sulla chiave primaria invece di un LIKE '%...%'. Di norma le righe
+    spariscono con il rollback di fine richiesta; quelle confermate da un
+    commit del chiamante sono eliminate dopo RESULT_TTL_SECONDS.
+    """
+    __tablename__ = 'ticket_search_results'
+    
+    search_id = db.Column(db.String(40), primary_key=True)
+    ticket_id = db.Column(db.BigInteger, primary_key=True, autoincrement=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<TicketSearchResult {self.search_id} ticket={self.ticket_id}>'
@@ -0,0 +1,47 @@
+"""Add composite indexes for keyset pagination
+
+Revision ID: 7c1e5a9d3b20
+Revises: 462b61d4f9f6
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1e5a9d3b20'
+down_revision = '462b61d4f9f6'
+branch_labels = None
+depends_on = None
+
+
+# (nome indice, tabella, colonne) - ordine (timestamp, id) usato da services.pagination
+INDEXES = [
+    ('ix_ticket_cabecera_fecha_id', 'dat_ticket_cabecera', ['Fecha', 'IdTicket']),
+    ('ix_scan_log_timestamp_id', 'scan_log', ['timestamp', 'id']),
+    ('ix_chat_message_timestamp_id', 'chat_message', ['timestamp', 'id']),
+]
+
+
+def _existing_indexes(table_name):
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table(table_name):
+        return None
+    return {index['name'] for index in inspector.get_indexes(table_name)}
+
+
+def upgrade():
+    # Le tabelle locali possono essere già state create da db.create_all() con gli indici
+    for index_name, table_name, columns in INDEXES:
+        existing = _existing_indexes(table_name)
+        if existing is None or index_name in existing:
+            continue
+        op.create_index(index_name, table_name, columns, unique=False)
+
+
+def downgrade():
+    for index_name, table_name, columns in reversed(INDEXES):
+        existing = _existing_indexes(table_name)
+        if existing and index_name in existing:
+            op.drop_index(index_name, table_name=table_name)
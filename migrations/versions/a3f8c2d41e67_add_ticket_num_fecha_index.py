@@ -0,0 +1,36 @@
+"""Add (NumTicket, Fecha) index for QR scan resolution
+
+Revision ID: a3f8c2d41e67
+Revises: 7c1e5a9d3b20
+Create Date: 2026-10-18 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a3f8c2d41e67'
+down_revision = '7c1e5a9d3b20'
+branch_labels = None
+depends_on = None
+
+
+INDEX_NAME = 'ix_ticket_cabecera_num_fecha'
+TABLE_NAME = 'dat_ticket_cabecera'
+
+
+def _index_exists():
+    inspector = sa.inspect(op.get_bind())
+    return any(index['name'] == INDEX_NAME for index in inspector.get_indexes(TABLE_NAME))
+
+
+def upgrade():
+    # services.scan_resolution cerca il ticket per NumTicket con la Fecha più vicina al QR
+    if not _index_exists():
+        op.create_index(INDEX_NAME, TABLE_NAME, ['NumTicket', 'Fecha'], unique=False)
+
+
+def downgrade():
+    if _index_exists():
+        op.drop_index(INDEX_NAME, table_name=TABLE_NAME)
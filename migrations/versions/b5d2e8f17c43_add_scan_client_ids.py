@@ -0,0 +1,41 @@
+"""Add client-generated ids to scan_log and task_ticket_scans
+
+Revision ID: b5d2e8f17c43
+Revises: a3f8c2d41e67
+Create Date: 2026-10-18 12:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b5d2e8f17c43'
+down_revision = 'a3f8c2d41e67'
+branch_labels = None
+depends_on = None
+
+
+TABLES = ('scan_log', 'task_ticket_scans')
+
+
+def _has_column(table_name, column_name):
+    inspector = sa.inspect(op.get_bind())
+    return any(column['name'] == column_name for column in inspector.get_columns(table_name))
+
+
+def upgrade():
+    # services.audit_buffer restituisce client_id al posto dell'id autoincrement
+    for table_name in TABLES:
+        if not _has_column(table_name, 'client_id'):
+            with op.batch_alter_table(table_name, schema=None) as batch_op:
+                batch_op.add_column(sa.Column('client_id', sa.String(length=32), nullable=True))
+                batch_op.create_index(f'ix_{table_name}_client_id', ['client_id'], unique=True)
+
+
+def downgrade():
+    for table_name in TABLES:
+        if _has_column(table_name, 'client_id'):
+            with op.batch_alter_table(table_name, schema=None) as batch_op:
+                batch_op.drop_index(f'ix_{table_name}_client_id')
+                batch_op.drop_column('client_id')
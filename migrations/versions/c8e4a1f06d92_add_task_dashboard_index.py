@@ -0,0 +1,36 @@
+"""Add (status, created_at) index on tasks for the admin dashboard
+
+Revision ID: c8e4a1f06d92
+Revises: b5d2e8f17c43
+Create Date: 2026-10-18 13:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c8e4a1f06d92'
+down_revision = 'b5d2e8f17c43'
+branch_labels = None
+depends_on = None
+
+
+INDEX_NAME = 'ix_tasks_status_created_at'
+TABLE_NAME = 'tasks'
+
+
+def _index_exists():
+    inspector = sa.inspect(op.get_bind())
+    return any(index['name'] == INDEX_NAME for index in inspector.get_indexes(TABLE_NAME))
+
+
+def upgrade():
+    # La dashboard task pagina ogni categoria nel database (stato, più recenti prima)
+    if not _index_exists():
+        op.create_index(INDEX_NAME, TABLE_NAME, ['status', 'created_at'], unique=False)
+
+
+def downgrade():
+    if _index_exists():
+        op.drop_index(INDEX_NAME, table_name=TABLE_NAME)
@@ -0,0 +1,36 @@
+"""Add (Fecha, IdAlbaran) index on dat_albaran_cabecera for the DDT list
+
+Revision ID: d3b7f2a9c514
+Revises: c8e4a1f06d92
+Create Date: 2026-10-18 15:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3b7f2a9c514'
+down_revision = 'c8e4a1f06d92'
+branch_labels = None
+depends_on = None
+
+
+INDEX_NAME = 'ix_albaran_cabecera_fecha_id'
+TABLE_NAME = 'dat_albaran_cabecera'
+
+
+def _index_exists():
+    inspector = sa.inspect(op.get_bind())
+    return any(index['name'] == INDEX_NAME for index in inspector.get_indexes(TABLE_NAME))
+
+
+def upgrade():
+    # La lista DDT pagina su (Fecha, IdAlbaran) in ordine decrescente (services.pagination)
+    if not _index_exists():
+        op.create_index(INDEX_NAME, TABLE_NAME, ['Fecha', 'IdAlbaran'], unique=False)
+
+
+def downgrade():
+    if _index_exists():
+        op.drop_index(INDEX_NAME, table_name=TABLE_NAME)
@@ -0,0 +1,39 @@
+"""Store ddt_preview_drafts.payload as LONGTEXT on MySQL
+
+Revision ID: e6a4c9d2f318
+Revises: d3b7f2a9c514
+Create Date: 2026-10-18 16:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6a4c9d2f318'
+down_revision = 'd3b7f2a9c514'
+branch_labels = None
+depends_on = None
+
+
+TABLE_NAME = 'ddt_preview_drafts'
+
+
+def _alter_needed():
+    bind = op.get_bind()
+    return bind.dialect.name == 'mysql' and TABLE_NAME in sa.inspect(bind).get_table_names()
+
+
+def upgrade():
+    # TEXT su MySQL si ferma a 64 KB: le bozze create prima di questa revisione
+    # (tabella da create_all) passano a LONGTEXT; le altre basi dati non hanno il limite
+    if _alter_needed():
+        with op.batch_alter_table(TABLE_NAME) as batch_op:
+            batch_op.alter_column('payload', existing_type=sa.Text(), type_=mysql.LONGTEXT(), existing_nullable=False)
+
+
+def downgrade():
+    if _alter_needed():
+        with op.batch_alter_table(TABLE_NAME) as batch_op:
+            batch_op.alter_column('payload', existing_type=mysql.LONGTEXT(), type_=sa.Text(), existing_nullable=False)
@@ -1,8 +1,7 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app
 from flask_login import login_required, current_user
-from app.models import db, User, ScanLog, Product, TicketHeader, Company, SystemConfig, ChatMessage, Client, AlbaranCabecera, AlbaranLinea
+from app.models import db, User, ScanLog, Company, SystemConfig, ChatMessage, Client, AlbaranCabecera, AlbaranLinea
 from app.forms import RegistrationForm, DbConfigForm, CompanyConfigForm, ResetPasswordForm, SystemConfigForm
-from sqlalchemy import func, desc
 from app.config import (REMOTE_DB_CONFIG, update_db_config, reload_config,
                       get_company_config_from_file, get_system_config_from_file,
                       get_chat_config_from_file, get_clienti_config_from_file,
@@ -10,6 +9,8 @@ from app.config import (REMOTE_DB_CONFIG, update_db_config, reload_config,
                       update_company_config, update_system_config,
                       update_chat_config, update_clienti_config,
                       update_ddt_config, update_fatture_config)
+from services.pagination import keyset_paginate
+from services.badge_counters import get_catalog_counts, get_scan_activity, get_scan_counts, get_ticket_count
 import pymysql
 from datetime import datetime, timedelta
 import json
@@ -47,47 +48,26 @@ def index():
 @admin_required
 def dashboard():
     """Admin dashboard with statistics and overview"""
-    # User statistics
-    total_users = User.query.count()
-    admin_users = User.query.filter_by(is_admin=True).count()
+    # User and product statistics (contatori in cache, vedi services.badge_counters)
+    catalog = get_catalog_counts()
+    total_users = catalog['users']
+    admin_users = catalog['admin_users']
+    products_count = catalog['products']
     
     # Activity statistics (today)
-    today = datetime.utcnow().date()
-    tomorrow = today + timedelta(days=1)
+    scans = get_scan_counts()
+    today_scans = scans['today']
+    checkout_scans = scans['checkout']
+    view_scans = scans['view']
     
-    today_scans = ScanLog.query.filter(
-        ScanLog.timestamp >= today,
-        ScanLog.timestamp < tomorrow
-    ).count()
+    # Ticket statistics (una query raggruppata su ticket_summary)
+    total_tickets = get_ticket_count()
+    processed_tickets = get_ticket_count(1)
+    giacenza_tickets = get_ticket_count(0)
+    expired_tickets = get_ticket_count(4)
     
-    checkout_scans = ScanLog.query.filter_by(action='checkout').count()
-    view_scans = ScanLog.query.filter_by(action='view').count()
-    
-    # Product statistics
-    products_count = Product.query.count()
-    
-    # Ticket statistics
-    total_tickets = TicketHeader.query.count()
-    processed_tickets = TicketHeader.query.filter_by(Enviado=1).count()
-    giacenza_tickets = TicketHeader.query.filter_by(Enviado=0).count()
-    expired_tickets = TicketHeader.query.filter_by(Enviado=4).count()
-    
-    # Most active users (top 5)
-    active_users = db.session.query(
-        User.username,
-        func.count(ScanLog.id).label('scan_count')
-    ).join(ScanLog).group_by(User.id).order_by(
-        desc('scan_count')
-    ).limit(5).all()
-    
-    # Last 7 days activity
-    last_week = datetime.utcnow() - timedelta(days=7)
-    daily_activity = db.session.query(
-        func.date(ScanLog.timestamp).label('date'),
-        func.count(ScanLog.id).label('count')
-    ).filter(ScanLog.timestamp >= last_week).group_by(
-        'date'
-    ).order_by('date').all()
+    # Most active users (top 5) and last 7 days activity
+    active_users, daily_activity = get_scan_activity(days=7, top_users=5)
     
     # Format data for charts
     dates = [item[0].strftime('%d/%m') for item in daily_activity]
@@ -119,9 +99,8 @@ def scan_logs():
     page = request.args.get('page', 1, type=int)
     per_page = 20
     
-    logs = ScanLog.query.join(User).order_by(
-        ScanLog.timestamp.desc()
-    ).paginate(page=page, per_page=per_page)
+    logs = keyset_paginate(ScanLog.query.join(User), ScanLog.timestamp, ScanLog.id,
+                           page=page, per_page=per_page, cursor=request.args.get('cursor'))
     
     return render_template('admin/dashboard/scan_logs.html', logs=logs)
 
@@ -709,6 +688,39 @@ def db_config():
     """Redirect to general config for backward compatibility"""
     return redirect(url_for('admin.general_config'))
 
+@admin_bp.route('/configurazioni/ticket-sweeper-stats')
+@admin_required
+def ticket_sweeper_stats():
+    """Get ticket sweeper scheduler state and recent run metrics"""
+    from services.ticket_sweeper import get_sweeper_status
+    
+    try:
+        return jsonify({'success': True, 'stats': get_sweeper_status()})
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
+@admin_bp.route('/configurazioni/ticket-sweeper-operation', methods=['POST'])
+@admin_required
+def ticket_sweeper_operation():
+    """Run the ticket sweeper immediately"""
+    from services.ticket_sweeper import run_sweep
+    from app.config import get_sweeper_config_from_file
+    
+    try:
+        result = run_sweep(trigger='manual', batch_size=get_sweeper_config_from_file()['batch_size'])
+        if result is None:
+            return jsonify({'success': False, 'error': 'Sweep già in esecuzione su un altro processo'})
+        if result['status'] != 'success':
+            return jsonify({'success': False, 'error': result['error_message']})
+        
+        return jsonify({
+            'success': True,
+            'message': f"Sweep completato: {result['expired_count']} ticket scaduti, "
+                       f"{result['released_count']} rimessi in giacenza"
+        })
+    except Exception as e:
+        return jsonify({'success': False, 'error': str(e)})
+
 @admin_bp.route('/configurazioni/chat-operation', methods=['POST'])
 @admin_required
 def chat_operation():
@@ -1,6 +1,6 @@
 from flask import Blueprint, render_template, flash, redirect, url_for, request, jsonify
 from flask_login import login_required, current_user
-from sqlalchemy import or_, text, cast, String
+from sqlalchemy import text
 from app.models import db, Article
 from app.forms import ArticleSearchForm, ArticleForm, ArticleDeleteForm
 import csv
@@ -10,6 +10,7 @@ from decimal import Decimal
 import base64
 from werkzeug.utils import secure_filename
 from services.utils import admin_required, is_admin
+from services.search_index import search_product_ids, invalidate_product_index
 
 articles_bp = Blueprint('articles', __name__)
 
@@ -267,6 +268,7 @@ def save_eanscanner(id_articulo, eanscanner, activo=1):
         
         # Make sure changes are committed immediately
         db.session.commit()
+        invalidate_product_index()
         print(f"Changes committed successfully")
         
         return True
@@ -387,41 +389,10 @@ def index():
         
         # Query articles
         if query:
-            try:
-                # First check if we can find any products by EAN code
-                ean_article_ids = []
-                try:
-                    # Run raw SQL query to get article IDs matching EAN scanner
-                    ean_result = db.session.execute(text("""
-                        SELECT IdArticulo FROM dat_articulo_eanscanner 
-                        WHERE EANScanner LIKE :ean
-                    """), {"ean": f'%{query}%'}).fetchall()
-                    
-                    # Extract article IDs
-                    ean_article_ids = [row[0] for row in ean_result]
-                except Exception:
-                    pass
-                
-                # Now build the query
-                if ean_article_ids:
-                    # If we found EANs, include them in the search
-                    articles_base_query = Article.query.filter(
-                        or_(
-                            Article.Descripcion.ilike(f'%{query}%'),
-                            cast(Article.IdArticulo, String).ilike(f'%{query}%'),
-                            Article.IdArticulo.in_(ean_article_ids)
-                        )
-                    )
-                else:
-                    # Otherwise just search by description and ID
-                    articles_base_query = Article.query.filter(
-                        or_(
-                            Article.Descripcion.ilike(f'%{query}%'),
-                            cast(Article.IdArticulo, String).ilike(f'%{query}%')
-                        )
-                    )
-            except Exception as e:
-                raise
+            # Descrizione, codice o EAN (indice a trigrammi, services.search_index)
+            articles_base_query = Article.query.filter(
+                Article.IdArticulo.in_(search_product_ids(query))
+            )
         else:
             articles_base_query = Article.query
         
@@ -1390,6 +1361,7 @@ def remove_eanscanner(id_registro):
                 """), {"id_registro": result[0]})
         
         db.session.commit()
+        invalidate_product_index()
         flash('Scanner EAN eliminato!', 'success')
         
         return jsonify({"success": True})
@@ -1468,46 +1440,14 @@ def api_search():
         return jsonify([])
     
     try:
-        # First find articles with matching EAN codes
-        ean_article_ids = []
-        try:
-            # Run raw SQL query to get article IDs matching EAN scanner
-            ean_result = db.session.execute(text("""
-                SELECT IdArticulo FROM dat_articulo_eanscanner 
-                WHERE EANScanner LIKE :ean
-            """), {"ean": f'%{query}%'}).fetchall()
-            
-            # Extract article IDs
-            ean_article_ids = [row[0] for row in ean_result]
-        except Exception:
-            pass
-        
-        # Build the article query
-        if ean_article_ids:
-            # If we found matching EANs, include them
-            articles_query = db.session.query(
-                Article.IdArticulo,
-                Article.Descripcion,
-                Article.PrecioConIVA
-            ).filter(
-                or_(
-                    Article.Descripcion.ilike(f'%{query}%'),
-                    cast(Article.IdArticulo, String).ilike(f'%{query}%'),
-                    Article.IdArticulo.in_(ean_article_ids)
-                )
-            ).order_by(Article.Descripcion).limit(10)
-        else:
-            # Just search by description and ID
-            articles_query = db.session.query(
-                Article.IdArticulo,
-                Article.Descripcion,
-                Article.PrecioConIVA
-            ).filter(
-                or_(
-                    Article.Descripcion.ilike(f'%{query}%'),
-                    cast(Article.IdArticulo, String).ilike(f'%{query}%')
-                )
-            ).order_by(Article.Descripcion).limit(10)
+        # Descrizione, codice o EAN (indice a trigrammi, services.search_index)
+        articles_query = db.session.query(
+            Article.IdArticulo,
+            Article.Descripcion,
+            Article.PrecioConIVA
+        ).filter(
+            Article.IdArticulo.in_(search_product_ids(query))
+        ).order_by(Article.Descripcion).limit(10)
         
         results = []
         for article in articles_query:
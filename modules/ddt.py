@@ -1,4 +1,5 @@
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file, current_app
+from flask import (Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file, current_app,
+                   Response, abort, stream_with_context)
 from flask_login import login_required, current_user
 from sqlalchemy.orm import joinedload
 from sqlalchemy import and_, not_, exists
@@ -7,22 +8,20 @@ from app.forms import DDTClientSelectForm, DDTTicketFilterForm, DDTCreateForm, D
 from flask_cors import cross_origin
 import json
 from datetime import datetime, timedelta
-import io
-import os
 from decimal import Decimal
 import tempfile
-from reportlab.lib.pagesizes import A4
-from reportlab.lib import colors
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import cm, mm
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle, Image
-from reportlab.pdfgen import canvas
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
 from sqlalchemy.sql import text
-import time
-from app.models import SystemConfig
 from services.utils import admin_required
+from services.badge_counters import get_ddt_count
+from services.ddt_builder import DDTBuilder, mark_processed
+from services.ddt_export import (DIRECT_EXPORT_LIMIT, export_filename, export_mimetype, export_progress,
+                                 load_job, select_ddts, start_export, stream_export)
+from services.ddt_pdf import ddt_pdf_path
+from services.ddt_preview import consume_draft, create_draft, load_draft, resolve_tickets, update_draft
+from services.pagination import keyset_paginate
+from services.scan_resolution import invalidate_tickets
+from services.search_index import search_product_ids, ticket_search_clause
+from services.sequences import next_ddt_numbers
 
 ddt_bp = Blueprint('ddt', __name__)
 
@@ -34,8 +33,16 @@ def index():
     per_page = 15  # Aumentato da 10 a 15 per visualizzare più elementi
     search_query = request.args.get('search', '', type=str).strip()
     
-    # Base query
-    ddts_query = AlbaranCabecera.query
+    # Solo le colonne mostrate (l'intestazione DDT ne ha circa 80), paginate nel database
+    ddts_query = db.session.query(
+        AlbaranCabecera.IdAlbaran,
+        AlbaranCabecera.Fecha,
+        AlbaranCabecera.IdCliente,
+        AlbaranCabecera.NombreCliente,
+        AlbaranCabecera.ImporteTotal,
+        AlbaranCabecera.NumLineas,
+        AlbaranCabecera.Usuario
+    )
     
     # Apply search filter if provided
     if search_query:
@@ -54,75 +61,25 @@ def index():
                 AlbaranCabecera.NombreCliente.ilike(f'%{search_query}%')
             )
     
-    # Order by date descending
-    ddts = ddts_query.order_by(AlbaranCabecera.Fecha.desc()).all()
+    # Most recent first, on the (Fecha, IdAlbaran) index; the total of the unfiltered list is cached
+    pagination = keyset_paginate(ddts_query, AlbaranCabecera.Fecha, AlbaranCabecera.IdAlbaran,
+                                 page=page, per_page=per_page, cursor=request.args.get('cursor'),
+                                 count=bool(search_query))
+    if not search_query:
+        pagination.total = get_ddt_count()
     
     # Preparare i dati per la visualizzazione
-    combined_ddts = []
-    
-    for ddt in ddts:
-        combined_ddts.append({
-            'id': ddt.IdAlbaran,
-            'date': ddt.Fecha,
-            'formatted_date': ddt.Fecha.strftime('%d/%m/%Y %H:%M') if ddt.Fecha else 'N/A',
-            'cliente_id': ddt.IdCliente,
-            'cliente_nome': ddt.NombreCliente,
-            'totale': float(ddt.ImporteTotal) if ddt.ImporteTotal else 0,
-            'num_linee': ddt.NumLineas,
-            'model_type': 'albaran',
-            'created_by': ddt.Usuario  # Add the Usuario field to identify the creator
-        })
-    
-    # Paginazione manuale
-    start = (page - 1) * per_page
-    end = start + per_page
-    paginated_ddts = combined_ddts[start:end]
-    
-    # Crea un oggetto paginazione manuale per il template
-    class ManualPagination:
-        def __init__(self, items, total, page, per_page):
-            self.items = items
-            self.total = total
-            self.page = page
-            self.per_page = per_page
-        
-        @property
-        def pages(self):
-            return max(1, (self.total + self.per_page - 1) // self.per_page)
-        
-        @property
-        def has_prev(self):
-            return self.page > 1
-        
-        @property
-        def has_next(self):
-            return self.page < self.pages
-        
-        @property
-        def prev_num(self):
-            return self.page - 1 if self.has_prev else None
-        
-        @property
-        def next_num(self):
-            return self.page + 1 if self.has_next else None
-        
-        def iter_pages(self, left_edge=2, left_current=2, right_current=5, right_edge=2):
-            last = 0
-            for num in range(1, self.pages + 1):
-                if num <= left_edge or \
-                   (num > self.page - left_current - 1 and num < self.page + right_current) or \
-                   num > self.pages - right_edge:
-                    if last + 1 != num:
-                        yield None
-                    yield num
-                    last = num
-    
-    pagination = ManualPagination(
-        items=paginated_ddts,
-        total=len(combined_ddts),
-        page=page,
-        per_page=per_page
-    )
+    pagination.items = [{
+        'id': ddt.IdAlbaran,
+        'date': ddt.Fecha,
+        'formatted_date': ddt.Fecha.strftime('%d/%m/%Y %H:%M') if ddt.Fecha else 'N/A',
+        'cliente_id': ddt.IdCliente,
+        'cliente_nome': ddt.NombreCliente,
+        'totale': float(ddt.ImporteTotal) if ddt.ImporteTotal else 0,
+        'num_linee': ddt.NumLineas,
+        'model_type': 'albaran',
+        'created_by': ddt.Usuario  # Add the Usuario field to identify the creator
+    } for ddt in pagination.items]
     
     return render_template('ddt/index.html', ddts=pagination, search_query=search_query)
 
@@ -218,158 +175,12 @@ def preview():
             return redirect(url_for('tasks.view_task', task_id=task_id))
         return redirect(url_for('ddt.select_tickets', cliente_id=cliente_id))
     
-    # Get detailed ticket information
-    preview_data = []
-    total_amount = 0
-    total_weight = 0
-    
-    # Debug: Log selected tickets
-    current_app.logger.info(f"🔍 DEBUG: Elaborazione {len(selected_tickets)} ticket selezionati")
-    
-    for ticket_info in selected_tickets:
-        # Force session refresh to avoid caching issues
-        db.session.expire_all()
-        
-        ticket = TicketHeader.query.filter_by(
-            IdTicket=ticket_info['id_ticket'],
-            IdEmpresa=ticket_info['id_empresa']
-        ).first()
-        
-        if ticket:
-            # DEBUG: Log ticket info
-            current_app.logger.info(f"🎫 DEBUG: Processando Ticket #{ticket.NumTicket} (ID: {ticket.IdTicket})")
-            
-            # Get ticket lines with both ORM and raw SQL for comparison
-            lines = TicketLine.query.filter_by(
-                IdTicket=ticket.IdTicket
-            ).all()
-            
-            # More robust query using explicit join to ensure data integrity
-            verified_query = db.session.query(TicketLine).join(
-                TicketHeader, TicketLine.IdTicket == TicketHeader.IdTicket
-            ).filter(
-                TicketHeader.IdTicket == ticket.IdTicket,
-                TicketLine.IdTicket == ticket.IdTicket
-            ).all()
-            
-            current_app.logger.info(f"🔍 DEBUG: Standard query: {len(lines)} lines, Join query: {len(verified_query)} lines")
-            
-            # Use the join query as it's more reliable
-            lines = verified_query
-            
-            # Alternative query using raw SQL to avoid potential ORM caching issues
-            raw_query = """
-            SELECT IdLineaTicket, IdTicket, IdArticulo, Descripcion, Peso, FechaCaducidad, comportamiento
-            FROM dat_ticket_linea 
-            WHERE IdTicket = :ticket_id
-            ORDER BY IdLineaTicket
-            """
-            raw_result = db.session.execute(text(raw_query), {'ticket_id': ticket.IdTicket})
-            raw_lines = []
-            for row in raw_result:
-                raw_lines.append({
-                    'IdLineaTicket': row[0],
-                    'IdTicket': row[1],
-                    'IdArticulo': row[2],
-                    'Descripcion': row[3],
-                    'Peso': row[4],
-                    'FechaCaducidad': row[5],
-                    'comportamiento': row[6]
-                })
-            
-            # Compare ORM vs raw results
-            current_app.logger.info(f"🔍 DEBUG: ORM query returned {len(lines)} lines, Raw SQL returned {len(raw_lines)} lines")
-            if len(lines) != len(raw_lines):
-                current_app.logger.error(f"🚨 DISCREPANZA: ORM e SQL raw hanno risultati diversi per ticket {ticket.IdTicket}")
-                # Use raw SQL results as they are more reliable
-                lines = []
-                for raw_line in raw_lines:
-                    # Create a mock TicketLine object for compatibility
-                    mock_line = type('MockTicketLine', (), raw_line)()
-                    lines.append(mock_line)
-            
-            # DEBUG: Log lines found
-            current_app.logger.info(f"📋 DEBUG: Trovate {len(lines)} linee per ticket {ticket.IdTicket}")
-            
-            # Additional verification: ensure all lines actually belong to this ticket
-            verified_lines = []
-            for line in lines:
-                if line.IdTicket == ticket.IdTicket:
-                    verified_lines.append(line)
-                else:
-                    current_app.logger.error(f"🚨 ERRORE: Linea {line.IdLineaTicket} ha IdTicket={line.IdTicket} ma dovrebbe essere {ticket.IdTicket}")
-            
-            current_app.logger.info(f"✅ DEBUG: Verificate {len(verified_lines)} linee valide per ticket {ticket.IdTicket}")
-            
-            ticket_total = 0
-            ticket_lines_data = []
-            
-            for line in verified_lines:
-                # DEBUG: Log each line
-                current_app.logger.info(f"   🔸 Linea {line.IdLineaTicket}: IdTicket={line.IdTicket}, IdArticulo={line.IdArticulo}, Desc={line.Descripcion}")
-                
-                # Additional verification: ensure line belongs to this ticket
-                if line.IdTicket != ticket.IdTicket:
-                    current_app.logger.error(f"🚨 ERRORE CRITICO: Linea {line.IdLineaTicket} non appartiene al ticket {ticket.IdTicket}")
-                    continue
-                
-                # Get product info
-                product = Product.query.get(line.IdArticulo)
-                if product:
-                    line_amount = float(line.Peso or 0) * float(product.PrecioConIVA or 0)
-                    ticket_total += line_amount
-                    
-                    ticket_lines_data.append({
-                        'id_linea_ticket': line.IdLineaTicket,  # Added for better tracking
-                        'id_ticket': line.IdTicket,  # Added for verification
-                        'id_articulo': line.IdArticulo,
-                        'descripcion': line.Descripcion,
-                        'peso': line.Peso,
-                        'precio': product.PrecioConIVA,
-                        'importe': line_amount,
-                        'fecha_caducidad': line.FechaCaducidad
-                    })
-                else:
-                    current_app.logger.warning(f"   ⚠️  Prodotto non trovato per IdArticulo={line.IdArticulo}")
-            
-            # DEBUG: Final ticket data
-            current_app.logger.info(f"🎯 DEBUG: Ticket {ticket.IdTicket} completato con {len(ticket_lines_data)} linee valide")
-            
-            # Add detailed summary for this ticket
-            line_ids = [line_data['id_linea_ticket'] for line_data in ticket_lines_data]
-            article_ids = [line_data['id_articulo'] for line_data in ticket_lines_data]
-            current_app.logger.info(f"📝 DEBUG: Ticket {ticket.IdTicket} - Linee: {line_ids}")
-            current_app.logger.info(f"📝 DEBUG: Ticket {ticket.IdTicket} - Articoli: {article_ids}")
-            
-            preview_data.append({
-                'ticket': {
-                    'IdTicket': ticket.IdTicket,
-                    'NumTicket': ticket.NumTicket,
-                    'Fecha': ticket.Fecha.strftime('%d/%m/%Y %H:%M') if ticket.Fecha else None,
-                    'IdEmpresa': ticket.IdEmpresa,
-                    'IdTienda': ticket.IdTienda,
-                    'IdBalanzaMaestra': ticket.IdBalanzaMaestra,
-                    'IdBalanzaEsclava': ticket.IdBalanzaEsclava,
-                    'TipoVenta': ticket.TipoVenta
-                },
-                'ticket_info': ticket_info,
-                'lines': ticket_lines_data,
-                'ticket_total': ticket_total
-            })
-            
-            total_amount += ticket_total
-            total_weight += sum(float(line.get('peso', 0)) for line in ticket_lines_data)
-        else:
-            current_app.logger.warning(f"⚠️  Ticket non trovato: ID={ticket_info['id_ticket']}, Empresa={ticket_info['id_empresa']}")
-    
-    # DEBUG: Final summary
-    current_app.logger.info(f"📊 DEBUG: Elaborazione completata - {len(preview_data)} ticket nel preview")
-    
-    # Get all available tickets for adding more
-    available_tickets = TicketHeader.query.filter(
-        TicketHeader.Enviado == 0,
-        ~TicketHeader.IdTicket.in_([t['id_ticket'] for t in selected_tickets])
-    ).order_by(TicketHeader.Fecha.desc()).limit(50).all()
+    # Ticket, linee e prezzi risolti una volta e conservati nella bozza (services.ddt_preview)
+    draft = create_draft(current_user.id, cliente.IdCliente, empresa.IdEmpresa, selected_tickets,
+                         from_task=from_task, task_id=int(task_id) if task_id and task_id.isdigit() else None,
+                         from_warehouse=from_warehouse)
+    summary = draft.summary()
+    current_app.logger.info(f"Anteprima DDT {draft.id}: {summary['tickets']} ticket su {len(selected_tickets)} selezionati")
     
     # Create form for final DDT creation
     create_form = DDTCreateForm()
@@ -377,12 +188,11 @@ def preview():
     return render_template('ddt/preview.html',
                           cliente=cliente,
                           empresa=empresa,
-                          preview_data=preview_data,
-                          total_amount=total_amount,
-                          total_weight=total_weight,
-                          available_tickets=available_tickets,
+                          draft_id=draft.id,
+                          preview_data=draft.ticket_views(),
+                          total_amount=summary['amount'],
+                          total_weight=summary['weight'],
                           create_form=create_form,
-                          selected_tickets_json=tickets_data,
                           from_task=from_task,
                           from_warehouse=from_warehouse,
                           task_id=task_id)
@@ -450,9 +260,10 @@ def create():
     # Get form data
     cliente_id = request.form.get('cliente_id')
     id_empresa = request.form.get('id_empresa', 1)
+    draft_id = request.form.get('draft_id')  # Bozza dell'anteprima (services.ddt_preview)
     tickets_data = request.form.get('tickets')
-    manual_tickets_data = request.form.get('manual_tickets')  # Ticket manuali dal localStorage
-    ticket_discounts_data = request.form.get('ticket_discounts')  # Sconti dei ticket dal localStorage
+    manual_tickets_data = request.form.get('manual_tickets')
+    ticket_discounts_data = request.form.get('ticket_discounts')
     note = request.form.get('note')
     
     # Gestione task
@@ -465,14 +276,25 @@ def create():
         flash('Cliente mancante', 'danger')
         return redirect(url_for('ddt.new'))
     
-    # Parse ticket data
-    try:
-        ticket_data = json.loads(tickets_data) if tickets_data else []
-        manual_tickets = json.loads(manual_tickets_data) if manual_tickets_data else []
-        ticket_discounts = json.loads(ticket_discounts_data) if ticket_discounts_data else {}
-    except json.JSONDecodeError:
-        flash('Formato dati ticket non valido', 'danger')
-        return redirect(url_for('ddt.select_tickets', cliente_id=cliente_id))
+    draft = None
+    if draft_id:
+        # Ticket, linee, prezzi, ticket manuali e sconti già risolti nell'anteprima
+        draft = load_draft(draft_id, current_user.id)
+        if draft is None:
+            flash('Anteprima DDT scaduta o già utilizzata: seleziona di nuovo i ticket', 'warning')
+            return redirect(url_for('ddt.select_tickets', cliente_id=cliente_id))
+        ticket_data = draft.ticket_infos()
+        manual_tickets = draft.manual_tickets()
+        ticket_discounts = draft.discounts
+    else:
+        # Parse ticket data
+        try:
+            ticket_data = json.loads(tickets_data) if tickets_data else []
+            manual_tickets = json.loads(manual_tickets_data) if manual_tickets_data else []
+            ticket_discounts = json.loads(ticket_discounts_data) if ticket_discounts_data else {}
+        except json.JSONDecodeError:
+            flash('Formato dati ticket non valido', 'danger')
+            return redirect(url_for('ddt.select_tickets', cliente_id=cliente_id))
     
     # Verifica che ci sia almeno un ticket (normale o manuale)
     if not ticket_data and not manual_tickets:
@@ -481,10 +303,7 @@ def create():
         return redirect(url_for('ddt.select_tickets', cliente_id=cliente_id))
     
     # DEBUG: Verifica immediata dei dati ricevuti
-    current_app.logger.info(f"📥 DEBUG: Dati ricevuti dal form:")
-    current_app.logger.info(f"    tickets_data (raw): {tickets_data}")
-    current_app.logger.info(f"    manual_tickets_data (raw): {manual_tickets_data}")
-    current_app.logger.info(f"    ticket_discounts_data (raw): {ticket_discounts_data}")
+    current_app.logger.info(f"📥 DEBUG: Dati ricevuti dal form (bozza: {draft_id or 'nessuna'}):")
     current_app.logger.info(f"    ticket_data (parsed): {ticket_data}")
     current_app.logger.info(f"    manual_tickets (parsed): {manual_tickets}")
     current_app.logger.info(f"    ticket_discounts (parsed): {ticket_discounts}")
@@ -519,16 +338,18 @@ def create():
     
     # Start a transaction
     try:
+        if draft is not None:
+            # Consumata nella transazione del DDT: un secondo invio della stessa bozza fallisce qui
+            consume_draft(draft)
+
         # Create new AlbaranCabecera (DDT header)
         now = datetime.now()
-        # Correctly calculate the max ID by adding 1 after getting the max value
-        max_id = db.session.query(db.func.max(AlbaranCabecera.IdAlbaran)).scalar() or 0
-        # Get the last NumAlbaran and add 1 to make it sequential
-        max_num_albaran = db.session.query(db.func.max(AlbaranCabecera.NumAlbaran)).scalar() or 0
+        # Id e numero dal contatore atomico (bloccato fino al commit: nessun doppione tra richieste)
+        new_id, new_num_albaran = next_ddt_numbers()
         ddt = AlbaranCabecera(
             # Chiavi primarie
-            IdAlbaran=max_id + 1,
-            NumAlbaran=max_num_albaran + 1,
+            IdAlbaran=new_id,
+            NumAlbaran=new_num_albaran,
             IdEmpresa=id_empresa,
             IdTienda=1,  # Valore predefinito
             IdBalanzaMaestra=1,  # Valore predefinito
@@ -603,307 +424,28 @@ def create():
         
         current_app.logger.info(f"✅ Created AlbaranCabecera with ID: {ddt.IdAlbaran}")
         
-        # Create AlbaranLinea (DDT lines) for each ticket
-        line_count = 0
-        total_ddt_amount = 0
-        total_without_vat = 0
-        total_vat = 0
-
-        # PROCESSO TICKET NORMALI
-        for ticket in ticket_data:
-            current_app.logger.info(f"🎫 DEBUG: Elaborazione ticket normale {ticket['id_ticket']}")
-            
-            # Get ticket lines from the database
-            ticket_header = TicketHeader.query.filter_by(
-                IdTicket=ticket['id_ticket']
-            ).first()
-            
-            if not ticket_header:
-                current_app.logger.warning(f"⚠️  Ticket header non trovato per ID {ticket['id_ticket']}")
-                continue
-            
-            lines = TicketLine.query.filter_by(
-                IdTicket=ticket['id_ticket']
-            ).all()
-            
-            current_app.logger.info(f"📋 DEBUG: Trovate {len(lines)} linee per ticket {ticket['id_ticket']}")
-            
-            # Create an AlbaranLinea for each product in the ticket
-            for ticket_line in lines:
-                line_count += 1
-                product = Product.query.get(ticket_line.IdArticulo)
-                
-                if not product:
-                    current_app.logger.warning(f"⚠️  Prodotto {ticket_line.IdArticulo} non trovato, riga saltata")
-                    continue
-                
-                # Determine VAT rate
-                vat_rate = 0
-                if product.IdIva == 1:
-                    vat_rate = 0.04  # 4%
-                elif product.IdIva == 2:
-                    vat_rate = 0.10  # 10%
-                elif product.IdIva == 3:
-                    vat_rate = 0.22  # 22%
-                
-                # Calculate prices - Handle None value for PrecioConIVA
-                price_with_vat = float(product.PrecioConIVA) if product.PrecioConIVA is not None else 0.0
-                price_without_vat = price_with_vat / (1 + vat_rate)
-                # Handle None value for Peso - use 1.0 as default if Peso is None
-                peso_value = float(ticket_line.Peso) if ticket_line.Peso is not None else 1.0
-                line_total = price_without_vat * peso_value
-                line_vat = line_total * vat_rate
-                
-                # Applica sconto del ticket se presente
-                ticket_id_str = str(ticket['id_ticket'])
-                ticket_discount = float(ticket_discounts.get(ticket_id_str, 0))
-                if ticket_discount > 0:
-                    discount_factor = 1 - (ticket_discount / 100)
-                    line_total = line_total * discount_factor
-                    line_vat = line_vat * discount_factor
-                    current_app.logger.info(f"💰 Applicato sconto {ticket_discount}% al ticket {ticket['id_ticket']}")
-                    current_app.logger.info(f"   Totale scontato: {line_total:.2f}, IVA scontata: {line_vat:.2f}")
-                
-                # Get product family, subfamily, class info
-                product_article = Article.query.get(product.IdArticulo)
-                
-                # Create DDT line con assegnazione esplicita di IdTicket
-                albaran_line = AlbaranLinea()
-                albaran_line.IdLineaAlbaran = line_count
-                albaran_line.IdEmpresa = ddt.IdEmpresa
-                albaran_line.IdTienda = ddt.IdTienda
-                albaran_line.IdBalanzaMaestra = ddt.IdBalanzaMaestra
-                albaran_line.IdBalanzaEsclava = ddt.IdBalanzaEsclava
-                albaran_line.IdAlbaran = ddt.IdAlbaran
-                albaran_line.TipoVenta = ddt.TipoVenta
-                
-                # Assegna esplicitamente l'ID del ticket
-                albaran_line.IdTicket = int(ticket['id_ticket'])
-                
-                # Dati prodotto - usa i dati dalla linea del ticket, non dal prodotto
-                albaran_line.IdArticulo = ticket_line.IdArticulo
-                albaran_line.Descripcion = ticket_line.Descripcion or product.Descripcion
-                albaran_line.Descripcion1 = getattr(product_article, 'Descripcion1', '') if product_article else ''
-                albaran_line.Comportamiento = getattr(ticket_line, 'comportamiento', 0)  # Usa il valore dal ticket
-                albaran_line.ComportamientoDevolucion = getattr(ticket_line, 'comportamiento_devolucion', 0)
-                
-                # Pesi e quantità - Handle None value for Peso
-                albaran_line.Peso = peso_value  # Use the same peso_value calculated above
-                albaran_line.Medida2 = "un"  # Default come nell'esempio
-                
-                # Prezzi e IVA
-                albaran_line.Precio = 0.0  # Sarà calcolato
-                albaran_line.PrecioSinIVA = price_without_vat
-                albaran_line.IdIVA = product.IdIva
-                albaran_line.PorcentajeIVA = vat_rate * 100
-                albaran_line.RecargoEquivalencia = 0.0
-                
-                # Importi
-                albaran_line.Importe = 0.0  # Sarà calcolato
-                albaran_line.ImporteSinIVASinDtoL = line_total
-                albaran_line.ImporteDelIVAConDtoL = line_vat
-                
-                # Informazioni aggiuntive dal prodotto
-                albaran_line.IdClase = getattr(product_article, 'IdClase', None)
-                albaran_line.NombreClase = "ARTICOLI"  # Default come nell'esempio
-                albaran_line.IdFamilia = product.IdFamilia
-                albaran_line.NombreFamilia = ""  # Da popolare se disponibile
-                albaran_line.IdSeccion = getattr(product_article, 'IdSeccion', None)
-                albaran_line.IdSubFamilia = product.IdSubFamilia
-                albaran_line.IdDepartamento = getattr(product_article, 'IdDepartamento', None)
-                
-                # Gestisci il campo Texto1 in modo sicuro
-                texto1_value = ""
-                if hasattr(ticket_line, 'Texto1') and ticket_line.Texto1:
-                    texto1_value = ticket_line.Texto1
-                elif product_article and hasattr(product_article, 'Texto1') and product_article.Texto1:
-                    texto1_value = product_article.Texto1
-                albaran_line.Texto1 = texto1_value
-                
-                # Data di scadenza
-                albaran_line.FechaCaducidad = ticket_line.FechaCaducidad
-                
-                # Campi di default
-                albaran_line.EstadoLinea = 0
-                albaran_line.EntradaManual = 0
-                albaran_line.Tara = 0.0
-                albaran_line.PrecioPorCienGramos = 0
-                albaran_line.Descuento = ticket_discount if ticket_discount > 0 else 0.0
-                albaran_line.TipoDescuento = 1
-                albaran_line.Facturada = 0
-                albaran_line.CantidadFacturada = 0.0
-                albaran_line.CantidadFacturada2 = 0.0
-                albaran_line.HayTaraAplicada = 0
-                albaran_line.Modificado = 1
-                albaran_line.Operacion = "A"
-                albaran_line.Usuario = "DBLogiX"
-                
-                # Debug line info
-                current_app.logger.info(f"📝 DEBUG: Linea DDT {line_count} - Ticket {ticket['id_ticket']}")
-                current_app.logger.info(f"    IdArticolo: {albaran_line.IdArticulo}")
-                current_app.logger.info(f"    Peso: {albaran_line.Peso}")
-                current_app.logger.info(f"    Prezzo senza IVA: {albaran_line.PrecioSinIVA}")
-                current_app.logger.info(f"    Sconto applicato: {albaran_line.Descuento}%")
-                current_app.logger.info(f"    Totale senza IVA: {albaran_line.ImporteSinIVASinDtoL}")
-                current_app.logger.info(f"    IVA: {albaran_line.ImporteDelIVAConDtoL}")
-                
-                db.session.add(albaran_line)
-                
-                # Accumula totali
-                total_without_vat += line_total
-                total_vat += line_vat
-            
-            # Aggiorna lo stato del ticket a 'processato'
-            # Usiamo direttamente l'ID del ticket passato dal frontend
-            ticket_header = TicketHeader.query.get(ticket['id_ticket'])
-            if ticket_header:
-                ticket_header.Enviado = 1
-                current_app.logger.info(f"✅ Ticket {ticket['id_ticket']} impostato come elaborato")
-            else:
-                current_app.logger.warning(f"⚠️  Non è stato possibile trovare il ticket {ticket['id_ticket']} per aggiornarne lo stato")
-
-        # PROCESSO TICKET MANUALI DAL LOCALSTORAGE
-        for manual_ticket in manual_tickets:
-            current_app.logger.info(f"✋ DEBUG: Elaborazione ticket manuale {manual_ticket['id_ticket']}")
-            
-            # Crea direttamente le righe AlbaranLinea per i ticket manuali
-            for ticket_line in manual_ticket['lines']:
-                line_count += 1
-                
-                # Calcola aliquota IVA
-                id_iva = ticket_line.get('id_iva', 3)  # Default 22%
-                vat_rate = 0
-                if id_iva == 1:
-                    vat_rate = 0.04  # 4%
-                elif id_iva == 2:
-                    vat_rate = 0.10  # 10%
-                elif id_iva == 3:
-                    vat_rate = 0.22  # 22%
-                
-                # Calcola prezzi
-                price_with_vat = float(ticket_line['precio'])
-                price_without_vat = price_with_vat / (1 + vat_rate)
-                peso_value = float(ticket_line['peso'])
-                line_total = price_without_vat * peso_value
-                line_vat = line_total * vat_rate
-                
-                # Applica sconto del ticket manuale se presente
-                manual_ticket_id_str = str(manual_ticket['id_ticket'])
-                ticket_discount = float(ticket_discounts.get(manual_ticket_id_str, 0))
-                if ticket_discount > 0:
-                    discount_factor = 1 - (ticket_discount / 100)
-                    line_total = line_total * discount_factor
-                    line_vat = line_vat * discount_factor
-                    current_app.logger.info(f"💰 Applicato sconto {ticket_discount}% al ticket manuale {manual_ticket['id_ticket']}")
-                    current_app.logger.info(f"   Totale scontato: {line_total:.2f}, IVA scontata: {line_vat:.2f}")
-                
-                # Crea riga DDT per ticket manuale
-                albaran_line = AlbaranLinea()
-                albaran_line.IdLineaAlbaran = line_count
-                albaran_line.IdEmpresa = ddt.IdEmpresa
-                albaran_line.IdTienda = ddt.IdTienda
-                albaran_line.IdBalanzaMaestra = ddt.IdBalanzaMaestra
-                albaran_line.IdBalanzaEsclava = ddt.IdBalanzaEsclava
-                albaran_line.IdAlbaran = ddt.IdAlbaran
-                albaran_line.TipoVenta = ddt.TipoVenta
-                
-                # Per i ticket manuali, usiamo un ID ticket speciale o NULL
-                albaran_line.IdTicket = None  # Ticket manuale non ha ID ticket reale
-                
-                # Dati prodotto dal ticket manuale
-                albaran_line.IdArticulo = 999  # ID prodotto personalizzato
-                albaran_line.Descripcion = ticket_line['descripcion']
-                albaran_line.Descripcion1 = "Prodotto manuale"
-                albaran_line.Comportamiento = ticket_line.get('comportamiento', 1)
-                albaran_line.ComportamientoDevolucion = 0
-                
-                # Pesi e quantità
-                albaran_line.Peso = peso_value
-                albaran_line.Medida2 = "un"
-                
-                # Prezzi e IVA
-                albaran_line.Precio = 0.0
-                albaran_line.PrecioSinIVA = price_without_vat
-                albaran_line.IdIVA = id_iva
-                albaran_line.PorcentajeIVA = vat_rate * 100
-                albaran_line.RecargoEquivalencia = 0.0
-                
-                # Importi
-                albaran_line.Importe = 0.0
-                albaran_line.ImporteSinIVASinDtoL = line_total
-                albaran_line.ImporteDelIVAConDtoL = line_vat
-                
-                # Informazioni di default per prodotti manuali
-                albaran_line.IdClase = 1
-                albaran_line.NombreClase = "ARTICOLI"
-                albaran_line.IdFamilia = 1
-                albaran_line.NombreFamilia = "MANUALE"
-                albaran_line.IdSubFamilia = 1
-                albaran_line.NombreSubFamilia = "MANUALE"
-                albaran_line.IdDepartamento = 1
-                albaran_line.NombreDepartamento = "MANUALE"
-                albaran_line.Texto1 = "Prodotto aggiunto manualmente"
-                
-                # Data di scadenza se presente
-                if ticket_line.get('fecha_caducidad'):
-                    try:
-                        albaran_line.FechaCaducidad = datetime.strptime(ticket_line['fecha_caducidad'], '%Y-%m-%d')
-                    except:
-                        albaran_line.FechaCaducidad = None
-                
-                # Campi di default
-                albaran_line.EstadoLinea = 0
-                albaran_line.EntradaManual = 1  # Indica che è stato inserito manualmente
-                albaran_line.Tara = 0.0
-                albaran_line.PrecioPorCienGramos = 0
-                albaran_line.Descuento = ticket_discount if ticket_discount > 0 else 0.0
-                albaran_line.TipoDescuento = 1
-                albaran_line.Facturada = 0
-                albaran_line.CantidadFacturada = 0.0
-                albaran_line.CantidadFacturada2 = 0.0
-                albaran_line.HayTaraAplicada = 0
-                albaran_line.Modificado = 1
-                albaran_line.Operacion = "A"
-                albaran_line.Usuario = "DBLogiX"
-                
-                # Debug line info
-                current_app.logger.info(f"✋ DEBUG: Linea DDT manuale {line_count}")
-                current_app.logger.info(f"    Descrizione: {albaran_line.Descripcion}")
-                current_app.logger.info(f"    Peso: {albaran_line.Peso}")
-                current_app.logger.info(f"    Prezzo senza IVA: {albaran_line.PrecioSinIVA}")
-                current_app.logger.info(f"    Sconto applicato: {albaran_line.Descuento}%")
-                current_app.logger.info(f"    Totale senza IVA: {albaran_line.ImporteSinIVASinDtoL}")
-                current_app.logger.info(f"    IVA: {albaran_line.ImporteDelIVAConDtoL}")
-                
-                db.session.add(albaran_line)
-                
-                # Accumula totali
-                total_without_vat += line_total
-                total_vat += line_vat
-
-        # Aggiorna i totali del DDT
-        total_ddt_amount = total_without_vat + total_vat
-        ddt.NumLineas = line_count
-        ddt.ImporteLineas = total_ddt_amount
-        ddt.ImporteTotal = total_ddt_amount
-        ddt.ImporteTotalSinIVAConDtoL = total_without_vat
-        ddt.ImporteTotalDelIVAConDtoLConDtoTotal = total_vat
-        ddt.ImporteTotalSinIVAConDtoLConDtoTotal = total_without_vat
-        
-        current_app.logger.info(f"💰 DEBUG: Totali DDT - Senza IVA: €{total_without_vat:.2f}, IVA: €{total_vat:.2f}, Totale: €{total_ddt_amount:.2f}")
-        
-        # DEBUG: Verifica che le righe siano state aggiunte alla sessione
-        pending_albaran_lines = [obj for obj in db.session.new if isinstance(obj, AlbaranLinea)]
-        current_app.logger.info(f"🔍 DEBUG: {len(pending_albaran_lines)} righe AlbaranLinea in attesa di commit")
-        
-        if len(pending_albaran_lines) == 0:
-            current_app.logger.error("❌ ERRORE CRITICO: Nessuna riga AlbaranLinea in attesa di commit!")
-            current_app.logger.error(f"📊 DEBUG: ticket_data={len(ticket_data)}, manual_tickets={len(manual_tickets)}")
-            current_app.logger.error(f"📊 DEBUG: line_count={line_count}")
+        # Righe del DDT: tre query per linee, prodotti e articoli, un solo INSERT (services.ddt_builder)
+        ticket_ids = [int(ticket['id_ticket']) for ticket in ticket_data]
+        builder = DDTBuilder(ddt, 'DBLogiX', ticket_discounts)
+        if draft is not None:
+            builder.add_resolved(draft.resolved_tickets())
+        else:
+            builder.add_tickets(ticket_ids)
+        builder.add_manual_tickets(manual_tickets)
+        
+        if builder.line_count == 0:
+            current_app.logger.error(f"❌ ERRORE CRITICO: Nessuna riga DDT creata - ticket_data={len(ticket_data)}, manual_tickets={len(manual_tickets)}")
             raise Exception("Nessuna riga DDT creata - verifica i dati di input")
         
+        line_count = builder.write()
+        
+        # I ticket normali passano a 'processato' con un solo UPDATE
+        mark_processed(ticket_ids)
+        
         # Commit della transazione
         db.session.commit()
+        # Le risoluzioni in cache hanno ancora il vecchio Enviado
+        invalidate_tickets(ticket_ids)
         
         current_app.logger.info(f"🎉 DDT #{ddt.IdAlbaran} creato con successo!")
         current_app.logger.info(f"📊 Riepilogo: {len(ticket_data)} ticket normali + {len(manual_tickets)} ticket manuali = {line_count} righe totali")
@@ -1078,9 +620,6 @@ def delete(ddt_id):
             task_with_ddt.ddt_id = None
             task_with_ddt.status = 'completed'  # Mantiene completed ma senza DDT
             
-            # Aggiorna il progresso del task
-            task_with_ddt.update_progress()
-            
             current_app.logger.info(f"✅ Task #{task_with_ddt.task_number} aggiornato: DDT rimosso, stato reset")
             
             flash_message = f'DDT #{ddt_id} eliminato. Task #{task_with_ddt.task_number} aggiornato e {reset_tickets_count} ticket reimpostati.'
@@ -1178,11 +717,11 @@ def export(ddt_id):
             cliente = Client.query.get(ddt.IdCliente)
             empresa = Company.query.get(ddt.IdEmpresa)
             
-            # Generate PDF
-            pdf_data = generate_ddt_pdf(ddt, cliente, empresa)
+            # PDF dalla cache o impaginato nel pool di rendering
+            pdf_path = ddt_pdf_path(ddt, cliente, empresa)
             
             return send_file(
-                io.BytesIO(pdf_data),
+                pdf_path,
                 mimetype='application/pdf',
                 as_attachment=True,
                 download_name=f'DDT_{ddt_id}.pdf'
@@ -1193,604 +732,103 @@ def export(ddt_id):
     
     return redirect(url_for('ddt.detail', ddt_id=ddt_id))
 
-def generate_ddt_pdf(ddt, cliente, empresa):
-    """Generate a stunning, professional PDF document for the DDT with exceptional layout"""
-    buffer = io.BytesIO()
-    
-    # Create the PDF document with optimized margins
-    doc = SimpleDocTemplate(
-        buffer, 
-        pagesize=A4,
-        rightMargin=15*mm,
-        leftMargin=15*mm,
-        topMargin=80*mm,  # Slightly increased for better header
-        bottomMargin=40*mm,  # Optimized for footer with signatures
-        title=f"DDT #{ddt.IdAlbaran}",
-        author=empresa.NombreEmpresa if empresa else "DBLogiX"
-    )
-    
-    # Original sophisticated color palette - restored
-    primary_color = colors.HexColor('#1a365d')      # Deep professional blue
-    secondary_color = colors.HexColor('#2d5a7b')    # Lighter blue
-    accent_color = colors.HexColor('#e53e3e')       # Elegant red accent
-    success_color = colors.HexColor('#38a169')      # Success green
-    text_primary = colors.HexColor('#2d3748')       # Primary text
-    text_secondary = colors.HexColor('#4a5568')     # Secondary text
-    text_muted = colors.HexColor('#718096')         # Muted text
-    border_light = colors.HexColor('#e2e8f0')       # Light borders
-    background_light = colors.HexColor('#f7fafc')   # Light background
-    background_accent = colors.HexColor('#ebf8ff')  # Accent background
-    white = colors.white
-    
-    # Premium typography system with improved sizes
-    styles = getSampleStyleSheet()
-    
-    # Document Title - More prominent
-    styles.add(ParagraphStyle(
-        name='DocumentTitle',
-        parent=styles['Normal'],
-        fontSize=22,
-        alignment=1,  # center aligned
-        textColor=white,
-        spaceAfter=2*mm,
-        fontName='Helvetica-Bold',
-        leading=24
-    ))
-    
-    # Document Subtitle - Refined
-    styles.add(ParagraphStyle(
-        name='DocumentSubtitle',
-        parent=styles['Normal'],
-        fontSize=11,
-        alignment=1,  # center aligned
-        textColor=white,
-        spaceAfter=1*mm,
-        fontName='Helvetica',
-        leading=13
-    ))
-    
-    # Section Headers - Premium styling
-    styles.add(ParagraphStyle(
-        name='SectionHeader',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=primary_color,
-        fontName='Helvetica-Bold',
-        spaceAfter=2*mm,
-        spaceBefore=1*mm,
-        leading=12
-    ))
-    
-    # Company Information - Professional
-    styles.add(ParagraphStyle(
-        name='CompanyInfo',
-        parent=styles['Normal'],
-        fontSize=8,
-        textColor=text_primary,
-        fontName='Helvetica',
-        leading=12,  # Increased line spacing
-        spaceAfter=1*mm  # More space between lines
-    ))
-    
-    # Company Name - Distinguished
-    styles.add(ParagraphStyle(
-        name='CompanyName',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=primary_color,
-        fontName='Helvetica-Bold',
-        spaceAfter=2*mm,  # More space after company name
-        leading=12
-    ))
-    
-    # Table Headers - Premium design
-    styles.add(ParagraphStyle(
-        name='TableHeader',
-        parent=styles['Normal'],
-        fontSize=8,
-        alignment=1,
-        textColor=white,
-        fontName='Helvetica-Bold',
-        leading=10
-    ))
-    
-    # Table Cells - Clean and readable
-    styles.add(ParagraphStyle(
-        name='TableCell',
-        parent=styles['Normal'],
-        fontSize=8,
-        textColor=text_primary,
-        fontName='Helvetica',
-        alignment=1,
-        leading=10
-    ))
-    
-    styles.add(ParagraphStyle(
-        name='TableCellLeft',
-        parent=styles['Normal'],
-        fontSize=8,
-        textColor=text_primary,
-        fontName='Helvetica',
-        alignment=0,
-        leading=10
-    ))
-    
-    styles.add(ParagraphStyle(
-        name='TableCellRight',
-        parent=styles['Normal'],
-        fontSize=8,
-        textColor=text_primary,
-        fontName='Helvetica',
-        alignment=2,
-        leading=10
-    ))
-    
-    # Transport Information - Elegant
-    styles.add(ParagraphStyle(
-        name='TransportInfo',
-        parent=styles['Normal'],
-        fontSize=8,
-        textColor=text_primary,
-        fontName='Helvetica',
-        leading=10
-    ))
-    
-    # Summary Style - More prominent
-    styles.add(ParagraphStyle(
-        name='SummaryLabel',
-        parent=styles['Normal'],
-        fontSize=9,
-        textColor=text_primary,
-        fontName='Helvetica-Bold',
-        alignment=2,
-        leading=11
-    ))
-    
-    styles.add(ParagraphStyle(
-        name='SummaryValue',
-        parent=styles['Normal'],
-        fontSize=10,
-        textColor=primary_color,
-        fontName='Helvetica-Bold',
-        alignment=2,
-        leading=12
-    ))
-    
-    # Collect all elements
-    elements = []
-    
-    # === PREMIUM PRODUCTS TABLE ===
-    products_data = []
-    
-    # Sophisticated table header
-    header_style = [
-        Paragraph("<b>COD.</b>", styles['TableHeader']),
-        Paragraph("<b>DESCRIZIONE ARTICOLO</b>", styles['TableHeader']),
-        Paragraph("<b>U.M.</b>", styles['TableHeader']),
-        Paragraph("<b>QUANTITÀ</b>", styles['TableHeader']),
-        Paragraph("<b>PREZZO</b>", styles['TableHeader']),
-        Paragraph("<b>SCONTO</b>", styles['TableHeader']),
-        Paragraph("<b>IVA</b>", styles['TableHeader']),
-        Paragraph("<b>IMPORTO</b>", styles['TableHeader']),
-    ]
-    products_data.append(header_style)
-    
-    # Get product lines
-    lines = AlbaranLinea.query.filter_by(IdAlbaran=ddt.IdAlbaran).all()
-    
-    total_amount = 0
-    total_quantity = 0
-    subtotal_without_vat = 0
-    total_vat = 0
-    
-    for line in lines:
-        # Extract data with safe defaults
-        code = str(line.IdArticulo or '')
-        description = line.Descripcion or 'N/A'
-        unit = line.Medida2 or 'un'
-        quantity = float(line.Peso or 0)
-        price = float(line.PrecioSinIVA or 0)
-        discount_percent = float(line.Descuento or 0)
-        vat_rate = float(line.PorcentajeIVA or 0)
-        line_total_without_vat = float(line.ImporteSinIVASinDtoL or 0)
-        line_vat = float(line.ImporteDelIVAConDtoL or 0)
-        line_total = line_total_without_vat + line_vat
-        
-        total_amount += line_total
-        total_quantity += quantity
-        subtotal_without_vat += line_total_without_vat
-        total_vat += line_vat
-        
-        # Format discount display
-        discount_display = f"{discount_percent:.0f}%" if discount_percent > 0 else "-"
-        
-        # Create elegant table rows
-        products_data.append([
-            Paragraph(code if code != '999' else '', styles['TableCell']),
-            Paragraph(description, styles['TableCellLeft']),
-            Paragraph(unit, styles['TableCell']),
-            Paragraph(f"{quantity:.2f}", styles['TableCellRight']),
-            Paragraph(f"€ {price:.2f}", styles['TableCellRight']),
-            Paragraph(discount_display, styles['TableCell']),
-            Paragraph(f"{vat_rate:.0f}%", styles['TableCell']),
-            Paragraph(f"<b>€ {line_total:.2f}</b>", styles['TableCellRight']),
-        ])
-    
-    # Create sophisticated products table with updated column widths
-    col_widths = [16*mm, 78*mm, 11*mm, 18*mm, 18*mm, 12*mm, 11*mm, 20*mm]
-    products_table = Table(products_data, colWidths=col_widths, repeatRows=1)
-    
-    # Apply modern table styling
-    table_style = [
-        # Header styling - elegant gradient
-        ('BACKGROUND', (0, 0), (-1, 0), primary_color),
-        ('TEXTCOLOR', (0, 0), (-1, 0), white),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 8),
-        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
-        ('VALIGN', (0, 0), (-1, 0), 'MIDDLE'),
-        ('TOPPADDING', (0, 0), (-1, 0), 6),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 6),
-        
-        # Data rows - clean styling
-        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
-        ('FONTSIZE', (0, 1), (-1, -1), 8),
-        ('ALIGN', (0, 1), (0, -1), 'CENTER'),   # Code column
-        ('ALIGN', (1, 1), (1, -1), 'LEFT'),     # Description column
-        ('ALIGN', (2, 1), (2, -1), 'CENTER'),   # Unit column
-        ('ALIGN', (3, 1), (3, -1), 'RIGHT'),    # Quantity column
-        ('ALIGN', (4, 1), (4, -1), 'RIGHT'),    # Price column
-        ('ALIGN', (5, 1), (5, -1), 'CENTER'),   # Discount column
-        ('ALIGN', (6, 1), (6, -1), 'CENTER'),   # VAT column
-        ('ALIGN', (7, 1), (7, -1), 'RIGHT'),    # Total column
-        ('VALIGN', (0, 1), (-1, -1), 'MIDDLE'),
-        ('TOPPADDING', (0, 1), (-1, -1), 5),
-        ('BOTTOMPADDING', (0, 1), (-1, -1), 5),
-        ('LEFTPADDING', (0, 1), (-1, -1), 4),
-        ('RIGHTPADDING', (0, 1), (-1, -1), 4),
-        
-        # Modern borders
-        ('LINEBELOW', (0, 0), (-1, 0), 1, primary_color),
-        ('GRID', (0, 1), (-1, -1), 0.5, border_light),
-        ('LINEBEFORE', (0, 0), (0, -1), 1, primary_color),
-        ('LINEAFTER', (-1, 0), (-1, -1), 1, primary_color),
-        ('LINEBELOW', (0, -1), (-1, -1), 1, primary_color),
-    ]
-    
-    # Add subtle alternating row colors
-    for i in range(1, len(products_data)):
-        if i % 2 == 0:
-            table_style.append(('BACKGROUND', (0, i), (-1, i), background_light))
-    
-    products_table.setStyle(TableStyle(table_style))
-    elements.append(products_table)
-    elements.append(Spacer(1, 8*mm))
-    
-    # === DISCOUNT SUMMARY (if any discounts applied) ===
-    total_discount_amount = 0
-    lines_with_discount = 0
-    
-    # Calculate total discount savings
-    for line in lines:
-        discount_percent = float(line.Descuento or 0)
-        if discount_percent > 0:
-            lines_with_discount += 1
-            price = float(line.PrecioSinIVA or 0)
-            quantity = float(line.Peso or 0)
-            vat_rate = float(line.PorcentajeIVA or 0)
-            
-            # Calculate original amount (without discount)
-            original_subtotal = price * quantity
-            original_vat = original_subtotal * (vat_rate / 100)
-            original_total = original_subtotal + original_vat
-            
-            # Get actual discounted amount
-            discounted_subtotal = float(line.ImporteSinIVASinDtoL or 0)
-            discounted_vat = float(line.ImporteDelIVAConDtoL or 0)
-            discounted_total = discounted_subtotal + discounted_vat
-            
-            # Calculate discount amount
-            discount_amount = original_total - discounted_total
-            total_discount_amount += discount_amount
-    
-    # Add discount summary if there are discounts
-    if total_discount_amount > 0:
-        discount_summary_data = [
-            [
-                Paragraph(f"<b>Sconti applicati su {lines_with_discount} articoli</b>", styles['SummaryLabel']),
-                Paragraph(f"<b>- € {total_discount_amount:.2f}</b>", ParagraphStyle(
-                    name='DiscountValue',
-                    parent=styles['SummaryValue'],
-                    textColor=colors.HexColor('#e53e3e')  # Red color for discount
-                ))
-            ]
-        ]
-        
-        discount_summary_table = Table(discount_summary_data, colWidths=[40*mm, 30*mm])
-        discount_summary_table.setStyle(TableStyle([
-            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-            ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
-            ('TOPPADDING', (0, 0), (-1, -1), 4),
-            ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-            ('LEFTPADDING', (0, 0), (-1, -1), 8),
-            ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-            ('BACKGROUND', (0, 0), (-1, -1), colors.HexColor('#fff5f5')),  # Light red background
-            ('GRID', (0, 0), (-1, -1), 0.5, border_light),
-            ('ROUNDEDCORNERS', [3, 3, 3, 3]),
-        ]))
-        
-        # Right align the discount summary
-        discount_summary_container = Table([[discount_summary_table]], colWidths=[doc.width])
-        discount_summary_container.setStyle(TableStyle([
-            ('ALIGN', (0, 0), (0, 0), 'RIGHT'),
-            ('VALIGN', (0, 0), (0, 0), 'TOP'),
-        ]))
-        
-        elements.append(discount_summary_container)
-        elements.append(Spacer(1, 5*mm))
-    
-    # === IMPROVED FINANCIAL SUMMARY ===
-    # Create a more prominent summary box
-    summary_data = [
-        [
-            Paragraph("<b>Subtotale (esclusa IVA)</b>", styles['SummaryLabel']),
-            Paragraph(f"<b>€ {subtotal_without_vat:.2f}</b>", styles['SummaryValue'])
-        ],
-        [
-            Paragraph("<b>Totale IVA</b>", styles['SummaryLabel']),
-            Paragraph(f"<b>€ {total_vat:.2f}</b>", styles['SummaryValue'])
-        ],
-        [
-            Paragraph("<b>TOTALE GENERALE</b>", styles['SummaryLabel']),
-            Paragraph(f"<b>€ {total_amount:.2f}</b>", styles['SummaryValue'])
-        ]
-    ]
-    
-    summary_table = Table(summary_data, colWidths=[40*mm, 30*mm])
-    summary_table.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
-        ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
-        ('TOPPADDING', (0, 0), (-1, -1), 4),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-        ('LEFTPADDING', (0, 0), (-1, -1), 8),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
-        ('BACKGROUND', (0, 0), (-1, 1), background_light),
-        ('BACKGROUND', (0, 2), (-1, 2), background_accent),
-        ('LINEABOVE', (0, 2), (-1, 2), 1, success_color),
-        ('LINEBELOW', (0, 2), (-1, 2), 1, success_color),
-        ('GRID', (0, 0), (-1, -1), 0.5, border_light),
-        ('ROUNDEDCORNERS', [3, 3, 3, 3]),
-    ]))
-    
-    # Right align the summary
-    summary_container = Table([[summary_table]], colWidths=[doc.width])
-    summary_container.setStyle(TableStyle([
-        ('ALIGN', (0, 0), (0, 0), 'RIGHT'),
-        ('VALIGN', (0, 0), (0, 0), 'TOP'),
-    ]))
-    
-    elements.append(summary_container)
-    elements.append(Spacer(1, 10*mm))
-    
-    # === COMPACT TRANSPORT CONDITIONS ===
-    # Calculate number of packages (colli) based on system configuration
-    articles_per_package = SystemConfig.get_config('articles_per_package', 5)
-    
-    # Count articles excluding "trasporto" items
-    total_articles = 0
-    for line in lines:
-        description = (line.Descripcion or '').lower()
-        if 'trasporto' not in description:
-            total_articles += 1
-    
-    # Calculate number of packages
-    num_packages = max(1, (total_articles + articles_per_package - 1) // articles_per_package)  # Round up division
-    
-    transport_data = [
-        [
-            Paragraph("<b>Causale trasporto:</b> Vendita", styles['TransportInfo']),
-            Paragraph("<b>Trasporto a cura:</b> Mittente", styles['TransportInfo'])
-        ],
-        [
-            Paragraph("<b>Aspetto esteriore beni:</b> Confezioni integre", styles['TransportInfo']),
-            Paragraph(f"<b>Numero colli:</b> {num_packages}", styles['TransportInfo'])
-        ],
-        [
-            Paragraph("<b>Data e ora partenza:</b> _______________", styles['TransportInfo']),
-            Paragraph("<b>Data e ora arrivo:</b> _______________", styles['TransportInfo'])
-        ]
-    ]
-    
-    transport_table = Table(transport_data, colWidths=[doc.width/2 - 5*mm, doc.width/2 - 5*mm])
-    transport_table.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 6),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
-        ('TOPPADDING', (0, 0), (-1, -1), 4),
-        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
-        ('BACKGROUND', (0, 0), (-1, -1), background_light),
-        ('GRID', (0, 0), (-1, -1), 0.5, border_light),
-        ('ROUNDEDCORNERS', [2, 2, 2, 2]),
-    ]))
-    
-    elements.append(transport_table)
-    
-    # === PREMIUM HEADER AND FOOTER FUNCTIONS ===
-    def draw_premium_header_footer(canvas, doc):
-        canvas.saveState()
-        
-        # === CLEAN HEADER WITH WHITE BACKGROUND ===
-        header_height = 80*mm
-        
-        # White background for entire document
-        canvas.setFillColor(white)
-        canvas.rect(0, 0, A4[0], A4[1], fill=1, stroke=0)
-        
-        # === LOGO AND TITLE SECTION ===
-        logo_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static', 'uploads', 'logos', 'LogoDDT.png')
-        logo_width = 50*mm
-        logo_height = 25*mm
-        
-        if os.path.exists(logo_path):
-            try:
-                canvas.drawImage(logo_path, doc.leftMargin, A4[1] - 30*mm, 
-                               width=logo_width, height=logo_height, mask='auto')
-            except:
-                # Fallback elegant company name
-                canvas.setFont('Helvetica-Bold', 20)
-                canvas.setFillColor(primary_color)
-                canvas.drawString(doc.leftMargin, A4[1] - 20*mm, 
-                                empresa.NombreEmpresa if empresa else "DBLogiX")
-        else:
-            # Elegant company name design
-            canvas.setFont('Helvetica-Bold', 20)
-            canvas.setFillColor(primary_color)
-            canvas.drawString(doc.leftMargin, A4[1] - 20*mm, 
-                            empresa.NombreEmpresa if empresa else "DBLogiX")
-        
-        # Document title section
-        title_width = 95*mm  # Slightly increased width
-        title_height = 25*mm
-        title_x = A4[0] - doc.rightMargin - title_width
-        title_y = A4[1] - 30*mm
-        
-        # Create background for title
-        canvas.setFillColor(primary_color)
-        canvas.roundRect(title_x, title_y, title_width, title_height, 4*mm, fill=1, stroke=0)
-        
-        # Document title with smaller font to fit better
-        canvas.setFont('Helvetica-Bold', 16)  # Reduced from 18 to 16
-        canvas.setFillColor(white)
-        title_text = "DOCUMENTO DI TRASPORTO"
-        text_width = canvas.stringWidth(title_text, 'Helvetica-Bold', 16)
-        canvas.drawString(title_x + (title_width - text_width)/2, title_y + 12*mm, title_text)
-        
-        # Document number and date
-        canvas.setFont('Helvetica', 10)
-        subtitle_text = f"N° {ddt.IdAlbaran} del {ddt.Fecha.strftime('%d/%m/%Y') if ddt.Fecha else 'N/A'}"
-        subtitle_width = canvas.stringWidth(subtitle_text, 'Helvetica', 10)
-        canvas.drawString(title_x + (title_width - subtitle_width)/2, title_y + 6*mm, subtitle_text)
-        
-        # === CLEAN COMPANY AND CLIENT BOXES (NO BORDERS) ===
-        box_y = A4[1] - 75*mm
-        box_height = 38*mm  # Increased height for more space
-        
-        # Company information (left) - no borders, more spacing
-        if empresa:
-            company_box_width = 80*mm
-            company_x = doc.leftMargin
-            
-            # Company header
-            canvas.setFont('Helvetica-Bold', 10)
-            canvas.setFillColor(primary_color)
-            canvas.drawString(company_x, box_y + box_height - 8*mm, "MITTENTE")
-            
-            # Company details with more spacing
-            canvas.setFont('Helvetica-Bold', 9)
-            canvas.setFillColor(text_primary)
-            y_offset = box_y + box_height - 16*mm
-            canvas.drawString(company_x, y_offset, empresa.NombreEmpresa)
-            
-            canvas.setFont('Helvetica', 8)
-            y_offset -= 10  # Increased spacing between lines
-            if empresa.Direccion:
-                canvas.drawString(company_x, y_offset, empresa.Direccion)
-                y_offset -= 10
-            city_postal = f"{empresa.CodPostal or ''} {empresa.Poblacion or ''}".strip()
-            if city_postal:
-                canvas.drawString(company_x, y_offset, city_postal)
-                y_offset -= 10
-            if empresa.CIF_VAT:
-                canvas.drawString(company_x, y_offset, f"P.IVA: {empresa.CIF_VAT}")
-                y_offset -= 10
-            if empresa.Telefono1:
-                canvas.drawString(company_x, y_offset, f"Tel: {empresa.Telefono1}")
-        
-        # Client information (right) - no borders, more spacing
-        if cliente:
-            client_box_width = 80*mm
-            client_x = A4[0] - doc.rightMargin - client_box_width
-            
-            # Client header
-            canvas.setFont('Helvetica-Bold', 10)
-            canvas.setFillColor(primary_color)
-            canvas.drawString(client_x, box_y + box_height - 8*mm, "DESTINATARIO")
-            
-            # Client details with more spacing
-            canvas.setFont('Helvetica-Bold', 9)
-            canvas.setFillColor(text_primary)
-            y_offset = box_y + box_height - 16*mm
-            canvas.drawString(client_x, y_offset, cliente.Nombre)
-            
-            canvas.setFont('Helvetica', 8)
-            y_offset -= 10  # Increased spacing between lines
-            if cliente.Direccion:
-                canvas.drawString(client_x, y_offset, cliente.Direccion)
-                y_offset -= 10
-            city_postal = f"{cliente.CodPostal or ''} {cliente.Poblacion or ''}".strip()
-            if city_postal:
-                canvas.drawString(client_x, y_offset, city_postal)
-                y_offset -= 10
-            if cliente.DNI:
-                canvas.drawString(client_x, y_offset, f"P.IVA/CF: {cliente.DNI}")
-                y_offset -= 10
-            if cliente.Telefono1:
-                canvas.drawString(client_x, y_offset, f"Tel: {cliente.Telefono1}")
-        
-        # === CLEAN FOOTER WITH SIGNATURES (NO SEPARATOR LINES) ===
-        footer_height = 40*mm
-        
-        # === ELEGANT SIGNATURE FIELDS ===
-        signature_y = 25*mm
-        signature_width = 70*mm
-        
-        # Left signature (VETTORE)
-        left_sig_x = doc.leftMargin + 10*mm
-        canvas.setFont('Helvetica-Bold', 9)
-        canvas.setFillColor(primary_color)
-        canvas.drawString(left_sig_x, signature_y + 8*mm, "FIRMA DEL VETTORE")
-        
-        # Elegant signature box for vettore
-        canvas.setStrokeColor(border_light)
-        canvas.setLineWidth(1)
-        canvas.rect(left_sig_x, signature_y, signature_width, 6*mm, fill=0, stroke=1)
-        
-        # Right signature (DESTINATARIO)
-        right_sig_x = A4[0] - doc.rightMargin - signature_width - 10*mm
-        canvas.setFont('Helvetica-Bold', 9)
-        canvas.setFillColor(primary_color)
-        canvas.drawString(right_sig_x, signature_y + 8*mm, "FIRMA DEL DESTINATARIO")
-        
-        # Elegant signature box for destinatario
-        canvas.setStrokeColor(border_light)
-        canvas.setLineWidth(1)
-        canvas.rect(right_sig_x, signature_y, signature_width, 6*mm, fill=0, stroke=1)
-        
-        # Document info footer
-        canvas.setFont('Helvetica', 7)
-        canvas.setFillColor(text_muted)
-        footer_text = f"DDT #{ddt.IdAlbaran} • Generato il {datetime.now().strftime('%d/%m/%Y alle ore %H:%M')} • DBLogiX Professional"
-        canvas.drawString(doc.leftMargin, 8*mm, footer_text)
-        
-        # Page number
-        page_num = canvas.getPageNumber()
-        canvas.setFont('Helvetica-Bold', 8)
-        canvas.setFillColor(primary_color)
-        page_text = f"Pagina {page_num}"
-        page_width = canvas.stringWidth(page_text, 'Helvetica-Bold', 8)
-        canvas.drawString(A4[0] - doc.rightMargin - page_width, 8*mm, page_text)
-        
-        canvas.restoreState()
-    
-    # Build the premium document
-    doc.build(elements, onFirstPage=draw_premium_header_footer, onLaterPages=draw_premium_header_footer)
-    
-    # Get the PDF content
-    pdf_content = buffer.getvalue()
-    buffer.close()
-    
-    return pdf_content
+def batch_export_criteria(source):
+    """select_ddts() filters and format from a form or JSON body.
+
+    Raises:
+        ValueError: malformed date, client or id
+    """
+    def date_value(name):
+        value = (source.get(name) or '').strip()
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+
+    ids = source.get('ids') or []
+    if isinstance(ids, str):
+        ids = [part for part in ids.replace(';', ',').replace(' ', ',').split(',') if part]
+    try:
+        date_from = date_value('date_from')
+        date_to = date_value('date_to')
+        client_id = int(source['client_id']) if source.get('client_id') else None
+        ddt_ids = [int(ddt_id) for ddt_id in ids]
+    except (TypeError, ValueError):
+        raise ValueError('Periodo, cliente o id dei DDT non validi')
+
+    criteria = {
+        'date_from': date_from,
+        # Include the entire day
+        'date_to': date_to + timedelta(days=1) if date_to else None,
+        'client_id': client_id,
+        'ddt_ids': ddt_ids
+    }
+    return criteria, (source.get('format') or 'zip').lower()
+
+
+def export_response(job):
+    return Response(stream_with_context(stream_export(job)), mimetype=export_mimetype(job), headers={
+        'Content-Disposition': f'attachment; filename="{export_filename(job)}"',
+        'X-Accel-Buffering': 'no'
+    })
+
+
+def owned_job(job_id):
+    """Export manifest of job_id started by the current user (admins see all), or 404"""
+    job = load_job(job_id)
+    if job is None or (job.get('user_id') != current_user.id and not current_user.is_admin):
+        abort(404)
+    return job
+
+
+@ddt_bp.route('/export/batch', methods=['POST'])
+@login_required
+def export_batch():
+    """Export the DDTs of a period, client or id list as one ZIP or merged PDF"""
+    try:
+        criteria, export_format = batch_export_criteria(request.form)
+        job = start_export(select_ddts(**criteria), export_format, current_user.id)
+    except ValueError as e:
+        flash(str(e), 'warning')
+        return redirect(url_for('ddt.index'))
+
+    if not job['items']:
+        flash('Nessun DDT corrisponde ai filtri indicati.', 'info')
+        return redirect(url_for('ddt.index'))
+
+    # Poche decine di DDT: download immediato; oltre, pagina con l'avanzamento
+    if len(job['items']) <= DIRECT_EXPORT_LIMIT:
+        return export_response(job)
+    return render_template('ddt/export_batch.html', job=job, progress=export_progress(job))
+
+
+@ddt_bp.route('/api/export/batch', methods=['POST'])
+@login_required
+def api_export_batch():
+    """Start a batch export: {date_from, date_to, client_id, ids, format}"""
+    try:
+        criteria, export_format = batch_export_criteria(request.get_json(silent=True) or {})
+        job = start_export(select_ddts(**criteria), export_format, current_user.id)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+
+    return jsonify({
+        'success': True,
+        'job': export_progress(job),
+        'progress_url': url_for('ddt.api_export_batch_progress', job_id=job['id']),
+        'download_url': url_for('ddt.export_batch_download', job_id=job['id'])
+    }), 202
+
+
+@ddt_bp.route('/api/export/batch/<job_id>', methods=['GET'])
+@login_required
+def api_export_batch_progress(job_id):
+    """Progress of a batch export"""
+    return jsonify({'success': True, 'job': export_progress(owned_job(job_id))})
+
+
+@ddt_bp.route('/export/batch/<job_id>/download', methods=['GET'])
+@login_required
+def export_batch_download(job_id):
+    """Stream a batch export; PDFs still missing are waited for or rendered again"""
+    return export_response(owned_job(job_id))
 
 # Utility function for calculating VAT rate from IdIva
 def get_vat_rate(id_iva):
@@ -1981,94 +1019,55 @@ def inittest():
 @ddt_bp.route('/api/preview/add_ticket', methods=['POST'])
 @login_required
 def api_add_ticket_to_preview():
-    """API to add a ticket to DDT preview"""
+    """API to add a ticket to the DDT preview draft"""
     data = request.get_json()
+    draft_id = data.get('draft_id')
     ticket_id = data.get('ticket_id')
     empresa_id = data.get('empresa_id', 1)
     
     if not ticket_id:
         return jsonify({'success': False, 'message': 'ID ticket mancante'})
     
-    # Get ticket info
-    ticket = TicketHeader.query.filter_by(
+    enviado = db.session.query(TicketHeader.Enviado).filter_by(
         IdTicket=ticket_id,
         IdEmpresa=empresa_id
-    ).first()
+    ).scalar()
     
-    if not ticket:
+    if enviado is None:
         return jsonify({'success': False, 'message': 'Ticket non trovato'})
     
-    if ticket.Enviado != 0:
+    if enviado != 0:
         return jsonify({'success': False, 'message': 'Ticket già processato'})
     
-    # Get unique ticket lines and calculate total - avoid duplicates
-    lines_query = """
-        SELECT DISTINCT 
-            tl.IdArticulo,
-            tl.Descripcion,
-            tl.Peso,
-            tl.FechaCaducidad,
-            p.PrecioConIVA
-        FROM dat_ticket_linea tl
-        LEFT JOIN dat_articulo p ON tl.IdArticulo = p.IdArticulo
-        WHERE tl.IdTicket = :ticket_id
-        ORDER BY tl.IdArticulo
-    """
-    
-    lines_result = db.session.execute(text(lines_query), {'ticket_id': ticket_id})
-    
-    ticket_total = 0
-    ticket_lines_data = []
-    unique_products = {}
-    
-    for row in lines_result:
-        id_articulo = row[0]
-        descripcion = row[1]
-        peso = float(row[2] or 0)
-        fecha_caducidad = row[3]
-        precio = float(row[4] or 0)
-        
-        # Skip if we already processed this article
-        if id_articulo in unique_products:
-            current_app.logger.warning(f"⚠️ Skipping duplicate IdArticulo {id_articulo} in ticket {ticket_id}")
-            continue
-        
-        # Mark this article as processed
-        unique_products[id_articulo] = True
-        
-        line_amount = peso * precio
-        ticket_total += line_amount
-        
-        ticket_lines_data.append({
-            'id_articulo': id_articulo,
-            'descripcion': descripcion,
-            'peso': peso,
-            'precio': precio,
-            'importe': line_amount,
-            'fecha_caducidad': fecha_caducidad.strftime('%d/%m/%Y') if fecha_caducidad else None
-        })
+    # Solo il ticket aggiunto viene risolto; i totali della bozza sono aggiornati con il delta
+    entry = resolve_tickets([ticket_id], empresa_id).get(int(ticket_id))
+    if entry is None:
+        return jsonify({'success': False, 'message': 'Ticket non trovato'})
+    draft, added = update_draft(draft_id, current_user.id, lambda draft: draft.add_ticket(entry))
+    if draft is None:
+        return jsonify({'success': False, 'message': 'Anteprima scaduta, ricaricare la pagina'})
+    if not added:
+        return jsonify({'success': False, 'message': 'Questo ticket è già incluso nel DDT'})
     
     return jsonify({
         'success': True,
-        'ticket': {
-            'id_ticket': ticket.IdTicket,
-            'num_ticket': ticket.NumTicket,
-            'fecha': ticket.Fecha.strftime('%d/%m/%Y %H:%M') if ticket.Fecha else '',
-            'lines': ticket_lines_data,
-            'total': ticket_total,
-            'id_empresa': ticket.IdEmpresa,
-            'id_tienda': ticket.IdTienda or 1,
-            'id_balanza_maestra': ticket.IdBalanzaMaestra or 1,
-            'id_balanza_esclava': ticket.IdBalanzaEsclava or -1,
-            'tipo_venta': ticket.TipoVenta or 2
-        }
+        'ticket': draft.ticket_view(ticket_id),
+        'summary': draft.summary()
     })
 
+def remove_from_draft(draft_id, ticket_id):
+    """Summary of the preview draft after removing ticket_id, or None without a draft"""
+    if not draft_id:
+        return None
+    draft, _ = update_draft(draft_id, current_user.id, lambda draft: draft.remove_ticket(ticket_id))
+    return draft.summary() if draft is not None else None
+
 @ddt_bp.route('/api/preview/remove_ticket', methods=['POST'])
 @login_required
 def api_remove_ticket_from_preview():
     """API to remove a ticket from DDT preview and optionally from task"""
     data = request.get_json()
+    draft_id = data.get('draft_id')
     ticket_id = data.get('ticket_id')
     from_task = data.get('from_task', False)  # Indica se viene da un task
     task_id = data.get('task_id')  # ID della task specifica (se disponibile)
@@ -2076,7 +1075,25 @@ def api_remove_ticket_from_preview():
     if not ticket_id:
         return jsonify({'success': False, 'message': 'ID ticket mancante'})
     
+    # Task di provenienza registrato nella bozza
+    draft = load_draft(draft_id, current_user.id)
+    if draft is not None:
+        from_task = draft.from_task
+        task_id = task_id or draft.task_id
+    
     try:
+        # Ticket manuale: esiste solo nella bozza
+        if int(ticket_id) < 0:
+            summary = remove_from_draft(draft_id, ticket_id)
+            if summary is None:
+                return jsonify({'success': False, 'message': 'Anteprima scaduta, ricaricare la pagina'})
+            return jsonify({
+                'success': True,
+                'message': 'Ticket manuale rimosso dal preview',
+                'task_deleted': False,
+                'summary': summary
+            })
+        
         # Trova il ticket e resetta il suo stato
         ticket = TicketHeader.query.get(ticket_id)
         if not ticket:
@@ -2115,15 +1132,15 @@ def api_remove_ticket_from_preview():
                     current_app.logger.info(f"🗑️ Rimozione TaskTicket ID: {task_ticket.id}")
                     
                     # Rimuovi tutti i scan associati a questo TaskTicket
+                    from services.audit_buffer import flush_audit_buffer
+                    flush_audit_buffer()  # scansioni ancora nel buffer di scrittura
                     TaskTicketScan.query.filter_by(task_ticket_id=task_ticket.id).delete()
                     
                     # Rimuovi il TaskTicket
                     db.session.delete(task_ticket)
                     
-                    # Aggiorna il progresso della task
+                    # Il progresso della task viene aggiornato al flush (services.task_progress)
                     if task:
-                        task.update_progress()
-                        
                         # Verifica se la task è ora vuota (senza ticket)
                         remaining_tickets = TaskTicket.query.filter_by(task_id=task_id).count()
                         current_app.logger.info(f"📊 Ticket rimanenti nella task {task.task_number}: {remaining_tickets}")
@@ -2149,7 +1166,8 @@ def api_remove_ticket_from_preview():
                                 'success': True, 
                                 'message': f'Ticket rimosso dalla task {task_number}. Task eliminata (vuota).',
                                 'task_deleted': True,
-                                'task_number': task_number
+                                'task_number': task_number,
+                                'summary': remove_from_draft(draft_id, ticket_id)
                             })
                         else:
                             current_app.logger.info(f"📋 Task {task.task_number} mantiene {remaining_tickets} ticket")
@@ -2168,7 +1186,8 @@ def api_remove_ticket_from_preview():
         return jsonify({
             'success': True, 
             'message': 'Ticket rimosso dal preview e stato reimpostato',
-            'task_deleted': False
+            'task_deleted': False,
+            'summary': remove_from_draft(draft_id, ticket_id)
         })
         
     except Exception as e:
@@ -2193,14 +1212,9 @@ def api_search_tickets_for_preview():
     
     # Apply search filter if provided
     if query:
-        if query.isdigit():
-            # Search by ticket number
-            base_query = base_query.filter(TicketHeader.NumTicket.like(f'%{query}%'))
-        else:
-            # Search by product description in ticket lines
-            base_query = base_query.join(TicketLine).filter(
-                TicketLine.Descripcion.like(f'%{query}%')
-            )
+        # Numero ticket o descrizione delle linee (indice a trigrammi, services.search_index)
+        fields = ('number',) if query.isdigit() else ('description',)
+        base_query = base_query.filter(ticket_search_clause(query, fields=fields))
     
     tickets = base_query.order_by(TicketHeader.Fecha.desc()).limit(20).all()
     
@@ -2225,7 +1239,7 @@ def api_search_tickets_for_preview():
 @ddt_bp.route('/api/preview/create_ticket', methods=['POST'])
 @login_required
 def api_create_manual_ticket():
-    """API to create a manual ticket data for localStorage (no DB write)"""
+    """API to add a manual ticket to the DDT preview draft (no DB write until the DDT is created)"""
     data = request.get_json()
     
     # Validazione dati richiesti
@@ -2234,7 +1248,7 @@ def api_create_manual_ticket():
         if field not in data or not data[field]:
             return jsonify({'success': False, 'message': f'Campo {field} mancante'})
     
-    cliente_id = data.get('cliente_id')
+    draft_id = data.get('draft_id')
     empresa_id = data.get('empresa_id', 1)
     products = data.get('products', [])
     
@@ -2242,64 +1256,48 @@ def api_create_manual_ticket():
         return jsonify({'success': False, 'message': 'Almeno un prodotto è richiesto'})
     
     try:
-        # Genera un ID ticket temporaneo unico (negativo per distinguerlo dai ticket reali)
-        import time
-        temp_ticket_id = -int(time.time())  # ID negativo basato su timestamp
-        temp_num_ticket = f"MAN{abs(temp_ticket_id)}"  # Numero ticket manuale
-        
-        # Prepara le righe del ticket per localStorage
-        ticket_lines_data = []
-        total_ticket = 0
-        
-        for idx, product_data in enumerate(products, 1):
-            peso = float(product_data.get('peso', 1))
-            descripcion = product_data.get('descripcion', 'Prodotto Personalizzato')
-            precio = float(product_data.get('precio', 1.00))
-            id_iva = int(product_data.get('id_iva', 3))  # Default 22%
-            fecha_caducidad = product_data.get('fecha_caducidad')
-            
-            # Calcola importo linea
-            importe = peso * precio
-            total_ticket += importe
-            
-            # Prepara dati per localStorage (simula una TicketLine)
-            ticket_lines_data.append({
-                'id_linea_ticket': f"temp_{temp_ticket_id}_{idx}",  # ID temporaneo
-                'id_ticket': temp_ticket_id,
-                'id_articulo': 999,  # Usa sempre ID 999 per prodotti personalizzati
-                'descripcion': descripcion,
-                'peso': float(peso),
-                'precio': precio,
-                'importe': importe,
-                'fecha_caducidad': fecha_caducidad,
-                'id_iva': id_iva,
-                'comportamiento': product_data.get('comportamiento', 1),
-                'is_manual': True  # Flag per identificare ticket manuali
-            })
+        # Id negativo assegnato dalla bozza, per distinguerlo dai ticket reali
+        draft, ticket = update_draft(draft_id, current_user.id,
+                                     lambda draft: draft.add_manual_ticket(products, empresa_id))
+        if draft is None:
+            return jsonify({'success': False, 'message': 'Anteprima scaduta, ricaricare la pagina'})
         
-        # Prepara risposta con i dati del ticket per localStorage
         return jsonify({
             'success': True,
-            'message': 'Ticket manuale creato (solo localStorage)',
-            'ticket': {
-                'id_ticket': temp_ticket_id,
-                'num_ticket': temp_num_ticket,
-                'fecha': datetime.now().strftime('%d/%m/%Y %H:%M'),
-                'lines': ticket_lines_data,
-                'total': total_ticket,
-                'id_empresa': empresa_id,
-                'id_tienda': 1,
-                'id_balanza_maestra': 1,
-                'id_balanza_esclava': -1,
-                'tipo_venta': 2,
-                'is_manual': True  # Flag per identificare ticket manuali
-            }
+            'message': 'Ticket manuale aggiunto al preview',
+            'ticket': ticket,
+            'summary': draft.summary()
         })
         
     except Exception as e:
+        db.session.rollback()
         current_app.logger.error(f"Errore nella creazione dei dati ticket manuale: {str(e)}")
         return jsonify({'success': False, 'message': f'Errore durante la creazione: {str(e)}'}) 
 
+@ddt_bp.route('/api/preview/discount', methods=['POST'])
+@login_required
+def api_set_preview_discount():
+    """API to set the discount percentage of a ticket in the DDT preview draft"""
+    data = request.get_json()
+    draft_id = data.get('draft_id')
+    ticket_id = data.get('ticket_id')
+    
+    try:
+        discount = float(data.get('discount') or 0)
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': 'Sconto non valido'})
+    if not ticket_id or not 0 <= discount <= 100:
+        return jsonify({'success': False, 'message': 'Ticket o sconto non valido'})
+    
+    draft, updated = update_draft(draft_id, current_user.id,
+                                  lambda draft: draft.set_discount(ticket_id, discount))
+    if draft is None:
+        return jsonify({'success': False, 'message': 'Anteprima scaduta, ricaricare la pagina'})
+    if not updated:
+        return jsonify({'success': False, 'message': 'Ticket non presente nel preview'})
+    
+    return jsonify({'success': True, 'summary': draft.summary()})
+
 @ddt_bp.route('/api/products/search', methods=['GET'])
 @login_required
 def api_search_products():
@@ -2316,8 +1314,10 @@ def api_search_products():
         # Ricerca per ID articolo
         products_query = products_query.filter(Product.IdArticulo == int(query))
     else:
-        # Ricerca per descrizione
-        products_query = products_query.filter(Product.Descripcion.like(f'%{query}%'))
+        # Ricerca per descrizione (indice a trigrammi, services.search_index)
+        products_query = products_query.filter(
+            Product.IdArticulo.in_(search_product_ids(query, fields=('description',)))
+        )
     
     products = products_query.limit(20).all()
     
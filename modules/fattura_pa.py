@@ -9,6 +9,7 @@ from xml.dom import minidom
 import io
 import logging
 import uuid
+from services.sequences import next_invoice_number
 from services.utils import admin_required
 
 # Set up logger
@@ -27,10 +28,8 @@ NAMESPACE_MAP = {
 
 # Helper functions
 def get_next_invoice_number():
-    """Get the next progressive invoice number"""
-    # TODO: Implement proper invoice numbering logic
-    # For now, using a simple timestamp-based number
-    return int(datetime.now().strftime('%y%m%d%H%M'))
+    """Get the next progressive invoice number (committed with the invoice file)"""
+    return next_invoice_number()
 
 def format_decimal(value, decimal_places=2):
     """Format a decimal value with fixed decimal places"""
@@ -269,10 +268,14 @@ def create_fattura_pa_from_ddt(ddt_id):
         # Save the XML to file
         with open(file_path, 'wb') as f:
             f.write(xml_data)
+        
+        # Il numero resta assegnato solo se il file è stato scritto
+        db.session.commit()
             
         return file_path, None  # Return the file path and no error
         
     except Exception as e:
+        db.session.rollback()
         logger.error(f"Error generating FatturaPA XML: {str(e)}")
         return None, str(e)
 
@@ -1,6 +1,6 @@
-from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash, current_app
+from flask import Blueprint, render_template, request, jsonify, redirect, url_for, flash, current_app, Response
 from flask_login import login_required, current_user
-from sqlalchemy import desc, and_, or_
+from sqlalchemy import desc, and_, or_, case, func, true
 from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta, date
 import json
@@ -8,9 +8,23 @@ import qrcode
 import io
 import base64
 import logging
+import time
 
-from app.models import db, Task, TaskTicket, TaskTicketScan, TaskNotification, TicketHeader, TicketLine, User, Client, AlbaranCabecera, AlbaranLinea, Company, Product, Article
+from app.models import db, Task, TaskTicket, TaskTicketScan, TaskNotification, TicketHeader, TicketLine, User, Client, AlbaranCabecera, Company, Product
 from services.utils import admin_required
+from services.audit_buffer import flush_audit_buffer
+from services.event_bus import replay as replay_events, subscribe as subscribe_events
+from services import notification_feed
+from services import task_screen as screen_feed
+from services.ddt_builder import DDTBuilder, mark_processed
+from services.ddt_preview import consume_draft, load_draft
+from services.scan_resolution import invalidate_tickets
+from services.sequences import next_ddt_numbers
+from services.task_scan import lock_task_ticket, scan_task_ticket
+from services.task_workspace import MAX_SYNC_ITEMS, build_workspace, sync_scans, workspace_delta
+from services.scan_analytics import analytics_report
+from services.task_cleanup import cleanup_running, delete_tasks, deletion_size, get_cleanup_job, needs_background, start_cleanup_job
+from services.ticket_picker import PICKER_MAX_PAGE_SIZE, PICKER_PAGE_SIZE, expired_lines, picker_lines, picker_page
 from app.forms import DDTCreateForm
 
 tasks_bp = Blueprint('tasks', __name__)
@@ -18,6 +32,33 @@ tasks_bp = Blueprint('tasks', __name__)
 # Configure logger
 logger = logging.getLogger(__name__)
 
+# Categorie della dashboard admin
+TASK_CATEGORIES = ('active', 'overdue', 'completed_no_ddt', 'completed_with_ddt')
+
+
+def task_category_conditions(today=None):
+    """SQL predicates of the admin dashboard categories, mutually exclusive.
+
+    Same rules as Task.is_overdue: a task is overdue once the day of its
+    deadline has passed and it is not completed; completed tasks are split
+    by whether a DDT was generated; everything else is active.
+    """
+    today = today or datetime.utcnow().date()
+    not_completed = or_(Task.status.is_(None), Task.status != 'completed')
+    overdue = and_(
+        Task.deadline.isnot(None),
+        Task.deadline < datetime.combine(today, datetime.min.time()),
+        not_completed
+    )
+    with_ddt = and_(func.coalesce(Task.ddt_generated, False) == True, Task.ddt_id.isnot(None))
+    return {
+        'active': and_(not_completed, ~overdue),
+        'overdue': overdue,
+        'completed_no_ddt': and_(Task.status == 'completed', ~with_ddt),
+        'completed_with_ddt': and_(Task.status == 'completed', with_ddt)
+    }
+
+
 @tasks_bp.route('/')
 @login_required
 def index():
@@ -67,159 +108,98 @@ def admin_dashboard():
                                status=status_filter,
                                category=category_filter))
     
-    # Base query
-    query = Task.query
+    # Filter conditions (shared by the counters and the per-category pages)
+    conditions = []
     
     # Enhanced search functionality - prioritize search_query over title_filter
     if search_query:
         logger.info(f"🔍 Task Search: cercando '{search_query}' in tutti i tasks")
-        try:
-            # Try to convert search to integer for task number search
-            search_id = int(search_query)
+        text_conditions = [
+            Task.task_number.ilike(f'%{search_query}%'),
+            Task.title.ilike(f'%{search_query}%'),
+            Task.description.ilike(f'%{search_query}%')
+        ]
+        if search_query.isdigit():
             # Search by task ID or task number
-            query = query.filter(
-                or_(
-                    Task.id_task == search_id,
-                    Task.task_number.ilike(f'%{search_query}%'),
-                    Task.title.ilike(f'%{search_query}%'),
-                    Task.description.ilike(f'%{search_query}%')
-                )
-            )
-        except ValueError:
-            # Search only by text fields if not a number
-            query = query.filter(
-                or_(
-                    Task.task_number.ilike(f'%{search_query}%'),
-                    Task.title.ilike(f'%{search_query}%'),
-                    Task.description.ilike(f'%{search_query}%')
-                )
-            )
+            text_conditions.insert(0, Task.id_task == int(search_query))
+        conditions.append(or_(*text_conditions))
         logger.info(f"🔍 Search query applied for '{search_query}'")
     elif title_filter:
         # Fallback to old title filter for compatibility
-        query = query.filter(Task.title.ilike(f'%{title_filter}%'))
+        conditions.append(Task.title.ilike(f'%{title_filter}%'))
     
     # Apply date filters
     if date_from:
         try:
             date_from_obj = datetime.strptime(date_from, '%Y-%m-%d')
-            query = query.filter(Task.created_at >= date_from_obj)
+            conditions.append(Task.created_at >= date_from_obj)
         except ValueError:
             pass
     
     if date_to:
         try:
             date_to_obj = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
-            query = query.filter(Task.created_at < date_to_obj)
+            conditions.append(Task.created_at < date_to_obj)
         except ValueError:
             pass
     
     # Apply other filters
     if priority_filter:
-        query = query.filter(Task.priority == priority_filter)
+        conditions.append(Task.priority == priority_filter)
     
     if status_filter:
-        query = query.filter(Task.status == status_filter)
-    
-    # Get filtered tasks
-    tasks = query.order_by(desc(Task.created_at)).all()
-    
-    # Update progress for all tasks
-    for task in tasks:
-        task.update_progress()
-    
-    # Separate tasks into the 4 specific categories
-    active_tasks = []           # pending, assigned, in_progress (not overdue)
-    overdue_tasks = []          # any task that is overdue
-    completed_no_ddt_tasks = [] # completed but no DDT generated
-    completed_with_ddt_tasks = [] # completed with DDT generated
-    
-    for task in tasks:
-        if task.is_overdue:
-            overdue_tasks.append(task)
-        elif task.status == 'completed':
-            if task.ddt_generated and task.ddt_id:
-                completed_with_ddt_tasks.append(task)
-            else:
-                completed_no_ddt_tasks.append(task)
-        else:
-            # pending, assigned, in_progress (and not overdue)
-            active_tasks.append(task)
-    
-    # Store original counts for statistics (before category filter)
-    original_stats = {
-        'total_tasks': Task.query.count(),
-        'active_tasks': len(active_tasks),
-        'overdue_tasks': len(overdue_tasks),
-        'completed_no_ddt_tasks': len(completed_no_ddt_tasks),
-        'completed_with_ddt_tasks': len(completed_with_ddt_tasks),
-        # Keep old stats for compatibility
-        'pending_tasks': Task.query.filter_by(status='pending').count(),
-        'in_progress_tasks': Task.query.filter_by(status='in_progress').count(),
-        'completed_tasks': Task.query.filter_by(status='completed').count(),
-        # Add completed notifications count
-        'completed_notifications_count': TaskNotification.query.filter_by(
-            user_id=current_user.id,
-            is_read=False,
-            notification_type='task_completed'
-        ).count()
+        conditions.append(Task.status == status_filter)
+    
+    categories = task_category_conditions()
+    filtered = and_(*conditions) if conditions else true()
+    
+    # Tutti i contatori con una sola query aggregata
+    counts = db.session.query(
+        func.count(Task.id_task),
+        *[func.coalesce(func.sum(case((Task.status == status, 1), else_=0)), 0)
+          for status in ('pending', 'in_progress', 'completed')],
+        *[func.coalesce(func.sum(case((and_(filtered, categories[category]), 1), else_=0)), 0)
+          for category in TASK_CATEGORIES]
+    ).one()
+    total_tasks, pending_count, in_progress_count, completed_count = counts[:4]
+    category_counts = dict(zip(TASK_CATEGORIES, (int(count) for count in counts[4:])))
+    
+    # Apply category filter if specified (the other categories are shown empty)
+    if category_filter in TASK_CATEGORIES:
+        category_counts = {category: (count if category == category_filter else 0)
+                           for category, count in category_counts.items()}
+    
+    # Una pagina per categoria, paginata nel database
+    pages = {
+        'active': active_page,
+        'overdue': overdue_page,
+        'completed_no_ddt': completed_no_ddt_page,
+        'completed_with_ddt': completed_with_ddt_page
     }
-    
-    # Apply category filter if specified
-    if category_filter:
-        if category_filter == 'active':
-            overdue_tasks = []
-            completed_no_ddt_tasks = []
-            completed_with_ddt_tasks = []
-        elif category_filter == 'overdue':
-            active_tasks = []
-            completed_no_ddt_tasks = []
-            completed_with_ddt_tasks = []
-        elif category_filter == 'completed_no_ddt':
-            active_tasks = []
-            overdue_tasks = []
-            completed_with_ddt_tasks = []
-        elif category_filter == 'completed_with_ddt':
-            active_tasks = []
-            overdue_tasks = []
-            completed_no_ddt_tasks = []
-    
-    # Apply pagination to each category
-    # Active tasks pagination
-    active_start = (active_page - 1) * per_page
-    active_end = active_start + per_page
-    active_tasks_paginated = active_tasks[active_start:active_end]
-    active_total_pages = (len(active_tasks) + per_page - 1) // per_page
-    
-    # Overdue tasks pagination
-    overdue_start = (overdue_page - 1) * per_page
-    overdue_end = overdue_start + per_page
-    overdue_tasks_paginated = overdue_tasks[overdue_start:overdue_end]
-    overdue_total_pages = (len(overdue_tasks) + per_page - 1) // per_page
-    
-    # Completed without DDT pagination
-    completed_no_ddt_start = (completed_no_ddt_page - 1) * per_page
-    completed_no_ddt_end = completed_no_ddt_start + per_page
-    completed_no_ddt_tasks_paginated = completed_no_ddt_tasks[completed_no_ddt_start:completed_no_ddt_end]
-    completed_no_ddt_total_pages = (len(completed_no_ddt_tasks) + per_page - 1) // per_page
-    
-    # Completed with DDT pagination
-    completed_with_ddt_start = (completed_with_ddt_page - 1) * per_page
-    completed_with_ddt_end = completed_with_ddt_start + per_page
-    completed_with_ddt_tasks_paginated = completed_with_ddt_tasks[completed_with_ddt_start:completed_with_ddt_end]
-    completed_with_ddt_total_pages = (len(completed_with_ddt_tasks) + per_page - 1) // per_page
+    category_tasks = {}
+    total_pages = {}
+    for category in TASK_CATEGORIES:
+        total_pages[category] = (category_counts[category] + per_page - 1) // per_page
+        if not category_counts[category]:
+            category_tasks[category] = []
+            continue
+        category_tasks[category] = Task.query.filter(
+            filtered, categories[category]
+        ).order_by(desc(Task.created_at), desc(Task.id_task)).offset(
+            (max(pages[category], 1) - 1) * per_page
+        ).limit(per_page).all()
     
     # Get task statistics with new categories
     stats = {
-        'total_tasks': Task.query.count(),
-        'active_tasks': len(active_tasks),
-        'overdue_tasks': len(overdue_tasks),
-        'completed_no_ddt_tasks': len(completed_no_ddt_tasks),
-        'completed_with_ddt_tasks': len(completed_with_ddt_tasks),
+        'total_tasks': total_tasks,
+        'active_tasks': category_counts['active'],
+        'overdue_tasks': category_counts['overdue'],
+        'completed_no_ddt_tasks': category_counts['completed_no_ddt'],
+        'completed_with_ddt_tasks': category_counts['completed_with_ddt'],
         # Keep old stats for compatibility
-        'pending_tasks': Task.query.filter_by(status='pending').count(),
-        'in_progress_tasks': Task.query.filter_by(status='in_progress').count(),
-        'completed_tasks': Task.query.filter_by(status='completed').count(),
+        'pending_tasks': int(pending_count),
+        'in_progress_tasks': int(in_progress_count),
+        'completed_tasks': int(completed_count),
         # Add completed notifications count
         'completed_notifications_count': TaskNotification.query.filter_by(
             user_id=current_user.id,
@@ -235,19 +215,20 @@ def admin_dashboard():
     clients = Client.query.order_by(Client.Nombre).all()
     
     return render_template('tasks/admin_dashboard.html', 
-                         active_tasks=active_tasks_paginated,
-                         overdue_tasks=overdue_tasks_paginated,
-                         completed_no_ddt_tasks=completed_no_ddt_tasks_paginated,
-                         completed_with_ddt_tasks=completed_with_ddt_tasks_paginated,
+                         cleanup_job=get_cleanup_job(),
+                         active_tasks=category_tasks['active'],
+                         overdue_tasks=category_tasks['overdue'],
+                         completed_no_ddt_tasks=category_tasks['completed_no_ddt'],
+                         completed_with_ddt_tasks=category_tasks['completed_with_ddt'],
                          # Pagination info
                          active_page=active_page,
-                         active_total_pages=active_total_pages,
+                         active_total_pages=total_pages['active'],
                          overdue_page=overdue_page,
-                         overdue_total_pages=overdue_total_pages,
+                         overdue_total_pages=total_pages['overdue'],
                          completed_no_ddt_page=completed_no_ddt_page,
-                         completed_no_ddt_total_pages=completed_no_ddt_total_pages,
+                         completed_no_ddt_total_pages=total_pages['completed_no_ddt'],
                          completed_with_ddt_page=completed_with_ddt_page,
-                         completed_with_ddt_total_pages=completed_with_ddt_total_pages,
+                         completed_with_ddt_total_pages=total_pages['completed_with_ddt'],
                          stats=stats,
                          users=users,
                          clients=clients,
@@ -312,10 +293,6 @@ def user_dashboard():
     # Get filtered tasks
     assigned_tasks = query.order_by(desc(Task.assigned_at)).all()
     
-    # Update progress for assigned tasks
-    for task in assigned_tasks:
-        task.update_progress()
-    
     # Separate tasks into categories
     active_tasks = []
     completed_tasks = []
@@ -391,58 +368,17 @@ def create_task():
                 deadline_date = deadline.date()
                 if deadline_date < today:
                     flash('La data di scadenza non può essere nel passato.', 'error')
-                    # Get data for re-rendering the form
-                    available_tickets = TicketHeader.query.filter_by(Enviado=0).order_by(desc(TicketHeader.Fecha)).all()
-                    for ticket in available_tickets:
-                        ticket_lines = db.session.query(TicketLine).outerjoin(
-                            Product, TicketLine.IdArticulo == Product.IdArticulo
-                        ).filter(TicketLine.IdTicket == ticket.IdTicket).all()
-                        ticket.loaded_lines = ticket_lines
-                        actual_lines = len(ticket_lines)
-                        if ticket.NumLineas != actual_lines:
-                            ticket.NumLineas = actual_lines
-                    users = User.query.filter_by(is_admin=False).all()
-                    return render_template('tasks/create_task.html', tickets=available_tickets, users=users)
+                    return render_create_task_form()
             
             # Get selected tickets for validation
             selected_tickets = request.form.getlist('tickets')
             if not selected_tickets:
                 flash('Seleziona almeno un ticket per creare il task.', 'error')
-                # Get data for re-rendering the form
-                available_tickets = TicketHeader.query.filter_by(Enviado=0).order_by(desc(TicketHeader.Fecha)).all()
-                for ticket in available_tickets:
-                    ticket_lines = db.session.query(TicketLine).outerjoin(
-                        Product, TicketLine.IdArticulo == Product.IdArticulo
-                    ).filter(TicketLine.IdTicket == ticket.IdTicket).all()
-                    ticket.loaded_lines = ticket_lines
-                    actual_lines = len(ticket_lines)
-                    if ticket.NumLineas != actual_lines:
-                        ticket.NumLineas = actual_lines
-                users = User.query.filter_by(is_admin=False).all()
-                return render_template('tasks/create_task.html', tickets=available_tickets, users=users)
+                return render_create_task_form()
             
-            # Validate product expiry dates against task deadline
+            # Validate product expiry dates against task deadline (una sola query per tutti i ticket selezionati)
             if deadline:
-                invalid_tickets = []
-                for ticket_id in selected_tickets:
-                    ticket = TicketHeader.query.get(int(ticket_id))
-                    if ticket:
-                        ticket_lines = TicketLine.query.filter_by(IdTicket=ticket.IdTicket).all()
-                        for line in ticket_lines:
-                            if line.FechaCaducidad:
-                                # Convert to date for comparison if it's a datetime
-                                expiry_date = line.FechaCaducidad.date() if hasattr(line.FechaCaducidad, 'date') else line.FechaCaducidad
-                                task_deadline_date = deadline.date()
-                                
-                                # FIX: Corrected logic - block if expiry date is BEFORE task deadline (product is expired)
-                                if expiry_date < task_deadline_date:
-                                    invalid_tickets.append({
-                                        'ticket_num': ticket.NumTicket,
-                                        'product_id': line.IdArticulo,
-                                        'product_name': line.Descripcion,
-                                        'expiry_date': expiry_date.strftime('%d/%m/%Y'),
-                                        'task_deadline': task_deadline_date.strftime('%d/%m/%Y')
-                                    })
+                invalid_tickets = expired_lines([int(ticket_id) for ticket_id in selected_tickets], deadline)
                 
                 if invalid_tickets:
                     error_message = "I seguenti ticket contengono prodotti con scadenza anteriore alla scadenza del task:\n"
@@ -452,19 +388,7 @@ def create_task():
                         error_message += f"... e altri {len(invalid_tickets) - 3} prodotti"
                     
                     flash(error_message, 'error')
-                    # Get data for re-rendering the form
-                    available_tickets = TicketHeader.query.filter_by(Enviado=0).order_by(desc(TicketHeader.Fecha)).all()
-                    for ticket in available_tickets:
-                        # FIX: Use LEFT JOIN to handle missing products gracefully
-                        ticket_lines = db.session.query(TicketLine).outerjoin(
-                            Product, TicketLine.IdArticulo == Product.IdArticulo
-                        ).filter(TicketLine.IdTicket == ticket.IdTicket).all()
-                        ticket.loaded_lines = ticket_lines
-                        actual_lines = len(ticket_lines)
-                        if ticket.NumLineas != actual_lines:
-                            ticket.NumLineas = actual_lines
-                    users = User.query.filter_by(is_admin=False).all()
-                    return render_template('tasks/create_task.html', tickets=available_tickets, users=users)
+                    return render_create_task_form()
             
             # Create new task
             task = Task(
@@ -502,8 +426,7 @@ def create_task():
                 if ticket:
                     ticket.Enviado = 10
             
-            # Update progress
-            task.update_progress()
+            # total_tickets viene aggiornato al flush dei TaskTicket (services.task_progress)
             
             # Create notification for assigned user
             if task.assigned_to:
@@ -526,29 +449,13 @@ def create_task():
             flash(f'Errore nella creazione del task: {str(e)}', 'error')
     
     # GET request - show form
-    available_tickets = TicketHeader.query.filter_by(Enviado=0).order_by(desc(TicketHeader.Fecha)).all()
-    
-    # Calculate actual line count and load lines for each ticket
-    for ticket in available_tickets:
-        # FIX: Use LEFT JOIN to handle missing products gracefully
-        ticket_lines = db.session.query(TicketLine).outerjoin(
-            Product, TicketLine.IdArticulo == Product.IdArticulo
-        ).filter(TicketLine.IdTicket == ticket.IdTicket).all()
-        
-        # Attach lines to ticket object for template access
-        ticket.loaded_lines = ticket_lines
-        
-        # Count actual lines in database
-        actual_lines = len(ticket_lines)
-        # Update NumLineas if it's wrong
-        if ticket.NumLineas != actual_lines:
-            ticket.NumLineas = actual_lines
-            # Don't commit here, just for display
-    
-    # Get users for assignment
+    return render_create_task_form()
+
+
+def render_create_task_form():
+    """Task creation form; the tickets are loaded page by page from /api/ticket-picker"""
     users = User.query.filter_by(is_admin=False).all()
-        
-    return render_template('tasks/create_task.html', tickets=available_tickets, users=users)
+    return render_template('tasks/create_task.html', users=users, picker_page_size=PICKER_PAGE_SIZE)
 
 
 @tasks_bp.route('/task/<int:task_id>')
@@ -784,9 +691,8 @@ def process_scan(task_ticket_id):
         )
         db.session.add(scan)
         
-        # Update progress
+        # Update progress (i contatori del task seguono al flush, services.task_progress)
         task_ticket.update_scan_progress()
-        task_ticket.task.update_progress()
         
         # Check if ticket is completed
         remaining_lines = [line for line in ticket_lines if line.IdLineaTicket not in scanned_line_ids + [current_line.IdLineaTicket]]
@@ -798,7 +704,6 @@ def process_scan(task_ticket_id):
             
             # Check if there are more tickets in the task
             task = task_ticket.task
-            task.update_progress()
             
             # Find next ticket in task
             next_ticket = TaskTicket.query.filter(
@@ -891,7 +796,6 @@ def scan_ticket(task_ticket_id):
             task_ticket.status = 'completed'
             task_ticket.completed_at = datetime.utcnow()
             task_ticket.update_scan_progress()
-            task.update_progress()
             db.session.commit()
         
         # Find next incomplete ticket in the task
@@ -942,252 +846,90 @@ def api_scan_product():
     try:
         # Check if request has JSON data
         if not request.is_json:
-            current_app.logger.error("Request is not JSON")
             return jsonify({'success': False, 'message': 'Richiesta deve essere in formato JSON'}), 400
         
         data = request.get_json()
         if not data:
-            current_app.logger.error("No JSON data received")
             return jsonify({'success': False, 'message': 'Nessun dato ricevuto'}), 400
         
         task_ticket_id = data.get('task_ticket_id')
         scanned_code = data.get('scanned_code')
         ticket_line_id = data.get('ticket_line_id')
         
-        current_app.logger.info(f"🔍 Scan request: task_ticket_id={task_ticket_id}, scanned_code={scanned_code}")
-        
         if not task_ticket_id:
-            current_app.logger.error("Missing task_ticket_id")
             return jsonify({'success': False, 'message': 'ID ticket task mancante'}), 400
         
         if not scanned_code:
-            current_app.logger.error("Missing scanned_code")
             return jsonify({'success': False, 'message': 'Codice scansionato mancante'}), 400
         
-        task_ticket = TaskTicket.query.get_or_404(task_ticket_id)
+        try:
+            ticket_line_id = int(ticket_line_id) if ticket_line_id else None
+        except (TypeError, ValueError):
+            ticket_line_id = None
+        
+        # Riga del task_ticket bloccata fino al commit: le scansioni concorrenti dello stesso ticket si mettono in fila
+        locked = lock_task_ticket(task_ticket_id)
+        if locked is None:
+            db.session.rollback()
+            return jsonify({'success': False, 'message': 'Ticket task non trovato'}), 404
+        task_ticket, task = locked
         
         # Check permissions
-        if not current_user.is_admin and task_ticket.task.assigned_to != current_user.id:
+        if not current_user.is_admin and task.assigned_to != current_user.id:
+            db.session.rollback()
             return jsonify({'success': False, 'message': 'Permesso negato'}), 403
         
-        # Get the ticket line if specified
-        ticket_line = None
-        if ticket_line_id:
-            try:
-                ticket_line = TicketLine.query.get(ticket_line_id)
-                current_app.logger.info(f"🔍 Ticket line lookup: ID={ticket_line_id}, Found={ticket_line is not None}")
-                if ticket_line:
-                    current_app.logger.info(f"📋 Ticket line details: IdLineaTicket={ticket_line.IdLineaTicket}, IdTicket={ticket_line.IdTicket}, IdArticulo={getattr(ticket_line, 'IdArticulo', 'MISSING')}")
-                    current_app.logger.info(f"🔬 Ticket line type: {type(ticket_line)}")
-                    current_app.logger.info(f"🔬 Ticket line attributes: {dir(ticket_line)}")
-                else:
-                    current_app.logger.warning(f"❌ Ticket line not found for ID: {ticket_line_id}")
-            except Exception as e:
-                current_app.logger.error(f"❌ Error retrieving ticket line {ticket_line_id}: {str(e)}")
-                ticket_line = None
+        outcome = scan_task_ticket(task_ticket, task, scanned_code, ticket_line_id, current_user)
         
-        # Parse QR code using warehouse format: NumTicket(4)-IdArticolo(4)-Peso(5)-Timestamp(14)
-        try:
-            if not (scanned_code.isdigit() and len(scanned_code) == 27):
-                raise ValueError("Invalid QR code format - expected 27 digits")
-            
-            # Parse the QR components
-            ticket_num = int(scanned_code[:4])           # First 4 digits = NumTicket
-            product_id = int(scanned_code[4:8])          # Next 4 digits = IdArticulo
-            weight = int(scanned_code[8:13]) / 1000.0    # Next 5 digits = Peso (in grams, convert to kg)
-            
-            # Parse timestamp - format: DDMMYYYYHHMMSS
-            timestamp_str = scanned_code[13:27]
-            day = timestamp_str[0:2]
-            month = timestamp_str[2:4]
-            year = timestamp_str[4:8]
-            hour = timestamp_str[8:10]
-            minute = timestamp_str[10:12]
-            second = timestamp_str[12:14]
-            
-            formatted_date = f"{day}/{month}/{year}"
-            formatted_time = f"{hour}:{minute}:{second}"
-            
-            # Convert timestamp to datetime object for verification
-            try:
-                from datetime import datetime
-                timestamp_dt = datetime.strptime(timestamp_str, "%d%m%Y%H%M%S")
-            except ValueError:
-                timestamp_dt = None
-                
-        except (ValueError, IndexError) as e:
-            # Create failed scan record
-            scan_result = TaskTicketScan(
-                task_ticket_id=task_ticket_id,
-                ticket_line_id=ticket_line_id,
-                scanned_by=current_user.id,
-                scanned_code=scanned_code,
-                status='error',
-                error_message='Formato QR code non valido - attesi 27 caratteri numerici'
-            )
-            db.session.add(scan_result)
-            db.session.commit()
-            
+        qr = outcome.qr
+        if qr is None:
             return jsonify({
                 'success': False, 
                 'message': 'QR code non valido. Formato atteso: 27 cifre numeriche.'
             })
         
-        # Verify the scanned ticket matches the expected ticket
-        success = False
-        error_message = None
-        status = 'error'
-        
-        # Get the expected ticket number from task_ticket
-        expected_ticket = task_ticket.ticket
-        expected_ticket_num = expected_ticket.NumTicket
-        
-        # Check if ticket number matches
-        if ticket_num != expected_ticket_num:
-            success = False
-            status = 'ticket_mismatch'
-            error_message = f'Ticket non corrispondente. Atteso: #{expected_ticket_num}, Scansionato: #{ticket_num}'
-        else:
-            # Ticket number matches, now check product
-            if ticket_line_id and ticket_line:
-                # Specific product line selected - verify exact match
-                if hasattr(ticket_line, 'IdArticulo') and ticket_line.IdArticulo == product_id:
-                    # Perfect match: correct ticket and correct product
-                    success = True
-                    status = 'success'
-                else:
-                    # Correct ticket but wrong product for this specific line
-                    success = False
-                    status = 'product_mismatch'
-                    if hasattr(ticket_line, 'IdArticulo'):
-                        error_message = f'Prodotto non corrispondente. Atteso: {ticket_line.IdArticulo}, Scansionato: {product_id}'
-                    else:
-                        error_message = f'Prodotto non corrispondente. Scansionato: {product_id}'
-            else:
-                # No specific product line selected - verify product exists in this ticket
-                ticket_has_product = TicketLine.query.filter_by(
-                    IdTicket=expected_ticket.IdTicket,
-                    IdArticulo=product_id
-                ).first()
-                
-                if ticket_has_product:
-                    # Found the product in this ticket
-                    success = True
-                    status = 'success'
-                    # Update ticket_line_id to the found line for proper record keeping
-                    ticket_line_id = ticket_has_product.IdLineaTicket
-                    ticket_line = ticket_has_product
-                else:
-                    success = False
-                    status = 'product_not_in_ticket'
-                    error_message = f'Prodotto {product_id} non presente nel ticket #{ticket_num}'
-        
-        # Create scan record with detailed information
-        scan_result = TaskTicketScan(
-            task_ticket_id=task_ticket_id,
-            ticket_line_id=ticket_line_id,
-            product_id=product_id if success else None,
-            scanned_by=current_user.id,
-            scanned_code=scanned_code,
-            status=status,
-            error_message=error_message,
-            # Store additional scan data
-            weight_scanned=weight,
-            expected_code=f"{expected_ticket_num:04d}{ticket_line.IdArticulo if ticket_line and hasattr(ticket_line, 'IdArticulo') else '????'}"
-        )
-        db.session.add(scan_result)
-        
-        # Update progress
-        task_ticket.update_scan_progress()
-        task_ticket.task.update_progress()
-        
-        # Check if this specific ticket within the task is now fully verified
-        ticket_completed = False
-        next_ticket_id = None
-        task_completed = False
-        
-        if success:
-            # Check if current ticket is now completed
-            if task_ticket.status == 'completed':
-                ticket_completed = True
-                # Update ticket status to Enviado = 10 (completed in task)
-                expected_ticket.Enviado = 10
-                current_app.logger.info(f"✅ Ticket #{expected_ticket_num} completato - impostato Enviado = 10")
-                
-                # Find next incomplete ticket in the task
-                all_task_tickets = TaskTicket.query.filter_by(task_id=task_ticket.task_id).order_by(TaskTicket.id).all()
-                next_ticket = None
-                for tt in all_task_tickets:
-                    if tt.status != 'completed' and tt.id != task_ticket.id:
-                        next_ticket = tt
-                        break
-                
-                if next_ticket:
-                    next_ticket_id = next_ticket.id
-                else:
-                    # All tickets completed - mark task as completed
-                    task_ticket.task.status = 'completed'
-                    task_ticket.task.completed_at = datetime.utcnow()
-                    task_completed = True
-                    
-                    # Create notification for admin
-                    notification = TaskNotification(
-                        task_id=task_ticket.task.id_task,
-                        user_id=task_ticket.task.created_by,
-                        notification_type='task_completed',
-                        title=f'✅ Task Completato: {task_ticket.task.task_number}',
-                        message=f'Il task "{task_ticket.task.title}" è stato completato al 100% da {current_user.username} alle {datetime.utcnow().strftime("%H:%M")}.'
-                    )
-                    db.session.add(notification)
-        
-        db.session.commit()
+        scan_details = {
+            'ticket_number': qr.ticket_num,
+            'product_id': qr.product_id,
+            'weight': qr.weight_kg,
+            'scan_date': qr.scan_date,
+            'scan_time': qr.scan_time
+        }
         
-        if success:
-            success_message = f'✅ Ticket #{ticket_num} - Prodotto {product_id} verificato!'
-            if weight > 0:
-                success_message += f' Peso: {weight:.3f}kg'
+        if outcome.success:
+            success_message = f'✅ Ticket #{qr.ticket_num} - Prodotto {qr.product_id} verificato!'
+            if qr.weight_kg > 0:
+                success_message += f' Peso: {qr.weight_kg:.3f}kg'
             
             response_data = {
                 'success': True, 
                 'message': success_message,
-                'scan_id': scan_result.id,
+                'scan_id': outcome.scan_id,
                 'ticket_verified': True,
                 'product_verified': True,
-                'ticket_completed': ticket_completed,
-                'task_completed': task_completed,
-                'next_ticket_id': next_ticket_id,
-                'scan_details': {
-                    'ticket_number': ticket_num,
-                    'product_id': product_id,
-                    'weight': weight,
-                    'scan_date': formatted_date,
-                    'scan_time': formatted_time
-                }
+                'ticket_completed': outcome.ticket_completed,
+                'task_completed': outcome.task_completed,
+                'next_ticket_id': outcome.next_ticket_id,
+                'scan_details': scan_details
             }
             
-            if ticket_completed and next_ticket_id:
+            if outcome.ticket_completed and outcome.next_ticket_id:
                 response_data['message'] += f' Passaggio al prossimo ticket...'
-            elif task_completed:
-                response_data['message'] = f'🎉 Task {task_ticket.task.task_number} completato!'
+            elif outcome.task_completed:
+                response_data['message'] = f'🎉 Task {task.task_number} completato!'
             
             return jsonify(response_data)
         else:
+            scan_details['expected_ticket'] = outcome.expected_ticket_num
             return jsonify({
                 'success': False, 
-                'message': error_message or 'Errore nella verifica del QR code.',
-                'scan_id': scan_result.id,
-                'ticket_verified': status != 'ticket_mismatch',
+                'message': outcome.message or 'Errore nella verifica del QR code.',
+                'scan_id': outcome.scan_id,
+                'ticket_verified': outcome.status != 'ticket_mismatch',
                 'product_verified': False,
                 'ticket_completed': False,
                 'task_completed': False,
-                'scan_details': {
-                    'ticket_number': ticket_num,
-                    'product_id': product_id,
-                    'weight': weight,
-                    'scan_date': formatted_date,
-                    'scan_time': formatted_time,
-                    'expected_ticket': expected_ticket_num
-                }
+                'scan_details': scan_details
             })
     
     except Exception as e:
@@ -1217,27 +959,39 @@ def complete_task(task_id):
         return redirect(url_for('tasks.view_task', task_id=task_id))
     
     # Get additional data for manual tickets and discounts
+    draft_id = request.form.get('draft_id')  # Bozza dell'anteprima (services.ddt_preview)
     manual_tickets_data = request.form.get('manual_tickets')
     ticket_discounts_data = request.form.get('ticket_discounts')
     note = request.form.get('note')
     
-    # Parse manual tickets and discounts data
-    try:
-        manual_tickets = json.loads(manual_tickets_data) if manual_tickets_data else []
-        ticket_discounts = json.loads(ticket_discounts_data) if ticket_discounts_data else {}
-    except json.JSONDecodeError:
-        flash('Formato dati ticket manuali non valido', 'error')
-        return redirect(url_for('tasks.view_task', task_id=task_id))
+    draft = None
+    if draft_id:
+        draft = load_draft(draft_id, current_user.id)
+        if draft is None:
+            flash('Anteprima DDT scaduta o già utilizzata: riapri il preview dal task.', 'error')
+            return redirect(url_for('tasks.view_task', task_id=task_id))
+        manual_tickets = draft.manual_tickets()
+        ticket_discounts = draft.discounts
+    else:
+        # Parse manual tickets and discounts data
+        try:
+            manual_tickets = json.loads(manual_tickets_data) if manual_tickets_data else []
+            ticket_discounts = json.loads(ticket_discounts_data) if ticket_discounts_data else {}
+        except json.JSONDecodeError:
+            flash('Formato dati ticket manuali non valido', 'error')
+            return redirect(url_for('tasks.view_task', task_id=task_id))
     
     try:
         # Generate DDT with manual tickets and discounts
-        ddt_id = generate_ddt_from_task(task, int(client_id), manual_tickets, ticket_discounts, note)
+        ddt_id, ticket_ids = generate_ddt_from_task(task, int(client_id), manual_tickets, ticket_discounts, note, draft)
         
         task.ddt_generated = True
         task.ddt_id = ddt_id
         task.client_id = int(client_id)
         
         db.session.commit()
+        # Le risoluzioni in cache hanno ancora il vecchio Enviado
+        invalidate_tickets(ticket_ids)
         
         flash(f'DDT generato! ID: {ddt_id}', 'success')
         return redirect(url_for('ddt.detail', ddt_id=ddt_id))
@@ -1248,8 +1002,12 @@ def complete_task(task_id):
         return redirect(url_for('tasks.view_task', task_id=task_id))
 
 
-def generate_ddt_from_task(task, client_id, manual_tickets=None, ticket_discounts=None, note=None):
-    """Generate a DDT (Documento di Trasporto) from completed task"""
+def generate_ddt_from_task(task, client_id, manual_tickets=None, ticket_discounts=None, note=None, draft=None):
+    """Generate a DDT (Documento di Trasporto) from completed task; returns (DDT id, ticket ids).
+
+    draft (services.ddt_preview) is consumed in the same transaction.
+    The caller commits, then invalidates the scan cache of the ticket ids.
+    """
     client = Client.query.get(client_id)
     if not client:
         raise ValueError("Cliente non trovato")
@@ -1262,19 +1020,18 @@ def generate_ddt_from_task(task, client_id, manual_tickets=None, ticket_discount
     
     # Ensure custom product exists for manual tickets
     if manual_tickets:
-        from ddt import ensure_custom_product_exists
+        from modules.ddt import ensure_custom_product_exists
         ensure_custom_product_exists()
+
+    if draft is not None:
+        # Consumata nella transazione del DDT: un secondo invio della stessa bozza fallisce qui
+        consume_draft(draft)
     
     # Create DDT header
     company = Company.query.first()
     
-    # Get next DDT ID using the same logic as ddt.py
-    max_id = db.session.query(db.func.max(AlbaranCabecera.IdAlbaran)).scalar() or 0
-    next_id = max_id + 1
-    
-    # Get next DDT number (NumAlbaran)
-    max_num_albaran = db.session.query(db.func.max(AlbaranCabecera.NumAlbaran)).scalar() or 0
-    next_num = max_num_albaran + 1
+    # Get next DDT ID and number from the same atomic counter as ddt.py
+    next_id, next_num = next_ddt_numbers()
     
     ddt_header = AlbaranCabecera(
         # Use the calculated unique ID
@@ -1325,260 +1082,22 @@ def generate_ddt_from_task(task, client_id, manual_tickets=None, ticket_discount
     db.session.add(ddt_header)
     db.session.flush()  # Get the DDT ID
     
-    # Add lines from all task tickets
-    line_number = 1
-    total_amount = 0
-    total_without_vat = 0
-    total_vat = 0
-    
-    # PROCESS TASK TICKETS
-    for task_ticket in task.task_tickets:
-        for ticket_line in task_ticket.ticket.lines:
-            # Only add successfully scanned items
-            scan_result = task_ticket.scan_results.filter_by(
-                ticket_line_id=ticket_line.IdLineaTicket,
-                status='success'
-            ).first()
-            
-            if scan_result:
-                product = Product.query.get(ticket_line.IdArticulo)
-                
-                if not product:
-                    current_app.logger.warning(f"⚠️  Prodotto {ticket_line.IdArticulo} non trovato, riga saltata")
-                    continue
-                
-                # Determine VAT rate (same logic as ddt.py)
-                vat_rate = 0
-                if product.IdIva == 1:
-                    vat_rate = 0.04  # 4%
-                elif product.IdIva == 2:
-                    vat_rate = 0.10  # 10%
-                elif product.IdIva == 3:
-                    vat_rate = 0.22  # 22%
-                
-                # Calculate prices (same logic as ddt.py)
-                price_with_vat = float(product.PrecioConIVA) if product.PrecioConIVA is not None else 0.0
-                price_without_vat = price_with_vat / (1 + vat_rate) if vat_rate > 0 else price_with_vat
-                peso_value = float(ticket_line.Peso) if ticket_line.Peso is not None else 1.0
-                line_total = price_without_vat * peso_value
-                line_vat = line_total * vat_rate
-                
-                # Apply ticket discount if present
-                ticket_id_str = str(task_ticket.ticket_id)
-                ticket_discount = float(ticket_discounts.get(ticket_id_str, 0))
-                if ticket_discount > 0:
-                    discount_factor = 1 - (ticket_discount / 100)
-                    line_total = line_total * discount_factor
-                    line_vat = line_vat * discount_factor
-                    current_app.logger.info(f"💰 Applicato sconto {ticket_discount}% al ticket {task_ticket.ticket_id}")
-                    current_app.logger.info(f"   Totale scontato: {line_total:.2f}, IVA scontata: {line_vat:.2f}")
-                
-                # Get product article info
-                product_article = Article.query.get(product.IdArticulo)
-                
-                ddt_line = AlbaranLinea(
-                    IdAlbaran=ddt_header.IdAlbaran,
-                    IdLineaAlbaran=line_number,
-                    IdEmpresa=ddt_header.IdEmpresa,
-                    IdTienda=ddt_header.IdTienda,
-                    IdBalanzaMaestra=ddt_header.IdBalanzaMaestra,
-                    IdBalanzaEsclava=ddt_header.IdBalanzaEsclava,
-                    TipoVenta=ddt_header.TipoVenta,
-                    EstadoLinea=0,  # Default value
-                    IdTicket=task_ticket.ticket_id,  # Reference to the original ticket
-                    IdArticulo=ticket_line.IdArticulo,
-                    Descripcion=ticket_line.Descripcion or product.Descripcion,
-                    Descripcion1=getattr(product_article, 'Descripcion1', '') if product_article else '',
-                    Comportamiento=getattr(ticket_line, 'comportamiento', 0),
-                    ComportamientoDevolucion=getattr(ticket_line, 'comportamiento_devolucion', 0),
-                    EntradaManual=0,  # Default value
-                    Tara=0,  # Default value
-                    Peso=peso_value,
-                    Medida2="un",  # Default unit
-                    PrecioPorCienGramos=0,  # Default value
-                    Precio=0.0,  # Will be calculated if needed
-                    PrecioSinIVA=price_without_vat,  # FIXED: Calculate price without VAT
-                    IdIVA=product.IdIva,  # FIXED: Set VAT ID from product
-                    PorcentajeIVA=vat_rate * 100,  # FIXED: Calculate VAT percentage
-                    RecargoEquivalencia=0,  # Default value
-                    Descuento=ticket_discount if ticket_discount > 0 else 0.0,  # Apply discount
-                    TipoDescuento=1,  # Default discount type
-                    Importe=line_total + line_vat,  # Total amount with VAT
-                    ImporteSinOferta=None,
-                    ImporteSinIVASinDtoL=line_total,  # FIXED: Amount without VAT
-                    ImporteConIVASinDtoL=None,
-                    ImporteSinIVAConDtoL=line_total,  # FIXED: Amount without VAT after discount
-                    ImporteDelIVAConDtoL=line_vat,  # FIXED: VAT amount
-                    ImporteSinIVAConDtoLConDtoTotal=line_total,
-                    ImporteDelIVAConDtoLConDtoTotal=line_vat,
-                    ImporteDelRE=0,
-                    ImporteDelDescuento=line_total * (ticket_discount / 100) if ticket_discount > 0 else 0,
-                    ImporteConDtoTotal=line_total + line_vat,
-                    FechaCaducidad=ticket_line.FechaCaducidad,
-                    # Additional product info fields (same as ddt.py)
-                    IdClase=getattr(product_article, 'IdClase', None) if product_article else None,
-                    NombreClase="ARTICOLI",  # Default class name
-                    IdFamilia=product.IdFamilia,
-                    NombreFamilia="",  # To be populated if available
-                    IdSeccion=getattr(product_article, 'IdSeccion', None) if product_article else None,
-                    IdSubFamilia=product.IdSubFamilia,
-                    IdDepartamento=getattr(product_article, 'IdDepartamento', None) if product_article else None,
-                    Texto1=getattr(ticket_line, 'Texto1', '') or (getattr(product_article, 'Texto1', '') if product_article else ''),
-                    Facturada=0,  # Not invoiced yet
-                    CantidadFacturada=0,  # Default value
-                    CantidadFacturada2=0,  # Default value
-                    HayTaraAplicada=0,  # No tare applied
-                    Modificado=1,  # Modified flag
-                    Operacion="A",  # Add operation
-                    Usuario=current_user.username,
-                    TimeStamp=datetime.utcnow()
-                )
-                db.session.add(ddt_line)
-                
-                # Accumulate totals (same logic as ddt.py)
-                total_without_vat += line_total
-                total_vat += line_vat
-                total_amount += (line_total + line_vat)
-                line_number += 1
-                
-                current_app.logger.info(f"📝 DDT da Task - Linea {line_number-1}: {ticket_line.Descripcion}")
-                current_app.logger.info(f"   Prezzo senza IVA: €{price_without_vat:.2f}, IVA {vat_rate*100:.0f}%: €{line_vat:.2f}, Totale: €{line_total + line_vat:.2f}")
-    
-    # PROCESS MANUAL TICKETS (same logic as ddt.py)
-    for manual_ticket in manual_tickets:
-        current_app.logger.info(f"✋ DEBUG: Elaborazione ticket manuale {manual_ticket['id_ticket']}")
-        
-        # Create DDT lines directly for manual tickets
-        for ticket_line in manual_ticket['lines']:
-            line_number += 1
-            
-            # Calculate VAT rate
-            id_iva = ticket_line.get('id_iva', 3)  # Default 22%
-            vat_rate = 0
-            if id_iva == 1:
-                vat_rate = 0.04  # 4%
-            elif id_iva == 2:
-                vat_rate = 0.10  # 10%
-            elif id_iva == 3:
-                vat_rate = 0.22  # 22%
-            
-            # Calculate prices
-            price_with_vat = float(ticket_line['precio'])
-            price_without_vat = price_with_vat / (1 + vat_rate) if vat_rate > 0 else price_with_vat
-            peso_value = float(ticket_line['peso'])
-            line_total = price_without_vat * peso_value
-            line_vat = line_total * vat_rate
-            
-            # Apply discount for manual ticket if present
-            manual_ticket_id_str = str(manual_ticket['id_ticket'])
-            ticket_discount = float(ticket_discounts.get(manual_ticket_id_str, 0))
-            if ticket_discount > 0:
-                discount_factor = 1 - (ticket_discount / 100)
-                line_total = line_total * discount_factor
-                line_vat = line_vat * discount_factor
-                current_app.logger.info(f"💰 Applicato sconto {ticket_discount}% al ticket manuale {manual_ticket['id_ticket']}")
-                current_app.logger.info(f"   Totale scontato: {line_total:.2f}, IVA scontata: {line_vat:.2f}")
-            
-            # Create DDT line for manual ticket
-            albaran_line = AlbaranLinea()
-            albaran_line.IdLineaAlbaran = line_number
-            albaran_line.IdEmpresa = ddt_header.IdEmpresa
-            albaran_line.IdTienda = ddt_header.IdTienda
-            albaran_line.IdBalanzaMaestra = ddt_header.IdBalanzaMaestra
-            albaran_line.IdBalanzaEsclava = ddt_header.IdBalanzaEsclava
-            albaran_line.IdAlbaran = ddt_header.IdAlbaran
-            albaran_line.TipoVenta = ddt_header.TipoVenta
-            
-            # For manual tickets, use special ID or NULL
-            albaran_line.IdTicket = None  # Manual ticket has no real ticket ID
-            
-            # Product data from manual ticket
-            albaran_line.IdArticulo = 999  # Custom product ID
-            albaran_line.Descripcion = ticket_line['descripcion']
-            albaran_line.Descripcion1 = "Prodotto manuale"
-            albaran_line.Comportamiento = ticket_line.get('comportamiento', 1)
-            albaran_line.ComportamientoDevolucion = 0
-            
-            # Weights and quantities
-            albaran_line.Peso = peso_value
-            albaran_line.Medida2 = "un"  # Default unit
-            
-            # Prices and VAT
-            albaran_line.Precio = 0.0  # Will be calculated if needed
-            albaran_line.PrecioSinIVA = price_without_vat
-            albaran_line.IdIVA = id_iva
-            albaran_line.PorcentajeIVA = vat_rate * 100
-            albaran_line.RecargoEquivalencia = 0.0
-            
-            # Amounts
-            albaran_line.Importe = line_total + line_vat
-            albaran_line.ImporteSinIVASinDtoL = line_total
-            albaran_line.ImporteDelIVAConDtoL = line_vat
-            
-            # Additional info for manual tickets
-            albaran_line.IdClase = None
-            albaran_line.NombreClase = "ARTICOLI"  # Default like the example
-            albaran_line.IdFamilia = None
-            albaran_line.NombreFamilia = ""
-            albaran_line.IdSeccion = None
-            albaran_line.IdSubFamilia = None
-            albaran_line.IdDepartamento = None
-            albaran_line.Texto1 = ""
-            
-            # Default fields
-            albaran_line.EstadoLinea = 0
-            albaran_line.EntradaManual = 1  # Mark as manual entry
-            albaran_line.Tara = 0.0
-            albaran_line.PrecioPorCienGramos = 0
-            albaran_line.Descuento = ticket_discount if ticket_discount > 0 else 0.0
-            albaran_line.TipoDescuento = 1
-            albaran_line.Facturada = 0
-            albaran_line.CantidadFacturada = 0.0
-            albaran_line.CantidadFacturada2 = 0.0
-            albaran_line.HayTaraAplicada = 0
-            albaran_line.Modificado = 1
-            albaran_line.Operacion = "A"
-            albaran_line.Usuario = current_user.username
-            albaran_line.TimeStamp = datetime.utcnow()
-            
-            # Add calculated fields for manual ticket
-            albaran_line.ImporteSinIVAConDtoL = line_total
-            albaran_line.ImporteSinIVAConDtoLConDtoTotal = line_total
-            albaran_line.ImporteDelIVAConDtoLConDtoTotal = line_vat
-            albaran_line.ImporteDelRE = 0
-            albaran_line.ImporteDelDescuento = line_total * (ticket_discount / 100) if ticket_discount > 0 else 0
-            albaran_line.ImporteConDtoTotal = line_total + line_vat
-            
-            db.session.add(albaran_line)
-            
-            # Accumulate totals for manual tickets
-            total_without_vat += line_total
-            total_vat += line_vat
-            total_amount += (line_total + line_vat)
-            
-            current_app.logger.info(f"📝 DDT da Task - Linea manuale {line_number}: {ticket_line['descripcion']}")
-            current_app.logger.info(f"   Prezzo senza IVA: €{price_without_vat:.2f}, IVA {vat_rate*100:.0f}%: €{line_vat:.2f}, Totale: €{line_total + line_vat:.2f}")
+    # Lines of the scanned ticket lines and of the manual tickets (services.ddt_builder)
+    ticket_ids = [row[0] for row in db.session.query(TaskTicket.ticket_id).filter(
+        TaskTicket.task_id == task.id_task
+    ).order_by(TaskTicket.id).all()]
+    builder = DDTBuilder(ddt_header, current_user.username, ticket_discounts)
+    builder.add_tickets(ticket_ids, scanned_in_task=task.id_task)
+    builder.add_manual_tickets(manual_tickets)
+    line_count = builder.write()
     
-    # Update DDT totals (using calculated values)
-    ddt_header.ImporteLineas = total_amount
-    ddt_header.ImporteTotal = total_amount
-    ddt_header.ImporteTotalSinIVAConDtoL = total_without_vat
-    ddt_header.ImporteTotalDelIVAConDtoLConDtoTotal = total_vat
-    ddt_header.ImporteTotalSinIVAConDtoLConDtoTotal = total_without_vat
-    ddt_header.NumLineas = line_number - 1
+    # Update all tickets in this task to Enviado = 1 (processed/sent), one UPDATE
+    mark_processed(ticket_ids)
     
-    # Update all tickets in this task to Enviado = 1 (processed/sent)
-    # This marks them as completed and sent via DDT
-    for task_ticket in task.task_tickets:
-        ticket = task_ticket.ticket
-        ticket.Enviado = 1  # Set to processed/sent status
-        current_app.logger.info(f"📦 Ticket #{ticket.NumTicket} impostato come inviato (Enviado = 1) via DDT #{ddt_header.IdAlbaran}")
+    current_app.logger.info(f"✅ DDT #{ddt_header.IdAlbaran} generato da task con {line_count} linee")
+    current_app.logger.info(f"   Ticket task: {len(ticket_ids)}, Ticket manuali: {len(manual_tickets)}")
     
-    current_app.logger.info(f"✅ DDT #{ddt_header.IdAlbaran} generato da task con {line_number - 1} linee")
-    current_app.logger.info(f"   Ticket task: {task.task_tickets.count()}, Ticket manuali: {len(manual_tickets)}")
-    current_app.logger.info(f"   Totale senza IVA: €{total_without_vat:.2f}, IVA: €{total_vat:.2f}, Totale: €{total_amount:.2f}")
-    
-    return ddt_header.IdAlbaran
+    return ddt_header.IdAlbaran, ticket_ids
 
 
 @tasks_bp.route('/notifications')
@@ -1673,8 +1192,6 @@ def api_get_task_progress(task_id):
     if not current_user.is_admin and task.assigned_to != current_user.id:
         return jsonify({'error': 'Unauthorized'}), 403
     
-    task.update_progress()
-    
     return jsonify({
         'task_id': task.id_task,
         'total_tickets': task.total_tickets,
@@ -1685,31 +1202,131 @@ def api_get_task_progress(task_id):
     })
 
 
+def workspace_task(task_id):
+    """Task of the workspace endpoints, or an error response for the current user"""
+    task = db.session.get(Task, task_id)
+    if task is None:
+        return None, (jsonify({'error': 'Task non trovato'}), 404)
+    if not current_user.is_admin and task.assigned_to != current_user.id:
+        return None, (jsonify({'error': 'Unauthorized'}), 403)
+    return task, None
+
+
+@tasks_bp.route('/api/tasks/<int:task_id>/workspace')
+@login_required
+def api_task_workspace(task_id):
+    """Whole task (tickets, lines, scan state) for the handheld scanner, supports If-None-Match"""
+    task, error = workspace_task(task_id)
+    if error:
+        return error
+    
+    response = jsonify(build_workspace(task))
+    response.add_etag()
+    # Lo scanner rivalida a ogni riapertura: se nulla è cambiato riceve un 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+@tasks_bp.route('/api/tasks/<int:task_id>/workspace/delta')
+@login_required
+def api_task_workspace_delta(task_id):
+    """Ticket states and lines verified after ?since=<cursor>"""
+    task, error = workspace_task(task_id)
+    if error:
+        return error
+    return jsonify(workspace_delta(task, request.args.get('since', 0, type=int)))
+
+
+@tasks_bp.route('/api/tasks/<int:task_id>/workspace/scans', methods=['POST'])
+@login_required
+def api_task_workspace_sync(task_id):
+    """Batch of scans verified offline by the handheld: {"scans": [...], "since": cursor}"""
+    task, error = workspace_task(task_id)
+    if error:
+        return error
+    
+    data = request.get_json(silent=True) or {}
+    scans = data.get('scans')
+    if not isinstance(scans, list):
+        return jsonify({'error': 'Lista "scans" mancante'}), 400
+    if len(scans) > MAX_SYNC_ITEMS:
+        return jsonify({'error': f'Troppe scansioni: massimo {MAX_SYNC_ITEMS} per richiesta'}), 400
+    # Validato prima di applicare le scansioni: dopo i commit di sync_scans un 400 le farebbe reinviare
+    try:
+        since = max(int(data.get('since') or 0), 0)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Cursore "since" non valido'}), 400
+    
+    try:
+        return jsonify(sync_scans(task, scans, current_user, since=since))
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Error syncing workspace scans for task {task_id}: {str(e)}")
+        return jsonify({'error': 'Unable to sync scans'}), 500
+
+
+@tasks_bp.route('/api/ticket-picker')
+@admin_required
+def api_ticket_picker():
+    """Paginated, filtered available tickets (Enviado=0) for the task creation form"""
+    try:
+        result = picker_page(
+            page=request.args.get('page', 1, type=int),
+            per_page=request.args.get('per_page', PICKER_PAGE_SIZE, type=int),
+            sort=request.args.get('sort', 'date_desc'),
+            search=request.args.get('search', ''),
+            expiry=request.args.get('expiry'),
+            date_from=request.args.get('date_from'),
+            date_to=request.args.get('date_to'),
+            min_quantity=request.args.get('min_quantity', type=float),
+            max_quantity=request.args.get('max_quantity', type=float)
+        )
+        return jsonify(result)
+        
+    except Exception as e:
+        current_app.logger.error(f"Error fetching ticket picker page: {str(e)}")
+        return jsonify({'error': 'Unable to fetch tickets'}), 500
+
+
+@tasks_bp.route('/api/ticket-picker/lines')
+@admin_required
+def api_ticket_picker_lines():
+    """Lines of a batch of tickets (?ids=1,2,3), loaded after the picker page"""
+    try:
+        ticket_ids = [int(value) for value in request.args.get('ids', '').split(',') if value.strip().isdigit()]
+        lines = picker_lines(ticket_ids)
+        return jsonify({str(ticket_id): ticket_lines for ticket_id, ticket_lines in lines.items()})
+        
+    except Exception as e:
+        current_app.logger.error(f"Error fetching ticket picker lines: {str(e)}")
+        return jsonify({'error': 'Unable to fetch ticket lines'}), 500
+
+
 @tasks_bp.route('/api/available-tickets')
 @login_required
 def api_available_tickets():
-    """Get list of available tickets (Enviado=0) as JSON"""
+    """Get list of available tickets (Enviado=0) as JSON, one page at a time"""
     try:
-        tickets = TicketHeader.query.filter_by(Enviado=0).order_by(desc(TicketHeader.Fecha)).all()
+        result = picker_page(
+            page=request.args.get('page', 1, type=int),
+            per_page=request.args.get('per_page', PICKER_MAX_PAGE_SIZE, type=int)
+        )
         
         tickets_data = []
-        for ticket in tickets:
-            # Calculate formatted date
-            formatted_date = ticket.Fecha.strftime('%d/%m/%Y %H:%M') if ticket.Fecha else 'N/A'
-            
-            # Get ticket lines for preview
-            lines_count = TicketLine.query.filter_by(IdTicket=ticket.IdTicket).count()
-            
+        for ticket in result['items']:
+            barcode = ticket['barcode']
             tickets_data.append({
-                'IdTicket': ticket.IdTicket,
-                'NumTicket': ticket.NumTicket,
-                'Fecha': formatted_date,
-                'NumLineas': lines_count,
-                'CodigoBarras': ticket.CodigoBarras[:30] + '...' if ticket.CodigoBarras and len(ticket.CodigoBarras) > 30 else ticket.CodigoBarras,
-                'Enviado': ticket.Enviado
+                'IdTicket': ticket['id'],
+                'NumTicket': ticket['number'],
+                'Fecha': ticket['formatted_date'],
+                'NumLineas': ticket['line_count'],
+                'CodigoBarras': barcode[:30] + '...' if barcode and len(barcode) > 30 else barcode,
+                'Enviado': 0
             })
         
-        return jsonify(tickets_data)
+        response = jsonify(tickets_data)
+        response.headers['X-Total-Count'] = str(result['total'])
+        return response
         
     except Exception as e:
         current_app.logger.error(f"Error fetching available tickets: {str(e)}")
@@ -1723,52 +1340,18 @@ def delete_task(task_id):
     task = Task.query.get_or_404(task_id)
     
     try:
-        # Get all task tickets before deletion
-        task_tickets = TaskTicket.query.filter_by(task_id=task_id).all()
-        
-# Check if DDT was already generated from this task
-        if task.ddt_generated and task.ddt_id:
-            # DDT already generated - DO NOT reset ticket status
-            # Tickets must remain Enviado = 1 (processed) because they're already in a DDT
-            current_app.logger.info(f"Task {task.task_number} had DDT #{task.ddt_id} generated - keeping tickets as processed (Enviado = 1)")
-            tickets_reset = 0
-            
-            # Just log which tickets are being preserved
-            for task_ticket in task_tickets:
-                ticket = TicketHeader.query.get(task_ticket.ticket_id)
-                if ticket:
-                    current_app.logger.info(f"Preserving Ticket #{ticket.NumTicket} status (Enviado = {ticket.Enviado}) - already in DDT #{task.ddt_id}")
-        else:
-            # No DDT generated - safe to reset tickets to Enviado=0
-            tickets_reset = 0
-            for task_ticket in task_tickets:
-                ticket = TicketHeader.query.get(task_ticket.ticket_id)
-                if ticket:
-                    ticket.Enviado = 0
-                    tickets_reset += 1
-                    current_app.logger.info(f"Reset Ticket #{ticket.NumTicket} to Enviado = 0 (task deleted before DDT generation)")
-        
-        # Delete task notifications
-        TaskNotification.query.filter_by(task_id=task_id).delete()
-        
-        # Delete task ticket scans
-        for task_ticket in task_tickets:
-            TaskTicketScan.query.filter_by(task_ticket_id=task_ticket.id).delete()
-        
-        # Delete task tickets
-        TaskTicket.query.filter_by(task_id=task_id).delete()
-        
-        # Delete the task
         task_number = task.task_number
-        db.session.delete(task)
+        ddt_id = task.ddt_id if task.ddt_generated else None
         
-        db.session.commit()
+        # Ticket rimessi in Giacenza con un solo UPDATE, tranne se il task ha già un DDT
+        # (restano Enviado = 1); scansioni e notifiche cancellate a blocchi (services.task_cleanup)
+        result = delete_tasks([task_id])
         
-# Different success messages based on DDT status
-        if task.ddt_generated and task.ddt_id:
-            flash(f'Task {task_number} eliminato. Ticket preservati (DDT #{task.ddt_id}).', 'success')
+        # Different success messages based on DDT status
+        if ddt_id:
+            flash(f'Task {task_number} eliminato. Ticket preservati (DDT #{ddt_id}).', 'success')
         else:
-            flash(f'Task {task_number} eliminato. {tickets_reset} ticket disponibili.', 'success')
+            flash(f'Task {task_number} eliminato. {result["tickets_released"]} ticket disponibili.', 'success')
         return redirect(url_for('tasks.admin_dashboard'))
         
     except Exception as e:
@@ -1806,16 +1389,14 @@ def remove_ticket_from_task():
             current_app.logger.info(f"Reset Ticket #{ticket.NumTicket} to Enviado = 0 (removed from task before DDT generation)")
         
         # Delete associated scans
+        flush_audit_buffer()  # scansioni ancora nel buffer di scrittura
         TaskTicketScan.query.filter_by(task_ticket_id=task_ticket_id).delete()
         
         # Remove the task ticket
         ticket_number = task_ticket.ticket.NumTicket
         db.session.delete(task_ticket)
         
-        # Update task progress
-        task.update_progress()
-        
-        # Check if the task has no more tickets after removal
+        # Check if the task has no more tickets after removal (il flush aggiorna i contatori)
         remaining_tickets_count = TaskTicket.query.filter_by(task_id=task_id).count()
         
         if remaining_tickets_count == 0:
@@ -1903,39 +1484,28 @@ def preview_ddt_from_task(task_id):
 @tasks_bp.route('/delete-all', methods=['POST'])
 @admin_required
 def delete_all_tasks():
-    """Delete all tasks and reset associated tickets to Enviado=0"""
+    """Delete all tasks and reset associated tickets to Enviado=0 (tasks with a DDT keep theirs)"""
     try:
-        # Get all tasks
-        all_tasks = Task.query.all()
-        total_tasks = len(all_tasks)
+        total_tasks, total_tickets = deletion_size()
         
         if total_tasks == 0:
             flash('Nessun task da eliminare.', 'info')
             return redirect(url_for('tasks.admin_dashboard'))
         
-        # Reset all associated tickets to Enviado=0
-        for task in all_tasks:
-            task_tickets = TaskTicket.query.filter_by(task_id=task.id_task).all()
-            for task_ticket in task_tickets:
-                ticket = TicketHeader.query.get(task_ticket.ticket_id)
-                if ticket:
-                    ticket.Enviado = 0
-        
-        # Delete all task notifications
-        TaskNotification.query.delete()
-        
-        # Delete all task ticket scans
-        TaskTicketScan.query.delete()
-        
-        # Delete all task tickets
-        TaskTicket.query.delete()
+        if cleanup_running():
+            flash('Un\'eliminazione dei task è già in corso.', 'warning')
+            return redirect(url_for('tasks.admin_dashboard'))
         
-        # Delete all tasks
-        Task.query.delete()
+        if needs_background(total_tasks, total_tickets):
+            # Molti task: eliminazione a gruppi in background, avanzamento su /tasks/delete-all/status
+            start_cleanup_job(current_app._get_current_object(), total_tasks=total_tasks,
+                              requested_by=current_user.id)
+            flash(f'Eliminazione di {total_tasks} task avviata in background.', 'info')
+            return redirect(url_for('tasks.admin_dashboard'))
         
-        db.session.commit()
+        result = delete_tasks()
         
-        flash(f'{total_tasks} task eliminati. Ticket disponibili.', 'success')
+        flash(f'{result["tasks"]} task eliminati. {result["tickets_released"]} ticket disponibili.', 'success')
         return redirect(url_for('tasks.admin_dashboard'))
         
     except Exception as e:
@@ -1945,6 +1515,57 @@ def delete_all_tasks():
         return redirect(url_for('tasks.admin_dashboard'))
 
 
+@tasks_bp.route('/delete-all/status')
+@admin_required
+def delete_all_tasks_status():
+    """Progress of the background deletion of tasks"""
+    job = get_cleanup_job()
+    if job is None:
+        return jsonify({'state': 'none'})
+    return jsonify(job)
+
+
+def analytics_range():
+    """(start, end, days) of the analytics report from ?date_from/date_to (default last 7 days)"""
+    days = min(max(request.args.get('days', 7, type=int), 1), 366)
+    end = datetime.utcnow()
+    start = end - timedelta(days=days)
+    try:
+        if request.args.get('date_from'):
+            start = datetime.strptime(request.args['date_from'], '%Y-%m-%d')
+        if request.args.get('date_to'):
+            # Include the entire day
+            end = datetime.strptime(request.args['date_to'], '%Y-%m-%d') + timedelta(days=1)
+    except ValueError:
+        pass
+    return start, end, days
+
+
+@tasks_bp.route('/analytics')
+@admin_required
+def analytics():
+    """Operator throughput and scan quality dashboard"""
+    start, end, days = analytics_range()
+    return render_template('tasks/analytics.html',
+                         report=analytics_report(start, end),
+                         days=days,
+                         date_from=request.args.get('date_from', ''),
+                         date_to=request.args.get('date_to', ''))
+
+
+@tasks_bp.route('/api/analytics')
+@admin_required
+def api_analytics():
+    """Operator and task scan statistics from the rollup tables as JSON"""
+    try:
+        start, end, _ = analytics_range()
+        return jsonify(analytics_report(start, end))
+        
+    except Exception as e:
+        current_app.logger.error(f"Error building scan analytics: {str(e)}")
+        return jsonify({'error': 'Unable to build scan analytics'}), 500
+
+
 @tasks_bp.route('/task-screen')
 @login_required
 def task_screen():
@@ -1954,92 +1575,66 @@ def task_screen():
         flash('Accesso negato: solo utenti SCREEN TASK possono accedere a questa pagina.', 'error')
         return redirect(url_for('tasks.index'))
     
-    # Get all active tasks (non-completed) ordered by priority and creation date
-    active_tasks = Task.query.filter(
-        Task.status.in_(['pending', 'assigned', 'in_progress'])
-    ).order_by(
-        db.case(
-            (Task.priority == 'urgent', 1),
-            (Task.priority == 'high', 2), 
-            (Task.priority == 'medium', 3),
-            (Task.priority == 'low', 4)
-        ),
-        desc(Task.created_at)
-    ).all()
-    
-    # Update progress and load ticket lines for all tasks
-    for task in active_tasks:
-        task.update_progress()
-        
-        # Load tickets and their lines for each task
-        task_tickets = TaskTicket.query.filter_by(task_id=task.id_task).all()
-        task.loaded_tickets = []
-        
-        for task_ticket in task_tickets:
-            if task_ticket.ticket:
-                # Load product lines for each ticket using LEFT JOIN to handle missing products gracefully
-                ticket_lines = db.session.query(TicketLine).outerjoin(
-                    Product, TicketLine.IdArticulo == Product.IdArticulo
-                ).filter(TicketLine.IdTicket == task_ticket.ticket.IdTicket).all()
-                
-                # Attach lines to ticket object for template access
-                task_ticket.ticket.loaded_lines = ticket_lines
-                task.loaded_tickets.append(task_ticket.ticket)
-    
-    # Separate tasks by status and priority for better visualization
-    urgent_tasks = []      # urgent priority (regardless of status)
-    high_tasks = []        # high priority (regardless of status)
-    medium_tasks = []      # medium priority (regardless of status)
-    low_tasks = []         # low priority (regardless of status)
-    overdue_tasks = []     # overdue tasks (separate category)
-    
-    for task in active_tasks:
-        # PRIMA categorizza per priorità, poi aggiungi flag scadenza
-        if task.priority == 'urgent':
-            urgent_tasks.append(task)
-        elif task.priority == 'high':
-            high_tasks.append(task)
-        elif task.priority == 'medium':
-            medium_tasks.append(task)
-        else:  # low priority
-            low_tasks.append(task)
-        
-        # Se è scaduta, aggiungila ANCHE alle scadute (per statistiche)
-        # ma mantienila nella sua categoria di priorità principale
-        if task.is_overdue:
-            overdue_tasks.append(task)
+    # Task attivi (per priorità e data) e ultimi completati, in un numero costante di query;
+    # gli aggiornamenti successivi arrivano da /task-screen/stream
+    snapshot = screen_feed.build_snapshot()
+    
+    return render_template('tasks/task_screen.html',
+                         snapshot=snapshot,
+                         stats=screen_feed.snapshot_stats(snapshot),
+                         now=datetime.now)
+
+
+@tasks_bp.route('/task-screen/stream')
+@login_required
+def task_screen_stream():
+    """Server-sent events for the task screen: a snapshot, then only the changes"""
+    if not current_user.screen_task:
+        return jsonify({'error': 'Unauthorized'}), 403
     
-    # Combine for assigned_tasks display in priority order
-    assigned_tasks = urgent_tasks + high_tasks + medium_tasks + low_tasks
+    app = current_app._get_current_object()
     
-    # Get completed tasks for the display (last 3-5 completed tasks)
-    completed_tasks = Task.query.filter_by(status='completed').order_by(desc(Task.completed_at)).limit(5).all()
-    for task in completed_tasks:
-        # Load basic info for completed tasks too
-        task_tickets = TaskTicket.query.filter_by(task_id=task.id_task).all()
-        task.loaded_tickets = [task_ticket.ticket for task_ticket in task_tickets if task_ticket.ticket]
+    def sse(event_name, data):
+        return f"event: {event_name}\ndata: {json.dumps(data, default=str)}\n\n"
     
-    # Get task statistics
-    stats = {
-        'total_assigned': len(assigned_tasks),
-        'total_completed': len(completed_tasks),
-        'total_urgent': len(urgent_tasks),
-        'total_high': len(high_tasks),
-        'total_medium': len(medium_tasks),
-        'total_low': len(low_tasks),
-        'total_overdue': len(overdue_tasks)
-    }
+    def generate():
+        # Ogni lettura usa un proprio app context: nessuna connessione resta aperta tra un evento e l'altro
+        with subscribe_events(screen_feed.TOPIC) as subscription:
+            try:
+                with app.app_context():
+                    state = screen_feed.ScreenState(screen_feed.build_snapshot())
+                yield 'retry: 5000\n' + sse('snapshot', {'tasks': list(state.tasks.values()),
+                                                          'completed': state.completed})
+                
+                started = last_sync = time.monotonic()
+                while time.monotonic() - started < screen_feed.STREAM_MAX_SECONDS:
+                    published = subscription.get(timeout=screen_feed.HEARTBEAT_SECONDS)
+                    resync = subscription.overflowed or time.monotonic() - last_sync >= screen_feed.RESYNC_SECONDS
+                    if published is None and not resync:
+                        yield ': ping\n\n'
+                        continue
+                    
+                    task_ids = set()
+                    for item in ([published] if published else []) + subscription.drain():
+                        task_ids.update(item.data.get('task_ids', ()))
+                    
+                    with app.app_context():
+                        if resync:
+                            subscription.overflowed = False
+                            last_sync = time.monotonic()
+                            changes = state.resync(screen_feed.build_snapshot())
+                        else:
+                            changes = state.apply_changes(task_ids)
+                    for event_name, data in changes:
+                        yield sse(event_name, data)
+            except Exception as e:
+                # Il browser si ricollega da solo (retry) e riparte da uno snapshot
+                logger.error(f"Errore nello stream dello schermo task: {str(e)}")
     
-    return render_template('tasks/task_screen.html',
-                         assigned_tasks=assigned_tasks,
-                         completed_tasks=completed_tasks,
-                         urgent_tasks=urgent_tasks,
-                         high_tasks=high_tasks,
-                         medium_tasks=medium_tasks,
-                         low_tasks=low_tasks,
-                         overdue_tasks=overdue_tasks,
-                         stats=stats,
-                         now=datetime.now)
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 
 
@@ -2071,6 +1666,7 @@ def api_remove_ticket_from_task():
             current_app.logger.info(f"Reset Ticket #{ticket.NumTicket} to Enviado = 0 (removed from task before DDT generation)")
         
         # Delete associated scans
+        flush_audit_buffer()  # scansioni ancora nel buffer di scrittura
         TaskTicketScan.query.filter_by(task_ticket_id=task_ticket_id).delete()
         
         # Remove the task ticket
@@ -2079,10 +1675,7 @@ def api_remove_ticket_from_task():
         task_number = task.task_number
         db.session.delete(task_ticket)
         
-        # Update task progress
-        task.update_progress()
-        
-        # Check if the task has no more tickets after removal
+        # Check if the task has no more tickets after removal (il flush aggiorna i contatori)
         remaining_tickets_count = TaskTicket.query.filter_by(task_id=task_id).count()
         
         if remaining_tickets_count == 0:
@@ -2152,6 +1745,69 @@ def api_get_unread_notifications():
         return jsonify({'success': False, 'error': str(e)}), 500
 
 
+@tasks_bp.route('/api/notifications/stream')
+@login_required
+def api_notifications_stream():
+    """Server-sent events for bell, task badge and chat: counters and online users, then only the news"""
+    app = current_app._get_current_object()
+    user_id, username, is_admin = current_user.id, current_user.username, current_user.is_admin
+    topics = notification_feed.stream_topics(is_admin)
+    last_event_id = request.headers.get('Last-Event-ID', type=int) or request.args.get('last_event_id', type=int)
+    
+    def sse(event_name, data, event_id=None):
+        event_line = f"id: {event_id}\n" if event_id is not None else ''
+        return f"{event_line}event: {event_name}\ndata: {json.dumps(data, default=str)}\n\n"
+    
+    def generate():
+        # Ogni lettura usa un proprio app context: nessuna connessione resta aperta tra un evento e l'altro
+        with subscribe_events(*topics, user_id=user_id) as subscription:
+            try:
+                with app.app_context():
+                    notification_feed.announce_presence(user_id, username)
+                    state = notification_feed.FeedState(user_id, is_admin)
+                    changes = state.snapshot()
+                    missed = replay_events(topics, last_event_id, user_id=user_id) if last_event_id else []
+                    if missed is None:
+                        # Troppi eventi persi: il client ricarica i messaggi di chat
+                        changes.append(('resync', {}, None))
+                        missed = []
+                    changes.extend(state.apply(missed))
+                # Gli eventi ripetuti possono arrivare anche dall'iscrizione
+                replayed = {published.id for published in missed}
+                yield 'retry: 5000\n' + ''.join(sse(*change) for change in changes)
+                
+                started = last_refresh = time.monotonic()
+                while time.monotonic() - started < notification_feed.STREAM_MAX_SECONDS:
+                    published = subscription.get(timeout=notification_feed.HEARTBEAT_SECONDS)
+                    events = [item for item in ([published] if published else []) + subscription.drain()
+                              if item.id not in replayed]
+                    refresh = time.monotonic() - last_refresh >= notification_feed.PRESENCE_SECONDS
+                    if not events and not refresh and not subscription.overflowed:
+                        yield ': ping\n\n'
+                        continue
+                    
+                    with app.app_context():
+                        if subscription.overflowed:
+                            subscription.overflowed = False
+                            changes = [('resync', {}, None)] + state.snapshot()
+                        else:
+                            changes = state.apply(events)
+                        if refresh:
+                            # Presenza ancora valida e contatori cambiati senza eventi (modifiche in blocco)
+                            last_refresh = time.monotonic()
+                            notification_feed.announce_presence(user_id, username)
+                            changes.extend(state.counters_change())
+                    yield ''.join(sse(*change) for change in changes) or ': ping\n\n'
+            except Exception as e:
+                # Il browser si ricollega da solo (retry) con Last-Event-ID
+                logger.error(f"Errore nello stream notifiche dell'utente {user_id}: {str(e)}")
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+
 @tasks_bp.route('/api/notifications/completed-count')
 @login_required
 def api_get_completed_notifications_count():
@@ -2160,11 +1816,7 @@ def api_get_completed_notifications_count():
         if not current_user.is_admin:
             return jsonify({'success': False, 'error': 'Admin access required'}), 403
             
-        count = TaskNotification.query.filter_by(
-            user_id=current_user.id,
-            is_read=False,
-            notification_type='task_completed'
-        ).count()
+        count = notification_feed.get_user_counters(current_user)['completed']
         
         return jsonify({
             'success': True,
@@ -1,8 +1,17 @@
 from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, current_app
 from flask_login import login_required, current_user
-from app.models import db, Product, TicketHeader, TicketLine, ScanLog, Client, Company, SystemConfig, User, Task
+from app.models import db, Product, TicketHeader, TicketLine, TicketSummary, ScanLog, Client, Company, SystemConfig, User
 from app.forms import SearchForm, FilterForm, ManualScanForm
-from sqlalchemy import func, or_, select
+from services.ticket_enrichment import enrich_tickets, enrich_tickets_by_id
+from services.ticket_summary import expiring_conditions
+from services.pagination import keyset_paginate
+from services.search_index import ticket_search_clause
+from services.ticket_search import search_tickets
+from services.scan_resolution import decode_qr, resolve_scan
+from services.audit_buffer import record_scan_log, update_scan_log
+from services.badge_counters import get_catalog_counts, get_expiring_count, get_ticket_count
+from services.ticket_transitions import apply_bulk_transition
+from sqlalchemy import select
 from datetime import datetime, timedelta
 import re
 import logging
@@ -52,88 +61,17 @@ def index():
     from datetime import datetime, timedelta
     from sqlalchemy import func, select
     
-    # Get summary statistics
-    products_count = Product.query.count()
-    
-    # Get recent tickets (limit to 5) with enhanced data
-    recent_tickets_query = db.session.query(TicketHeader).order_by(TicketHeader.Fecha.desc()).limit(5)
-    recent_tickets_raw = recent_tickets_query.all()
-    
-    # Enhance tickets with additional data
-    enhanced_tickets = []
-    for ticket in recent_tickets_raw:
-        # Get main product info for this ticket
-        main_product_info = db.session.query(
-            TicketLine.IdArticulo,
-            TicketLine.Descripcion.label('linea_descripcion'),
-            Product.Descripcion.label('producto_descripcion')
-        ).join(
-            Product, 
-            TicketLine.IdArticulo == Product.IdArticulo,
-            isouter=True
-        ).filter(
-            TicketLine.IdTicket == ticket.IdTicket
-        ).first()
-        
-        # Get earliest expiry date for this ticket
-        earliest_expiry = db.session.query(
-            func.min(TicketLine.FechaCaducidad).label('earliest_expiry')
-        ).filter(
-            TicketLine.IdTicket == ticket.IdTicket,
-            TicketLine.FechaCaducidad.isnot(None)
-        ).scalar()
-        
-        # Create enhanced ticket object
-        enhanced_ticket = type('EnhancedTicket', (), {})()
-        
-        # Copy original ticket properties
-        for attr in dir(ticket):
-            if not attr.startswith('_'):
-                setattr(enhanced_ticket, attr, getattr(ticket, attr))
-        
-        # Add article name
-        if main_product_info:
-            enhanced_ticket.article_name = (
-                main_product_info.producto_descripcion or 
-                main_product_info.linea_descripcion
-            )
-        else:
-            enhanced_ticket.article_name = None
-        
-        # Add expiry information
-        enhanced_ticket.expiry_date = earliest_expiry
-        if earliest_expiry:
-            enhanced_ticket.formatted_expiry = earliest_expiry.strftime('%d/%m/%Y')
-            
-            # Calculate expiry status
-            today = datetime.now().date()
-            expiry_date = earliest_expiry.date() if hasattr(earliest_expiry, 'date') else earliest_expiry
-            days_to_expire = (expiry_date - today).days
-            
-            if days_to_expire < 0:
-                enhanced_ticket.expiry_class = 'danger'
-            elif days_to_expire <= 7:
-                enhanced_ticket.expiry_class = 'warning'
-            else:
-                enhanced_ticket.expiry_class = 'success'
-        else:
-            enhanced_ticket.formatted_expiry = None
-            enhanced_ticket.expiry_class = None
-        
-        # Add formatted date
-        if ticket.Fecha:
-            enhanced_ticket.formatted_date = ticket.Fecha.strftime('%d/%m/%Y')
-        else:
-            enhanced_ticket.formatted_date = 'N/D'
-        
-        # Add status information - Use the model's status_text property for consistency
-        enhanced_ticket.status_text = ticket.status_text
-        enhanced_ticket.status_class = ticket.status_class
-        
-        enhanced_tickets.append(enhanced_ticket)
+    # Get summary statistics (contatori in cache, vedi services.badge_counters)
+    products_count = get_catalog_counts()['products']
+    
+    # Get recent tickets (limit to 5) with main product, expiry and status
+    recent_ticket_ids = [row.IdTicket for row in db.session.query(TicketHeader.IdTicket).order_by(
+        TicketHeader.Fecha.desc()
+    ).limit(5).all()]
+    enhanced_tickets = enrich_tickets(recent_ticket_ids)
     
     # Get tickets in task (Enviado=10) - new counter
-    task_tickets = TicketHeader.query.filter_by(Enviado=10).count()
+    task_tickets = get_ticket_count(10)
     
     # Get recent scans with user information (limit to 5)
     recent_scans_query = db.session.query(
@@ -187,10 +125,7 @@ def product_detail(product_id):
 @login_required
 def tickets():
     """List of all tickets with enhanced search functionality"""
-    
-    # Update ticket statuses before displaying
-    update_expired_tickets()
-    reset_non_expired_tickets_to_giacenza()
+    # Le transizioni Scaduto/Giacenza sono gestite da services.ticket_sweeper
     
     # Get query parameters
     page = request.args.get('page', 1, type=int)
@@ -246,43 +181,11 @@ def tickets():
                 current_app.logger.info(f"🔍 Searching by ticket number: {ticket_number}")
         else:
             # Ricerca multipla: barcode, descrizione prodotto o descrizione linea
-            # Crea una subquery per i ticket che contengono prodotti con la descrizione cercata
-            product_search_subquery = db.session.query(TicketLine.IdTicket).distinct().\
-                join(Product, TicketLine.IdArticulo == Product.IdArticulo).\
-                filter(
-                    or_(
-                        Product.Descripcion.ilike(f'%{search_query}%'),
-                        TicketLine.Descripcion.ilike(f'%{search_query}%')
-                    )
-                ).subquery()
-            
-            # Applica filtro combinato: barcode O descrizione prodotto
-            query = query.filter(
-                or_(
-                    TicketHeader.CodigoBarras.like(f'%{search_query}%'),
-                    TicketHeader.IdTicket.in_(
-                        db.session.query(product_search_subquery.c.IdTicket)
-                    )
-                )
-            )
+            # (indice a trigrammi, services.search_index)
+            query = query.filter(ticket_search_clause(search_query, fields=('barcode', 'description', 'product')))
         
         current_app.logger.info(f"🔍 Search query applied for '{search_query}'")
     
-    # Crea subquery per trovare la linea con la data di scadenza più vicina per ogni ticket
-    # Questa è la chiave: usiamo lo stesso approccio JOIN per tutti i filtri
-    subquery = db.session.query(
-        TicketLine.IdTicket,
-        TicketLine.IdArticulo,
-        TicketLine.FechaCaducidad,
-        func.row_number().over(
-            partition_by=TicketLine.IdTicket,
-            order_by=TicketLine.FechaCaducidad.asc()
-        ).label('row_num')
-    ).subquery()
-    
-    # Seleziona solo la prima riga per ogni ticket (quella con la data di scadenza più vicina)
-    first_expiring_line = db.session.query(subquery).filter(subquery.c.row_num == 1).subquery()
-    
     # Applica filtro di stato - Updated with new logic
     status = request.args.get('status')
     if status == 'in_task':  # New filter for tickets in task
@@ -292,129 +195,50 @@ def tickets():
     elif status == 'expired':  # Filter for expired tickets
         query = query.filter_by(Enviado=4)
     elif status == 'expiring':
-        today = datetime.now().date()  # Usa solo la data, non l'ora
-        
-        # Ottieni i giorni di preavviso dalla configurazione (default 7 giorni)
+        # Solo ticket nei task (Enviado = 10) con la scadenza più vicina entro i giorni
+        # di preavviso (default 7), letti da ticket_summary, prima i più urgenti
         expiry_warning_days = SystemConfig.get_config('expiry_warning_days', 7)
-        warning_date = today + timedelta(days=expiry_warning_days)
-        
-        # Correggo il filtro scadenza per mostrare SOLO prodotti con data di scadenza
-        # E SOLO ticket nei task (Enviado = 10)
-        # Usiamo una subquery per trovare solo i ticket con almeno un prodotto in scadenza
-        ticket_ids_with_expiry = db.session.query(TicketLine.IdTicket).join(
-            TicketHeader, TicketLine.IdTicket == TicketHeader.IdTicket
-        ).filter(
-            TicketHeader.Enviado == 10,  # Solo ticket nei task
-            TicketLine.FechaCaducidad.isnot(None),
-            func.date(TicketLine.FechaCaducidad) <= warning_date,
-            func.date(TicketLine.FechaCaducidad) >= today
-        ).distinct().subquery()
-        
-        # Usa la subquery per limitare i risultati solo ai ticket trovati
         query = query.join(
-            ticket_ids_with_expiry,
-            TicketHeader.IdTicket == ticket_ids_with_expiry.c.IdTicket
-        )
+            TicketSummary, TicketHeader.IdTicket == TicketSummary.IdTicket
+        ).filter(*expiring_conditions(expiry_warning_days))
     
     # Applica ordinamento
     if status == 'expiring':
-        # Ottieni i ticket con ordine di scadenza (prima i più urgenti)
-        # Join con TicketLine per ordinare per data di scadenza
-        expiry_subquery = db.session.query(
-            TicketLine.IdTicket,
-            func.min(TicketLine.FechaCaducidad).label('min_expiry_date')
-        ).filter(
-            TicketLine.FechaCaducidad.isnot(None)
-        ).group_by(TicketLine.IdTicket).subquery()
-        
-        tickets = query.join(
-            expiry_subquery,
-            TicketHeader.IdTicket == expiry_subquery.c.IdTicket
-        ).order_by(expiry_subquery.c.min_expiry_date.asc()).paginate(page=page, per_page=per_page)
+        tickets = query.order_by(TicketSummary.earliest_expiry.asc()).paginate(page=page, per_page=per_page)
     else:
-        # Ordinamento standard per data per gli altri filtri
-        tickets = query.order_by(TicketHeader.Fecha.desc()).paginate(page=page, per_page=per_page)
+        # Ordinamento standard per data (keyset su Fecha, IdTicket) per gli altri filtri
+        tickets = keyset_paginate(query, TicketHeader.Fecha, TicketHeader.IdTicket,
+                                  page=page, per_page=per_page, cursor=request.args.get('cursor'))
     
-    # Get main product for each ticket
+    # Main product, line count and earliest expiry for the tickets of this page
+    ticket_views = enrich_tickets_by_id(tickets.items)
     ticket_products = {}
-    for ticket in tickets.items:
-        main_product_info = db.session.query(
-            TicketLine.IdTicket,
-            TicketLine.IdArticulo,
-            TicketLine.Descripcion.label('linea_descripcion'),
-            Product.Descripcion.label('producto_descripcion')
-        ).join(
-            Product, 
-            TicketLine.IdArticulo == Product.IdArticulo
-        ).filter(
-            TicketLine.IdTicket == ticket.IdTicket
-        ).first()
-        
-        if main_product_info:
-            ticket_products[ticket.IdTicket] = {
-                'product_name': main_product_info.producto_descripcion or main_product_info.linea_descripcion,
-                'product_id': main_product_info.IdArticulo
-            }
-    
-    # Get the count of lines for each ticket
-    ticket_ids = [ticket.IdTicket for ticket in tickets.items]
     ticket_lines_count = {}
+    ticket_expiry = {}
     
-    if ticket_ids:
-        # Count lines for each ticket
-        line_counts = db.session.query(
-            TicketLine.IdTicket,
-            func.count(TicketLine.IdTicket).label('line_count')
-        ).filter(
-            TicketLine.IdTicket.in_(ticket_ids)
-        ).group_by(
-            TicketLine.IdTicket
-        ).all()
-        
-        # Create dictionary of ticket_id: line_count
-        for ticket_id, line_count in line_counts:
-            ticket_lines_count[ticket_id] = line_count
+    for ticket_id, view in ticket_views.items():
+        if view.product_name:
+            ticket_products[ticket_id] = {
+                'product_name': view.product_name,
+                'product_id': view.product_id
+            }
+        if view.line_count:
+            ticket_lines_count[ticket_id] = view.line_count
+        if view.expiry_date:
+            ticket_expiry[ticket_id] = {
+                'expiry_date': view.formatted_expiry,
+                'days_remaining': view.days_to_expire
+            }
     
-    # Get expiry information for each ticket
-    ticket_expiry = {}
-    today = datetime.now()
-    
-    if ticket_ids:
-        # Query per trovare la data di scadenza più vicina per ogni ticket
-        expiry_data = db.session.query(
-            TicketLine.IdTicket,
-            func.min(TicketLine.FechaCaducidad).label('earliest_expiry')
-        ).filter(
-            TicketLine.IdTicket.in_(ticket_ids),
-            TicketLine.FechaCaducidad.isnot(None)
-        ).group_by(TicketLine.IdTicket).all()
-        
-        for ticket_id, earliest_expiry in expiry_data:
-            if earliest_expiry:
-                days_remaining = (earliest_expiry - today).days
-                ticket_expiry[ticket_id] = {
-                    'expiry_date': earliest_expiry.strftime('%d/%m/%Y'),
-                    'days_remaining': days_remaining
-                }
-    
-    # Count the total expiring tickets for the badge in filter
-    today = datetime.now().date()  # Usa solo la data per il confronto
+    # Badge dei filtri: contatori in cache invalidati dai cambi di stato
     expiry_warning_days = SystemConfig.get_config('expiry_warning_days', 7)
-    warning_date = today + timedelta(days=expiry_warning_days)
-    expiring_count = db.session.query(TicketHeader.IdTicket).distinct().\
-        join(TicketLine, TicketHeader.IdTicket == TicketLine.IdTicket).\
-        filter(
-            TicketHeader.Enviado == 10,  # Solo ticket nei task
-            TicketLine.FechaCaducidad.isnot(None),
-            func.date(TicketLine.FechaCaducidad) <= warning_date,
-            func.date(TicketLine.FechaCaducidad) >= today
-        ).count()
+    expiring_count = get_expiring_count(expiry_warning_days)
     
     # Count expired tickets for the badge
-    expired_count = TicketHeader.query.filter_by(Enviado=4).count()
+    expired_count = get_ticket_count(4)
     
     # Count tickets in task
-    task_count = TicketHeader.query.filter_by(Enviado=10).count()
+    task_count = get_ticket_count(10)
     
     return render_template('warehouse/tickets.html', 
                           tickets=tickets,
@@ -429,92 +253,6 @@ def tickets():
                           expired_count=expired_count,
                           task_count=task_count)  # New counter
 
-def update_expired_tickets():
-    """
-    Trova tutti i ticket che dovrebbero essere marcati come scaduti (Enviado = 4)
-    e li aggiorna nel database. Questa funzione viene eseguita ad ogni richiesta
-    della pagina tickets per mantenere i dati sempre aggiornati.
-    
-    Un prodotto è considerato scaduto solo dal giorno DOPO la sua data di scadenza,
-    non lo stesso giorno (così può essere aperto e chiuso nello stesso giorno).
-    """
-    try:
-        from app.models import SystemConfig
-        today = datetime.now().date()  # Usa solo la data, non l'ora
-        
-        # Trova tutti i ticket nei task (Enviado = 10) che hanno prodotti scaduti
-        # Un prodotto è considerato scaduto solo DOPO la sua data di scadenza (non oggi)
-        expired_ticket_ids = db.session.query(TicketHeader.IdTicket).distinct().\
-            join(TicketLine, TicketHeader.IdTicket == TicketLine.IdTicket).\
-            filter(
-                TicketHeader.Enviado == 10,  # Solo ticket nei task
-                TicketLine.FechaCaducidad.isnot(None),
-                func.date(TicketLine.FechaCaducidad) < today  # Data di scadenza PASSATA (non oggi)
-            ).all()
-        
-        if expired_ticket_ids:
-            # Estrai solo gli ID dei ticket dalla tupla
-            ticket_ids_list = [ticket_id[0] for ticket_id in expired_ticket_ids]
-            
-            # Aggiorna tutti i ticket scaduti in una volta sola
-            db.session.query(TicketHeader).filter(
-                TicketHeader.IdTicket.in_(ticket_ids_list)
-            ).update({TicketHeader.Enviado: 4}, synchronize_session=False)
-            
-            db.session.commit()
-            
-            print(f"Aggiornati {len(ticket_ids_list)} ticket come scaduti")
-    
-    except Exception as e:
-        print(f"Errore nell'aggiornamento dei ticket scaduti: {str(e)}")
-        db.session.rollback()
-
-def reset_non_expired_tickets_to_giacenza():
-    """
-    Trova tutti i ticket con stato Enviado = 10 (Task) che NON sono più associati 
-    a task attivi o che non hanno prodotti scaduti e li riporta allo stato 
-    Enviado = 0 (Giacenza) per renderli nuovamente disponibili.
-    """
-    try:
-        from app.models import TaskTicket, Task
-        today = datetime.now().date()
-        
-        # Trova ticket con Enviado = 10 che non sono in task attivi
-        # o che sono in task ma non hanno prodotti scaduti
-        tickets_to_reset = db.session.query(TicketHeader).filter(
-            TicketHeader.Enviado == 10
-        ).all()
-        
-        reset_count = 0
-        for ticket in tickets_to_reset:
-            should_reset = False
-            
-            # Verifica se il ticket è ancora associato a un task attivo
-            active_task_ticket = db.session.query(TaskTicket).join(Task).filter(
-                TaskTicket.ticket_id == ticket.IdTicket,
-                Task.status.in_(['pending', 'assigned', 'in_progress'])
-            ).first()
-            
-            if not active_task_ticket:
-                # Ticket non è in un task attivo, può essere rimesso in giacenza
-                should_reset = True
-            # NON resettare mai i ticket che sono in task attivi
-            # Se un ticket è in un task attivo, deve rimanere con Enviado=10 
-            # indipendentemente dalla scadenza dei prodotti
-            
-            if should_reset:
-                ticket.Enviado = 0
-                reset_count += 1
-                print(f"Ticket #{ticket.NumTicket} (ID: {ticket.IdTicket}) reimpostato a Giacenza")
-        
-        if reset_count > 0:
-            db.session.commit()
-            print(f"Reset {reset_count} ticket da Task a Giacenza")
-            
-    except Exception as e:
-        print(f"Errore nel reset dei ticket non scaduti: {str(e)}")
-        db.session.rollback()
-
 @warehouse_bp.route('/ticket/<int:ticket_id>')
 @login_required
 def ticket_detail(ticket_id):
@@ -698,26 +436,12 @@ def ticket_detail(ticket_id):
             elif days_to_expire < 0:
                 expired = True
     
-    # Count the total expiring tickets for the badge in filter
-    today = datetime.now().date()  # Usa solo la data per il confronto
+    # Count the total expiring tickets for the badge in filter (in cache)
     expiry_warning_days = SystemConfig.get_config('expiry_warning_days', 7)
-    warning_date = today + timedelta(days=expiry_warning_days)
-    expiring_count = db.session.query(TicketHeader.IdTicket).distinct().\
-        join(TicketLine, TicketHeader.IdTicket == TicketLine.IdTicket).\
-        filter(
-            TicketHeader.Enviado == 10,  # Solo ticket nei task
-            TicketLine.FechaCaducidad.isnot(None),
-            func.date(TicketLine.FechaCaducidad) <= warning_date,
-            func.date(TicketLine.FechaCaducidad) >= today
-        ).count()
-    
-    # Log this view
-    log = ScanLog(
-        user_id=current_user.id,
-        ticket_id=ticket_id,
-        action='view'
-    )
-    db.session.add(log)
+    expiring_count = get_expiring_count(expiry_warning_days)
+    
+    # Log this view (scrittura differita, vedi services.audit_buffer)
+    record_scan_log(user_id=current_user.id, ticket_id=ticket_id, action='view')
     db.session.commit()
     
     return render_template('warehouse/ticket_detail.html', 
@@ -777,78 +501,26 @@ def scanner():
         ticket_code = form.ticket_id.data.strip()
         
         # Check for QR code format: NumTicket(4)-IdArticolo(4)-Peso(5)-Timestamp(14)
-        if ticket_code.isdigit() and len(ticket_code) == 27:
-            # Parse the QR components
-            ticket_num = int(ticket_code[:4])           # First 4 digits = NumTicket
-            product_id = int(ticket_code[4:8])          # Next 4 digits = IdArticolo
-            weight = int(ticket_code[8:13]) / 1000.0    # Next 5 digits = Peso (in grams, convert to kg)
-            
-            # Parse timestamp - format: DDMMYYYYHHMMSS
-            timestamp_str = ticket_code[13:27]
-            day = timestamp_str[0:2]
-            month = timestamp_str[2:4]
-            year = timestamp_str[4:8]
-            hour = timestamp_str[8:10]
-            minute = timestamp_str[10:12]
-            second = timestamp_str[12:14]
-            
-            formatted_date = f"{day}/{month}/{year}"
-            formatted_time = f"{hour}:{minute}:{second}"
-            
-            # Convert timestamp to datetime object (for comparison)
-            try:
-                timestamp_dt = datetime.strptime(timestamp_str, "%d%m%Y%H%M%S")
-            except ValueError:
-                timestamp_dt = None
-            
-            # Find tickets with matching NumTicket
-            tickets = TicketHeader.query.filter_by(NumTicket=ticket_num).all()
-            
-            # If there are multiple tickets with the same NumTicket, try to find the one closest to the timestamp
-            matching_ticket = None
-            if tickets:
-                if len(tickets) == 1:
-                    # If there's only one ticket, use it
-                    matching_ticket = tickets[0]
-                elif timestamp_dt:
-                    # Find the ticket with date closest to the timestamp in QR code
-                    min_diff = None
-                    for t in tickets:
-                        if t.Fecha:  # Make sure ticket has a date
-                            diff = abs((t.Fecha - timestamp_dt).total_seconds())
-                            if min_diff is None or diff < min_diff:
-                                min_diff = diff
-                                matching_ticket = t
-                    
-                    # If we still don't have a match, use the first one as fallback
-                    if not matching_ticket:
-                        matching_ticket = tickets[0]
-                else:
-                    # If no timestamp, use the first ticket as fallback
-                    matching_ticket = tickets[0]
-            
-            # Find the product
-            product = Product.query.filter_by(IdArticulo=product_id).first()
+        qr = decode_qr(ticket_code)
+        if qr:
+            # Ticket con la data più vicina al timestamp del QR, con linee e prodotti
+            resolution = resolve_scan(qr)
+            matching_ticket = resolution.ticket
             
             # Log the scan in scan_log table
-            log = ScanLog(
+            record_scan_log(
                 user_id=current_user.id,
                 ticket_id=matching_ticket.IdTicket if matching_ticket else None,
                 action='scan',
                 raw_code=ticket_code,
-                product_code=product_id,
-                scan_date=formatted_date,
-                scan_time=formatted_time
+                product_code=qr.product_id,
+                scan_date=qr.scan_date,
+                scan_time=qr.scan_time
             )
-            db.session.add(log)
             db.session.commit()
             
             if matching_ticket:
-                # Check if this product is in the ticket
-                ticket_line = TicketLine.query.filter_by(
-                    IdTicket=matching_ticket.IdTicket,
-                    IdArticulo=product_id
-                ).first()
+                ticket_line = resolution.line
                 
                 # Check for expiration date
                 expiration_msg = ""
@@ -861,10 +533,10 @@ def scanner():
                     elif days_to_expire < 0:
                         expiration_msg = f" - ATTENZIONE: Prodotto SCADUTO da {abs(days_to_expire)} giorni!"
                 
-                flash(f'QR: Ticket #{ticket_num}, Prodotto #{product_id}, Peso: {weight:.3f}kg{expiration_msg}', 'success')
+                flash(f'QR: Ticket #{qr.ticket_num}, Prodotto #{qr.product_id}, Peso: {qr.weight_kg:.3f}kg{expiration_msg}', 'success')
                 return redirect(url_for('warehouse.ticket_detail', ticket_id=matching_ticket.IdTicket))
             else:
-                flash(f'Ticket {ticket_num} non trovato.', 'danger')
+                flash(f'Ticket {qr.ticket_num} non trovato.', 'danger')
         else:
             flash('Formato QR code non valido. Inserisci un codice a 27 cifre nel formato corretto.', 'danger')
     
@@ -884,13 +556,9 @@ def api_checkout():
     ticket_id = data.get('ticket_id')
     
     if scan_log_id:
-        # Find the scan log entry
-        log = ScanLog.query.get(scan_log_id)
-        if not log:
+        # client_id restituito da process_qr: la riga può essere ancora nel buffer
+        if not update_scan_log(scan_log_id, action='checkout'):
             return jsonify({'success': False, 'error': 'Scan log not found'}), 404
-        
-        # Update the scan log
-        log.action = 'checkout'
         db.session.commit()
         
         return jsonify({
@@ -923,6 +591,39 @@ def api_checkout():
     
     return jsonify({'success': False, 'error': 'Missing scan_log_id or ticket_id'}), 400
 
+@warehouse_bp.route('/api/checkout/bulk', methods=['POST'])
+@login_required
+def api_checkout_bulk():
+    """Checkout (or DDT assignment) of many tickets in one request.
+
+    Body: {"items": [ticket_id | "27-digit QR" | {"ticket_id"|"qr_code", "client_id"}],
+           "action": "checkout" | "assign_ddt1" | "assign_ddt2"}
+    Used by the scanner to close a pallet and to flush its offline queue.
+    """
+    data = request.get_json(silent=True)
+    
+    if not data or not isinstance(data.get('items'), list):
+        return jsonify({'success': False, 'error': 'Missing items'}), 400
+    
+    try:
+        results = apply_bulk_transition(data['items'], data.get('action', 'checkout'), current_user.id)
+    except ValueError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Errore nel checkout in blocco ({len(data['items'])} elementi): {str(e)}")
+        return jsonify({'success': False, 'error': 'Errore database durante il checkout in blocco'}), 500
+    
+    processed = sum(1 for result in results if result['status'] == 'ok')
+    failed = sum(1 for result in results if not result['success'])
+    return jsonify({
+        'success': failed == 0,
+        'message': f'{processed} ticket aggiornati, {failed} non elaborati',
+        'processed': processed,
+        'failed': failed,
+        'results': results
+    })
+
 # Process QR code scan
 @warehouse_bp.route('/process_qr', methods=['POST'])
 @login_required
@@ -937,74 +638,50 @@ def process_qr():
         }), 400
     
     qr_data = data['qr_data'].strip()
+    qr = decode_qr(qr_data)
     
-    if qr_data.isdigit() and len(qr_data) == 27:
+    if qr:
         try:
-            ticket_num_str = qr_data[:4]
-            product_id_str = qr_data[4:8]
-            weight_str = qr_data[8:13] # Peso in grammi
-            timestamp_str = qr_data[13:27]
-
-            ticket_num = int(ticket_num_str)
-            product_id = int(product_id_str)
-            weight_grams = int(weight_str)
-            weight_kg = weight_grams / 1000.0
-
-            day = timestamp_str[0:2]
-            month = timestamp_str[2:4]
-            year = timestamp_str[4:8]
-            hour = timestamp_str[8:10]
-            minute = timestamp_str[10:12]
-            second = timestamp_str[12:14]
-            
-            formatted_scan_date = f"{day}/{month}/{year}"
-            formatted_scan_time = f"{hour}:{minute}:{second}"
+            ticket_num = qr.ticket_num
+            product_id = qr.product_id
+            weight_kg = qr.weight_kg
+            formatted_scan_date = qr.scan_date
+            formatted_scan_time = qr.scan_time
             
-            try:
-                timestamp_dt = datetime.strptime(timestamp_str, "%d%m%Y%H%M%S")
-            except ValueError:
-                timestamp_dt = None
-            
-            tickets = TicketHeader.query.filter_by(NumTicket=ticket_num).all()
-            matching_ticket = None
-            if tickets:
-                if len(tickets) == 1:
-                    matching_ticket = tickets[0]
-                elif timestamp_dt:
-                    min_diff = None
-                    for t in tickets:
-                        if t.Fecha:
-                            diff = abs((t.Fecha - timestamp_dt).total_seconds())
-                            if min_diff is None or diff < min_diff:
-                                min_diff = diff
-                                matching_ticket = t
-                    if not matching_ticket: # Fallback if timestamp logic fails
-                        matching_ticket = tickets[0]
-                else:
-                    matching_ticket = tickets[0] # Fallback if no timestamp in QR
+            # Una query (indice NumTicket, Fecha) per ticket, linee e prodotti; poi cache
+            resolution = resolve_scan(qr)
+            matching_ticket = resolution.ticket
+            product_found = resolution.product_found
+            ticket_line = resolution.line if matching_ticket and product_found else None
             
-            product = Product.query.filter_by(IdArticulo=product_id).first()
+            # Esito deciso prima di scrivere il log: la riga va nel buffer con l'azione finale
+            log_message = ""
+            if matching_ticket and product_found:
+                action = 'scan_success' if ticket_line else 'scan_fail_product_not_in_ticket'
+            elif not matching_ticket and not product_found:
+                log_message = f'Ticket {ticket_num} e Prodotto {product_id} non trovati.'
+                action = 'scan_fail_ticket_product_not_found'
+            elif not matching_ticket:
+                log_message = f'Ticket {ticket_num} non trovato.'
+                action = 'scan_fail_ticket_not_found'
+            else:
+                log_message = f'Prodotto {product_id} non trovato.'
+                action = 'scan_fail_product_not_found'
             
-            log = ScanLog(
+            # client_id generato dall'app: nessun flush per attendere l'autoincrement
+            scan_log_id = record_scan_log(
                 user_id=current_user.id,
                 ticket_id=matching_ticket.IdTicket if matching_ticket else None,
-                action='scan_attempt', # Changed from 'scan' to 'scan_attempt' initially
+                action=action,
                 raw_code=qr_data,
                 product_code=product_id,
                 scan_date=formatted_scan_date,
                 scan_time=formatted_scan_time
             )
-            db.session.add(log)
-            db.session.flush() # Get log.id before full commit
+            db.session.commit() # Scrive il log solo in modalità sync
             
-            if matching_ticket and product:
-                ticket_line = TicketLine.query.filter_by(
-                    IdTicket=matching_ticket.IdTicket,
-                    IdArticulo=product_id
-                ).first()
-                
+            if matching_ticket and product_found:
                 if ticket_line:
-                    log.action = 'scan_success' # Update action to success
                     expiration_info = None
                     # ... (keep existing expiration logic here if present) ...
 
@@ -1016,7 +693,6 @@ def process_qr():
                         display_weight = f"{weight_kg:.3f}".rstrip('0').rstrip('.')
                         weight_unit = "kg"
 
-                    db.session.commit() # Commit the log and any other changes
                     return jsonify({
                         'success': True,
                         'ticket_id': matching_ticket.IdTicket,
@@ -1026,44 +702,30 @@ def process_qr():
                         'is_processed': matching_ticket.Enviado == 1, 
                         'enviado': str(matching_ticket.Enviado) if matching_ticket.Enviado is not None else "10",  # Changed default from "0" to "10"
                         'product': {
-                            'id': product.IdArticulo,
-                            'name': product.Descripcion,
-                            'code': product.IdArticulo, # Assuming code is IdArticulo, adjust if different
+                            'id': product_id,
+                            'name': resolution.product_name,
+                            'code': product_id, # Assuming code is IdArticulo, adjust if different
                             'weight': f"{display_weight} {weight_unit}",
                             'comportamiento': ticket_line.comportamiento  # Aggiungo il comportamiento
                         },
                         # 'expiration': expiration_info, # Add back if logic is present
-                        'scan_log_id': log.id
+                        'scan_log_id': scan_log_id
                     })
                 else:
                     # Product not in this specific ticket
-                    log.action = 'scan_fail_product_not_in_ticket'
-                    db.session.commit()
                     return jsonify({
                         'success': False,
-                        'message': f'Prodotto {product_id} ({product.Descripcion if product else "N/A"}) non trovato nel ticket {ticket_num}.',
+                        'message': f'Prodotto {product_id} ({resolution.product_name or "N/A"}) non trovato nel ticket {ticket_num}.',
                         'ticket_number': ticket_num,
                         'product_id': product_id,
-                        'scan_log_id': log.id
+                        'scan_log_id': scan_log_id
                     })
             
             # Handle cases where ticket or product is not found
-            log_message = ""
-            if not matching_ticket and not product:
-                log_message = f'Ticket {ticket_num} e Prodotto {product_id} non trovati.'
-                log.action = 'scan_fail_ticket_product_not_found'
-            elif not matching_ticket:
-                log_message = f'Ticket {ticket_num} non trovato.'
-                log.action = 'scan_fail_ticket_not_found'
-            elif not product:
-                log_message = f'Prodotto {product_id} non trovato.'
-                log.action = 'scan_fail_product_not_found'
-            
-            db.session.commit() # Commit the log
             return jsonify({
                 'success': False,
                 'message': log_message,
-                'scan_log_id': log.id
+                'scan_log_id': scan_log_id
             })
                 
         except Exception as e:
@@ -1502,99 +1164,24 @@ def get_first_company():
 @warehouse_bp.route('/api/tickets/search')
 @login_required
 def api_tickets_search():
-    """API endpoint for real-time ticket search"""
-    query = request.args.get('query', '').strip()
-    start_date = request.args.get('start_date')
-    end_date = request.args.get('end_date')
-    
-    if not query and not (start_date or end_date):
+    """API endpoint for real-time ticket search (cached, supports If-None-Match)"""
+    result = search_tickets(
+        request.args.get('query', ''),
+        request.args.get('start_date'),
+        request.args.get('end_date')
+    )
+    if result is None:
         return jsonify([])
     
-    # Initialize query
-    ticket_query = TicketHeader.query
-    
-    # Apply date filter if provided
-    if start_date:
-        try:
-            start_date = datetime.strptime(start_date, '%Y-%m-%d')
-            ticket_query = ticket_query.filter(TicketHeader.Fecha >= start_date)
-        except ValueError:
-            pass
-    
-    if end_date:
-        try:
-            end_date = datetime.strptime(end_date, '%Y-%m-%d')
-            end_date = end_date + timedelta(days=1)  # Include the entire day
-            ticket_query = ticket_query.filter(TicketHeader.Fecha <= end_date)
-        except ValueError:
-            pass
-    
-    # Apply text search if provided
-    if query:
-        # Check if it's a ticket number search (starts with #)
-        if query.startswith('#'):
-            ticket_number = query[1:].strip()
-            if ticket_number.isdigit():
-                ticket_query = ticket_query.filter(TicketHeader.NumTicket == int(ticket_number))
-        else:
-            # Ricerca multipla: barcode, descrizione prodotto o descrizione linea
-            # Crea una subquery per i ticket che contengono prodotti con la descrizione cercata
-            product_search_subquery = db.session.query(TicketLine.IdTicket).distinct().\
-                join(Product, TicketLine.IdArticulo == Product.IdArticulo).\
-                filter(
-                    or_(
-                        Product.Descripcion.ilike(f'%{query}%'),
-                        TicketLine.Descripcion.ilike(f'%{query}%')
-                    )
-                ).subquery()
-            
-            # Applica filtro combinato: barcode O descrizione prodotto
-            ticket_query = ticket_query.filter(
-                or_(
-                    TicketHeader.CodigoBarras.like(f'%{query}%'),
-                    TicketHeader.IdTicket.in_(
-                        db.session.query(product_search_subquery.c.IdTicket)
-                    )
-                )
-            )
-    
-    # Limit and order results
-    tickets = ticket_query.order_by(TicketHeader.Fecha.desc()).limit(10).all()
-    
-    results = []
-    for ticket in tickets:
-        # Format date for display
-        formatted_date = ticket.Fecha.strftime('%d/%m/%Y %H:%M') if ticket.Fecha else 'N/A'
-        
-        # Get the main product for this ticket
-        main_product_info = db.session.query(
-            TicketLine.IdTicket,
-            TicketLine.IdArticulo,
-            TicketLine.Descripcion.label('linea_descripcion'),
-            Product.Descripcion.label('producto_descripcion')
-        ).join(
-            Product, 
-            TicketLine.IdArticulo == Product.IdArticulo
-        ).filter(
-            TicketLine.IdTicket == ticket.IdTicket
-        ).first()
-        
-        product_name = 'N/A'
-        product_id = None
-        
-        if main_product_info:
-            product_name = main_product_info.producto_descripcion or main_product_info.linea_descripcion or 'N/A'
-            product_id = main_product_info.IdArticulo
-        
-        results.append({
-            'id': ticket.IdTicket,
-            'number': ticket.NumTicket,
-            'formatted_date': formatted_date,
-            'barcode': ticket.CodigoBarras or 'N/A',
-            'product_name': product_name,
-            'product_id': product_id,
-            'is_processed': bool(ticket.Enviado),
-            'url': url_for('warehouse.ticket_detail', ticket_id=ticket.IdTicket)
-        })
-    
-    return jsonify(results) 
\ No newline at end of file
+    if request.if_none_match.contains(result.etag):
+        # Stessa ricerca, stessi dati: nessun corpo da costruire
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify([
+            dict(item, url=url_for('warehouse.ticket_detail', ticket_id=item['id']))
+            for item in result.items
+        ])
+    response.set_etag(result.etag)
+    # Il browser rivalida ogni volta: se nulla è cambiato riceve un 304
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response 
\ No newline at end of file
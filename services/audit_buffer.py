@@ -0,0 +1,366 @@
+"""
+Audit buffer - scrittura differita (write-behind) dei log di scansione
+
+Ogni scansione scriveva la propria riga di scan_log (o task_ticket_scans) con
+un commit dedicato, più un flush per ottenere l'id autoincrement: durante il
+carico di un camion il fsync per scansione era il limite alla latenza.
+
+Le righe vengono invece accodate in memoria e scritte da un thread in
+background con INSERT multi-riga ogni AUDIT_FLUSH_INTERVAL_MS o appena in coda
+ci sono AUDIT_FLUSH_MAX_ROWS righe. Il client riceve subito un id generato
+dall'app (client_id, uuid4 esadecimale) che identifica la riga anche prima
+della scrittura.
+
+Modalità di durabilità (AUDIT_DURABILITY_MODE):
+- buffered: write-behind; in caso di crash del processo si perdono al più le
+  righe degli ultimi AUDIT_FLUSH_INTERVAL_MS. La coda viene scritta allo
+  shutdown (atexit).
+- sync: le righe vengono aggiunte alla sessione della richiesta e scritte nel
+  suo commit, come prima.
+
+Le scritture che devono essere lette nella stessa richiesta (es. le
+scansioni riuscite che fanno avanzare il task) usano durable=True e passano
+sempre dalla sessione.
+"""
+
+import atexit
+import logging
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from sqlalchemy import insert
+from sqlalchemy.exc import DBAPIError, InterfaceError, OperationalError, SQLAlchemyError
+
+from app.models import db, ScanLog, TaskTicketScan
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_MODES = ('buffered', 'sync')
+DEFAULT_FLUSH_INTERVAL_MS = 250
+DEFAULT_FLUSH_MAX_ROWS = 200
+DEFAULT_MAX_PENDING = 10000
+
+_buffer = None
+
+
+def new_client_id():
+    return uuid.uuid4().hex
+
+
+def _column_defaults(table):
+    """Values for the columns left out of a row, so every row of a batch has the same keys"""
+    defaults = {}
+    for column in table.columns:
+        if column.primary_key:
+            continue
+        default = column.default
+        if default is None:
+            defaults[column.key] = None
+        elif default.is_scalar or default.is_callable:
+            # I default callable (es. datetime.utcnow) sono già avvolti da SQLAlchemy: arg(context)
+            defaults[column.key] = default.arg
+        else:
+            defaults[column.key] = None
+    return defaults
+
+
+class AuditWriteBuffer:
+    """Per-process queue of audit rows flushed in multi-row INSERTs by a daemon thread"""
+
+    def __init__(self, app, durability='buffered', flush_interval_ms=DEFAULT_FLUSH_INTERVAL_MS,
+                 flush_max_rows=DEFAULT_FLUSH_MAX_ROWS, max_pending=DEFAULT_MAX_PENDING):
+        self.app = app
+        self.durability = durability if durability in DURABILITY_MODES else 'buffered'
+        self.flush_interval = max(int(flush_interval_ms), 10) / 1000.0
+        self.flush_max_rows = max(int(flush_max_rows), 1)
+        self.max_pending = max(int(max_pending), self.flush_max_rows)
+        self._lock = threading.Lock()
+        # Un solo flush alla volta: chi attende il lock trova le righe in scrittura già committate
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._pending = {}
+        self._defaults = {}
+        self.flushed_rows = 0
+        self.flush_count = 0
+        self.dropped_rows = 0
+        self.last_flush_ms = None
+        self.last_error = None
+
+    @property
+    def is_buffered(self):
+        return self.durability == 'buffered'
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    @property
+    def pending_count(self):
+        with self._lock:
+            return sum(len(rows) for rows in self._pending.values())
+
+    def _row(self, model, values):
+        table = model.__table__
+        defaults = self._defaults.get(table.name)
+        if defaults is None:
+            defaults = self._defaults[table.name] = _column_defaults(table)
+        row = {}
+        for key, default in defaults.items():
+            if key in values:
+                row[key] = values[key]
+            else:
+                row[key] = default(None) if callable(default) else default
+        return row
+
+    def add(self, model, values):
+        """Queue a row for model; returns its client_id"""
+        values = dict(values)
+        client_id = values.setdefault('client_id', new_client_id())
+        row = self._row(model, values)
+
+        with self._lock:
+            rows = self._pending.setdefault(model.__table__.name, [])
+            rows.append(row)
+            queued = sum(len(table_rows) for table_rows in self._pending.values())
+            if queued > self.max_pending:
+                # Database irraggiungibile da troppo tempo: si scartano le righe più vecchie
+                del rows[0]
+                self.dropped_rows += 1
+                if self.dropped_rows % 100 == 1:
+                    logger.error(f"Buffer log di scansione pieno ({self.max_pending} righe): "
+                                 f"{self.dropped_rows} righe scartate finora")
+
+        self.start()
+        if queued >= self.flush_max_rows:
+            self._wake.set()
+        return client_id
+
+    def update_pending(self, model, client_id, values):
+        """Update a row still waiting in the queue; returns False if it is not queued"""
+        with self._lock:
+            for row in self._pending.get(model.__table__.name, ()):
+                if row['client_id'] == client_id:
+                    row.update(values)
+                    return True
+        return False
+
+    def flush(self):
+        """Write every queued row; returns the number of rows written"""
+        with self._flush_lock:
+            with self._lock:
+                batches, self._pending = self._pending, {}
+            if not any(batches.values()):
+                return 0
+
+            start = time.perf_counter()
+            written = 0
+            with self.app.app_context():
+                for table_name, rows in batches.items():
+                    if rows:
+                        written += self._write(db.metadata.tables[table_name], rows)
+
+            self.flushed_rows += written
+            self.flush_count += 1
+            self.last_flush_ms = int((time.perf_counter() - start) * 1000)
+            return written
+
+    def _write(self, table, rows):
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(insert(table), rows)
+            return len(rows)
+        except DBAPIError as e:
+            self.last_error = f"{datetime.now().isoformat(timespec='seconds')} {table.name}: {str(e.orig or e)}"
+            if self._is_transient(e):
+                # Database non raggiungibile: le righe tornano in testa alla coda
+                logger.warning(f"Scrittura differita {table.name} rinviata ({len(rows)} righe): {str(e)}")
+                self._requeue(table.name, rows)
+                return 0
+            # Riga non valida nel batch: si scrive una riga alla volta per non perdere le altre
+            return self._write_one_by_one(table, rows)
+        except SQLAlchemyError as e:
+            self.last_error = f"{datetime.now().isoformat(timespec='seconds')} {table.name}: {str(e)}"
+            logger.warning(f"Scrittura differita {table.name} rinviata ({len(rows)} righe): {str(e)}")
+            self._requeue(table.name, rows)
+            return 0
+
+    @staticmethod
+    def _is_transient(error):
+        return error.connection_invalidated or isinstance(error, (OperationalError, InterfaceError))
+
+    def _write_one_by_one(self, table, rows):
+        written = 0
+        with db.engine.connect() as conn:
+            for row in rows:
+                try:
+                    with conn.begin():
+                        conn.execute(insert(table), row)
+                    written += 1
+                except SQLAlchemyError as e:
+                    self.dropped_rows += 1
+                    logger.error(f"Riga {table.name} scartata (client_id {row.get('client_id')}): {str(e)}")
+        return written
+
+    def _requeue(self, table_name, rows):
+        with self._lock:
+            self._pending[table_name] = rows + self._pending.get(table_name, [])
+
+    def start(self):
+        if self.is_running or self._stop_event.is_set():
+            return
+        with self._lock:
+            if self.is_running:
+                return
+            self._thread = threading.Thread(target=self._run_loop, name='audit-buffer', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """Stop the flusher thread and write what is left in the queue"""
+        self._stop_event.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        try:
+            written = self.flush()
+            if written:
+                logger.info(f"Buffer log di scansione svuotato allo shutdown: {written} righe")
+        except Exception as e:
+            logger.error(f"Errore nello svuotamento del buffer log allo shutdown: {str(e)}")
+
+    def _run_loop(self):
+        while not self._stop_event.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            if self._stop_event.is_set():
+                break
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Errore nel thread del buffer log di scansione: {str(e)}")
+
+    def stats(self):
+        return {
+            'durability': self.durability,
+            'running': self.is_running,
+            'pending': self.pending_count,
+            'flushed_rows': self.flushed_rows,
+            'flush_count': self.flush_count,
+            'dropped_rows': self.dropped_rows,
+            'last_flush_ms': self.last_flush_ms,
+            'last_error': self.last_error,
+            'flush_interval_ms': int(self.flush_interval * 1000),
+            'flush_max_rows': self.flush_max_rows
+        }
+
+
+def _record(model, values, durable):
+    values = dict(values)
+    values.setdefault('client_id', new_client_id())
+    if _buffer is None or durable or not _buffer.is_buffered:
+        # Scrittura nella transazione della richiesta: il commit resta al chiamante
+        db.session.add(model(**values))
+        return values['client_id']
+    return _buffer.add(model, values)
+
+
+def record_scan_log(durable=False, **values):
+    """Record a scan_log row; returns its client_id.
+
+    In buffered mode the row is written by the background flusher, otherwise
+    it is added to the current session and the caller commits it.
+    """
+    values.setdefault('timestamp', datetime.utcnow())
+    return _record(ScanLog, values, durable)
+
+
+def record_task_scan(durable=False, **values):
+    """Record a task_ticket_scans row; returns its client_id (see record_scan_log).
+
+    Use durable=True for rows that must be visible to queries in the same
+    request (e.g. the success scans counted by update_scan_progress).
+    """
+    values.setdefault('scanned_at', datetime.utcnow())
+    return _record(TaskTicketScan, values, durable)
+
+
+def update_scan_log(scan_log_id, wait=True, **values):
+    """Update a scan_log row by client_id (or legacy numeric id) wherever it is.
+
+    The row may still be queued in this process, being written, or already in
+    the database. With wait=True, a row queued by another worker is given one
+    flush interval to reach the database. Call it before making other changes
+    in the session: a retry rolls the session back to see the new rows.
+
+    Returns:
+        bool: False if the row was not found
+    """
+    client_id = str(scan_log_id)
+    if _buffer is not None and _buffer.update_pending(ScanLog, client_id, values):
+        return True
+
+    def find():
+        log = ScanLog.query.filter_by(client_id=client_id).first()
+        if log is None and client_id.isdigit():
+            log = ScanLog.query.get(int(client_id))
+        return log
+
+    log = find()
+    if log is None and _buffer is not None and _buffer.is_buffered:
+        # Riga in scrittura in questo processo, o ancora in coda in un altro worker
+        _buffer.flush()
+        db.session.rollback()
+        log = find()
+        if log is None and wait:
+            time.sleep(_buffer.flush_interval)
+            db.session.rollback()
+            log = find()
+    if log is None:
+        return False
+
+    for key, value in values.items():
+        setattr(log, key, value)
+    return True
+
+
+def flush_audit_buffer():
+    """Write the queued rows now (e.g. before a report on scan_log)"""
+    return _buffer.flush() if _buffer is not None else 0
+
+
+def get_audit_buffer_stats():
+    if _buffer is None:
+        return {'durability': 'sync', 'running': False, 'pending': 0}
+    return _buffer.stats()
+
+
+def init_app(app):
+    """Create the buffer of this process and register the shutdown flush.
+
+    The flusher thread starts with the first queued row, so CLI commands
+    never spawn it.
+    """
+    global _buffer
+    from app.config import get_audit_buffer_config_from_file
+
+    if _buffer is not None:
+        return
+
+    config = get_audit_buffer_config_from_file()
+    if config['durability'] not in DURABILITY_MODES:
+        logger.warning(f"AUDIT_DURABILITY_MODE '{config['durability']}' non valido, uso 'buffered'")
+
+    _buffer = AuditWriteBuffer(
+        app,
+        durability=config['durability'],
+        flush_interval_ms=config['flush_interval_ms'],
+        flush_max_rows=config['flush_max_rows'],
+        max_pending=config['max_pending']
+    )
+    atexit.register(_buffer.stop)
+    logger.info(f"Log di scansione: modalità {_buffer.durability}"
+                + (f" (flush ogni {int(_buffer.flush_interval * 1000)} ms o {_buffer.flush_max_rows} righe)"
+                   if _buffer.is_buffered else ''))
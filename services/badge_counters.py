@@ -0,0 +1,308 @@
+"""
+Badge counters - contatori in cache per badge dei filtri e dashboard
+
+Lista ticket, dettaglio ticket, home magazzino, dashboard admin e lista DDT
+mostrano conteggi (ticket per stato, in scadenza, scansioni, utenti,
+articoli, DDT) che prima venivano ricalcolati con una COUNT per valore ad
+ogni pagina.
+
+I conteggi sono calcolati con una query raggruppata per gruppo e tenuti in
+memoria nel processo. Validità:
+- ogni gruppo ha una generazione in counter_generations, incrementata dopo
+  il commit delle modifiche che cambiano i conteggi (gruppi raccolti dall'hook
+  di flush su TicketHeader/Product/User/AlbaranCabecera e da
+  invalidate_counters per gli update in blocco), in una transazione breve
+  propria: la riga del gruppo non resta bloccata per tutta la transazione di
+  checkout, DDT o scansione; ogni worker rilegge le generazioni al più ogni
+  GENERATION_CHECK_SECONDS e ricalcola i gruppi cambiati, il worker che ha
+  fatto la modifica subito dopo il commit
+- in ogni caso un valore non è mai più vecchio di COUNTER_TTL_SECONDS
+  (ticket arrivati dalle bilance, scansioni scritte dal buffer dei log)
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, event, func, insert, inspect, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.models import db, AlbaranCabecera, CounterGeneration, Product, ScanLog, TicketHeader, TicketSummary, User
+from services.ticket_summary import expiring_conditions
+
+logger = logging.getLogger(__name__)
+
+TICKETS = 'tickets'
+CATALOG = 'catalog'
+SCANS = 'scans'
+DDTS = 'ddts'
+
+COUNTER_TTL_SECONDS = 120
+SCAN_COUNTER_TTL_SECONDS = 60
+GENERATION_CHECK_SECONDS = 2
+
+_listeners_registered = False
+
+
+class CounterCache:
+    """Process-wide cache of counter groups validated against counter_generations"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._generations = {}
+        self._generations_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def _current_generations(self):
+        now = time.monotonic()
+        with self._lock:
+            if now - self._generations_at <= GENERATION_CHECK_SECONDS:
+                return self._generations
+        try:
+            with db.engine.connect() as conn:
+                generations = dict(conn.execute(
+                    select(CounterGeneration.name, CounterGeneration.generation)
+                ).all())
+        except SQLAlchemyError as e:
+            # Tabella non ancora creata: restano validi solo i TTL
+            logger.warning(f"Generazioni contatori non disponibili: {str(e)}")
+            generations = {}
+        with self._lock:
+            self._generations = generations
+            self._generations_at = now
+        return generations
+
+    def get(self, group, key, loader, ttl=COUNTER_TTL_SECONDS):
+        """Cached value of loader(conn) for (group, key), recomputed when stale"""
+        cache_key = (group, key)
+        with self._lock:
+            entry = self._entries.get(cache_key)
+        now = time.monotonic()
+
+        if entry is not None and now - entry[2] <= ttl:
+            if group == SCANS or entry[1] == self._current_generations().get(group, 0):
+                self.hits += 1
+                return entry[0]
+
+        self.misses += 1
+        # Generazione letta prima dei conteggi: una modifica concorrente forza un nuovo ricalcolo
+        generation = self._current_generations().get(group, 0)
+        # Connessione dedicata: la sessione della richiesta può avere uno snapshot più vecchio
+        with db.engine.connect() as conn:
+            value = loader(conn)
+        with self._lock:
+            self._entries[cache_key] = (value, generation, time.monotonic())
+        return value
+
+    def evict(self, groups):
+        with self._lock:
+            for cache_key in [k for k in self._entries if k[0] in groups]:
+                del self._entries[cache_key]
+            # La prossima lettura rilegge le generazioni incrementate da questo processo
+            self._generations_at = 0.0
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._generations_at = 0.0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'generations': dict(self._generations)}
+
+
+_cache = CounterCache()
+
+
+def _load_ticket_status(conn):
+    rows = conn.execute(
+        select(TicketSummary.Enviado, func.count(TicketSummary.IdTicket)).group_by(TicketSummary.Enviado)
+    ).all()
+    return {status: count for status, count in rows}
+
+
+def get_ticket_status_counts():
+    """{Enviado: numero di ticket} from ticket_summary, one grouped query"""
+    return _cache.get(TICKETS, 'status', _load_ticket_status)
+
+
+def get_ticket_count(status=None):
+    """Tickets with the given Enviado, or all tickets if status is None"""
+    counts = get_ticket_status_counts()
+    if status is None:
+        return sum(counts.values())
+    return counts.get(status, 0)
+
+
+def get_expiring_count(warning_days, today=None):
+    """In-task tickets expiring within warning_days (the 'In scadenza' badge)"""
+    today = today or datetime.now().date()
+
+    def load(conn):
+        return conn.execute(
+            select(func.count(TicketSummary.IdTicket)).where(*expiring_conditions(warning_days, today=today))
+        ).scalar() or 0
+
+    # Il giorno fa parte della chiave: a mezzanotte la finestra si sposta
+    return _cache.get(TICKETS, ('expiring', warning_days, today), load)
+
+
+def get_catalog_counts():
+    """Users, admin users and products"""
+    def load(conn):
+        total_users, admin_users = conn.execute(select(
+            func.count(User.id),
+            func.coalesce(func.sum(case((User.is_admin == True, 1), else_=0)), 0)
+        )).one()
+        return {
+            'users': total_users,
+            'admin_users': int(admin_users),
+            'products': conn.execute(select(func.count(Product.IdArticulo))).scalar() or 0
+        }
+
+    return _cache.get(CATALOG, 'totals', load)
+
+
+def get_ddt_count():
+    """DDT headers (the total of the DDT list)"""
+    def load(conn):
+        return conn.execute(select(func.count(AlbaranCabecera.IdAlbaran))).scalar() or 0
+
+    return _cache.get(DDTS, 'total', load)
+
+
+def get_scan_counts(today=None):
+    """Scans of today and checkout/view totals (refreshed by time only)"""
+    today = today or datetime.utcnow().date()
+
+    def load(conn):
+        by_action = dict(conn.execute(
+            select(ScanLog.action, func.count(ScanLog.id)).where(
+                ScanLog.action.in_(('checkout', 'view'))
+            ).group_by(ScanLog.action)
+        ).all())
+        today_scans = conn.execute(select(func.count(ScanLog.id)).where(
+            ScanLog.timestamp >= today,
+            ScanLog.timestamp < today + timedelta(days=1)
+        )).scalar() or 0
+        return {
+            'today': today_scans,
+            'checkout': by_action.get('checkout', 0),
+            'view': by_action.get('view', 0)
+        }
+
+    return _cache.get(SCANS, ('totals', today), load, ttl=SCAN_COUNTER_TTL_SECONDS)
+
+
+def get_scan_activity(days=7, top_users=5):
+    """Most active users and scans per day over the last days (refreshed by time only).
+
+    Returns:
+        tuple: (rows username/scan_count, rows date/count)
+    """
+    def load(conn):
+        active_users = conn.execute(select(
+            User.username,
+            func.count(ScanLog.id).label('scan_count')
+        ).join(ScanLog, ScanLog.user_id == User.id).group_by(User.id, User.username).order_by(
+            func.count(ScanLog.id).desc()
+        ).limit(top_users)).all()
+
+        since = datetime.utcnow() - timedelta(days=days)
+        day = func.date(ScanLog.timestamp)
+        daily_activity = conn.execute(select(
+            day.label('date'),
+            func.count(ScanLog.id).label('count')
+        ).where(ScanLog.timestamp >= since).group_by(day).order_by(day)).all()
+        return active_users, daily_activity
+
+    return _cache.get(SCANS, ('activity', days, top_users), load, ttl=SCAN_COUNTER_TTL_SECONDS)
+
+
+def _bump_generations(groups):
+    """Increment the generation of groups in a short transaction of its own"""
+    table = CounterGeneration.__table__
+    now = datetime.utcnow()
+    try:
+        with db.engine.begin() as conn:
+            for group in sorted(groups):
+                result = conn.execute(update(table).where(table.c.name == group).values(
+                    generation=table.c.generation + 1, updated_at=now
+                ))
+                if result.rowcount == 0:
+                    conn.execute(insert(table).values(name=group, generation=1, updated_at=now))
+    except SQLAlchemyError as e:
+        # I contatori non devono bloccare checkout/DDT: resta il TTL
+        logger.warning(f"Aggiornamento generazioni contatori fallito: {str(e)}")
+
+
+def invalidate_counters(*groups):
+    """Mark groups as changed by the current transaction (for bulk updates that
+    bypass the flush hook). The caller commits; the generations are bumped and
+    this process drops its cached values after the commit."""
+    groups = set(groups)
+    if groups:
+        db.session.info.setdefault('badge_counter_groups', set()).update(groups)
+
+
+def get_generations(*groups):
+    """Current generations of groups (re-read at most every GENERATION_CHECK_SECONDS),
+    for other caches that depend on the same data"""
+    generations = _cache._current_generations()
+    return tuple(generations.get(group, 0) for group in groups)
+
+
+def get_counter_stats():
+    return _cache.stats()
+
+
+def _changed_groups(session):
+    groups = set()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, TicketHeader):
+            groups.add(TICKETS)
+        elif isinstance(obj, (Product, User)):
+            groups.add(CATALOG)
+        elif isinstance(obj, AlbaranCabecera):
+            groups.add(DDTS)
+    for obj in session.dirty:
+        if isinstance(obj, TicketHeader):
+            if inspect(obj).attrs.Enviado.history.has_changes():
+                groups.add(TICKETS)
+        elif isinstance(obj, User):
+            if inspect(obj).attrs.is_admin.history.has_changes():
+                groups.add(CATALOG)
+    return groups
+
+
+def _collect_after_flush(session, flush_context):
+    groups = _changed_groups(session)
+    if groups:
+        session.info.setdefault('badge_counter_groups', set()).update(groups)
+
+
+def _bump_after_commit(session):
+    groups = session.info.pop('badge_counter_groups', None)
+    if groups:
+        # Dopo il commit, fuori dalla transazione: le modifiche sono già visibili agli altri worker
+        _bump_generations(groups)
+        _cache.evict(groups)
+
+
+def _discard_after_rollback(session):
+    session.info.pop('badge_counter_groups', None)
+
+
+def init_app(app):
+    """Register the invalidation hooks"""
+    global _listeners_registered
+
+    if not _listeners_registered:
+        event.listen(db.session, 'after_flush', _collect_after_flush)
+        event.listen(db.session, 'after_commit', _bump_after_commit)
+        event.listen(db.session, 'after_rollback', _discard_after_rollback)
+        _listeners_registered = True
@@ -1,7 +1,9 @@
 from flask import Blueprint, render_template, request, jsonify, flash
 from flask_login import login_required, current_user
 from app.models import db, ChatMessage, ChatRoom, User
-from datetime import datetime, timedelta
+from services.notification_feed import announce_presence, get_online_users, get_user_counters
+from services.pagination import keyset_paginate
+from datetime import datetime
 import logging
 from functools import wraps
 
@@ -9,9 +11,6 @@ logger = logging.getLogger(__name__)
 
 chat_bp = Blueprint('chat', __name__)
 
-# Store for tracking online users (in production, use Redis or similar)
-online_users = {}
-
 def api_login_required(f):
     """
     Decorator personalizzato per API che devono restituire JSON 
@@ -29,31 +28,13 @@ def api_login_required(f):
     return decorated_function
 
 def update_user_activity():
-    """Update user's last activity timestamp"""
+    """Update user's last activity timestamp (shared with the other workers)"""
     if current_user.is_authenticated:
-        online_users[current_user.id] = {
-            'user_id': current_user.id,
-            'username': current_user.username,
-            'last_activity': datetime.utcnow()
-        }
+        announce_presence(current_user.id, current_user.username)
 
 def get_online_users_list():
     """Get list of users active in the last 5 minutes"""
-    cutoff_time = datetime.utcnow() - timedelta(minutes=5)
-    active_users = []
-    
-    # Clean up old entries
-    to_remove = []
-    for user_id, user_data in online_users.items():
-        if user_data['last_activity'] < cutoff_time:
-            to_remove.append(user_id)
-        else:
-            active_users.append(user_data)
-    
-    for user_id in to_remove:
-        del online_users[user_id]
-    
-    return active_users
+    return get_online_users()
 
 @chat_bp.route('/api/messages', methods=['GET'])
 @api_login_required
@@ -66,9 +47,9 @@ def get_messages():
         per_page = request.args.get('per_page', 50, type=int)
         
         # Get messages ordered by timestamp (newest first for pagination, but we'll reverse for display)
-        messages = ChatMessage.query.order_by(ChatMessage.timestamp.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
-        )
+        # Con ?cursor=<next_cursor> i messaggi più vecchi vengono letti per chiave, senza OFFSET
+        messages = keyset_paginate(ChatMessage.query, ChatMessage.timestamp, ChatMessage.id,
+                                   page=page, per_page=per_page, cursor=request.args.get('cursor'))
         
         # Convert to dict and reverse order for proper display (oldest first)
         messages_data = [msg.to_dict() for msg in reversed(messages.items)]
@@ -77,6 +58,7 @@ def get_messages():
             'success': True,
             'messages': messages_data,
             'has_more': messages.has_next,
+            'next_cursor': messages.next_cursor,
             'total': messages.total
         })
     except Exception as e:
@@ -209,11 +191,8 @@ def get_unread_count():
     try:
         update_user_activity()
         
-        # Count only messages from OTHER users that are not read
-        count = ChatMessage.query.filter(
-            ChatMessage.user_id != current_user.id,
-            ChatMessage.is_read == False
-        ).count()
+        # Count only messages from OTHER users that are not read (cached, invalidated by the chat events)
+        count = get_user_counters(current_user)['chat']
         
         logger.info(f"Unread count for user {current_user.id}: {count}")
         
@@ -0,0 +1,332 @@
+"""
+DDT builder - righe del DDT (dat_albaran_linea) dai ticket selezionati
+
+ddt.create e tasks.generate_ddt_from_task scorrevano ticket e linee e per
+ogni linea leggevano prodotto e articolo (Product.query.get,
+Article.query.get), poi aggiungevano alla sessione un AlbaranLinea con un
+centinaio di assegnazioni: un DDT da 150 linee faceva più di 300 letture
+puntuali e 150 INSERT.
+
+Ora entrambi usano DDTBuilder:
+- linee dei ticket, prodotti e articoli sono letti con tre query IN per
+  tutta la selezione (per i task solo le linee con una scansione riuscita);
+  resolve_ticket_lines() restituisce valori semplici, così l'anteprima li
+  conserva nella bozza (services.ddt_preview) e ddt.create li riusa
+- i valori di ogni riga (IVA, sconto del ticket, importi) sono calcolati in
+  un solo passaggio, anche per le righe dei ticket manuali
+- le righe sono scritte con un solo INSERT multi-riga (executemany) e i
+  totali riportati sull'intestazione
+
+mark_processed() porta i ticket a Enviado = 1 con un solo UPDATE; come per
+le altre modifiche in blocco riepilogo e contatori sono allineati qui, la
+cache delle scansioni dal chiamante dopo il commit (invalidate_tickets).
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import exists, insert, select
+
+from app.models import (db, AlbaranLinea, Article, Product, TaskTicket, TaskTicketScan,
+                        TicketHeader, TicketLine)
+from services.badge_counters import TICKETS, invalidate_counters
+from services.ticket_summary import set_summary_status
+
+logger = logging.getLogger(__name__)
+
+# IdIva -> aliquota
+VAT_RATES = {1: 0.04, 2: 0.10, 3: 0.22}
+
+# Prodotto di riferimento delle righe dei ticket manuali (ddt.ensure_custom_product_exists)
+CUSTOM_PRODUCT_ID = 999
+
+ENVIADO_PROCESSED = 1
+
+
+def vat_rate(id_iva):
+    return VAT_RATES.get(id_iva, 0)
+
+
+def _parse_timestamp(value):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def _parse_expiry(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def resolve_ticket_lines(ticket_ids, scanned_in_task=None):
+    """Lines of ticket_ids with the product and article values of their DDT row.
+
+    Three queries for the whole selection. The values are plain JSON types
+    (dates as ISO strings), so the preview draft can keep them until the DDT
+    is created (DDTBuilder.add_resolved).
+
+    Args:
+        scanned_in_task: task id; only lines with a successful scan in that
+            task are included
+
+    Returns:
+        dict: ticket id -> [{id_linea_ticket, precio, id_iva, peso, values}],
+            lines of missing products skipped
+    """
+    ticket_ids = list({int(ticket_id) for ticket_id in ticket_ids})
+    if not ticket_ids:
+        return {}
+
+    # 1. Linee dei ticket (solo ticket esistenti, come prima)
+    statement = select(TicketLine).join(
+        TicketHeader, TicketHeader.IdTicket == TicketLine.IdTicket
+    ).where(TicketLine.IdTicket.in_(ticket_ids))
+    if scanned_in_task is not None:
+        statement = statement.where(exists().where(
+            TaskTicket.task_id == scanned_in_task,
+            TaskTicket.ticket_id == TicketLine.IdTicket,
+            TaskTicketScan.task_ticket_id == TaskTicket.id,
+            TaskTicketScan.ticket_line_id == TicketLine.IdLineaTicket,
+            TaskTicketScan.status == 'success'
+        ))
+    lines = db.session.execute(statement.order_by(TicketLine.IdLineaTicket)).scalars().all()
+
+    # 2-3. Prodotti e articoli di tutte le linee
+    product_ids = {line.IdArticulo for line in lines}
+    products = {}
+    articles = {}
+    if product_ids:
+        products = {product.IdArticulo: product for product in db.session.execute(
+            select(Product).where(Product.IdArticulo.in_(product_ids))
+        ).scalars()}
+        articles = {row.IdArticulo: row for row in db.session.execute(select(
+            Article.IdArticulo, Article.Descripcion1, Article.IdClase, Article.IdSeccion,
+            Article.IdDepartamento, Article.Texto1
+        ).where(Article.IdArticulo.in_(product_ids))).all()}
+
+    resolved = {}
+    for line in lines:
+        product = products.get(line.IdArticulo)
+        if product is None:
+            logger.warning(f"Prodotto {line.IdArticulo} non trovato, riga del ticket {line.IdTicket} saltata")
+            continue
+        article = articles.get(line.IdArticulo)
+        resolved.setdefault(line.IdTicket, []).append({
+            'id_linea_ticket': line.IdLineaTicket,
+            'precio': float(product.PrecioConIVA) if product.PrecioConIVA is not None else 0.0,
+            'id_iva': product.IdIva,
+            'peso': float(line.Peso) if line.Peso is not None else 1.0,
+            'values': {
+                'IdArticulo': line.IdArticulo,
+                'Descripcion': line.Descripcion or product.Descripcion,
+                'Descripcion1': (article.Descripcion1 or '') if article else '',
+                'Comportamiento': getattr(line, 'comportamiento', 0),
+                'ComportamientoDevolucion': getattr(line, 'comportamiento_devolucion', 0),
+                'EntradaManual': 0,
+                'FechaCaducidad': line.FechaCaducidad.isoformat() if line.FechaCaducidad else None,
+                'IdClase': article.IdClase if article else None,
+                'IdFamilia': product.IdFamilia,
+                'NombreFamilia': '',
+                'IdSeccion': article.IdSeccion if article else None,
+                'IdSubFamilia': product.IdSubFamilia,
+                'NombreSubFamilia': None,
+                'IdDepartamento': article.IdDepartamento if article else None,
+                'NombreDepartamento': None,
+                'Texto1': getattr(line, 'Texto1', None) or (article.Texto1 if article else None) or ''
+            }
+        })
+    return resolved
+
+
+class DDTBuilder:
+    """Lines of one DDT, collected in memory and written with one INSERT.
+
+    Usage: add_tickets() / add_manual_tickets(), then write() in the
+    transaction that created the header (already flushed).
+    """
+
+    def __init__(self, header, user_name, ticket_discounts=None, now=None):
+        self.header = header
+        self.user_name = user_name
+        self.ticket_discounts = ticket_discounts or {}
+        self.now = now or datetime.utcnow()
+        self.rows = []
+        self.total_without_vat = 0.0
+        self.total_vat = 0.0
+
+    def _discount(self, ticket_id):
+        try:
+            return float(self.ticket_discounts.get(str(ticket_id), 0) or 0)
+        except (TypeError, ValueError):
+            return 0.0
+
+    def _add_row(self, ticket_id, discount_ticket_id, price_with_vat, id_iva, peso, **values):
+        """Compute the amounts of one line and queue its row; every row has the same columns"""
+        rate = vat_rate(id_iva)
+        price_without_vat = price_with_vat / (1 + rate)
+        line_total = price_without_vat * peso
+        line_vat = line_total * rate
+
+        discount = self._discount(discount_ticket_id)
+        if discount > 0:
+            factor = 1 - (discount / 100)
+            line_total *= factor
+            line_vat *= factor
+
+        header = self.header
+        row = {
+            'IdLineaAlbaran': len(self.rows) + 1,
+            'IdEmpresa': header.IdEmpresa,
+            'IdTienda': header.IdTienda,
+            'IdBalanzaMaestra': header.IdBalanzaMaestra,
+            'IdBalanzaEsclava': header.IdBalanzaEsclava,
+            'IdAlbaran': header.IdAlbaran,
+            'TipoVenta': header.TipoVenta,
+            'IdTicket': ticket_id,
+            'EstadoLinea': 0,
+            'Tara': 0.0,
+            'Peso': peso,
+            'Medida2': 'un',
+            'PrecioPorCienGramos': 0,
+            'Precio': 0.0,
+            'PrecioSinIVA': price_without_vat,
+            'IdIVA': id_iva,
+            'PorcentajeIVA': rate * 100,
+            'RecargoEquivalencia': 0.0,
+            'Descuento': discount if discount > 0 else 0.0,
+            'TipoDescuento': 1,
+            'Importe': line_total + line_vat,
+            'ImporteSinIVASinDtoL': line_total,
+            'ImporteSinIVAConDtoL': line_total,
+            'ImporteDelIVAConDtoL': line_vat,
+            'ImporteSinIVAConDtoLConDtoTotal': line_total,
+            'ImporteDelIVAConDtoLConDtoTotal': line_vat,
+            'ImporteDelRE': 0.0,
+            'ImporteDelDescuento': line_total * (discount / 100) if discount > 0 else 0.0,
+            'ImporteConDtoTotal': line_total + line_vat,
+            'NombreClase': 'ARTICOLI',
+            'Facturada': 0,
+            'CantidadFacturada': 0.0,
+            'CantidadFacturada2': 0.0,
+            'HayTaraAplicada': 0,
+            'Modificado': 1,
+            'Operacion': 'A',
+            'Usuario': self.user_name,
+            'TimeStamp': self.now
+        }
+        row.update(values)
+        self.rows.append(row)
+        self.total_without_vat += line_total
+        self.total_vat += line_vat
+
+    def add_tickets(self, ticket_ids, scanned_in_task=None):
+        """Queue the lines of ticket_ids, in ticket order.
+
+        Args:
+            scanned_in_task: task id; only lines with a successful scan in
+                that task are included
+
+        Returns:
+            int: lines queued (lines of missing products are skipped)
+        """
+        ticket_ids = list(dict.fromkeys(int(ticket_id) for ticket_id in ticket_ids))
+        resolved = resolve_ticket_lines(ticket_ids, scanned_in_task)
+        return self.add_resolved((ticket_id, resolved.get(ticket_id, [])) for ticket_id in ticket_ids)
+
+    def add_resolved(self, tickets):
+        """Queue lines already read by resolve_ticket_lines() (e.g. kept by the preview draft).
+
+        Args:
+            tickets: iterable of (ticket id, resolved lines), in DDT order
+
+        Returns:
+            int: lines queued
+        """
+        added = 0
+        for ticket_id, lines in tickets:
+            for line in lines:
+                values = dict(line['values'])
+                values['FechaCaducidad'] = _parse_timestamp(values.get('FechaCaducidad'))
+                self._add_row(ticket_id, ticket_id, line['precio'], line['id_iva'], line['peso'], **values)
+                added += 1
+        return added
+
+    def add_manual_tickets(self, manual_tickets):
+        """Queue the lines of the manual tickets ({id_ticket, lines: [...]} from the browser)"""
+        added = 0
+        for manual_ticket in manual_tickets:
+            for line in manual_ticket.get('lines', []):
+                self._add_row(
+                    None, manual_ticket.get('id_ticket'),
+                    float(line['precio']),
+                    line.get('id_iva', 3),  # Default 22%
+                    float(line['peso']),
+                    IdArticulo=CUSTOM_PRODUCT_ID,
+                    Descripcion=line['descripcion'],
+                    Descripcion1='Prodotto manuale',
+                    Comportamiento=line.get('comportamiento', 1),
+                    ComportamientoDevolucion=0,
+                    EntradaManual=1,
+                    FechaCaducidad=_parse_expiry(line.get('fecha_caducidad')),
+                    IdClase=1,
+                    IdFamilia=1,
+                    NombreFamilia='MANUALE',
+                    IdSeccion=None,
+                    IdSubFamilia=1,
+                    NombreSubFamilia='MANUALE',
+                    IdDepartamento=1,
+                    NombreDepartamento='MANUALE',
+                    Texto1='Prodotto aggiunto manualmente'
+                )
+                added += 1
+        return added
+
+    @property
+    def line_count(self):
+        return len(self.rows)
+
+    def write(self):
+        """Insert the queued rows with one multi-row INSERT and set the header totals.
+
+        Returns:
+            int: lines written
+        """
+        if self.rows:
+            db.session.execute(insert(AlbaranLinea.__table__), self.rows)
+
+        total = self.total_without_vat + self.total_vat
+        header = self.header
+        header.NumLineas = len(self.rows)
+        header.ImporteLineas = total
+        header.ImporteTotal = total
+        header.ImporteTotalSinIVAConDtoL = self.total_without_vat
+        header.ImporteTotalDelIVAConDtoLConDtoTotal = self.total_vat
+        header.ImporteTotalSinIVAConDtoLConDtoTotal = self.total_without_vat
+
+        logger.info(f"DDT #{header.IdAlbaran}: {len(self.rows)} righe, senza IVA €{self.total_without_vat:.2f}, "
+                    f"IVA €{self.total_vat:.2f}, totale €{total:.2f}")
+        return len(self.rows)
+
+
+def mark_processed(ticket_ids):
+    """Set Enviado = 1 on ticket_ids with one UPDATE, in the current transaction.
+
+    The caller commits, then calls scan_resolution.invalidate_tickets(ticket_ids).
+
+    Returns:
+        int: tickets updated
+    """
+    ticket_ids = list({int(ticket_id) for ticket_id in ticket_ids})
+    if not ticket_ids:
+        return 0
+    updated = db.session.query(TicketHeader).filter(
+        TicketHeader.IdTicket.in_(ticket_ids)
+    ).update({TicketHeader.Enviado: ENVIADO_PROCESSED}, synchronize_session=False)
+    if updated:
+        set_summary_status(ticket_ids, ENVIADO_PROCESSED)
+        # L'update in blocco non passa dagli hook di flush
+        invalidate_counters(TICKETS)
+    return updated
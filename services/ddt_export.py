@@ -0,0 +1,285 @@
+"""
+DDT export - esportazione in blocco dei PDF dei DDT (ZIP o PDF unico)
+
+A fine mese l'ufficio esportava decine di DDT uno alla volta da ddt.export.
+Ora un periodo, un cliente o un elenco di id diventano un'esportazione:
+- select_ddts() sceglie le intestazioni (al massimo MAX_EXPORT_DDTS)
+- start_export() legge gli snapshot in blocco (services.ddt_pdf.ddt_snapshots)
+  e li passa al pool di rendering: per lo ZIP un PDF per DDT, impaginati in
+  parallelo e riusati dalla cache su disco; per il PDF unico un solo
+  documento (tra le dipendenze non c'è una libreria per unire i PDF)
+- l'esportazione è descritta da un manifest JSON nella cartella jobs della
+  cache: l'avanzamento (export_progress) è il numero di PDF già presenti su
+  disco, quindi qualunque processo worker può riportarlo
+- stream_export() restituisce lo ZIP a blocchi mentre i PDF vengono letti dal
+  disco, senza costruire l'archivio in memoria; un PDF mancante (rendering
+  fatto da un altro processo e poi rimosso) viene impaginato di nuovo
+
+Fino a DIRECT_EXPORT_LIMIT DDT il download parte subito; oltre, la pagina
+mostra l'avanzamento e scarica il file quando è pronto.
+"""
+
+import json
+import logging
+import os
+import time
+import uuid
+import zipfile
+
+from app.models import AlbaranCabecera
+from services.ddt_pdf import cache_key, ddt_snapshots, get_renderer, merged_cache_key
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('zip', 'pdf')
+MAX_EXPORT_DDTS = 500
+DIRECT_EXPORT_LIMIT = 20
+JOB_TTL_SECONDS = 24 * 3600
+CHUNK_SIZE = 64 * 1024
+
+
+def select_ddts(date_from=None, date_to=None, client_id=None, ddt_ids=None):
+    """DDT headers (id, date, client, company) matching every given filter, oldest first.
+
+    Args:
+        date_to: exclusive upper bound
+
+    Raises:
+        ValueError: no filter, or more than MAX_EXPORT_DDTS DDTs
+    """
+    if not (date_from or date_to or client_id or ddt_ids):
+        raise ValueError('Indicare un periodo, un cliente o gli id dei DDT da esportare')
+
+    query = AlbaranCabecera.query.with_entities(
+        AlbaranCabecera.IdAlbaran,
+        AlbaranCabecera.Fecha,
+        AlbaranCabecera.IdCliente,
+        AlbaranCabecera.IdEmpresa
+    )
+    if ddt_ids:
+        query = query.filter(AlbaranCabecera.IdAlbaran.in_(ddt_ids))
+    if date_from:
+        query = query.filter(AlbaranCabecera.Fecha >= date_from)
+    if date_to:
+        query = query.filter(AlbaranCabecera.Fecha < date_to)
+    if client_id:
+        query = query.filter(AlbaranCabecera.IdCliente == client_id)
+
+    ddts = query.order_by(AlbaranCabecera.Fecha, AlbaranCabecera.IdAlbaran).limit(MAX_EXPORT_DDTS + 1).all()
+    if len(ddts) > MAX_EXPORT_DDTS:
+        raise ValueError(f"Troppi DDT: massimo {MAX_EXPORT_DDTS} per esportazione")
+    return ddts
+
+
+# === Manifest ===
+
+def _jobs_dir():
+    path = os.path.join(get_renderer().cache_dir, 'jobs')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _job_path(job_id, suffix='.json'):
+    return os.path.join(_jobs_dir(), f"{job_id}{suffix}")
+
+
+def _prune_jobs():
+    limit = time.time() - JOB_TTL_SECONDS
+    try:
+        for entry in os.scandir(_jobs_dir()):
+            if entry.is_file() and entry.stat().st_mtime < limit:
+                os.remove(entry.path)
+    except OSError:
+        pass
+
+
+def load_job(job_id):
+    """Manifest of job_id, or None"""
+    if not job_id or not all(char in '0123456789abcdef' for char in job_id):
+        return None
+    try:
+        with open(_job_path(job_id), encoding='utf-8') as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return None
+
+
+def _record_failure(job_id, ddt_id, error):
+    try:
+        with open(_job_path(job_id, '.failed'), 'a', encoding='utf-8') as handle:
+            handle.write(f"{ddt_id}: {error}\n")
+    except OSError:
+        pass
+
+
+def _watch(future, job_id, ddt_id):
+    def done(finished):
+        if finished.exception() is not None:
+            _record_failure(job_id, ddt_id, finished.exception())
+    future.add_done_callback(done)
+
+
+def start_export(ddts, export_format, user_id=None):
+    """Queue the PDFs of ddts in the rendering pool and write the export manifest.
+
+    Returns:
+        dict: the manifest (id, format, items...), for export_progress() and stream_export()
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Formato non valido: {export_format}")
+    _prune_jobs()
+
+    renderer = get_renderer()
+    snapshots = ddt_snapshots(ddts)
+    job = {
+        'id': uuid.uuid4().hex,
+        'format': export_format,
+        'user_id': user_id,
+        'created_at': time.time(),
+        'items': [{'ddt_id': snapshot['id'], 'key': None} for snapshot in snapshots],
+        'merged_key': None
+    }
+
+    if export_format == 'pdf':
+        job['merged_key'] = merged_cache_key(snapshots)
+        future = renderer.submit_merged(snapshots)
+        _watch(future, job['id'], 'pdf')
+    else:
+        for item, snapshot in zip(job['items'], snapshots):
+            item['key'] = cache_key(snapshot)
+            _watch(renderer.submit(snapshot), job['id'], snapshot['id'])
+
+    with open(_job_path(job['id']), 'w', encoding='utf-8') as handle:
+        json.dump(job, handle)
+    logger.info(f"Esportazione DDT {job['id']}: {len(snapshots)} DDT in {export_format}")
+    return job
+
+
+def export_progress(job):
+    """Rendered PDFs of job, read from the cache directory.
+
+    Returns:
+        dict: id, format, total, done, status (rendering, ready or failed), error
+    """
+    renderer = get_renderer()
+    total = len(job['items'])
+    if job['format'] == 'pdf':
+        done = total if os.path.exists(renderer.path_for(job['merged_key'])) else 0
+    else:
+        done = sum(1 for item in job['items'] if os.path.exists(renderer.path_for(item['key'])))
+
+    error = None
+    try:
+        with open(_job_path(job['id'], '.failed'), encoding='utf-8') as handle:
+            error = handle.read().strip() or None
+    except OSError:
+        pass
+
+    status = 'ready' if done >= total else ('failed' if error else 'rendering')
+    return {'id': job['id'], 'format': job['format'], 'total': total, 'done': done,
+            'status': status, 'error': error}
+
+
+# === Download ===
+
+def _wait_for(key, render_again, timeout):
+    """Path of the cached PDF of key: on disk, rendering in this process, or rendered again"""
+    renderer = get_renderer()
+    path = renderer.path_for(key)
+    if os.path.exists(path):
+        return path
+    pending = renderer.pending(key)
+    if pending is not None:
+        return pending.result(timeout=timeout)
+    return render_again()
+
+
+def _item_path(item):
+    renderer = get_renderer()
+
+    def render_again():
+        ddts = select_ddts(ddt_ids=[item['ddt_id']])
+        if not ddts:
+            return None
+        return renderer.render(ddt_snapshots(ddts)[0])
+    return _wait_for(item['key'], render_again, renderer.timeout)
+
+
+def _merged_path(job):
+    renderer = get_renderer()
+    # Il documento unico cresce con il numero di DDT
+    timeout = renderer.timeout * max(1, len(job['items']))
+
+    def render_again():
+        ddts = {ddt.IdAlbaran: ddt for ddt in select_ddts(ddt_ids=[item['ddt_id'] for item in job['items']])}
+        snapshots = ddt_snapshots(ddts[item['ddt_id']] for item in job['items'] if item['ddt_id'] in ddts)
+        return renderer.submit_merged(snapshots).result(timeout=timeout)
+    return _wait_for(job['merged_key'], render_again, timeout)
+
+
+def _read_chunks(path):
+    with open(path, 'rb') as handle:
+        while True:
+            chunk = handle.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+class _ChunkWriter:
+    """Write-only file object for zipfile; the generator drains what it wrote"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _zip_chunks(job):
+    writer = _ChunkWriter()
+    # Senza seek zipfile scrive i descrittori dopo i dati: l'archivio esce in ordine
+    with zipfile.ZipFile(writer, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for item in job['items']:
+            path = _item_path(item)
+            if path is None:
+                logger.warning(f"Esportazione {job['id']}: DDT {item['ddt_id']} non più presente")
+                continue
+            with archive.open(f"DDT_{item['ddt_id']}.pdf", 'w') as entry:
+                for chunk in _read_chunks(path):
+                    entry.write(chunk)
+                    data = writer.drain()
+                    if data:
+                        yield data
+            yield writer.drain()
+    yield writer.drain()
+
+
+def stream_export(job):
+    """Generator of the export file (ZIP or merged PDF), in CHUNK_SIZE blocks"""
+    if job['format'] == 'pdf':
+        yield from _read_chunks(_merged_path(job))
+    else:
+        for data in _zip_chunks(job):
+            if data:
+                yield data
+
+
+def export_filename(job):
+    return f"DDT_{time.strftime('%Y%m%d', time.localtime(job['created_at']))}_{job['id'][:8]}.{job['format']}"
+
+
+def export_mimetype(job):
+    return 'application/zip' if job['format'] == 'zip' else 'application/pdf'
@@ -0,0 +1,340 @@
+"""
+DDT PDF - rendering dei DDT in un pool di processi con cache su disco
+
+ddt.export ricostruiva ad ogni richiesta il foglio di stili ReportLab, la
+palette e il layout e impaginava il PDF sul thread della richiesta: stampare i
+DDT di una giornata teneva occupati i worker per secondi ciascuno, e il lavoro
+di ReportLab (legato al GIL) non andava in parallelo.
+
+Ora:
+- ddt_snapshot() legge intestazione, righe, cliente e azienda in valori
+  semplici (serializzabili verso un altro processo); è l'unico punto che
+  tocca il database
+- render_pdf() (services.ddt_pdf_layout) impagina lo snapshot; stili,
+  palette e logo sono costruiti una volta per processo
+- DDTPdfRenderer esegue render_pdf in un ProcessPoolExecutor (contesto spawn:
+  i processi non ereditano thread e connessioni del server; importano solo
+  services.ddt_pdf_layout, senza Flask né app.models) e salva il
+  risultato in DDT_PDF_CACHE_PATH/<sha256>.pdf. La chiave è l'hash dello
+  snapshot, della versione del layout e del logo: un DDT non modificato viene
+  riletto dal file, un DDT modificato ha un'altra chiave
+- la stessa chiave richiesta due volte mentre è in rendering attende lo stesso
+  risultato; se il pool non è disponibile il PDF viene impaginato nel thread
+  chiamante
+- submit_merged() impagina più DDT in un solo documento (export in blocco,
+  services.ddt_export): ogni DDT inizia su una nuova pagina con intestazione
+  e numerazione proprie
+
+La data "Generato il" nel piè di pagina non fa parte della chiave: un PDF
+riletto dalla cache riporta l'ora del primo rendering.
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import tempfile
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from app.models import db, AlbaranLinea, Client, Company, SystemConfig
+from services.ddt_pdf_layout import (LAYOUT_VERSION, LOGO_PATH, generated_at_label, render_file,
+                                     render_merged_file)
+
+logger = logging.getLogger(__name__)
+
+PRUNE_EVERY = 50
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+# === Snapshot (processo del server) ===
+
+def _float(value):
+    return float(value or 0)
+
+
+def _party(record, fields):
+    if record is None:
+        return None
+    return {field: getattr(record, field, None) for field in fields}
+
+
+CLIENT_FIELDS = ('Nombre', 'Direccion', 'CodPostal', 'Poblacion', 'DNI', 'Telefono1')
+COMPANY_FIELDS = ('NombreEmpresa', 'Direccion', 'CodPostal', 'Poblacion', 'CIF_VAT', 'Telefono1')
+
+
+def _line_rows(ddt_ids):
+    """Printed columns of the lines of ddt_ids, in line order"""
+    return db.session.query(
+        AlbaranLinea.IdAlbaran,
+        AlbaranLinea.IdArticulo,
+        AlbaranLinea.Descripcion,
+        AlbaranLinea.Medida2,
+        AlbaranLinea.Peso,
+        AlbaranLinea.PrecioSinIVA,
+        AlbaranLinea.Descuento,
+        AlbaranLinea.PorcentajeIVA,
+        AlbaranLinea.ImporteSinIVASinDtoL,
+        AlbaranLinea.ImporteDelIVAConDtoL
+    ).filter(
+        AlbaranLinea.IdAlbaran.in_(ddt_ids)
+    ).order_by(AlbaranLinea.IdAlbaran, AlbaranLinea.IdLineaAlbaran).all()
+
+
+def _snapshot(ddt, lines, cliente, empresa, articles_per_package):
+    return {
+        'id': ddt.IdAlbaran,
+        'date': ddt.Fecha.strftime('%d/%m/%Y') if ddt.Fecha else None,
+        'articles_per_package': articles_per_package,
+        'lines': [{
+            'code': str(line.IdArticulo or ''),
+            'description': line.Descripcion or 'N/A',
+            'unit': line.Medida2 or 'un',
+            'quantity': _float(line.Peso),
+            'price': _float(line.PrecioSinIVA),
+            'discount': _float(line.Descuento),
+            'vat_rate': _float(line.PorcentajeIVA),
+            'total_without_vat': _float(line.ImporteSinIVASinDtoL),
+            'vat': _float(line.ImporteDelIVAConDtoL)
+        } for line in lines],
+        'client': _party(cliente, CLIENT_FIELDS),
+        'company': _party(empresa, COMPANY_FIELDS)
+    }
+
+
+def _articles_per_package():
+    return int(SystemConfig.get_config('articles_per_package', 5) or 5)
+
+
+def ddt_snapshot(ddt, cliente=None, empresa=None):
+    """Plain-value copy of everything the PDF shows, read with one line query.
+
+    Returns:
+        dict: JSON-serialisable, picklable snapshot for render_pdf()
+    """
+    return _snapshot(ddt, _line_rows([ddt.IdAlbaran]), cliente, empresa, _articles_per_package())
+
+
+def ddt_snapshots(ddts):
+    """ddt_snapshot() of several DDT headers, with one query each for lines, clients and companies"""
+    ddts = list(ddts)
+    if not ddts:
+        return []
+
+    lines = {}
+    for line in _line_rows([ddt.IdAlbaran for ddt in ddts]):
+        lines.setdefault(line.IdAlbaran, []).append(line)
+
+    client_ids = {ddt.IdCliente for ddt in ddts if ddt.IdCliente is not None}
+    company_ids = {ddt.IdEmpresa for ddt in ddts if ddt.IdEmpresa is not None}
+    clients = {client.IdCliente: client for client in
+               Client.query.filter(Client.IdCliente.in_(client_ids)).all()} if client_ids else {}
+    companies = {company.IdEmpresa: company for company in
+                 Company.query.filter(Company.IdEmpresa.in_(company_ids)).all()} if company_ids else {}
+
+    articles_per_package = _articles_per_package()
+    return [_snapshot(ddt, lines.get(ddt.IdAlbaran, []), clients.get(ddt.IdCliente),
+                      companies.get(ddt.IdEmpresa), articles_per_package) for ddt in ddts]
+
+
+def _logo_signature():
+    try:
+        stat = os.stat(LOGO_PATH)
+        return [stat.st_size, int(stat.st_mtime)]
+    except OSError:
+        return None
+
+
+def cache_key(snapshot):
+    """sha256 of the snapshot, the layout version and the logo file"""
+    payload = json.dumps([LAYOUT_VERSION, _logo_signature(), snapshot],
+                         sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def merged_cache_key(snapshots):
+    """sha256 of the cache keys of snapshots, in order"""
+    keys = ' '.join(['merged'] + [cache_key(snapshot) for snapshot in snapshots])
+    return hashlib.sha256(keys.encode('utf-8')).hexdigest()
+
+
+# === Pool e cache (processo del server) ===
+
+class DDTPdfRenderer:
+    """Process pool plus content-addressed disk cache for DDT PDFs.
+
+    The workers write the PDF into the cache directory themselves, so only
+    snapshots and paths cross the process boundary; submit() returns a
+    Future resolving to the path of the cached PDF.
+    """
+
+    def __init__(self, cache_dir, workers=2, timeout=60, max_files=2000):
+        self.cache_dir = cache_dir
+        self.workers = max(0, int(workers))
+        self.timeout = timeout
+        self.max_files = max_files
+        self._pool = None
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._writes = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, f"{key}.pdf")
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+            return self._pool
+
+    def _reset_pool(self, pool):
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+        pool.shutdown(wait=False)
+
+    def _finish(self, key, result, task, args, render, pool=None):
+        """Done callback of a render: resolve result, rendering inline if the pool died"""
+        try:
+            try:
+                path = render.result()
+            except BrokenProcessPool:
+                logger.warning("Pool di rendering PDF non disponibile, rendering nel processo del server")
+                if pool is not None:
+                    self._reset_pool(pool)
+                path = task(*args)
+            result.set_result(path)
+        except Exception as e:
+            logger.error(f"Errore nel rendering del PDF {key}: {str(e)}")
+            result.set_exception(e)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+                self._writes += 1
+                prune = self._writes % PRUNE_EVERY == 0
+            if prune:
+                self.prune()
+
+    def _submit(self, key, task, payload):
+        path = self.path_for(key)
+        if os.path.exists(path):
+            try:
+                os.utime(path)  # più recente per la potatura
+            except OSError:
+                pass
+            done = Future()
+            done.set_result(path)
+            return done
+
+        with self._lock:
+            pending = self._pending.get(key)
+            if pending is not None:
+                return pending
+            result = Future()
+            self._pending[key] = result
+
+        args = (payload, path, generated_at_label())
+        if self.workers:
+            pool = self._executor()
+            try:
+                render = pool.submit(task, *args)
+            except (BrokenProcessPool, RuntimeError) as e:
+                logger.warning(f"Pool di rendering PDF non disponibile: {str(e)}")
+                self._reset_pool(pool)
+            else:
+                render.add_done_callback(lambda done: self._finish(key, result, task, args, done, pool))
+                return result
+
+        # Senza pool: rendering nel thread chiamante
+        render = Future()
+        try:
+            render.set_result(task(*args))
+        except Exception as e:
+            render.set_exception(e)
+        self._finish(key, result, task, args, render)
+        return result
+
+    def submit(self, snapshot):
+        """Future resolving to the cached PDF path of snapshot, rendering it if missing"""
+        return self._submit(cache_key(snapshot), render_file, snapshot)
+
+    def submit_merged(self, snapshots):
+        """Future resolving to the cached path of one PDF with all the snapshots, in order"""
+        return self._submit(merged_cache_key(snapshots), render_merged_file, snapshots)
+
+    def pending(self, key):
+        """Future of the render of key in progress in this process, or None"""
+        with self._lock:
+            return self._pending.get(key)
+
+    def render(self, snapshot):
+        """Path of the cached PDF of snapshot, waiting for its rendering"""
+        return self.submit(snapshot).result(timeout=self.timeout)
+
+    def prune(self):
+        """Delete the least recently used PDFs beyond max_files"""
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir)
+                       if entry.is_file() and entry.name.endswith('.pdf')]
+        except OSError:
+            return 0
+        excess = len(entries) - self.max_files
+        if excess <= 0:
+            return 0
+        entries.sort(key=lambda entry: entry.stat().st_mtime)
+        removed = 0
+        for entry in entries[:excess]:
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except OSError:
+                pass
+        logger.info(f"Cache PDF DDT: {removed} file rimossi")
+        return removed
+
+    def stop(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
+
+
+def _create_renderer(config):
+    cache_dir = os.path.abspath(config['cache_path'])
+    try:
+        return DDTPdfRenderer(cache_dir, config['workers'], config['timeout_seconds'], config['cache_max_files'])
+    except OSError as e:
+        fallback = os.path.join(tempfile.gettempdir(), 'dblogix_ddt_pdf')
+        logger.warning(f"Cartella cache PDF {cache_dir} non disponibile ({str(e)}), uso {fallback}")
+        return DDTPdfRenderer(fallback, config['workers'], config['timeout_seconds'], config['cache_max_files'])
+
+
+def get_renderer():
+    """Renderer of this process, created from the .config settings on first use"""
+    global _renderer
+    if _renderer is None:
+        with _renderer_lock:
+            if _renderer is None:
+                from app.config import get_ddt_pdf_config_from_file
+                _renderer = _create_renderer(get_ddt_pdf_config_from_file())
+                atexit.register(_renderer.stop)
+    return _renderer
+
+
+def ddt_pdf_path(ddt, cliente=None, empresa=None):
+    """Path of the PDF of ddt, from the cache or rendered in the pool"""
+    return get_renderer().render(ddt_snapshot(ddt, cliente, empresa))
+
+
+def init_app(app):
+    """Create the renderer of this process; the pool starts with the first render."""
+    renderer = get_renderer()
+    logger.info(f"PDF DDT: cache in {renderer.cache_dir}, "
+                + (f"{renderer.workers} processi di rendering" if renderer.workers else "rendering nel server"))
@@ -0,0 +1,491 @@
+"""
+DDT PDF layout - impaginazione dei DDT eseguita nei processi del pool
+
+I processi del pool di services.ddt_pdf (contesto spawn) importano questo
+modulo per eseguire render_file e render_merged_file: per questo dipende solo
+dalla libreria standard e da ReportLab. Importare Flask, app.models o gli
+altri servizi in un processo di rendering ricostruirebbe l'applicazione con i
+suoi thread (sweeper, relay degli eventi, analytics) in ogni worker.
+
+Lo snapshot (services.ddt_pdf.ddt_snapshot) contiene già tutti i valori
+stampati; qui non si legge il database.
+"""
+
+import logging
+import os
+import threading
+from datetime import datetime
+from io import BytesIO
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from reportlab.lib.units import mm
+from reportlab.lib.utils import ImageReader
+from reportlab.platypus import (BaseDocTemplate, Frame, NextPageTemplate, PageBreak, PageTemplate,
+                                SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle)
+
+logger = logging.getLogger(__name__)
+
+# Da incrementare ad ogni modifica del layout: invalida i PDF in cache
+LAYOUT_VERSION = 1
+
+LOGO_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                         'static', 'uploads', 'logos', 'LogoDDT.png')
+
+# Margini del documento; la larghezza utile serve alle tabelle prima del build
+LEFT_MARGIN = 15*mm
+RIGHT_MARGIN = 15*mm
+TOP_MARGIN = 80*mm
+BOTTOM_MARGIN = 40*mm
+FRAME_WIDTH = A4[0] - LEFT_MARGIN - RIGHT_MARGIN
+
+# Stili, palette e logo di questo processo
+_assets = None
+_assets_lock = threading.Lock()
+
+
+def _get_assets():
+    """Stylesheet, palette and logo, built once per process"""
+    global _assets
+    if _assets is not None:
+        return _assets
+    with _assets_lock:
+        if _assets is not None:
+            return _assets
+
+        palette = {
+            'primary': colors.HexColor('#1a365d'),          # Deep professional blue
+            'secondary': colors.HexColor('#2d5a7b'),        # Lighter blue
+            'accent': colors.HexColor('#e53e3e'),           # Elegant red accent
+            'success': colors.HexColor('#38a169'),          # Success green
+            'text_primary': colors.HexColor('#2d3748'),     # Primary text
+            'text_secondary': colors.HexColor('#4a5568'),   # Secondary text
+            'text_muted': colors.HexColor('#718096'),       # Muted text
+            'border_light': colors.HexColor('#e2e8f0'),     # Light borders
+            'background_light': colors.HexColor('#f7fafc'), # Light background
+            'background_accent': colors.HexColor('#ebf8ff'),# Accent background
+            'discount_background': colors.HexColor('#fff5f5'),
+            'white': colors.white
+        }
+        primary = palette['primary']
+        text_primary = palette['text_primary']
+        white = palette['white']
+
+        styles = getSampleStyleSheet()
+        normal = styles['Normal']
+        for name, options in (
+            ('TableHeader', dict(fontSize=8, alignment=1, textColor=white, fontName='Helvetica-Bold', leading=10)),
+            ('TableCell', dict(fontSize=8, textColor=text_primary, fontName='Helvetica', alignment=1, leading=10)),
+            ('TableCellLeft', dict(fontSize=8, textColor=text_primary, fontName='Helvetica', alignment=0, leading=10)),
+            ('TableCellRight', dict(fontSize=8, textColor=text_primary, fontName='Helvetica', alignment=2, leading=10)),
+            ('TransportInfo', dict(fontSize=8, textColor=text_primary, fontName='Helvetica', leading=10)),
+            ('SummaryLabel', dict(fontSize=9, textColor=text_primary, fontName='Helvetica-Bold',
+                                  alignment=2, leading=11)),
+            ('SummaryValue', dict(fontSize=10, textColor=primary, fontName='Helvetica-Bold',
+                                  alignment=2, leading=12)),
+        ):
+            styles.add(ParagraphStyle(name=name, parent=normal, **options))
+        styles.add(ParagraphStyle(name='DiscountValue', parent=styles['SummaryValue'],
+                                  textColor=palette['accent']))
+
+        logo = None
+        if os.path.exists(LOGO_PATH):
+            try:
+                logo = ImageReader(LOGO_PATH)
+            except Exception as e:
+                logger.warning(f"Logo DDT non leggibile ({LOGO_PATH}): {str(e)}")
+
+        _assets = {'styles': styles, 'palette': palette, 'logo': logo}
+        return _assets
+
+
+def _products_table(snapshot, styles, palette):
+    products_data = [[
+        Paragraph("<b>COD.</b>", styles['TableHeader']),
+        Paragraph("<b>DESCRIZIONE ARTICOLO</b>", styles['TableHeader']),
+        Paragraph("<b>U.M.</b>", styles['TableHeader']),
+        Paragraph("<b>QUANTITÀ</b>", styles['TableHeader']),
+        Paragraph("<b>PREZZO</b>", styles['TableHeader']),
+        Paragraph("<b>SCONTO</b>", styles['TableHeader']),
+        Paragraph("<b>IVA</b>", styles['TableHeader']),
+        Paragraph("<b>IMPORTO</b>", styles['TableHeader']),
+    ]]
+
+    for line in snapshot['lines']:
+        line_total = line['total_without_vat'] + line['vat']
+        discount_display = f"{line['discount']:.0f}%" if line['discount'] > 0 else "-"
+        products_data.append([
+            Paragraph(line['code'] if line['code'] != '999' else '', styles['TableCell']),
+            Paragraph(line['description'], styles['TableCellLeft']),
+            Paragraph(line['unit'], styles['TableCell']),
+            Paragraph(f"{line['quantity']:.2f}", styles['TableCellRight']),
+            Paragraph(f"€ {line['price']:.2f}", styles['TableCellRight']),
+            Paragraph(discount_display, styles['TableCell']),
+            Paragraph(f"{line['vat_rate']:.0f}%", styles['TableCell']),
+            Paragraph(f"<b>€ {line_total:.2f}</b>", styles['TableCellRight']),
+        ])
+
+    col_widths = [16*mm, 78*mm, 11*mm, 18*mm, 18*mm, 12*mm, 11*mm, 20*mm]
+    products_table = Table(products_data, colWidths=col_widths, repeatRows=1)
+
+    primary = palette['primary']
+    table_style = [
+        # Intestazione
+        ('BACKGROUND', (0, 0), (-1, 0), primary),
+        ('TEXTCOLOR', (0, 0), (-1, 0), palette['white']),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 8),
+        ('ALIGN', (0, 0), (-1, 0), 'CENTER'),
+        ('VALIGN', (0, 0), (-1, 0), 'MIDDLE'),
+        ('TOPPADDING', (0, 0), (-1, 0), 6),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 6),
+
+        # Righe
+        ('FONTNAME', (0, 1), (-1, -1), 'Helvetica'),
+        ('FONTSIZE', (0, 1), (-1, -1), 8),
+        ('ALIGN', (0, 1), (0, -1), 'CENTER'),   # Codice
+        ('ALIGN', (1, 1), (1, -1), 'LEFT'),     # Descrizione
+        ('ALIGN', (2, 1), (2, -1), 'CENTER'),   # Unità
+        ('ALIGN', (3, 1), (3, -1), 'RIGHT'),    # Quantità
+        ('ALIGN', (4, 1), (4, -1), 'RIGHT'),    # Prezzo
+        ('ALIGN', (5, 1), (5, -1), 'CENTER'),   # Sconto
+        ('ALIGN', (6, 1), (6, -1), 'CENTER'),   # IVA
+        ('ALIGN', (7, 1), (7, -1), 'RIGHT'),    # Importo
+        ('VALIGN', (0, 1), (-1, -1), 'MIDDLE'),
+        ('TOPPADDING', (0, 1), (-1, -1), 5),
+        ('BOTTOMPADDING', (0, 1), (-1, -1), 5),
+        ('LEFTPADDING', (0, 1), (-1, -1), 4),
+        ('RIGHTPADDING', (0, 1), (-1, -1), 4),
+
+        # Bordi
+        ('LINEBELOW', (0, 0), (-1, 0), 1, primary),
+        ('GRID', (0, 1), (-1, -1), 0.5, palette['border_light']),
+        ('LINEBEFORE', (0, 0), (0, -1), 1, primary),
+        ('LINEAFTER', (-1, 0), (-1, -1), 1, primary),
+        ('LINEBELOW', (0, -1), (-1, -1), 1, primary),
+    ]
+    # Righe alternate
+    for i in range(2, len(products_data), 2):
+        table_style.append(('BACKGROUND', (0, i), (-1, i), palette['background_light']))
+
+    products_table.setStyle(TableStyle(table_style))
+    return products_table
+
+
+def _right_aligned(table):
+    container = Table([[table]], colWidths=[FRAME_WIDTH])
+    container.setStyle(TableStyle([
+        ('ALIGN', (0, 0), (0, 0), 'RIGHT'),
+        ('VALIGN', (0, 0), (0, 0), 'TOP'),
+    ]))
+    return container
+
+
+def _summary_elements(snapshot, styles, palette):
+    elements = []
+    lines = snapshot['lines']
+    subtotal_without_vat = sum(line['total_without_vat'] for line in lines)
+    total_vat = sum(line['vat'] for line in lines)
+    total_amount = subtotal_without_vat + total_vat
+
+    # Risparmio degli sconti: importo pieno meno importo scontato
+    total_discount_amount = 0
+    lines_with_discount = 0
+    for line in lines:
+        if line['discount'] > 0:
+            lines_with_discount += 1
+            original_subtotal = line['price'] * line['quantity']
+            original_total = original_subtotal + original_subtotal * (line['vat_rate'] / 100)
+            total_discount_amount += original_total - (line['total_without_vat'] + line['vat'])
+
+    if total_discount_amount > 0:
+        discount_table = Table([[
+            Paragraph(f"<b>Sconti applicati su {lines_with_discount} articoli</b>", styles['SummaryLabel']),
+            Paragraph(f"<b>- € {total_discount_amount:.2f}</b>", styles['DiscountValue'])
+        ]], colWidths=[40*mm, 30*mm])
+        discount_table.setStyle(TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+            ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
+            ('TOPPADDING', (0, 0), (-1, -1), 4),
+            ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+            ('LEFTPADDING', (0, 0), (-1, -1), 8),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 8),
+            ('BACKGROUND', (0, 0), (-1, -1), palette['discount_background']),
+            ('GRID', (0, 0), (-1, -1), 0.5, palette['border_light']),
+            ('ROUNDEDCORNERS', [3, 3, 3, 3]),
+        ]))
+        elements.append(_right_aligned(discount_table))
+        elements.append(Spacer(1, 5*mm))
+
+    summary_table = Table([
+        [
+            Paragraph("<b>Subtotale (esclusa IVA)</b>", styles['SummaryLabel']),
+            Paragraph(f"<b>€ {subtotal_without_vat:.2f}</b>", styles['SummaryValue'])
+        ],
+        [
+            Paragraph("<b>Totale IVA</b>", styles['SummaryLabel']),
+            Paragraph(f"<b>€ {total_vat:.2f}</b>", styles['SummaryValue'])
+        ],
+        [
+            Paragraph("<b>TOTALE GENERALE</b>", styles['SummaryLabel']),
+            Paragraph(f"<b>€ {total_amount:.2f}</b>", styles['SummaryValue'])
+        ]
+    ], colWidths=[40*mm, 30*mm])
+    summary_table.setStyle(TableStyle([
+        ('VALIGN', (0, 0), (-1, -1), 'MIDDLE'),
+        ('ALIGN', (0, 0), (-1, -1), 'RIGHT'),
+        ('TOPPADDING', (0, 0), (-1, -1), 4),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+        ('LEFTPADDING', (0, 0), (-1, -1), 8),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 8),
+        ('BACKGROUND', (0, 0), (-1, 1), palette['background_light']),
+        ('BACKGROUND', (0, 2), (-1, 2), palette['background_accent']),
+        ('LINEABOVE', (0, 2), (-1, 2), 1, palette['success']),
+        ('LINEBELOW', (0, 2), (-1, 2), 1, palette['success']),
+        ('GRID', (0, 0), (-1, -1), 0.5, palette['border_light']),
+        ('ROUNDEDCORNERS', [3, 3, 3, 3]),
+    ]))
+    elements.append(_right_aligned(summary_table))
+    elements.append(Spacer(1, 10*mm))
+    return elements
+
+
+def _transport_table(snapshot, styles, palette):
+    # Colli: articoli esclusi i "trasporto", arrotondati per eccesso
+    articles_per_package = max(1, snapshot['articles_per_package'])
+    total_articles = sum(1 for line in snapshot['lines'] if 'trasporto' not in line['description'].lower())
+    num_packages = max(1, (total_articles + articles_per_package - 1) // articles_per_package)
+
+    transport_table = Table([
+        [
+            Paragraph("<b>Causale trasporto:</b> Vendita", styles['TransportInfo']),
+            Paragraph("<b>Trasporto a cura:</b> Mittente", styles['TransportInfo'])
+        ],
+        [
+            Paragraph("<b>Aspetto esteriore beni:</b> Confezioni integre", styles['TransportInfo']),
+            Paragraph(f"<b>Numero colli:</b> {num_packages}", styles['TransportInfo'])
+        ],
+        [
+            Paragraph("<b>Data e ora partenza:</b> _______________", styles['TransportInfo']),
+            Paragraph("<b>Data e ora arrivo:</b> _______________", styles['TransportInfo'])
+        ]
+    ], colWidths=[FRAME_WIDTH/2 - 5*mm, FRAME_WIDTH/2 - 5*mm])
+    transport_table.setStyle(TableStyle([
+        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('LEFTPADDING', (0, 0), (-1, -1), 6),
+        ('RIGHTPADDING', (0, 0), (-1, -1), 6),
+        ('TOPPADDING', (0, 0), (-1, -1), 4),
+        ('BOTTOMPADDING', (0, 0), (-1, -1), 4),
+        ('BACKGROUND', (0, 0), (-1, -1), palette['background_light']),
+        ('GRID', (0, 0), (-1, -1), 0.5, palette['border_light']),
+        ('ROUNDEDCORNERS', [2, 2, 2, 2]),
+    ]))
+    return transport_table
+
+
+def _draw_party(canvas, x, top, title, name, rows, palette):
+    canvas.setFont('Helvetica-Bold', 10)
+    canvas.setFillColor(palette['primary'])
+    canvas.drawString(x, top - 8*mm, title)
+
+    canvas.setFont('Helvetica-Bold', 9)
+    canvas.setFillColor(palette['text_primary'])
+    y_offset = top - 16*mm
+    canvas.drawString(x, y_offset, name or '')
+
+    canvas.setFont('Helvetica', 8)
+    for row in rows:
+        if row:
+            y_offset -= 10
+            canvas.drawString(x, y_offset, row)
+
+
+def _page_decorator(snapshot, generated_at, assets):
+    palette = assets['palette']
+    company = snapshot['company']
+    client = snapshot['client']
+    company_name = company['NombreEmpresa'] if company else "DBLogiX"
+    # Prima pagina del DDT: nei PDF uniti la numerazione riparte per ogni DDT
+    first_page = [None]
+
+    def draw_header_footer(canvas, doc):
+        canvas.saveState()
+
+        canvas.setFillColor(palette['white'])
+        canvas.rect(0, 0, A4[0], A4[1], fill=1, stroke=0)
+
+        # Logo (o nome azienda)
+        drawn = False
+        if assets['logo'] is not None:
+            try:
+                canvas.drawImage(assets['logo'], doc.leftMargin, A4[1] - 30*mm,
+                                 width=50*mm, height=25*mm, mask='auto')
+                drawn = True
+            except Exception:
+                pass
+        if not drawn:
+            canvas.setFont('Helvetica-Bold', 20)
+            canvas.setFillColor(palette['primary'])
+            canvas.drawString(doc.leftMargin, A4[1] - 20*mm, company_name)
+
+        # Titolo del documento
+        title_width = 95*mm
+        title_height = 25*mm
+        title_x = A4[0] - doc.rightMargin - title_width
+        title_y = A4[1] - 30*mm
+        canvas.setFillColor(palette['primary'])
+        canvas.roundRect(title_x, title_y, title_width, title_height, 4*mm, fill=1, stroke=0)
+
+        canvas.setFont('Helvetica-Bold', 16)
+        canvas.setFillColor(palette['white'])
+        title_text = "DOCUMENTO DI TRASPORTO"
+        text_width = canvas.stringWidth(title_text, 'Helvetica-Bold', 16)
+        canvas.drawString(title_x + (title_width - text_width)/2, title_y + 12*mm, title_text)
+
+        canvas.setFont('Helvetica', 10)
+        subtitle_text = f"N° {snapshot['id']} del {snapshot['date'] or 'N/A'}"
+        subtitle_width = canvas.stringWidth(subtitle_text, 'Helvetica', 10)
+        canvas.drawString(title_x + (title_width - subtitle_width)/2, title_y + 6*mm, subtitle_text)
+
+        # Mittente e destinatario
+        box_top = A4[1] - 75*mm + 38*mm
+        if company:
+            _draw_party(canvas, doc.leftMargin, box_top, "MITTENTE", company['NombreEmpresa'], [
+                company['Direccion'],
+                f"{company['CodPostal'] or ''} {company['Poblacion'] or ''}".strip(),
+                f"P.IVA: {company['CIF_VAT']}" if company['CIF_VAT'] else None,
+                f"Tel: {company['Telefono1']}" if company['Telefono1'] else None
+            ], palette)
+        if client:
+            _draw_party(canvas, A4[0] - doc.rightMargin - 80*mm, box_top, "DESTINATARIO", client['Nombre'], [
+                client['Direccion'],
+                f"{client['CodPostal'] or ''} {client['Poblacion'] or ''}".strip(),
+                f"P.IVA/CF: {client['DNI']}" if client['DNI'] else None,
+                f"Tel: {client['Telefono1']}" if client['Telefono1'] else None
+            ], palette)
+
+        # Firme
+        signature_y = 25*mm
+        signature_width = 70*mm
+        for sig_x, label in ((doc.leftMargin + 10*mm, "FIRMA DEL VETTORE"),
+                             (A4[0] - doc.rightMargin - signature_width - 10*mm, "FIRMA DEL DESTINATARIO")):
+            canvas.setFont('Helvetica-Bold', 9)
+            canvas.setFillColor(palette['primary'])
+            canvas.drawString(sig_x, signature_y + 8*mm, label)
+            canvas.setStrokeColor(palette['border_light'])
+            canvas.setLineWidth(1)
+            canvas.rect(sig_x, signature_y, signature_width, 6*mm, fill=0, stroke=1)
+
+        # Piè di pagina
+        canvas.setFont('Helvetica', 7)
+        canvas.setFillColor(palette['text_muted'])
+        footer_text = f"DDT #{snapshot['id']} • Generato il {generated_at} • DBLogiX Professional"
+        canvas.drawString(doc.leftMargin, 8*mm, footer_text)
+
+        canvas.setFont('Helvetica-Bold', 8)
+        canvas.setFillColor(palette['primary'])
+        page_number = canvas.getPageNumber()
+        if first_page[0] is None:
+            first_page[0] = page_number
+        page_text = f"Pagina {page_number - first_page[0] + 1}"
+        page_width = canvas.stringWidth(page_text, 'Helvetica-Bold', 8)
+        canvas.drawString(A4[0] - doc.rightMargin - page_width, 8*mm, page_text)
+
+        canvas.restoreState()
+
+    return draw_header_footer
+
+
+def _story(snapshot, assets):
+    styles = assets['styles']
+    palette = assets['palette']
+    elements = [_products_table(snapshot, styles, palette), Spacer(1, 8*mm)]
+    elements.extend(_summary_elements(snapshot, styles, palette))
+    elements.append(_transport_table(snapshot, styles, palette))
+    return elements
+
+
+def generated_at_label():
+    return datetime.now().strftime('%d/%m/%Y alle ore %H:%M')
+
+
+def render_pdf(snapshot, generated_at=None):
+    """Lay out the PDF of a ddt_snapshot().
+
+    Returns:
+        bytes: PDF content
+    """
+    assets = _get_assets()
+    buffer = BytesIO()
+    company = snapshot['company']
+    doc = SimpleDocTemplate(
+        buffer,
+        pagesize=A4,
+        rightMargin=RIGHT_MARGIN,
+        leftMargin=LEFT_MARGIN,
+        topMargin=TOP_MARGIN,
+        bottomMargin=BOTTOM_MARGIN,
+        title=f"DDT #{snapshot['id']}",
+        author=company['NombreEmpresa'] if company else "DBLogiX"
+    )
+    decorator = _page_decorator(snapshot, generated_at or generated_at_label(), assets)
+    doc.build(_story(snapshot, assets), onFirstPage=decorator, onLaterPages=decorator)
+    return buffer.getvalue()
+
+
+def render_merged_pdf(snapshots, output, generated_at=None):
+    """Lay out several DDTs in one document written to output (path or file).
+
+    Every DDT starts on a new page with its own page template, so header,
+    footer and page numbers are those of the DDT on the page.
+    """
+    assets = _get_assets()
+    generated_at = generated_at or generated_at_label()
+    doc = BaseDocTemplate(
+        output,
+        pagesize=A4,
+        rightMargin=RIGHT_MARGIN,
+        leftMargin=LEFT_MARGIN,
+        topMargin=TOP_MARGIN,
+        bottomMargin=BOTTOM_MARGIN,
+        title=f"DDT ({len(snapshots)})",
+        author="DBLogiX"
+    )
+    frame = Frame(doc.leftMargin, doc.bottomMargin, doc.width, doc.height, id='normal')
+    doc.addPageTemplates([
+        PageTemplate(id=f"ddt{index}", frames=[frame], onPage=_page_decorator(snapshot, generated_at, assets))
+        for index, snapshot in enumerate(snapshots)
+    ])
+
+    elements = []
+    for index, snapshot in enumerate(snapshots):
+        if index:
+            elements.extend([NextPageTemplate(f"ddt{index}"), PageBreak()])
+        elements.extend(_story(snapshot, assets))
+    doc.build(elements)
+
+
+def _write_atomic(path, write):
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return path
+
+
+def render_file(snapshot, path, generated_at):
+    """Pool task: render one DDT into path"""
+    def write(temp_path):
+        with open(temp_path, 'wb') as handle:
+            handle.write(render_pdf(snapshot, generated_at))
+    return _write_atomic(path, write)
+
+
+def render_merged_file(snapshots, path, generated_at):
+    """Pool task: render several DDTs into one PDF at path"""
+    return _write_atomic(path, lambda temp_path: render_merged_pdf(snapshots, temp_path, generated_at))
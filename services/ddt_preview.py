@@ -0,0 +1,457 @@
+"""
+DDT preview - bozza dell'anteprima DDT conservata sul server
+
+ddt.preview rileggeva ogni ticket con db.session.expire_all() e la stessa
+query delle linee in tre forme (ORM, join, SQL), poi un Product.query.get
+per linea; le API di /api/preview ricalcolavano il ticket a ogni aggiunta,
+ticket manuali e sconti restavano nel localStorage del browser e ddt.create
+rileggeva tutto da capo.
+
+Ora l'anteprima è una bozza (PreviewDraft) per utente:
+- create_draft() risolve i ticket selezionati in blocco (intestazioni più
+  services.ddt_builder.resolve_ticket_lines: quattro query per tutta la
+  selezione) e conserva linee e prezzi
+- aggiunta e rimozione di un ticket, ticket manuali e sconti sono delta
+  sulla bozza: i totali sono aggiornati sommando o sottraendo il ticket,
+  senza ripercorrere gli altri
+- ddt.create e tasks.complete_task usano ticket manuali, sconti e linee
+  della bozza (DDTBuilder.add_resolved) e la consumano (consume_draft)
+
+Salvataggio: ogni ticket (anche manuale, con id negativo) è una riga di
+ddt_preview_draft_tickets con il proprio JSON; ddt_preview_drafts tiene
+solo intestazione, sconti, totali e un numero di versione. Una modifica
+scrive quindi la riga del ticket toccato e l'intestazione, non l'intera
+bozza. Ogni processo tiene in cache la bozza già decodificata con la sua
+versione e la rilegge solo se un altro processo l'ha modificata; le
+modifiche concorrenti sono riprovate (update_draft).
+
+La creazione del DDT consuma la bozza nella propria transazione
+(consume_draft: DELETE sulla versione letta), così un doppio invio o due
+schede non creano due DDT dagli stessi ticket. Le bozze più vecchie di
+DRAFT_TTL_HOURS sono eliminate alla creazione di una nuova.
+"""
+
+import json
+import logging
+import uuid
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, insert, select, update
+
+from app.models import db, DDTPreviewDraft, DDTPreviewDraftTicket, TicketHeader
+from services.ddt_builder import CUSTOM_PRODUCT_ID, resolve_ticket_lines
+
+logger = logging.getLogger(__name__)
+
+DRAFT_TTL_HOURS = 12
+MAX_CACHED_DRAFTS = 200
+MAX_UPDATE_ATTEMPTS = 3
+
+# Chiavi della bozza salvate come righe di ddt_preview_draft_tickets
+ROW_KEYS = ('tickets', 'manual')
+
+# id bozza -> PreviewDraft (con la versione letta); mai modificata sul posto
+_cache = {}
+
+
+class DraftConsumedError(ValueError):
+    """The draft was already used for a DDT (or changed meanwhile)"""
+
+
+def _round(value):
+    return round(value, 6)
+
+
+class PreviewDraft:
+    """Tickets of one DDT preview, with resolved lines and running totals.
+
+    Tickets and manual tickets are kept in insertion order, keyed by str(id)
+    like the discounts (DDTBuilder reads them the same way).
+    """
+
+    def __init__(self, data, version=None):
+        self.data = data
+        self.version = version
+        # Chiavi dei ticket aggiunti o rimossi, da scrivere in ddt_preview_draft_tickets
+        self.changed = set()
+
+    def copy(self):
+        """Copy to modify: ticket entries are shared, never modified in place"""
+        data = dict(self.data)
+        for key in ROW_KEYS + ('discounts', 'totals'):
+            data[key] = dict(self.data[key])
+        return PreviewDraft(data, self.version)
+
+    def header(self):
+        """Draft values stored in ddt_preview_drafts (without the ticket rows)"""
+        return {key: value for key, value in self.data.items() if key not in ROW_KEYS}
+
+    def row_payloads(self):
+        """(ticket id, entry) of the tickets to write; entry None for removed tickets"""
+        return [(int(key), self._entry(key)) for key in self.changed]
+
+    @classmethod
+    def new(cls, user_id, cliente_id, empresa_id, from_task=False, task_id=None, from_warehouse=False):
+        return cls({
+            'id': uuid.uuid4().hex,
+            'user_id': user_id,
+            'cliente_id': cliente_id,
+            'empresa_id': empresa_id,
+            'from_task': from_task,
+            'task_id': task_id,
+            'from_warehouse': from_warehouse,
+            'tickets': {},
+            'manual': {},
+            'discounts': {},
+            'next_manual_id': -1,
+            'totals': {'amount': 0.0, 'weight': 0.0, 'discount': 0.0}
+        })
+
+    @property
+    def id(self):
+        return self.data['id']
+
+    @property
+    def from_task(self):
+        return self.data['from_task']
+
+    @property
+    def task_id(self):
+        return self.data['task_id']
+
+    @property
+    def discounts(self):
+        return self.data['discounts']
+
+    def _entry(self, ticket_id):
+        key = str(ticket_id)
+        return self.data['tickets'].get(key) or self.data['manual'].get(key)
+
+    def _apply(self, entry, discount, sign):
+        totals = self.data['totals']
+        totals['amount'] = _round(totals['amount'] + sign * entry['total'])
+        totals['weight'] = _round(totals['weight'] + sign * entry['weight'])
+        totals['discount'] = _round(totals['discount'] + sign * entry['total'] * discount / 100)
+
+    def add_ticket(self, entry):
+        """Add a resolved ticket (resolve_tickets()); False if already in the draft"""
+        key = str(entry['info']['id_ticket'])
+        if key in self.data['tickets']:
+            return False
+        self.data['tickets'][key] = entry
+        self.changed.add(key)
+        self._apply(entry, self.discounts.get(key, 0), 1)
+        return True
+
+    def add_manual_ticket(self, products, empresa_id):
+        """Add a manual ticket built from the products of the modal.
+
+        Returns:
+            dict: the manual ticket (DDTBuilder.add_manual_tickets() shape)
+
+        Raises:
+            ValueError: invalid weight, price or VAT of a product
+        """
+        ticket_id = self.data['next_manual_id']
+        lines = []
+        for index, product in enumerate(products, 1):
+            peso = float(product.get('peso', 1))
+            precio = float(product.get('precio', 1.00))
+            lines.append({
+                'id_linea_ticket': f"temp_{ticket_id}_{index}",
+                'id_ticket': ticket_id,
+                'id_articulo': CUSTOM_PRODUCT_ID,
+                'descripcion': product.get('descripcion', 'Prodotto Personalizzato'),
+                'peso': peso,
+                'precio': precio,
+                'importe': peso * precio,
+                'fecha_caducidad': product.get('fecha_caducidad'),
+                'id_iva': int(product.get('id_iva', 3)),  # Default 22%
+                'comportamiento': product.get('comportamiento', 1),
+                'is_manual': True
+            })
+
+        ticket = {
+            'id_ticket': ticket_id,
+            'num_ticket': f"MAN{abs(ticket_id)}",
+            'fecha': datetime.now().strftime('%d/%m/%Y %H:%M'),
+            'lines': lines,
+            'total': sum(line['importe'] for line in lines),
+            'weight': sum(line['peso'] for line in lines),
+            'id_empresa': empresa_id,
+            'id_tienda': 1,
+            'id_balanza_maestra': 1,
+            'id_balanza_esclava': -1,
+            'tipo_venta': 2,
+            'is_manual': True
+        }
+        self.data['next_manual_id'] = ticket_id - 1
+        self.data['manual'][str(ticket_id)] = ticket
+        self.changed.add(str(ticket_id))
+        self._apply(ticket, 0, 1)
+        return ticket
+
+    def remove_ticket(self, ticket_id):
+        """Remove a ticket or manual ticket with its discount; False if not in the draft"""
+        key = str(ticket_id)
+        entry = self.data['tickets'].pop(key, None) or self.data['manual'].pop(key, None)
+        if entry is None:
+            return False
+        self.changed.add(key)
+        self._apply(entry, self.discounts.pop(key, 0), -1)
+        return True
+
+    def set_discount(self, ticket_id, discount):
+        """Set the discount percentage of a ticket; False if not in the draft"""
+        key = str(ticket_id)
+        entry = self._entry(key)
+        if entry is None:
+            return False
+        previous = self.discounts.get(key, 0)
+        if discount:
+            self.discounts[key] = discount
+        else:
+            self.discounts.pop(key, None)
+        totals = self.data['totals']
+        totals['discount'] = _round(totals['discount'] + entry['total'] * (discount - previous) / 100)
+        return True
+
+    def summary(self):
+        totals = self.data['totals']
+        return {
+            'tickets': len(self.data['tickets']) + len(self.data['manual']),
+            'amount': totals['amount'],
+            'weight': totals['weight'],
+            'discount': totals['discount'],
+            'net': _round(totals['amount'] - totals['discount'])
+        }
+
+    def ticket_view(self, ticket_id):
+        """A ticket as the preview page shows it (same shape for manual tickets)"""
+        entry = self._entry(ticket_id)
+        if entry is None or entry.get('is_manual'):
+            return entry
+        lines = []
+        for line in entry['lines']:
+            values = line['values']
+            expiry = values.get('FechaCaducidad')
+            lines.append({
+                'id_linea_ticket': line['id_linea_ticket'],
+                'id_articulo': values['IdArticulo'],
+                'descripcion': values['Descripcion'],
+                'peso': line['peso'],
+                'precio': line['precio'],
+                'importe': line['peso'] * line['precio'],
+                'fecha_caducidad': datetime.fromisoformat(expiry).strftime('%d/%m/%Y') if expiry else None
+            })
+        return dict(entry['info'], num_ticket=entry['num_ticket'], fecha=entry['fecha'],
+                    lines=lines, total=entry['total'], is_manual=False)
+
+    def ticket_views(self):
+        return [self.ticket_view(key) for key in list(self.data['tickets']) + list(self.data['manual'])]
+
+    def ticket_infos(self):
+        """Header values of the tickets, as the selection forms post them"""
+        return [entry['info'] for entry in self.data['tickets'].values()]
+
+    def resolved_tickets(self):
+        """(ticket id, resolved lines) for DDTBuilder.add_resolved()"""
+        return [(entry['info']['id_ticket'], entry['lines']) for entry in self.data['tickets'].values()]
+
+    def manual_tickets(self):
+        return list(self.data['manual'].values())
+
+
+def resolve_tickets(ticket_ids, empresa_id=None):
+    """Draft entries of ticket_ids (of empresa_id if given), with lines and prices (four queries).
+
+    Returns:
+        dict: ticket id -> entry for PreviewDraft.add_ticket(); missing tickets are left out
+    """
+    ticket_ids = list({int(ticket_id) for ticket_id in ticket_ids})
+    if not ticket_ids:
+        return {}
+
+    statement = select(
+        TicketHeader.IdTicket, TicketHeader.NumTicket, TicketHeader.Fecha, TicketHeader.IdEmpresa,
+        TicketHeader.IdTienda, TicketHeader.IdBalanzaMaestra, TicketHeader.IdBalanzaEsclava,
+        TicketHeader.TipoVenta
+    ).where(TicketHeader.IdTicket.in_(ticket_ids))
+    if empresa_id is not None:
+        statement = statement.where(TicketHeader.IdEmpresa == empresa_id)
+    headers = db.session.execute(statement).all()
+    lines = resolve_ticket_lines([header.IdTicket for header in headers])
+
+    entries = {}
+    for header in headers:
+        ticket_lines = lines.get(header.IdTicket, [])
+        entries[header.IdTicket] = {
+            'info': {
+                'id_ticket': header.IdTicket,
+                'id_empresa': header.IdEmpresa,
+                'id_tienda': header.IdTienda or 1,
+                'id_balanza_maestra': header.IdBalanzaMaestra or 1,
+                'id_balanza_esclava': header.IdBalanzaEsclava or -1,
+                'tipo_venta': header.TipoVenta or 2
+            },
+            'num_ticket': header.NumTicket,
+            'fecha': header.Fecha.strftime('%d/%m/%Y %H:%M') if header.Fecha else '',
+            'lines': ticket_lines,
+            'total': sum(line['peso'] * line['precio'] for line in ticket_lines),
+            'weight': sum(line['peso'] for line in ticket_lines)
+        }
+    return entries
+
+
+# === Salvataggio ===
+
+def _remember(draft):
+    if draft.id not in _cache and len(_cache) >= MAX_CACHED_DRAFTS:
+        # Le bozze sono brevi: basta togliere la più vecchia in cache
+        _cache.pop(next(iter(_cache)), None)
+    draft.changed = set()
+    _cache[draft.id] = draft
+
+
+def _write_rows(draft):
+    """Insert or delete the ticket rows changed in draft (no commit)"""
+    table = DDTPreviewDraftTicket.__table__
+    for ticket_id, entry in draft.row_payloads():
+        db.session.execute(delete(table).where(table.c.draft_id == draft.id, table.c.ticket_id == ticket_id))
+        if entry is not None:
+            db.session.execute(insert(table).values(draft_id=draft.id, ticket_id=ticket_id, payload=json.dumps(entry)))
+
+
+def _delete_drafts(condition):
+    ids = select(DDTPreviewDraft.id).where(condition)
+    db.session.execute(delete(DDTPreviewDraftTicket).where(DDTPreviewDraftTicket.draft_id.in_(ids)))
+    return db.session.execute(delete(DDTPreviewDraft).where(condition)).rowcount
+
+
+def prune_drafts():
+    """Delete drafts not modified for DRAFT_TTL_HOURS, in the current transaction"""
+    limit = datetime.utcnow() - timedelta(hours=DRAFT_TTL_HOURS)
+    return _delete_drafts(DDTPreviewDraft.updated_at < limit)
+
+
+def create_draft(user_id, cliente_id, empresa_id, tickets, from_task=False, task_id=None, from_warehouse=False):
+    """Resolve the selected tickets and save them as a new draft (committed).
+
+    Args:
+        tickets: [{id_ticket, ...}] as posted by the ticket selection forms
+
+    Returns:
+        PreviewDraft
+    """
+    draft = PreviewDraft.new(user_id, cliente_id, empresa_id, from_task, task_id, from_warehouse)
+    entries = resolve_tickets([ticket['id_ticket'] for ticket in tickets])
+    for ticket in tickets:
+        # Ogni ticket è cercato con la propria azienda, come nella selezione
+        ticket_empresa = int(ticket.get('id_empresa') or empresa_id)
+        entry = entries.get(int(ticket['id_ticket']))
+        if entry is not None and entry['info']['id_empresa'] == ticket_empresa:
+            draft.add_ticket(entry)
+        else:
+            logger.warning(f"Anteprima DDT: ticket {ticket['id_ticket']} non trovato per l'azienda {ticket_empresa}")
+
+    prune_drafts()
+    db.session.execute(insert(DDTPreviewDraft.__table__).values(
+        id=draft.id, user_id=user_id, version=1, payload=json.dumps(draft.header()), updated_at=datetime.utcnow()
+    ))
+    _write_rows(draft)
+    db.session.commit()
+    draft.version = 1
+    _remember(draft)
+    return draft
+
+
+def _load(draft_id, user_id):
+    """PreviewDraft of draft_id (shared, do not modify), or None if missing or of another user"""
+    row = db.session.execute(select(DDTPreviewDraft.user_id, DDTPreviewDraft.version).where(
+        DDTPreviewDraft.id == draft_id
+    )).first()
+    if row is None or row.user_id != user_id:
+        return None
+
+    cached = _cache.get(draft_id)
+    if cached is not None and cached.version == row.version:
+        return cached
+
+    # Modificata da un altro processo: rilegge intestazione e righe
+    header = db.session.execute(select(DDTPreviewDraft.version, DDTPreviewDraft.payload).where(
+        DDTPreviewDraft.id == draft_id
+    )).first()
+    if header is None:
+        return None
+    data = json.loads(header.payload)
+    data['tickets'], data['manual'] = {}, {}
+    for ticket_id, payload in db.session.execute(select(
+        DDTPreviewDraftTicket.ticket_id, DDTPreviewDraftTicket.payload
+    ).where(DDTPreviewDraftTicket.draft_id == draft_id).order_by(DDTPreviewDraftTicket.id)).all():
+        data['manual' if ticket_id < 0 else 'tickets'][str(ticket_id)] = json.loads(payload)
+    draft = PreviewDraft(data, header.version)
+    _remember(draft)
+    return draft
+
+
+def load_draft(draft_id, user_id):
+    """Draft draft_id of user_id, or None (expired, consumed or of another user)"""
+    if not draft_id:
+        return None
+    return _load(draft_id, user_id)
+
+
+def update_draft(draft_id, user_id, change):
+    """Apply change(draft) and save the draft (committed) if it returns a truthy value.
+
+    Only the changed ticket rows and the header are written. The save only
+    succeeds on the version that was read: if another request modified the
+    draft meanwhile, change is applied again to the new version.
+
+    Returns:
+        (PreviewDraft, result of change); (None, None) if the draft does not exist
+    """
+    for _ in range(MAX_UPDATE_ATTEMPTS):
+        current = _load(draft_id, user_id)
+        if current is None:
+            return None, None
+        draft = current.copy()
+        result = change(draft)
+        if not result:
+            return draft, result
+
+        # L'UPDATE sulla versione letta blocca l'intestazione fino al commit
+        saved = db.session.execute(update(DDTPreviewDraft).where(
+            DDTPreviewDraft.id == draft_id,
+            DDTPreviewDraft.version == current.version
+        ).values(version=current.version + 1, payload=json.dumps(draft.header()),
+                 updated_at=datetime.utcnow())).rowcount
+        if not saved:
+            db.session.rollback()
+            _cache.pop(draft_id, None)
+            continue
+        _write_rows(draft)
+        db.session.commit()
+        draft.version = current.version + 1
+        _remember(draft)
+        return draft, result
+    raise RuntimeError("Bozza modificata da altre richieste, riprovare")
+
+
+def consume_draft(draft):
+    """Delete draft in the current transaction, on the version that was read.
+
+    Call it in the transaction that creates the DDT: of two requests using
+    the same draft, the second one deletes nothing and raises.
+
+    Raises:
+        DraftConsumedError: draft already used (or modified meanwhile)
+    """
+    _cache.pop(draft.id, None)
+    deleted = db.session.execute(delete(DDTPreviewDraft).where(
+        DDTPreviewDraft.id == draft.id,
+        DDTPreviewDraft.version == draft.version
+    )).rowcount
+    if not deleted:
+        raise DraftConsumedError("Anteprima DDT già utilizzata o modificata: ricaricare il preview")
+    db.session.execute(delete(DDTPreviewDraftTicket).where(DDTPreviewDraftTicket.draft_id == draft.id))
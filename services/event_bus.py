@@ -0,0 +1,380 @@
+"""
+Event bus - pubblicazione/sottoscrizione di eventi tra i processi worker
+
+Gli stream verso i browser (schermo task, notifiche e chat) si iscrivono a
+uno o più topic e ricevono gli eventi pubblicati dall'applicazione, invece
+di interrogare il database a intervalli.
+
+Broker: la tabella event_log. publish_after_commit() scrive l'evento nella
+transazione della modifica che lo genera (visibile solo dopo il commit,
+scartato al rollback). In ogni processo un thread (EventLogRelay) legge le
+righe nuove ogni RELAY_POLL_SECONDS, o subito dopo un commit dello stesso
+processo, e le consegna alle iscrizioni e ai listener locali. L'id della riga
+è l'id dell'evento: uno stream che si ricollega con Last-Event-ID recupera
+gli eventi persi con replay(). Le righe più vecchie di
+EVENT_LOG_RETENTION_SECONDS vengono cancellate dal relay.
+
+Gli id sono assegnati all'INSERT ma diventano visibili al commit, quindi non
+sempre in ordine: un id saltato resta in attesa per RELAY_GAP_SECONDS.
+
+Ogni iscrizione ha una coda limitata: se un client è troppo lento la coda
+viene svuotata e l'iscrizione marcata come overflowed, e il client deve
+ripartire da uno snapshot completo.
+"""
+
+import atexit
+import json
+import logging
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, event, func, insert, or_, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.models import db, EventLog
+
+logger = logging.getLogger(__name__)
+
+SUBSCRIPTION_QUEUE_SIZE = 256
+RELAY_POLL_SECONDS = 1.0
+RELAY_BATCH_SIZE = 500
+RELAY_GAP_SECONDS = 10
+EVENT_LOG_RETENTION_SECONDS = 3600
+PRUNE_INTERVAL_SECONDS = 600
+REPLAY_LIMIT = 200
+
+_listeners_registered = False
+
+
+class Event:
+    """A published event: event_log id (None for local-only events), topic, data and recipient"""
+
+    __slots__ = ('id', 'topic', 'data', 'user_id', 'created_at')
+
+    def __init__(self, event_id, topic, data, user_id=None):
+        self.id = event_id
+        self.topic = topic
+        self.data = data
+        self.user_id = user_id
+        self.created_at = time.time()
+
+    def __repr__(self):
+        return f'<Event {self.id} {self.topic}>'
+
+
+class Subscription:
+    """Bounded queue of the events of some topics, consumed by one stream.
+
+    With a user_id only the broadcast events and the ones addressed to that
+    user are delivered.
+    """
+
+    def __init__(self, bus, topics, user_id=None, maxsize=SUBSCRIPTION_QUEUE_SIZE):
+        self.bus = bus
+        self.topics = frozenset(topics)
+        self.user_id = user_id
+        self.overflowed = False
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def accepts(self, published):
+        return published.topic in self.topics and published.user_id in (None, self.user_id)
+
+    def deliver(self, published):
+        try:
+            self._queue.put_nowait(published)
+        except queue.Full:
+            # Client troppo lento: gli eventi persi vengono sostituiti da una risincronizzazione
+            self.overflowed = True
+            self.drain()
+
+    def get(self, timeout=None):
+        """Next event, or None after timeout seconds"""
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def drain(self):
+        """Events already queued, without waiting"""
+        events = []
+        while True:
+            try:
+                events.append(self._queue.get_nowait())
+            except queue.Empty:
+                return events
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class EventBus:
+    """Process-wide topic fan-out to subscriptions and listeners"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._listeners = []
+        self.published = 0
+
+    def subscribe(self, topics, user_id=None):
+        subscription = Subscription(self, topics, user_id=user_id)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def add_listener(self, topics, callback):
+        with self._lock:
+            self._listeners.append((frozenset(topics), callback))
+
+    def publish_event(self, published):
+        with self._lock:
+            listeners = [callback for topics, callback in self._listeners if published.topic in topics]
+            targets = [s for s in self._subscriptions if s.accepts(published)]
+            self.published += 1
+        # Prima i listener (es. cache dei contatori), poi gli stream che li rileggono
+        for callback in listeners:
+            try:
+                callback(published)
+            except Exception as e:
+                logger.error(f"Listener evento {published.topic} fallito: {str(e)}")
+        for subscription in targets:
+            subscription.deliver(published)
+        return published
+
+    def publish(self, topic, data, user_id=None):
+        return self.publish_event(Event(None, topic, data, user_id=user_id))
+
+    def stats(self):
+        with self._lock:
+            return {'subscriptions': len(self._subscriptions), 'listeners': len(self._listeners),
+                    'published': self.published}
+
+
+def _log_values(topic, data, user_id):
+    return {
+        'topic': topic,
+        'user_id': user_id,
+        'payload': json.dumps(data, separators=(',', ':'), default=str),
+        'created_at': datetime.utcnow()
+    }
+
+
+def _row_event(row):
+    return Event(row.id, row.topic, json.loads(row.payload) if row.payload else None, user_id=row.user_id)
+
+
+class EventLogRelay:
+    """Per-process thread delivering the new event_log rows to the local bus"""
+
+    def __init__(self, bus, app):
+        self.bus = bus
+        self.app = app
+        self._last_id = None
+        # id saltati (transazione non ancora committata) -> quando sono stati notati
+        self._gaps = {}
+        self._pruned_at = 0.0
+        self._wake = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.relayed = 0
+        self.last_error = None
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._start_lock:
+            if self.is_running or self._stop_event.is_set():
+                return
+            self._thread = threading.Thread(target=self._run_loop, name='event-relay', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._wake.set()
+
+    def wake(self):
+        self._wake.set()
+
+    def _read(self, conn):
+        table = EventLog.__table__
+        if self._last_id is None:
+            # All'avvio si parte dagli eventi nuovi: chi si ricollega recupera il resto con replay()
+            self._last_id = conn.execute(select(func.max(table.c.id))).scalar() or 0
+            return []
+
+        now = time.monotonic()
+        self._gaps = {gap: seen for gap, seen in self._gaps.items() if now - seen <= RELAY_GAP_SECONDS}
+        condition = table.c.id > self._last_id
+        if self._gaps:
+            condition = or_(condition, table.c.id.in_(list(self._gaps)))
+        rows = conn.execute(select(table).where(condition).order_by(table.c.id).limit(RELAY_BATCH_SIZE)).all()
+
+        for row in rows:
+            if self._gaps.pop(row.id, None) is not None:
+                continue
+            if row.id - self._last_id <= RELAY_BATCH_SIZE:
+                for missing in range(self._last_id + 1, row.id):
+                    self._gaps[missing] = now
+            self._last_id = row.id
+        return rows
+
+    def _prune(self):
+        cutoff = datetime.utcnow() - timedelta(seconds=EVENT_LOG_RETENTION_SECONDS)
+        with db.engine.begin() as conn:
+            deleted = conn.execute(delete(EventLog.__table__).where(EventLog.created_at < cutoff)).rowcount
+        self._pruned_at = time.monotonic()
+        if deleted:
+            logger.info(f"Event log: {deleted} eventi più vecchi di {EVENT_LOG_RETENTION_SECONDS} s eliminati")
+
+    def poll(self):
+        """Deliver the rows committed since the last poll; returns how many"""
+        with self.app.app_context():
+            with db.engine.connect() as conn:
+                rows = self._read(conn)
+            if time.monotonic() - self._pruned_at >= PRUNE_INTERVAL_SECONDS:
+                self._prune()
+
+        for row in rows:
+            self.bus.publish_event(_row_event(row))
+        self.relayed += len(rows)
+        return len(rows)
+
+    def _run_loop(self):
+        while not self._stop_event.is_set():
+            self._wake.wait(RELAY_POLL_SECONDS)
+            self._wake.clear()
+            if self._stop_event.is_set():
+                break
+            try:
+                self.poll()
+            except SQLAlchemyError as e:
+                # Tabella non ancora creata o database non raggiungibile: si riprova al giro dopo
+                self.last_error = f"{datetime.now().isoformat(timespec='seconds')} {str(e)}"
+                logger.warning(f"Lettura event log fallita: {str(e)}")
+            except Exception as e:
+                logger.error(f"Errore nel thread del relay eventi: {str(e)}")
+
+    def stats(self):
+        return {
+            'running': self.is_running,
+            'last_id': self._last_id,
+            'pending_gaps': len(self._gaps),
+            'relayed': self.relayed,
+            'last_error': self.last_error
+        }
+
+
+_bus = EventBus()
+_relay = None
+
+
+def subscribe(*topics, user_id=None):
+    """Subscribe to topics; close the subscription (or use it as a context manager) when done"""
+    return _bus.subscribe(topics, user_id=user_id)
+
+
+def add_listener(topics, callback):
+    """Call callback(event) for every event of topics in this process.
+
+    Runs in the relay thread before the streams are served: keep it short
+    and without queries.
+    """
+    _bus.add_listener(topics, callback)
+
+
+def publish(topic, data):
+    """Publish now to the subscribers of this process only (not resumable)"""
+    return _bus.publish(topic, data)
+
+
+def publish_after_commit(topic, data, session=None, user_id=None):
+    """Publish to every process when the current transaction commits (dropped on rollback).
+
+    The event is written to event_log on the session connection, so it can
+    be called from flush hooks. With user_id only the streams of that user
+    receive it.
+    """
+    session = session or db.session
+    session.connection().execute(insert(EventLog.__table__).values(**_log_values(topic, data, user_id)))
+    session.info['event_bus_published'] = True
+
+
+def broadcast(topic, data, user_id=None):
+    """Publish to every process in a transaction of its own (events not tied to a data change)"""
+    with db.engine.begin() as conn:
+        conn.execute(insert(EventLog.__table__).values(**_log_values(topic, data, user_id)))
+    if _relay is not None:
+        _relay.wake()
+
+
+def replay(topics, after_id, user_id=None, limit=REPLAY_LIMIT):
+    """Events of topics visible to user_id published after after_id, oldest first.
+
+    Returns None when more than limit events were missed: the client has to
+    start again from a snapshot.
+    """
+    table = EventLog.__table__
+    rows = db.session.execute(select(table).where(
+        table.c.id > after_id,
+        table.c.topic.in_(list(topics)),
+        or_(table.c.user_id.is_(None), table.c.user_id == user_id)
+    ).order_by(table.c.id).limit(limit + 1)).all()
+    if len(rows) > limit:
+        return None
+    return [_row_event(row) for row in rows]
+
+
+def get_event_bus_stats():
+    stats = _bus.stats()
+    stats['relay'] = _relay.stats() if _relay is not None else {'running': False}
+    return stats
+
+
+def _wake_after_commit(session):
+    # Le altre istanze leggono l'evento al prossimo giro del proprio relay
+    if session.info.pop('event_bus_published', False) and _relay is not None:
+        _relay.wake()
+
+
+def _discard_after_rollback(session):
+    session.info.pop('event_bus_published', None)
+
+
+def init_app(app):
+    """Register the commit/rollback hooks and the relay of this process.
+
+    The relay thread starts on the first request, so CLI commands never
+    spawn it.
+    """
+    global _listeners_registered, _relay
+
+    if not _listeners_registered:
+        event.listen(db.session, 'after_commit', _wake_after_commit)
+        event.listen(db.session, 'after_rollback', _discard_after_rollback)
+        _listeners_registered = True
+
+    if _relay is not None:
+        return
+
+    _relay = EventLogRelay(_bus, app)
+    atexit.register(_relay.stop)
+
+    @app.before_request
+    def start_event_relay():
+        if not _relay.is_running:
+            _relay.start()
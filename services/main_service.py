@@ -7,6 +7,7 @@ Questo file è ottimizzato per essere compilato con PyInstaller e funzionare com
 import os
 import sys
 import logging
+import multiprocessing
 import signal
 import threading
 import time
@@ -216,6 +217,11 @@ def main():
     """Funzione principale del servizio"""
     global logger, service
     
+    # Nell'eseguibile PyInstaller i processi del pool PDF DDT (services.ddt_pdf)
+    # rilanciano questo eseguibile: freeze_support li esegue e termina qui,
+    # prima che avviino un altro servizio
+    multiprocessing.freeze_support()
+    
     # Setup logging
     logger = setup_logging()
     logger.info("=== Avvio DBLogiX Service ===")
@@ -0,0 +1,368 @@
+"""
+Notification feed - contatori e novità di campanella, task e chat in push
+
+Campanella, badge dei task e chat interrogavano ogni 3-15 secondi, da ogni
+scheda aperta, /tasks/api/notifications/unread, /completed-count,
+/chat/api/unread-count, /chat/api/messages/latest e /chat/api/users/online;
+il context processor contava i task attivi ad ogni pagina.
+
+Ora ogni scheda apre un solo stream SSE (/tasks/api/notifications/stream)
+che invia all'apertura i contatori e gli utenti online, poi solo le novità:
+- notification: una TaskNotification creata per l'utente
+- chat_message / chat_read: messaggi di chat nuovi o letti
+- presence: un utente connesso
+- counters: i contatori, solo quando cambiano
+- resync: eventi persi, il client ricarica i messaggi di chat
+Gli eventi sono pubblicati da un hook di flush sull'event bus
+(services.event_bus), quindi arrivano anche dagli altri processi worker, e
+uno stream che si ricollega con Last-Event-ID riceve quelli persi.
+
+I contatori di ogni utente sono tenuti in cache nel processo e invalidati
+dagli eventi, con un TTL di sicurezza per le modifiche in blocco che non
+passano dagli hook: il context processor li legge da qui.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, event, func, inspect, select
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.models import db, ChatMessage, Task, TaskNotification, User
+from services import task_screen
+from services.event_bus import add_listener, broadcast, publish_after_commit
+
+logger = logging.getLogger(__name__)
+
+NOTIFICATIONS = 'notifications'  # per utente: notifiche task create o lette
+CHAT = 'chat'                    # a tutti: messaggi di chat nuovi o letti
+PRESENCE = 'presence'            # a tutti: utenti connessi
+TASKS = 'task_counters'          # per utente: task assegnati, tolti o chiusi
+
+ACTIVE_TASK_STATUSES = ('pending', 'assigned', 'in_progress')
+COUNTER_TTL_SECONDS = 60
+PRESENCE_SECONDS = 120
+ONLINE_MINUTES = 5
+HEARTBEAT_SECONDS = 15
+# Lo stream si chiude dopo questo tempo e il browser si ricollega (libera il thread)
+STREAM_MAX_SECONDS = 1800
+
+_listeners_registered = False
+
+
+def stream_topics(is_admin):
+    """Topics of the feed stream of a user"""
+    if is_admin:
+        return (NOTIFICATIONS, CHAT, PRESENCE)
+    # Le scansioni cambiano lo stato dei task senza passare dall'ORM: arrivano dallo schermo task
+    return (NOTIFICATIONS, CHAT, PRESENCE, TASKS, task_screen.TOPIC)
+
+
+class UserCounterCache:
+    """Per-process counters of each user, invalidated by the feed events"""
+
+    def __init__(self, ttl=COUNTER_TTL_SECONDS):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # user_id -> (loaded_at, counters, ids dei task attivi)
+        self._users = {}
+        # (loaded_at, {autore: messaggi non letti})
+        self._chat = None
+        # Incrementata ad ogni invalidazione: un valore letto prima non viene salvato
+        self._version = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._users.pop(user_id, None)
+            self._version += 1
+
+    def invalidate_chat(self):
+        with self._lock:
+            self._chat = None
+            self._version += 1
+
+    def invalidate_tasks(self, task_ids):
+        task_ids = set(task_ids)
+        with self._lock:
+            for user_id in [user_id for user_id, entry in self._users.items() if entry[2] & task_ids]:
+                del self._users[user_id]
+            self._version += 1
+
+    def _load_user(self, user_id, is_admin):
+        unread, completed = db.session.query(
+            func.count(TaskNotification.id),
+            func.coalesce(func.sum(case((TaskNotification.notification_type == 'task_completed', 1), else_=0)), 0)
+        ).filter(
+            TaskNotification.user_id == user_id,
+            TaskNotification.is_read == False
+        ).one()
+
+        active_ids = frozenset()
+        if not is_admin:
+            active_ids = frozenset(row[0] for row in db.session.query(Task.id_task).filter(
+                Task.assigned_to == user_id,
+                Task.status.in_(ACTIVE_TASK_STATUSES)
+            ))
+        counters = {
+            'notifications': int(unread),
+            'completed': int(completed) if is_admin else 0,
+            'active_tasks': len(active_ids)
+        }
+        return counters, active_ids
+
+    def _chat_unread(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._chat is not None and now - self._chat[0] <= self.ttl:
+                return self._chat[1]
+            version = self._version
+        # Il flag is_read è globale: una query raggruppata vale per tutti gli utenti
+        unread = dict(db.session.query(ChatMessage.user_id, func.count(ChatMessage.id)).filter(
+            ChatMessage.is_read == False
+        ).group_by(ChatMessage.user_id).all())
+        with self._lock:
+            if version == self._version:
+                self._chat = (now, unread)
+        return unread
+
+    def get(self, user_id, is_admin):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            version = self._version
+        if entry is not None and now - entry[0] <= self.ttl:
+            self.hits += 1
+            counters = dict(entry[1])
+        else:
+            self.misses += 1
+            counters, active_ids = self._load_user(user_id, is_admin)
+            with self._lock:
+                if version == self._version:
+                    self._users[user_id] = (now, dict(counters), active_ids)
+
+        chat_unread = self._chat_unread()
+        counters['chat'] = sum(chat_unread.values()) - chat_unread.get(user_id, 0)
+        return counters
+
+    def stats(self):
+        with self._lock:
+            return {'users': len(self._users), 'hits': self.hits, 'misses': self.misses, 'ttl_seconds': self.ttl}
+
+
+class PresenceTracker:
+    """Users seen by any worker in the last ONLINE_MINUTES"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}
+        self._announced = {}
+
+    def seen(self, user_id, username, at=None):
+        with self._lock:
+            self._users[user_id] = {'user_id': user_id, 'username': username,
+                                    'last_activity': at or datetime.utcnow()}
+
+    def announce(self, user_id, username):
+        """Tell every worker the user is online, at most once every PRESENCE_SECONDS per process"""
+        now = time.monotonic()
+        with self._lock:
+            announced = self._announced.get(user_id)
+            if announced is not None and now - announced < PRESENCE_SECONDS:
+                announce = False
+            else:
+                self._announced[user_id] = now
+                announce = True
+        self.seen(user_id, username)
+        if announce:
+            try:
+                broadcast(PRESENCE, {'user_id': user_id, 'username': username})
+            except SQLAlchemyError as e:
+                logger.warning(f"Presenza utente {user_id} non pubblicata: {str(e)}")
+
+    def online(self):
+        cutoff = datetime.utcnow() - timedelta(minutes=ONLINE_MINUTES)
+        with self._lock:
+            for user_id in [user_id for user_id, user in self._users.items() if user['last_activity'] < cutoff]:
+                del self._users[user_id]
+            return sorted((dict(user) for user in self._users.values()), key=lambda user: user['username'])
+
+
+_counters = UserCounterCache()
+_presence = PresenceTracker()
+
+
+def get_user_counters(user):
+    """{'notifications', 'completed', 'active_tasks', 'chat'} of user, from the process cache"""
+    return _counters.get(user.id, user.is_admin)
+
+
+def announce_presence(user_id, username):
+    _presence.announce(user_id, username)
+
+
+def get_online_users():
+    """Dicts with user_id, username and last_activity (UTC) of the users online"""
+    return _presence.online()
+
+
+def get_feed_stats():
+    return {'counters': _counters.stats(), 'online_users': len(_presence.online())}
+
+
+def _online_data(users):
+    return [{'id': user['user_id'], 'username': user['username'],
+             'last_activity': user['last_activity'].isoformat()} for user in users]
+
+
+class FeedState:
+    """What one connected tab has received, to send the counters only when they change"""
+
+    def __init__(self, user_id, is_admin):
+        self.user_id = user_id
+        self.is_admin = is_admin
+        self.counters = None
+
+    def counters_change(self):
+        counters = _counters.get(self.user_id, self.is_admin)
+        if counters == self.counters:
+            return []
+        self.counters = counters
+        return [('counters', counters, None)]
+
+    def snapshot(self):
+        """(event, data, id) triples for a tab that (re)connects"""
+        self.counters = None
+        return self.counters_change() + [('online', {'users': _online_data(get_online_users())}, None)]
+
+    def apply(self, events):
+        """(event, data, id) triples for the published events"""
+        changes = []
+        counters_dirty = False
+        for published in events:
+            data = published.data or {}
+            if published.topic == NOTIFICATIONS:
+                if 'notification' in data:
+                    changes.append(('notification', data['notification'], published.id))
+                counters_dirty = True
+            elif published.topic == CHAT:
+                if 'message' in data:
+                    changes.append(('chat_message', data['message'], published.id))
+                if 'read' in data:
+                    changes.append(('chat_read', {'ids': data['read']}, published.id))
+                counters_dirty = True
+            elif published.topic == PRESENCE:
+                changes.append(('presence', {'id': data.get('user_id'), 'username': data.get('username'),
+                                             'last_activity': datetime.utcnow().isoformat()}, published.id))
+            else:
+                counters_dirty = True
+        if counters_dirty:
+            changes.extend(self.counters_change())
+        return changes
+
+
+def _on_event(published):
+    data = published.data or {}
+    if published.topic in (NOTIFICATIONS, TASKS):
+        _counters.invalidate_user(published.user_id)
+    elif published.topic == CHAT:
+        _counters.invalidate_chat()
+    elif published.topic == task_screen.TOPIC:
+        _counters.invalidate_tasks(data.get('task_ids', ()))
+    elif published.topic == PRESENCE and data.get('user_id') is not None:
+        _presence.seen(data['user_id'], data.get('username'))
+
+
+def _notification_data(notification):
+    created_at = notification.created_at or datetime.utcnow()
+    return {
+        'id': notification.id,
+        'title': notification.title,
+        'message': notification.message,
+        'type': notification.notification_type,
+        'task_id': notification.task_id,
+        'created_at': created_at.strftime('%d/%m/%Y %H:%M'),
+        'created_at_relative': 'Ora',
+        'is_read': False
+    }
+
+
+def _message_data(message, usernames):
+    timestamp = message.timestamp or datetime.utcnow()
+    return {
+        'id': message.id,
+        'user_id': message.user_id,
+        'username': usernames.get(message.user_id),
+        'message': message.message,
+        'timestamp': timestamp.isoformat(),
+        'is_read': bool(message.is_read),
+        'formatted_time': timestamp.strftime('%H:%M'),
+        'room_id': message.room_id
+    }
+
+
+def _changed(obj, field):
+    return inspect(obj).attrs[field].history.has_changes()
+
+
+def _publish_after_flush(session, flush_context):
+    new_messages = []
+    read_messages = []
+    read_notifications = {}
+    task_users = {}
+
+    def add_task_user(user_id, task_id):
+        if user_id is not None:
+            task_users.setdefault(user_id, set()).add(task_id)
+
+    for obj in session.new:
+        if isinstance(obj, TaskNotification):
+            publish_after_commit(NOTIFICATIONS, {'notification': _notification_data(obj)},
+                                 session=session, user_id=obj.user_id)
+        elif isinstance(obj, ChatMessage):
+            new_messages.append(obj)
+        elif isinstance(obj, Task):
+            add_task_user(obj.assigned_to, obj.id_task)
+
+    for obj in session.dirty:
+        if isinstance(obj, TaskNotification) and _changed(obj, 'is_read'):
+            read_notifications.setdefault(obj.user_id, []).append(obj.id)
+        elif isinstance(obj, ChatMessage) and _changed(obj, 'is_read'):
+            read_messages.append(obj.id)
+        elif isinstance(obj, Task) and (_changed(obj, 'assigned_to') or _changed(obj, 'status')):
+            add_task_user(obj.assigned_to, obj.id_task)
+            for previous in inspect(obj).attrs.assigned_to.history.deleted:
+                add_task_user(previous, obj.id_task)
+
+    for obj in session.deleted:
+        if isinstance(obj, TaskNotification):
+            read_notifications.setdefault(obj.user_id, []).append(obj.id)
+        elif isinstance(obj, Task):
+            add_task_user(obj.assigned_to, obj.id_task)
+
+    if new_messages:
+        author_ids = {message.user_id for message in new_messages}
+        usernames = dict(session.connection().execute(
+            select(User.id, User.username).where(User.id.in_(author_ids))
+        ).all())
+        for message in new_messages:
+            publish_after_commit(CHAT, {'message': _message_data(message, usernames)}, session=session)
+    if read_messages:
+        publish_after_commit(CHAT, {'read': sorted(read_messages)}, session=session)
+    for user_id, notification_ids in read_notifications.items():
+        publish_after_commit(NOTIFICATIONS, {'read': sorted(notification_ids)}, session=session, user_id=user_id)
+    for user_id, task_ids in task_users.items():
+        publish_after_commit(TASKS, {'task_ids': sorted(task_ids)}, session=session, user_id=user_id)
+
+
+def init_app(app):
+    """Register the hook publishing notifications, chat messages and task assignments"""
+    global _listeners_registered
+
+    if not _listeners_registered:
+        event.listen(db.session, 'after_flush', _publish_after_flush)
+        add_listener((NOTIFICATIONS, CHAT, PRESENCE, TASKS, task_screen.TOPIC), _on_event)
+        _listeners_registered = True
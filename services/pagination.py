@@ -0,0 +1,182 @@
+"""
+Keyset (seek) pagination
+
+Paginazione su (timestamp, id) in ordine decrescente: invece di OFFSET, la
+pagina successiva/precedente parte dalla chiave dell'ultimo/primo elemento
+mostrato, quindi le pagine profonde costano come la prima (indice composito
+sulle due colonne).
+
+KeysetPagination espone la stessa interfaccia della Pagination di
+Flask-SQLAlchemy (items, page, pages, total, has_prev/has_next,
+prev_num/next_num, iter_pages) più prev_cursor/next_cursor: i template
+esistenti continuano a funzionare, i link numerati usano ancora OFFSET.
+"""
+
+import base64
+import json
+import logging
+from datetime import datetime
+from math import ceil
+
+from sqlalchemy import tuple_
+
+logger = logging.getLogger(__name__)
+
+
+def encode_cursor(direction, sort_value, id_value):
+    """Encode an opaque cursor; direction is 'next' (older rows) or 'prev' (newer rows)"""
+    if sort_value is None or id_value is None:
+        return None
+    if isinstance(sort_value, datetime):
+        payload = {'d': direction, 't': 'dt', 'k': sort_value.isoformat(), 'i': id_value}
+    else:
+        payload = {'d': direction, 't': 'raw', 'k': sort_value, 'i': id_value}
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return (direction, sort_value, id_value) or None for a missing/invalid cursor"""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+        direction = payload['d']
+        if direction not in ('next', 'prev'):
+            return None
+        sort_value = datetime.fromisoformat(payload['k']) if payload['t'] == 'dt' else payload['k']
+        return direction, sort_value, payload['i']
+    except (ValueError, KeyError, TypeError) as e:
+        logger.warning(f"Cursore di paginazione non valido ignorato: {str(e)}")
+        return None
+
+
+class KeysetPagination:
+    """Page of results with a Flask-SQLAlchemy compatible interface plus cursors"""
+
+    def __init__(self, items, page, per_page, total, has_prev, has_next, prev_cursor=None, next_cursor=None):
+        self.items = items
+        self.page = page
+        self.per_page = per_page
+        self.total = total
+        self._has_prev = has_prev
+        self._has_next = has_next
+        self.prev_cursor = prev_cursor if has_prev else None
+        self.next_cursor = next_cursor if has_next else None
+
+    @property
+    def pages(self):
+        if not self.total or not self.per_page:
+            return 0
+        return int(ceil(self.total / float(self.per_page)))
+
+    @property
+    def has_prev(self):
+        return self._has_prev
+
+    @property
+    def has_next(self):
+        return self._has_next
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    @property
+    def first(self):
+        return (self.page - 1) * self.per_page + 1 if self.items else 0
+
+    @property
+    def last(self):
+        return self.first + len(self.items) - 1 if self.items else 0
+
+    def iter_pages(self, *, left_edge=2, left_current=2, right_current=4, right_edge=2):
+        """Page numbers for a pagination widget, None marking a gap (as Flask-SQLAlchemy)"""
+        pages_end = self.pages + 1
+        if pages_end == 1:
+            return
+
+        left_end = min(1 + left_edge, pages_end)
+        yield from range(1, left_end)
+        if left_end == pages_end:
+            return
+
+        mid_start = max(left_end, self.page - left_current)
+        mid_end = min(self.page + right_current + 1, pages_end)
+        if mid_start - left_end > 0:
+            yield None
+        yield from range(mid_start, mid_end)
+        if mid_end == pages_end:
+            return
+
+        right_start = max(mid_end, pages_end - right_edge)
+        if right_start - mid_end > 0:
+            yield None
+        yield from range(right_start, pages_end)
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def keyset_paginate(query, sort_column, id_column, page=1, per_page=20, cursor=None, count=True):
+    """Paginate query ordered by (sort_column DESC, id_column DESC).
+
+    With a cursor the page is fetched with a seek condition on the
+    (sort_column, id_column) tuple; without one (first page, or a numbered
+    link) it falls back to OFFSET. The query must not be ordered already.
+
+    Args:
+        query: query returning entities that expose sort_column/id_column
+        page: page number shown to the user (kept in sync by the links)
+        cursor: prev_cursor/next_cursor of the page the user comes from
+        count: False to skip the COUNT(*) (total/pages are then None/0)
+
+    Returns:
+        KeysetPagination
+    """
+    page = max(page or 1, 1)
+    per_page = max(per_page or 1, 1)
+    sort_key, id_key = sort_column.key, id_column.key
+    key = tuple_(sort_column, id_column)
+    decoded = decode_cursor(cursor)
+
+    if decoded and decoded[0] == 'next':
+        _, sort_value, id_value = decoded
+        rows = query.filter(key < tuple_(sort_value, id_value)).order_by(
+            sort_column.desc(), id_column.desc()
+        ).limit(per_page + 1).all()
+        items = rows[:per_page]
+        has_prev = True
+        has_next = len(rows) > per_page
+    elif decoded and decoded[0] == 'prev':
+        _, sort_value, id_value = decoded
+        rows = query.filter(key > tuple_(sort_value, id_value)).order_by(
+            sort_column.asc(), id_column.asc()
+        ).limit(per_page + 1).all()
+        items = list(reversed(rows[:per_page]))
+        has_prev = len(rows) > per_page
+        has_next = True
+        if not has_prev:
+            page = 1
+    else:
+        rows = query.order_by(sort_column.desc(), id_column.desc()).offset(
+            (page - 1) * per_page
+        ).limit(per_page + 1).all()
+        items = rows[:per_page]
+        has_prev = page > 1
+        has_next = len(rows) > per_page
+
+    total = query.order_by(None).count() if count else None
+
+    prev_cursor = next_cursor = None
+    if items:
+        first, last = items[0], items[-1]
+        prev_cursor = encode_cursor('prev', getattr(first, sort_key), getattr(first, id_key))
+        next_cursor = encode_cursor('next', getattr(last, sort_key), getattr(last, id_key))
+
+    return KeysetPagination(items, page, per_page, total, has_prev, has_next, prev_cursor, next_cursor)
@@ -0,0 +1,500 @@
+"""
+Scan analytics - velocità degli operatori e qualità delle scansioni dei task
+
+task_ticket_scans registra ogni scansione (operatore, esito, ora) ma nessuna
+pagina la aggregava. Con milioni di righe i report non possono leggerla ad
+ogni richiesta: un thread in background (ScanAnalyticsRefresher) riassume
+in modo incrementale le righe nuove in due tabelle piccole.
+
+- scan_rollups: per ora, operatore e task il numero di scansioni per esito,
+  prima/ultima scansione e il tempo attivo (somma degli intervalli tra
+  scansioni consecutive dello stesso operatore fino a IDLE_GAP_SECONDS:
+  oltre è una pausa e non conta)
+- scan_histograms: per ora e operatore gli istogrammi degli intervalli tra
+  scansioni ('gap') e dei tempi di completamento dei ticket ('completion',
+  da inizio a fine verifica), da cui si ricavano p50/p95
+
+Le scansioni sono lette per id oltre un watermark (system_config), i ticket
+completati per (completed_at, id). Le righe degli ultimi SETTLE_SECONDS sono
+lasciate al giro successivo: una transazione ancora aperta potrebbe avere un
+id più basso di una già visibile. `flask refresh-scan-analytics --rebuild`
+ricostruisce tutto da zero.
+"""
+
+import atexit
+import bisect
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import and_, func, or_, select, tuple_
+
+from app.models import db, ScanHistogram, ScanRollup, SystemConfig, Task, TaskTicket, TaskTicketScan, User
+from services.ticket_sweeper import leader_lock
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = 'dblogix_scan_analytics'
+SCAN_WATERMARK_KEY = 'scan_analytics_scan_watermark'
+COMPLETION_WATERMARK_KEY = 'scan_analytics_completion_watermark'
+DEFAULT_BATCH_SIZE = 5000
+REFRESH_INTERVAL_SECONDS = 300
+SETTLE_SECONDS = 60
+IDLE_GAP_SECONDS = 300
+
+GAP = 'gap'
+COMPLETION = 'completion'
+
+# Limiti superiori (secondi) delle fasce degli istogrammi; l'ultima fascia è aperta
+GAP_BINS = (1, 2, 3, 5, 8, 12, 20, 30, 45, 60, 90, 120, 180, IDLE_GAP_SECONDS)
+COMPLETION_BINS = (30, 60, 120, 180, 300, 600, 900, 1800, 3600, 7200, 14400, 28800)
+
+# Esiti con una colonna propria in scan_rollups; 'completed' è l'esito di process_scan
+STATUS_COLUMNS = ('success', 'ticket_mismatch', 'product_mismatch', 'product_not_in_ticket')
+SUCCESS_STATUSES = ('success', 'completed')
+
+_refresher = None
+
+
+def _hour(moment):
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+
+def _slot(bins, seconds):
+    return bisect.bisect_left(bins, seconds)
+
+
+def _percentile(bins, counts, fraction):
+    """Upper bound (seconds) of the slot holding the given fraction of the histogram, None if empty"""
+    total = sum(counts.values())
+    if not total:
+        return None
+    threshold = fraction * total
+    cumulative = 0
+    for slot in sorted(counts):
+        cumulative += counts[slot]
+        if cumulative >= threshold:
+            # Fascia aperta: almeno l'ultimo limite
+            return bins[min(slot, len(bins) - 1)]
+    return None
+
+
+class _Accumulator:
+    """Rollup rows and histogram slots touched by one batch, merged into the tables at the end"""
+
+    def __init__(self):
+        self.rollups = {}
+        self.histograms = {}
+
+    def rollup(self, bucket, user_id, task_id):
+        key = (bucket, user_id, task_id)
+        if key not in self.rollups:
+            self.rollups[key] = {'scans': 0, 'success': 0, 'ticket_mismatch': 0, 'product_mismatch': 0,
+                                 'product_not_in_ticket': 0, 'other_errors': 0, 'active_seconds': 0.0,
+                                 'gaps': 0, 'first_scan_at': None, 'last_scan_at': None}
+        return self.rollups[key]
+
+    def observe(self, kind, bins, bucket, user_id, seconds):
+        key = (kind, bucket, user_id, _slot(bins, seconds))
+        count, total = self.histograms.get(key, (0, 0.0))
+        self.histograms[key] = (count + 1, total + seconds)
+
+    def merge(self):
+        """Add the batch to the stored rows in the current transaction"""
+        if self.rollups:
+            existing = {(row.bucket, row.scanned_by, row.task_id): row for row in ScanRollup.query.filter(
+                tuple_(ScanRollup.bucket, ScanRollup.scanned_by, ScanRollup.task_id).in_(list(self.rollups))
+            )}
+            for key, values in self.rollups.items():
+                row = existing.get(key)
+                if row is None:
+                    db.session.add(ScanRollup(bucket=key[0], scanned_by=key[1], task_id=key[2], **values))
+                    continue
+                for column in ('scans', 'success', 'ticket_mismatch', 'product_mismatch',
+                               'product_not_in_ticket', 'other_errors', 'active_seconds', 'gaps'):
+                    setattr(row, column, (getattr(row, column) or 0) + values[column])
+                row.first_scan_at = min(filter(None, (row.first_scan_at, values['first_scan_at'])))
+                row.last_scan_at = max(filter(None, (row.last_scan_at, values['last_scan_at'])))
+
+        if self.histograms:
+            existing = {(row.kind, row.bucket, row.user_id, row.slot): row for row in ScanHistogram.query.filter(
+                tuple_(ScanHistogram.kind, ScanHistogram.bucket, ScanHistogram.user_id,
+                       ScanHistogram.slot).in_(list(self.histograms))
+            )}
+            for key, (count, total) in self.histograms.items():
+                row = existing.get(key)
+                if row is None:
+                    db.session.add(ScanHistogram(kind=key[0], bucket=key[1], user_id=key[2], slot=key[3],
+                                                 count=count, total_seconds=total))
+                else:
+                    row.count += count
+                    row.total_seconds += total
+
+
+def _last_scans(user_ids):
+    """{user_id: latest scan already rolled up}, to measure the gap to the first new scan"""
+    return dict(db.session.query(ScanRollup.scanned_by, func.max(ScanRollup.last_scan_at)).filter(
+        ScanRollup.scanned_by.in_(user_ids)
+    ).group_by(ScanRollup.scanned_by).all())
+
+
+def _rollup_scans(batch_size, cutoff):
+    """Roll up the next batch of scans; returns how many were processed"""
+    watermark = SystemConfig.get_config(SCAN_WATERMARK_KEY, 0) or 0
+    rows = db.session.execute(select(
+        TaskTicketScan.id,
+        TaskTicketScan.scanned_by,
+        TaskTicketScan.status,
+        TaskTicketScan.scanned_at,
+        TaskTicket.task_id
+    ).select_from(TaskTicketScan).outerjoin(
+        TaskTicket, TaskTicket.id == TaskTicketScan.task_ticket_id
+    ).where(TaskTicketScan.id > watermark).order_by(TaskTicketScan.id).limit(batch_size)).all()
+
+    # Le righe recenti restano al giro successivo (vedi SETTLE_SECONDS)
+    settled = []
+    for row in rows:
+        if row.scanned_at is not None and row.scanned_at >= cutoff:
+            break
+        settled.append(row)
+    if not settled:
+        return 0
+
+    scans = [row for row in settled if row.scanned_at is not None]
+    previous = _last_scans({row.scanned_by for row in scans})
+    accumulator = _Accumulator()
+
+    for row in sorted(scans, key=lambda r: (r.scanned_by, r.scanned_at)):
+        bucket = _hour(row.scanned_at)
+        values = accumulator.rollup(bucket, row.scanned_by, row.task_id or 0)
+        values['scans'] += 1
+        values['success' if row.status in SUCCESS_STATUSES else
+               row.status if row.status in STATUS_COLUMNS else 'other_errors'] += 1
+        values['first_scan_at'] = min(filter(None, (values['first_scan_at'], row.scanned_at)))
+        values['last_scan_at'] = max(filter(None, (values['last_scan_at'], row.scanned_at)))
+
+        last = previous.get(row.scanned_by)
+        if last is not None:
+            gap = (row.scanned_at - last).total_seconds()
+            # Gap negativi: scansione arrivata in ritardo dal buffer dei log, già superata
+            if 0 <= gap <= IDLE_GAP_SECONDS:
+                values['active_seconds'] += gap
+                values['gaps'] += 1
+                accumulator.observe(GAP, GAP_BINS, bucket, row.scanned_by, gap)
+        if last is None or row.scanned_at > last:
+            previous[row.scanned_by] = row.scanned_at
+
+    accumulator.merge()
+    # set_config esegue il commit del batch insieme al nuovo watermark
+    SystemConfig.set_config(SCAN_WATERMARK_KEY, settled[-1].id,
+                            description='Ultima scansione task riassunta in scan_rollups', data_type='integer')
+    return len(settled)
+
+
+def _completion_watermark():
+    value = SystemConfig.get_config(COMPLETION_WATERMARK_KEY)
+    if not value:
+        return datetime.min, 0
+    completed_at, _, task_ticket_id = value.partition('|')
+    return datetime.fromisoformat(completed_at), int(task_ticket_id or 0)
+
+
+def _rollup_completions(batch_size, cutoff):
+    """Roll up the next batch of completed task tickets; returns how many were processed"""
+    completed_after, last_id = _completion_watermark()
+    rows = db.session.execute(select(
+        TaskTicket.id,
+        TaskTicket.started_at,
+        TaskTicket.assigned_at,
+        TaskTicket.completed_at,
+        Task.assigned_to
+    ).select_from(TaskTicket).join(
+        Task, Task.id_task == TaskTicket.task_id
+    ).where(
+        TaskTicket.completed_at.isnot(None),
+        TaskTicket.completed_at < cutoff,
+        or_(TaskTicket.completed_at > completed_after,
+            and_(TaskTicket.completed_at == completed_after, TaskTicket.id > last_id))
+    ).order_by(TaskTicket.completed_at, TaskTicket.id).limit(batch_size)).all()
+    if not rows:
+        return 0
+
+    accumulator = _Accumulator()
+    for row in rows:
+        started = row.started_at or row.assigned_at
+        if started is None:
+            continue
+        seconds = (row.completed_at - started).total_seconds()
+        if seconds >= 0:
+            accumulator.observe(COMPLETION, COMPLETION_BINS, _hour(row.completed_at), row.assigned_to or 0, seconds)
+
+    accumulator.merge()
+    last = rows[-1]
+    SystemConfig.set_config(COMPLETION_WATERMARK_KEY, f'{last.completed_at.isoformat()}|{last.id}',
+                            description='Ultimo ticket completato riassunto in scan_histograms')
+    return len(rows)
+
+
+def refresh_scan_analytics(batch_size=DEFAULT_BATCH_SIZE, now=None):
+    """Roll up every scan and completed ticket not yet summarized.
+
+    Returns:
+        dict: scans, completions processed
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=SETTLE_SECONDS)
+    result = {'scans': 0, 'completions': 0}
+    while True:
+        processed = _rollup_scans(batch_size, cutoff)
+        result['scans'] += processed
+        if processed < batch_size:
+            break
+    while True:
+        processed = _rollup_completions(batch_size, cutoff)
+        result['completions'] += processed
+        if processed < batch_size:
+            break
+    return result
+
+
+def rebuild_scan_analytics(batch_size=DEFAULT_BATCH_SIZE):
+    """Drop the rollups and summarize every scan again"""
+    db.session.query(ScanRollup).delete(synchronize_session=False)
+    db.session.query(ScanHistogram).delete(synchronize_session=False)
+    SystemConfig.set_config(SCAN_WATERMARK_KEY, 0, data_type='integer')
+    SystemConfig.set_config(COMPLETION_WATERMARK_KEY, '')
+    return refresh_scan_analytics(batch_size=batch_size)
+
+
+def _histograms(kind, start, end, user_id=None):
+    """{user_id: ({slot: count}, count, total_seconds)} of kind between start and end"""
+    query = db.session.query(
+        ScanHistogram.user_id, ScanHistogram.slot,
+        func.sum(ScanHistogram.count), func.sum(ScanHistogram.total_seconds)
+    ).filter(ScanHistogram.kind == kind, ScanHistogram.bucket >= start, ScanHistogram.bucket < end)
+    if user_id is not None:
+        query = query.filter(ScanHistogram.user_id == user_id)
+
+    histograms = {}
+    for row_user, slot, count, total in query.group_by(ScanHistogram.user_id, ScanHistogram.slot):
+        slots, user_count, user_total = histograms.get(row_user, ({}, 0, 0.0))
+        slots[slot] = int(count or 0)
+        histograms[row_user] = (slots, user_count + int(count or 0), user_total + float(total or 0))
+    return histograms
+
+
+def _rates(scans, success, active_seconds):
+    return {
+        'scans_per_minute': round(scans / (active_seconds / 60.0), 2) if active_seconds else None,
+        'error_ratio': round((scans - success) / scans, 4) if scans else None
+    }
+
+
+def _distribution(bins, slots):
+    """[{label, count}] of a histogram for the charts"""
+    rows = []
+    lower = 0
+    for slot in range(len(bins) + 1):
+        label = f'{lower}-{bins[slot]}s' if slot < len(bins) else f'>{bins[-1]}s'
+        rows.append({'label': label, 'count': slots.get(slot, 0)})
+        lower = bins[slot] if slot < len(bins) else lower
+    return rows
+
+
+def operator_report(start, end):
+    """Per-operator throughput, error ratios, scan gaps and completion times between start and end"""
+    status_sums = [func.sum(getattr(ScanRollup, column)).label(column)
+                   for column in STATUS_COLUMNS + ('other_errors',)]
+    rows = db.session.query(
+        ScanRollup.scanned_by,
+        User.username,
+        func.sum(ScanRollup.scans).label('scans'),
+        func.sum(ScanRollup.active_seconds).label('active_seconds'),
+        func.count(func.distinct(ScanRollup.task_id)).label('tasks'),
+        *status_sums
+    ).outerjoin(User, User.id == ScanRollup.scanned_by).filter(
+        ScanRollup.bucket >= start, ScanRollup.bucket < end
+    ).group_by(ScanRollup.scanned_by, User.username).order_by(func.sum(ScanRollup.scans).desc()).all()
+
+    gaps = _histograms(GAP, start, end)
+    completions = _histograms(COMPLETION, start, end)
+
+    operators = []
+    for row in rows:
+        scans = int(row.scans or 0)
+        success = int(row.success or 0)
+        gap_slots = gaps.get(row.scanned_by, ({}, 0, 0.0))[0]
+        completion_slots, completed, completion_seconds = completions.get(row.scanned_by, ({}, 0, 0.0))
+        operator = {
+            'user_id': row.scanned_by,
+            'username': row.username or f'#{row.scanned_by}',
+            'scans': scans,
+            'tasks': row.tasks,
+            'active_minutes': round(float(row.active_seconds or 0) / 60.0, 1),
+            'errors': {column: int(getattr(row, column) or 0) for column in STATUS_COLUMNS[1:] + ('other_errors',)},
+            'gap_p50': _percentile(GAP_BINS, gap_slots, 0.5),
+            'gap_p95': _percentile(GAP_BINS, gap_slots, 0.95),
+            'tickets_completed': completed,
+            'completion_avg': round(completion_seconds / completed) if completed else None,
+            'completion_p50': _percentile(COMPLETION_BINS, completion_slots, 0.5),
+            'completion_p95': _percentile(COMPLETION_BINS, completion_slots, 0.95)
+        }
+        operator.update(_rates(scans, success, float(row.active_seconds or 0)))
+        operators.append(operator)
+    return operators
+
+
+def task_report(start, end, limit=50):
+    """Tasks with the most scans between start and end, with their rates"""
+    rows = db.session.query(
+        ScanRollup.task_id,
+        Task.task_number,
+        Task.title,
+        func.sum(ScanRollup.scans).label('scans'),
+        func.sum(ScanRollup.success).label('success'),
+        func.sum(ScanRollup.active_seconds).label('active_seconds'),
+        func.count(func.distinct(ScanRollup.scanned_by)).label('operators'),
+        func.min(ScanRollup.first_scan_at).label('first_scan_at'),
+        func.max(ScanRollup.last_scan_at).label('last_scan_at')
+    ).outerjoin(Task, Task.id_task == ScanRollup.task_id).filter(
+        ScanRollup.bucket >= start, ScanRollup.bucket < end
+    ).group_by(ScanRollup.task_id, Task.task_number, Task.title).order_by(
+        func.sum(ScanRollup.scans).desc()
+    ).limit(limit).all()
+
+    tasks = []
+    for row in rows:
+        scans = int(row.scans or 0)
+        task = {
+            'task_id': row.task_id if row.task_number else None,
+            'task_number': row.task_number or 'Task eliminato',
+            'title': row.title,
+            'scans': scans,
+            'operators': row.operators,
+            'active_minutes': round(float(row.active_seconds or 0) / 60.0, 1),
+            'first_scan_at': row.first_scan_at.isoformat() if row.first_scan_at else None,
+            'last_scan_at': row.last_scan_at.isoformat() if row.last_scan_at else None
+        }
+        task.update(_rates(scans, int(row.success or 0), float(row.active_seconds or 0)))
+        tasks.append(task)
+    return tasks
+
+
+def analytics_report(start, end):
+    """Operators, tasks, status totals and distributions between start and end (naive UTC)"""
+    operators = operator_report(start, end)
+    totals = {'scans': sum(operator['scans'] for operator in operators)}
+    for column in STATUS_COLUMNS[1:] + ('other_errors',):
+        totals[column] = sum(operator['errors'][column] for operator in operators)
+    totals['errors'] = sum(totals[column] for column in STATUS_COLUMNS[1:] + ('other_errors',))
+
+    gap_slots = {}
+    for slots, _, _ in _histograms(GAP, start, end).values():
+        for slot, count in slots.items():
+            gap_slots[slot] = gap_slots.get(slot, 0) + count
+    completion_slots = {}
+    for slots, _, _ in _histograms(COMPLETION, start, end).values():
+        for slot, count in slots.items():
+            completion_slots[slot] = completion_slots.get(slot, 0) + count
+
+    return {
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'totals': totals,
+        'operators': operators,
+        'tasks': task_report(start, end),
+        'gap_distribution': _distribution(GAP_BINS, gap_slots),
+        'completion_distribution': _distribution(COMPLETION_BINS, completion_slots),
+        'gap_p50': _percentile(GAP_BINS, gap_slots, 0.5),
+        'gap_p95': _percentile(GAP_BINS, gap_slots, 0.95),
+        'completion_p50': _percentile(COMPLETION_BINS, completion_slots, 0.5),
+        'completion_p95': _percentile(COMPLETION_BINS, completion_slots, 0.95),
+        'refreshed': get_refresh_status()
+    }
+
+
+class ScanAnalyticsRefresher:
+    """Background thread rolling up the new scans every REFRESH_INTERVAL_SECONDS"""
+
+    def __init__(self, app, interval_seconds=REFRESH_INTERVAL_SECONDS):
+        self.app = app
+        self.interval_seconds = interval_seconds
+        self.last_run = None
+        self.last_result = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._start_lock:
+            if self.is_running or self._stop_event.is_set():
+                return
+            self._thread = threading.Thread(target=self._run_loop, name='scan-analytics', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run_once(self):
+        with self.app.app_context():
+            try:
+                # Un solo processo worker aggiorna le tabelle
+                with leader_lock(LOCK_NAME) as is_leader:
+                    if not is_leader:
+                        return None
+                    self.last_result = refresh_scan_analytics()
+                    self.last_run = datetime.utcnow()
+                    return self.last_result
+            finally:
+                db.session.remove()
+
+    def _run_loop(self):
+        while not self._stop_event.wait(self.interval_seconds):
+            try:
+                self.run_once()
+            except Exception as e:
+                logger.error(f"Errore nell'aggiornamento delle statistiche scansioni: {str(e)}")
+
+
+def get_refresh_status():
+    return {
+        'running': _refresher.is_running if _refresher else False,
+        'interval_seconds': REFRESH_INTERVAL_SECONDS,
+        'last_run': _refresher.last_run.isoformat() if _refresher and _refresher.last_run else None,
+        'scan_watermark': SystemConfig.get_config(SCAN_WATERMARK_KEY, 0)
+    }
+
+
+def init_app(app):
+    """Register the refresh CLI command and the background refresher.
+
+    The thread starts on the first request, so CLI commands never spawn it.
+    """
+    global _refresher
+
+    @app.cli.command('refresh-scan-analytics')
+    @click.option('--rebuild', is_flag=True, help='Ricostruisce le tabelle da zero')
+    @click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True, help='Righe per transazione')
+    def refresh_scan_analytics_command(rebuild, batch_size):
+        """Aggiorna le statistiche delle scansioni dei task (scan_rollups, scan_histograms)."""
+        if rebuild:
+            result = rebuild_scan_analytics(batch_size=batch_size)
+        else:
+            result = refresh_scan_analytics(batch_size=batch_size)
+        click.echo(f"Statistiche scansioni: {result['scans']} scansioni e "
+                   f"{result['completions']} ticket completati riassunti")
+
+    if _refresher is not None:
+        return
+
+    _refresher = ScanAnalyticsRefresher(app)
+    atexit.register(_refresher.stop)
+
+    @app.before_request
+    def start_scan_analytics_refresher():
+        if not _refresher.is_running:
+            _refresher.start()
@@ -0,0 +1,425 @@
+"""
+Scan resolution - decodifica dei QR code delle bilance e risoluzione del ticket
+
+Formato QR (27 cifre): NumTicket(4) IdArticulo(4) Peso in grammi(5)
+Timestamp DDMMYYYYHHMMSS(14).
+
+NumTicket si ripete nel tempo (4 cifre), quindi il ticket corretto è quello
+con Fecha più vicina al timestamp del QR: i due candidati (il precedente e il
+successivo al timestamp) vengono letti con una sola query sull'indice
+(NumTicket, Fecha), insieme a tutte le linee del ticket e ai loro prodotti.
+
+I ticket risolti restano in cache per CACHE_TTL_SECONDS: le scansioni
+successive dello stesso ticket (tipicamente i prodotti di un task) non
+tornano sul database. Le voci vengono invalidate quando l'applicazione
+modifica il ticket o le sue linee.
+"""
+
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import event, select, union_all
+
+from app.models import db, Product, TicketHeader, TicketLine
+
+logger = logging.getLogger(__name__)
+
+QR_CODE_LENGTH = 27
+CACHE_TTL_SECONDS = 60
+CACHE_MAX_ENTRIES = 512
+
+_QR_PATTERN = re.compile(r'(\d{4})(\d{4})(\d{5})(\d{2})(\d{2})(\d{4})(\d{2})(\d{2})(\d{2})')
+
+
+class QrCode:
+    """Decoded 27-digit scale QR code"""
+
+    __slots__ = ('raw', 'ticket_num', 'product_id', 'weight_grams',
+                 'day', 'month', 'year', 'hour', 'minute', 'second')
+
+    def __init__(self, raw, groups):
+        self.raw = raw
+        (ticket_num, product_id, weight_grams,
+         self.day, self.month, self.year, self.hour, self.minute, self.second) = groups
+        self.ticket_num = int(ticket_num)
+        self.product_id = int(product_id)
+        self.weight_grams = int(weight_grams)
+
+    def __repr__(self):
+        return f'<QrCode ticket={self.ticket_num} product={self.product_id} {self.weight_grams}g>'
+
+    @property
+    def weight_kg(self):
+        return self.weight_grams / 1000.0
+
+    @property
+    def scan_date(self):
+        return f"{self.day}/{self.month}/{self.year}"
+
+    @property
+    def scan_time(self):
+        return f"{self.hour}:{self.minute}:{self.second}"
+
+    @property
+    def timestamp(self):
+        """Scale timestamp as datetime, None if the digits are not a valid date"""
+        try:
+            return datetime(int(self.year), int(self.month), int(self.day),
+                            int(self.hour), int(self.minute), int(self.second))
+        except ValueError:
+            return None
+
+
+def decode_qr(code):
+    """Decode a scale QR code; returns QrCode or None if the format is invalid"""
+    if not code or len(code) != QR_CODE_LENGTH:
+        return None
+    match = _QR_PATTERN.fullmatch(code)
+    if match is None:
+        return None
+    return QrCode(code, match.groups())
+
+
+class ResolvedLine:
+    """Ticket line with its product, as needed by the scan screens"""
+
+    __slots__ = ('IdLineaTicket', 'IdArticulo', 'Descripcion', 'comportamiento',
+                 'FechaCaducidad', 'product_name')
+
+    def __init__(self, row):
+        self.IdLineaTicket = row.IdLineaTicket
+        self.IdArticulo = row.IdArticulo
+        self.Descripcion = row.linea_descripcion
+        self.comportamiento = row.comportamiento
+        self.FechaCaducidad = row.FechaCaducidad
+        self.product_name = row.producto_descripcion
+
+
+class ResolvedTicket:
+    """Snapshot of a ticket header and its lines"""
+
+    __slots__ = ('IdTicket', 'NumTicket', 'Fecha', 'Enviado', 'CodigoBarras', 'lines', 'loaded_at')
+
+    def __init__(self, row):
+        self.IdTicket = row.IdTicket
+        self.NumTicket = row.NumTicket
+        self.Fecha = row.Fecha
+        self.Enviado = row.Enviado
+        self.CodigoBarras = row.CodigoBarras
+        self.lines = []
+        self.loaded_at = time.monotonic()
+
+    def __repr__(self):
+        return f'<ResolvedTicket {self.IdTicket}: Ticket #{self.NumTicket}>'
+
+    @property
+    def formatted_date(self):
+        return self.Fecha.strftime('%d/%m/%Y %H:%M') if self.Fecha else 'N/A'
+
+    def line_for(self, product_id):
+        """First line (lowest IdLineaTicket) of the given article, or None"""
+        for line in self.lines:
+            if line.IdArticulo == product_id:
+                return line
+        return None
+
+    def line_by_id(self, line_id):
+        for line in self.lines:
+            if line.IdLineaTicket == line_id:
+                return line
+        return None
+
+
+class ScanResolution:
+    """Result of resolve_scan: the ticket, the scanned line and the product"""
+
+    __slots__ = ('qr', 'ticket', 'line', 'product_id', 'product_name', 'product_found')
+
+    def __init__(self, qr, ticket, line, product_name, product_found):
+        self.qr = qr
+        self.ticket = ticket
+        self.line = line
+        self.product_id = qr.product_id
+        self.product_name = product_name
+        self.product_found = product_found
+
+
+class _TicketCache:
+    """Small thread-safe TTL cache of ResolvedTicket by IdTicket and by QR key"""
+
+    def __init__(self, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._tickets = OrderedDict()
+        self._keys = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _fresh(self, ticket):
+        return ticket is not None and time.monotonic() - ticket.loaded_at <= self.ttl
+
+    def get(self, ticket_id):
+        with self._lock:
+            ticket = self._tickets.get(ticket_id)
+            if self._fresh(ticket):
+                self._tickets.move_to_end(ticket_id)
+                self.hits += 1
+                return ticket
+            self.misses += 1
+            return None
+
+    def get_by_key(self, key):
+        with self._lock:
+            ticket_id = self._keys.get(key)
+        return self.get(ticket_id) if ticket_id is not None else None
+
+    def put(self, ticket, key=None):
+        with self._lock:
+            self._tickets[ticket.IdTicket] = ticket
+            self._tickets.move_to_end(ticket.IdTicket)
+            if key is not None:
+                self._keys[key] = ticket.IdTicket
+            while len(self._tickets) > self.max_entries:
+                evicted_id, _ = self._tickets.popitem(last=False)
+                self._keys = {k: v for k, v in self._keys.items() if v != evicted_id}
+
+    def evict(self, ticket_ids):
+        with self._lock:
+            for ticket_id in ticket_ids:
+                self._tickets.pop(ticket_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._tickets.clear()
+            self._keys.clear()
+
+
+_cache = _TicketCache()
+_listeners_registered = False
+
+
+def _ticket_columns():
+    return (
+        TicketHeader.IdTicket,
+        TicketHeader.NumTicket,
+        TicketHeader.Fecha,
+        TicketHeader.Enviado,
+        TicketHeader.CodigoBarras,
+        TicketLine.IdLineaTicket,
+        TicketLine.IdArticulo,
+        TicketLine.Descripcion.label('linea_descripcion'),
+        TicketLine.comportamiento,
+        TicketLine.FechaCaducidad,
+        Product.Descripcion.label('producto_descripcion')
+    )
+
+
+def _with_lines(statement):
+    return statement.outerjoin(
+        TicketLine, TicketLine.IdTicket == TicketHeader.IdTicket
+    ).outerjoin(
+        Product, TicketLine.IdArticulo == Product.IdArticulo
+    ).order_by(TicketHeader.IdTicket, TicketLine.IdLineaTicket)
+
+
+def _build_tickets(rows):
+    """Group joined header/line rows into ResolvedTicket objects"""
+    tickets = OrderedDict()
+    seen_lines = set()
+    for row in rows:
+        ticket = tickets.get(row.IdTicket)
+        if ticket is None:
+            ticket = tickets[row.IdTicket] = ResolvedTicket(row)
+        # La chiave primaria di dat_ticket_linea è composta: una riga per IdLineaTicket
+        if row.IdLineaTicket is not None and (row.IdTicket, row.IdLineaTicket) not in seen_lines:
+            seen_lines.add((row.IdTicket, row.IdLineaTicket))
+            ticket.lines.append(ResolvedLine(row))
+    return list(tickets.values())
+
+
+def _closest(tickets, timestamp):
+    if not tickets:
+        return None
+    if timestamp is None:
+        return max(tickets, key=lambda t: t.Fecha or datetime.min)
+    return min(tickets, key=lambda t: abs((t.Fecha - timestamp).total_seconds()) if t.Fecha else float('inf'))
+
+
+def _load_candidates(ticket_num, timestamp):
+    """The ticket with this NumTicket just before and just after timestamp, with lines"""
+    if timestamp is not None:
+        before = select(TicketHeader.IdTicket).where(
+            TicketHeader.NumTicket == ticket_num,
+            TicketHeader.Fecha <= timestamp
+        ).order_by(TicketHeader.Fecha.desc()).limit(1).subquery()
+        after = select(TicketHeader.IdTicket).where(
+            TicketHeader.NumTicket == ticket_num,
+            TicketHeader.Fecha > timestamp
+        ).order_by(TicketHeader.Fecha.asc()).limit(1).subquery()
+        candidates = union_all(select(before.c.IdTicket), select(after.c.IdTicket)).subquery()
+    else:
+        candidates = select(TicketHeader.IdTicket).where(
+            TicketHeader.NumTicket == ticket_num
+        ).order_by(TicketHeader.Fecha.desc()).limit(1).subquery()
+
+    statement = select(*_ticket_columns()).select_from(candidates).join(
+        TicketHeader, TicketHeader.IdTicket == candidates.c.IdTicket
+    )
+    tickets = _build_tickets(db.session.execute(_with_lines(statement)).all())
+
+    if not tickets and timestamp is not None:
+        # Ticket senza Fecha: non raggiungibili dalle due ricerche per data
+        statement = select(*_ticket_columns()).select_from(TicketHeader).where(
+            TicketHeader.NumTicket == ticket_num
+        )
+        tickets = _build_tickets(db.session.execute(_with_lines(statement)).all())
+
+    return tickets
+
+
+def get_ticket_snapshot(ticket_id):
+    """ResolvedTicket for a known IdTicket (cached), None if it does not exist"""
+    ticket = _cache.get(ticket_id)
+    if ticket is not None:
+        return ticket
+
+    statement = select(*_ticket_columns()).select_from(TicketHeader).where(
+        TicketHeader.IdTicket == ticket_id
+    )
+    tickets = _build_tickets(db.session.execute(_with_lines(statement)).all())
+    if not tickets:
+        return None
+    _cache.put(tickets[0])
+    return tickets[0]
+
+
+def resolve_scan(code):
+    """Resolve a QR code (string or QrCode) to its ticket, line and product.
+
+    Returns:
+        ScanResolution, or None if the code is not a valid QR code
+    """
+    qr = code if isinstance(code, QrCode) else decode_qr(code)
+    if qr is None:
+        return None
+
+    timestamp = qr.timestamp
+    key = (qr.ticket_num, timestamp)
+    ticket = _cache.get_by_key(key)
+    if ticket is None:
+        ticket = _closest(_load_candidates(qr.ticket_num, timestamp), timestamp)
+        if ticket is not None:
+            _cache.put(ticket, key=key)
+
+    line = ticket.line_for(qr.product_id) if ticket else None
+    if line is not None and line.product_name is not None:
+        return ScanResolution(qr, ticket, line, line.product_name, True)
+
+    # Prodotto non presente nel ticket (o ticket non trovato): serve solo per il messaggio
+    product = db.session.query(Product.IdArticulo, Product.Descripcion).filter(
+        Product.IdArticulo == qr.product_id
+    ).first()
+    return ScanResolution(qr, ticket, line, product.Descripcion if product else None, product is not None)
+
+
+def _load_candidates_many(keys):
+    """Candidates of many (NumTicket, timestamp) keys with a single query.
+
+    Every ticket loaded for a NumTicket is the one before or after the
+    timestamp of some key, so the closest one to each key is always among them.
+    """
+    selects = []
+    for ticket_num, timestamp in keys:
+        before = select(TicketHeader.IdTicket).where(
+            TicketHeader.NumTicket == ticket_num,
+            TicketHeader.Fecha <= timestamp
+        ).order_by(TicketHeader.Fecha.desc()).limit(1).subquery()
+        after = select(TicketHeader.IdTicket).where(
+            TicketHeader.NumTicket == ticket_num,
+            TicketHeader.Fecha > timestamp
+        ).order_by(TicketHeader.Fecha.asc()).limit(1).subquery()
+        selects.extend((select(before.c.IdTicket), select(after.c.IdTicket)))
+
+    candidates = union_all(*selects).subquery()
+    statement = select(*_ticket_columns()).select_from(candidates).join(
+        TicketHeader, TicketHeader.IdTicket == candidates.c.IdTicket
+    )
+    by_num = {}
+    for ticket in _build_tickets(db.session.execute(_with_lines(statement)).all()):
+        by_num.setdefault(ticket.NumTicket, []).append(ticket)
+    return by_num
+
+
+def resolve_tickets(codes):
+    """Ticket of each QR code, resolving all cache misses with one query.
+
+    Returns:
+        dict: {code: (QrCode, ResolvedTicket or None)}; invalid codes map to (None, None)
+    """
+    results = {}
+    missing = {}
+    for code in codes:
+        qr = decode_qr(code)
+        if qr is None:
+            results[code] = (None, None)
+            continue
+        key = (qr.ticket_num, qr.timestamp)
+        ticket = _cache.get_by_key(key)
+        if ticket is not None:
+            results[code] = (qr, ticket)
+        else:
+            missing.setdefault(key, []).append(qr)
+
+    dated = [key for key in missing if key[1] is not None]
+    by_num = _load_candidates_many(dated) if dated else {}
+
+    for key, qrs in missing.items():
+        ticket_num, timestamp = key
+        if timestamp is not None:
+            ticket = _closest(by_num.get(ticket_num, []), timestamp)
+        else:
+            # Timestamp del QR non valido (raro): ricerca singola come resolve_scan
+            ticket = _closest(_load_candidates(ticket_num, None), None)
+        if ticket is not None:
+            _cache.put(ticket, key=key)
+        for qr in qrs:
+            results[qr.raw] = (qr, ticket)
+
+    return results
+
+
+def invalidate_tickets(ticket_ids):
+    _cache.evict(ticket_ids)
+
+
+def invalidate_all_tickets():
+    """Drop every cached ticket (bulk changes whose ticket ids are not read back)"""
+    _cache.clear()
+
+
+def get_cache_stats():
+    return {'entries': len(_cache._tickets), 'hits': _cache.hits, 'misses': _cache.misses,
+            'ttl_seconds': _cache.ttl}
+
+
+def _evict_after_flush(session, flush_context):
+    ticket_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (TicketHeader, TicketLine)) and obj.IdTicket is not None:
+            ticket_ids.add(obj.IdTicket)
+    if ticket_ids:
+        _cache.evict(ticket_ids)
+
+
+def init_app(app):
+    """Register the cache invalidation hook"""
+    global _listeners_registered
+
+    if not _listeners_registered:
+        event.listen(db.session, 'after_flush', _evict_after_flush)
+        _listeners_registered = True
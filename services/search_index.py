@@ -0,0 +1,505 @@
+"""
+Search index - ricerca testuale indicizzata su articoli e ticket
+
+Sostituisce i filtri ILIKE '%q%' (che non possono usare indici) con un indice
+invertito a trigrammi in memoria:
+- articoli: descrizione, codice (IdArticulo) ed EAN (dat_articulo_eanscanner)
+- ticket: barcode, numero ticket, descrizioni delle linee e, tramite l'indice
+  articoli, descrizione del prodotto delle linee
+
+La ricerca usa la lista di posting del trigramma più raro e verifica la
+sottostringa sui soli candidati, quindi supporta prefissi e infissi con una
+latenza che dipende dai risultati e non dalle dimensioni delle tabelle.
+
+Aggiornamento:
+- ticket: incrementale per IdTicket (i ticket arrivano dalle bilance in ordine
+  crescente), al più ogni TICKET_REFRESH_SECONDS; i ticket già indicizzati di
+  cui l'app cambia un testo cercato (barcode, numero, descrizione o articolo
+  di una linea) o aggiunge/elimina linee sono indicizzati di nuovo dopo il
+  commit; i cambi di stato (Enviado) non toccano l'indice. L'indice è solo in aggiunta: un testo rimosso resta tra i candidati
+  fino alla ricostruzione, fatta dopo REBUILD_AFTER_REINDEX ticket rivisti
+- articoli: ricaricati per intero (poche migliaia di righe) quando più vecchi
+  di PRODUCT_REFRESH_SECONDS o quando un Product viene modificato dall'app
+
+ticket_search_clause() restituisce una condizione SQL che i chiamanti
+combinano con i propri filtri (date, Enviado), ordinamento e LIMIT nella
+stessa query, quindi nessun risultato viene scartato prima dei filtri. Se
+l'indice trova al più MAX_IN_LIST ticket la condizione è IdTicket IN (...);
+per ricerche poco selettive gli id sono scritti in ticket_search_results
+nella transazione del chiamante e la condizione è una subquery sulla chiave
+primaria di quella tabella: il database non valuta mai un LIKE '%...%'.
+"""
+
+import logging
+import threading
+import time
+import unicodedata
+import uuid
+from array import array
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import delete, event, false, insert, inspect, select, text
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.models import db, Product, TicketHeader, TicketLine, TicketSearchResult
+
+logger = logging.getLogger(__name__)
+
+NGRAM = 3
+TICKET_REFRESH_SECONDS = 30
+PRODUCT_REFRESH_SECONDS = 300
+TICKET_BATCH_SIZE = 5000
+# Oltre questo numero di ticket trovati gli id passano da ticket_search_results
+MAX_IN_LIST = 1000
+RESULT_INSERT_BATCH = 5000
+RESULT_TTL_SECONDS = 600
+# Ticket indicizzati di nuovo dopo le modifiche prima di ricostruire l'indice
+REBUILD_AFTER_REINDEX = 2000
+
+PRODUCT_FIELDS = ('description', 'code', 'ean')
+TICKET_FIELDS = ('barcode', 'number', 'description', 'product')
+
+# Colonne indicizzate: solo una loro modifica richiede di indicizzare di nuovo il ticket
+INDEXED_COLUMNS = {
+    TicketHeader: ('CodigoBarras', 'NumTicket'),
+    TicketLine: ('Descripcion', 'IdArticulo')
+}
+
+_SEPARATOR = '\x00'
+
+
+def normalize(value):
+    """Lowercase and strip accents, so 'Caffè' matches 'caffe' as with MySQL *_ci collations"""
+    if value is None:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', str(value).lower())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).strip()
+
+
+class NgramIndex:
+    """Trigram inverted index over short texts, append-only"""
+
+    def __init__(self):
+        self._postings = {}
+        self._texts = {}
+
+    def __len__(self):
+        return len(self._texts)
+
+    def add(self, doc_id, *values):
+        values = [v for v in (normalize(value) for value in values) if v]
+        previous = self._texts.get(doc_id)
+        if previous is not None:
+            existing = previous.split(_SEPARATOR)
+            values = [v for v in values if v not in existing]
+        if not values:
+            return
+        # Più valori per documento (es. più EAN) separati da un carattere mai presente nelle query
+        self._texts[doc_id] = _SEPARATOR.join(([previous] if previous is not None else []) + values)
+
+        grams = {value[i:i + NGRAM] for value in values for i in range(len(value) - NGRAM + 1)}
+        if previous is not None:
+            grams -= {previous[i:i + NGRAM] for i in range(len(previous) - NGRAM + 1)}
+        for gram in grams:
+            postings = self._postings.get(gram)
+            if postings is None:
+                postings = self._postings[gram] = array('q')
+            postings.append(doc_id)
+
+    def search(self, query):
+        """Return the set of doc ids whose text contains query (already normalized)"""
+        if not query:
+            return set()
+
+        if len(query) < NGRAM:
+            # Query troppo corta per i trigrammi: scansione dei testi (solo 1-2 caratteri)
+            return {doc_id for doc_id, value in self._texts.items() if query in value}
+
+        rarest = None
+        for gram in {query[i:i + NGRAM] for i in range(len(query) - NGRAM + 1)}:
+            postings = self._postings.get(gram)
+            if postings is None:
+                return set()
+            if rarest is None or len(postings) < len(rarest):
+                rarest = postings
+
+        texts = self._texts
+        return {doc_id for doc_id in rarest if query in texts[doc_id]}
+
+
+class ProductSearchIndex:
+    """Articles by description, code and EAN"""
+
+    def __init__(self):
+        self.fields = {field: NgramIndex() for field in PRODUCT_FIELDS}
+        self.built_at = 0.0
+
+    def build(self):
+        for product_id, description in db.session.query(Product.IdArticulo, Product.Descripcion).all():
+            self.fields['description'].add(product_id, description)
+            self.fields['code'].add(product_id, str(product_id))
+
+        try:
+            eans = db.session.execute(text(
+                "SELECT IdArticulo, EANScanner FROM dat_articulo_eanscanner"
+            )).fetchall()
+        except Exception as e:
+            # Tabella EAN non presente su alcune installazioni
+            db.session.rollback()
+            logger.warning(f"EAN non indicizzati: {str(e)}")
+            eans = []
+        for product_id, ean in eans:
+            self.fields['ean'].add(product_id, ean)
+
+        self.built_at = time.monotonic()
+        return self
+
+    def search(self, query, fields=PRODUCT_FIELDS):
+        normalized = normalize(query)
+        matches = set()
+        for field in fields:
+            matches |= self.fields[field].search(normalized)
+        return matches
+
+
+class TicketSearchIndex:
+    """Tickets by barcode, number, line description and line product"""
+
+    def __init__(self):
+        self.barcodes = NgramIndex()
+        self.numbers = NgramIndex()
+        # Le descrizioni delle linee si ripetono (nome prodotto): indicizzate una volta sola
+        self.descriptions = NgramIndex()
+        self._description_ids = {}
+        self._description_tickets = {}
+        self._article_tickets = {}
+        self.ticket_count = 0
+        self.watermark = 0
+        self.reindexed = 0
+        self.refreshed_at = 0.0
+
+    def _add_line(self, ticket_id, article_id, description):
+        normalized = normalize(description)
+        if normalized:
+            description_id = self._description_ids.get(normalized)
+            if description_id is None:
+                description_id = self._description_ids[normalized] = len(self._description_ids) + 1
+                self.descriptions.add(description_id, normalized)
+                self._description_tickets[description_id] = array('q')
+            tickets = self._description_tickets[description_id]
+            if not tickets or tickets[-1] != ticket_id:
+                tickets.append(ticket_id)
+        if article_id is not None:
+            tickets = self._article_tickets.get(article_id)
+            if tickets is None:
+                tickets = self._article_tickets[article_id] = array('q')
+            if not tickets or tickets[-1] != ticket_id:
+                tickets.append(ticket_id)
+
+    def _add_tickets(self, headers, lines):
+        for header in headers:
+            self.barcodes.add(header.IdTicket, header.CodigoBarras or '')
+            if header.NumTicket is not None:
+                self.numbers.add(header.IdTicket, str(header.NumTicket))
+        for line in lines:
+            self._add_line(line.IdTicket, line.IdArticulo, line.Descripcion)
+
+    def reindex(self, ticket_ids):
+        """Add the current text of already indexed tickets; returns how many were read"""
+        ticket_ids = sorted(ticket_id for ticket_id in ticket_ids if ticket_id <= self.watermark)
+        if not ticket_ids:
+            return 0
+        headers = db.session.query(
+            TicketHeader.IdTicket,
+            TicketHeader.NumTicket,
+            TicketHeader.CodigoBarras
+        ).filter(TicketHeader.IdTicket.in_(ticket_ids)).all()
+        lines = db.session.query(
+            TicketLine.IdTicket,
+            TicketLine.IdArticulo,
+            TicketLine.Descripcion
+        ).filter(TicketLine.IdTicket.in_(ticket_ids)).order_by(TicketLine.IdTicket.asc()).all()
+        self._add_tickets(headers, lines)
+        self.reindexed += len(ticket_ids)
+        return len(ticket_ids)
+
+    def refresh(self, batch_size=TICKET_BATCH_SIZE):
+        """Index tickets with IdTicket above the watermark; returns how many were added"""
+        added = 0
+        while True:
+            headers = db.session.query(
+                TicketHeader.IdTicket,
+                TicketHeader.NumTicket,
+                TicketHeader.CodigoBarras
+            ).filter(
+                TicketHeader.IdTicket > self.watermark
+            ).order_by(TicketHeader.IdTicket.asc()).limit(batch_size).all()
+
+            if not headers:
+                break
+
+            first_id, last_id = headers[0].IdTicket, headers[-1].IdTicket
+            lines = db.session.query(
+                TicketLine.IdTicket,
+                TicketLine.IdArticulo,
+                TicketLine.Descripcion
+            ).filter(
+                TicketLine.IdTicket >= first_id,
+                TicketLine.IdTicket <= last_id
+            ).order_by(TicketLine.IdTicket.asc()).all()
+
+            self._add_tickets(headers, lines)
+
+            self.watermark = last_id
+            self.ticket_count += len(headers)
+            added += len(headers)
+            if len(headers) < batch_size:
+                break
+
+        self.refreshed_at = time.monotonic()
+        return added
+
+    def search(self, query, product_index, fields=TICKET_FIELDS):
+        normalized = normalize(query)
+        matches = set()
+        if 'barcode' in fields:
+            matches |= self.barcodes.search(normalized)
+        if 'number' in fields:
+            matches |= self.numbers.search(normalized)
+        if 'description' in fields:
+            for description_id in self.descriptions.search(normalized):
+                matches.update(self._description_tickets[description_id])
+        if 'product' in fields:
+            for article_id in product_index.search(query, fields=('description',)):
+                matches.update(self._article_tickets.get(article_id, ()))
+        return matches
+
+
+class SearchService:
+    """Process-wide holder of the indexes, refreshed lazily under a lock"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._products = None
+        self._tickets = None
+        self._products_stale = False
+        # Ticket modificati dopo l'indicizzazione, letti di nuovo alla prossima ricerca
+        self._changed_lock = threading.Lock()
+        self._changed_tickets = set()
+
+    def invalidate_products(self):
+        self._products_stale = True
+
+    def tickets_changed(self, ticket_ids):
+        with self._changed_lock:
+            self._changed_tickets.update(ticket_ids)
+
+    def _take_changed(self):
+        with self._changed_lock:
+            changed, self._changed_tickets = self._changed_tickets, set()
+        return changed
+
+    def products(self):
+        with self._lock:
+            index = self._products
+            if (index is None or self._products_stale
+                    or time.monotonic() - index.built_at > PRODUCT_REFRESH_SECONDS):
+                self._products_stale = False
+                start = time.perf_counter()
+                self._products = index = ProductSearchIndex().build()
+                logger.info(f"Indice ricerca articoli costruito: {len(index.fields['code'])} articoli "
+                            f"in {int((time.perf_counter() - start) * 1000)} ms")
+            return index
+
+    def tickets(self):
+        with self._lock:
+            index = self._tickets
+            if index is not None and index.reindexed > REBUILD_AFTER_REINDEX:
+                # Troppi testi sostituiti: ricostruzione per togliere i candidati non più validi
+                logger.info(f"Indice ricerca ticket ricostruito dopo {index.reindexed} ticket modificati")
+                index = None
+                self._take_changed()
+            if index is None:
+                index = self._tickets = TicketSearchIndex()
+            changed = self._take_changed()
+            if changed:
+                index.reindex(changed)
+            if time.monotonic() - index.refreshed_at > TICKET_REFRESH_SECONDS:
+                start = time.perf_counter()
+                added = index.refresh()
+                if added:
+                    logger.info(f"Indice ricerca ticket: {added} ticket aggiunti "
+                                f"in {int((time.perf_counter() - start) * 1000)} ms")
+            return index
+
+    def search_products(self, query, fields):
+        with self._lock:
+            return self.products().search(query, fields=fields)
+
+    def search_tickets(self, query, fields):
+        with self._lock:
+            return self.tickets().search(query, self.products(), fields=fields)
+
+    def reset(self):
+        with self._lock:
+            self._products = None
+            self._tickets = None
+
+    def stats(self):
+        return {
+            'products': len(self._products.fields['code']) if self._products else 0,
+            'tickets': self._tickets.ticket_count if self._tickets else 0,
+            'ticket_watermark': self._tickets.watermark if self._tickets else 0,
+            'descriptions': len(self._tickets.descriptions) if self._tickets else 0
+        }
+
+
+_service = SearchService()
+_listeners_registered = False
+
+
+def search_product_ids(query, fields=PRODUCT_FIELDS):
+    """IdArticulo of the articles matching query (infix, case/accent insensitive)"""
+    return _service.search_products(query, fields)
+
+
+class SearchResultStore:
+    """Writes broad ticket matches to ticket_search_results for the caller's query"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    def _prune(self):
+        # Solo le righe confermate da un commit del chiamante: transazione breve propria
+        now = time.monotonic()
+        with self._lock:
+            if now - self._pruned_at < RESULT_TTL_SECONDS:
+                return
+            self._pruned_at = now
+        table = TicketSearchResult.__table__
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(delete(table).where(
+                    table.c.created_at < datetime.utcnow() - timedelta(seconds=RESULT_TTL_SECONDS)
+                ))
+        except SQLAlchemyError as e:
+            logger.warning(f"Pulizia di ticket_search_results non riuscita: {str(e)}")
+
+    def clause(self, matches):
+        """IdTicket IN (subquery on the primary key of the rows written for matches)"""
+        self._prune()
+        table = TicketSearchResult.__table__
+        search_id = uuid.uuid4().hex
+        now = datetime.utcnow()
+        ticket_ids = sorted(matches)
+        # Nella transazione del chiamante: la sua query le vede, il rollback di fine richiesta le elimina
+        for start in range(0, len(ticket_ids), RESULT_INSERT_BATCH):
+            db.session.execute(insert(table), [
+                {'search_id': search_id, 'ticket_id': ticket_id, 'created_at': now}
+                for ticket_id in ticket_ids[start:start + RESULT_INSERT_BATCH]
+            ])
+        return TicketHeader.IdTicket.in_(select(table.c.ticket_id).where(table.c.search_id == search_id))
+
+
+_results = SearchResultStore()
+
+
+def ticket_search_clause(query, fields=TICKET_FIELDS):
+    """SQL condition on TicketHeader for the tickets matching query (infix, case/accent insensitive).
+
+    Combine it with the caller's filters, order and LIMIT in the same query,
+    in the same transaction (broad matches are written to ticket_search_results).
+    """
+    matches = _service.search_tickets(query, fields)
+    if not matches:
+        return false()
+    if len(matches) <= MAX_IN_LIST:
+        return TicketHeader.IdTicket.in_(sorted(matches))
+    logger.info(f"Ricerca ticket '{query}': {len(matches)} candidati, id in ticket_search_results")
+    return _results.clause(matches)
+
+
+def invalidate_product_index():
+    _service.invalidate_products()
+
+
+def get_search_index_stats():
+    return _service.stats()
+
+
+def _text_changed(obj):
+    attrs = inspect(obj).attrs
+    return any(attrs[column].history.has_changes() for column in INDEXED_COLUMNS[type(obj)])
+
+
+def _collect_changes(session, flush_context):
+    changed_tickets = set()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Product):
+            _service.invalidate_products()
+        elif isinstance(obj, (TicketHeader, TicketLine)) and obj.IdTicket is not None:
+            changed_tickets.add(obj.IdTicket)
+    for obj in session.dirty:
+        if isinstance(obj, Product):
+            _service.invalidate_products()
+        elif isinstance(obj, (TicketHeader, TicketLine)) and obj.IdTicket is not None and _text_changed(obj):
+            # Un checkout cambia solo Enviado: nessuna rilettura del ticket
+            changed_tickets.add(obj.IdTicket)
+    if changed_tickets:
+        session.info.setdefault('search_changed_tickets', set()).update(changed_tickets)
+
+
+def _reindex_after_commit(session):
+    # Solo le modifiche confermate; i ticket nuovi arrivano comunque dal watermark
+    changed = session.info.pop('search_changed_tickets', None)
+    if changed:
+        _service.tickets_changed(changed)
+
+
+def _discard_after_rollback(session):
+    session.info.pop('search_changed_tickets', None)
+
+
+def init_app(app):
+    """Register the product change hook, the warm-up and the rebuild CLI command"""
+    global _listeners_registered
+
+    if not _listeners_registered:
+        event.listen(db.session, 'after_flush', _collect_changes)
+        event.listen(db.session, 'after_commit', _reindex_after_commit)
+        event.listen(db.session, 'after_rollback', _discard_after_rollback)
+        _listeners_registered = True
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """Ricostruisce gli indici di ricerca articoli e ticket."""
+        _service.reset()
+        start = time.perf_counter()
+        _service.products()
+        _service.tickets()
+        stats = _service.stats()
+        click.echo(f"Indici ricostruiti in {int((time.perf_counter() - start) * 1000)} ms: "
+                   f"{stats['products']} articoli, {stats['tickets']} ticket")
+
+    warmed_up = threading.Event()
+
+    @app.before_request
+    def warm_up_search_index():
+        # Costruzione iniziale in background, così la prima ricerca non attende
+        if warmed_up.is_set():
+            return
+        warmed_up.set()
+
+        def build():
+            with app.app_context():
+                try:
+                    _service.products()
+                    _service.tickets()
+                except Exception as e:
+                    logger.error(f"Errore nella costruzione degli indici di ricerca: {str(e)}")
+                finally:
+                    db.session.remove()
+
+        threading.Thread(target=build, name='search-index-warmup', daemon=True).start()
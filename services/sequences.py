@@ -0,0 +1,114 @@
+"""
+Sequences - numerazioni progressive senza collisioni (task, DDT, fatture)
+
+I numeri venivano calcolati come massimo esistente + 1 (per i task caricando
+tutti i task del giorno e leggendo i suffissi in Python): due richieste
+contemporanee potevano ottenere lo stesso numero.
+
+Ogni sequenza ha una riga in sequence_counters per (nome, periodo) e ogni
+numero è assegnato con un solo UPDATE atomico nella transazione del
+chiamante (su MySQL SET value = LAST_INSERT_ID(value + 1), letto senza
+un'altra query sulla tabella). La riga resta bloccata fino al commit: chi
+chiede un numero nello stesso momento attende, e un numero di una
+transazione annullata viene riassegnato (nessun buco nella numerazione DDT).
+
+Per le tabelle scritte anche da altri programmi (le bilance scrivono
+dat_albaran_cabecera) si può passare un floor: il valore assegnato non è mai
+inferiore a MAX(colonna) + 1.
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import case, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from app.models import db, AlbaranCabecera, SequenceCounter, Task
+
+logger = logging.getLogger(__name__)
+
+TASK_NUMBER = 'task_number'
+DDT_ID = 'ddt_id'
+DDT_NUMBER = 'ddt_number'
+INVOICE_NUMBER = 'invoice_number'
+
+
+def _increment(conn, name, period, floor):
+    """Increment the row and return the new value, None if the row does not exist"""
+    table = SequenceCounter.__table__
+    where = (table.c.name == name) & (table.c.period == period)
+    new_value = table.c.value + 1
+    if floor is not None:
+        new_value = case((new_value >= floor, new_value), else_=floor)
+
+    if conn.dialect.name == 'mysql':
+        result = conn.execute(update(table).where(where).values(
+            value=func.last_insert_id(new_value), updated_at=datetime.utcnow()
+        ))
+        if not result.rowcount:
+            return None
+        return conn.execute(select(func.last_insert_id())).scalar()
+
+    # Altri database: la riga aggiornata resta bloccata, la rilettura vede il proprio valore
+    result = conn.execute(update(table).where(where).values(value=new_value, updated_at=datetime.utcnow()))
+    if not result.rowcount:
+        return None
+    return conn.execute(select(table.c.value).where(where)).scalar()
+
+
+def next_value(name, period='', floor=None, seed=None, session=None):
+    """Next value of the sequence (name, period), allocated in the current transaction.
+
+    The counter row stays locked until the caller commits or rolls back.
+
+    Args:
+        floor: SQL expression, lowest value that may be handed out
+        seed: callable(session) returning the last value already used,
+            called only when the row of (name, period) is created
+    """
+    session = session or db.session
+    value = _increment(session.connection(), name, period, floor)
+    if value is not None:
+        return int(value)
+
+    # Prima richiesta della sequenza (o del periodo): si crea la riga
+    initial = int(seed(session) or 0) if seed else 0
+    try:
+        with session.begin_nested():
+            session.connection().execute(insert(SequenceCounter.__table__).values(
+                name=name, period=period, value=initial, updated_at=datetime.utcnow()
+            ))
+    except IntegrityError:
+        # Creata nel frattempo da un'altra transazione
+        pass
+    return int(_increment(session.connection(), name, period, floor))
+
+
+def _last_task_suffix(session, prefix):
+    last = 0
+    for (task_number,) in session.query(Task.task_number).filter(Task.task_number.like(f'{prefix}%')):
+        suffix = task_number[len(prefix):]
+        if suffix.isdigit():
+            last = max(last, int(suffix))
+    return last
+
+
+def next_task_number(now=None, session=None):
+    """TASK-YYYYMMDD-NNNN with a daily sequence"""
+    date_str = (now or datetime.now()).strftime('%Y%m%d')
+    prefix = f'TASK-{date_str}-'
+    # Task creati prima della tabella delle sequenze: si riparte dal suffisso più alto del giorno
+    sequence = next_value(TASK_NUMBER, date_str, seed=lambda s: _last_task_suffix(s, prefix), session=session)
+    return f'{prefix}{sequence:04d}'
+
+
+def next_ddt_numbers(session=None):
+    """(IdAlbaran, NumAlbaran) for a new DDT header"""
+    max_id = select(func.coalesce(func.max(AlbaranCabecera.IdAlbaran), 0) + 1).scalar_subquery()
+    max_number = select(func.coalesce(func.max(AlbaranCabecera.NumAlbaran), 0) + 1).scalar_subquery()
+    return (next_value(DDT_ID, floor=max_id, session=session),
+            next_value(DDT_NUMBER, floor=max_number, session=session))
+
+
+def next_invoice_number(session=None):
+    return next_value(INVOICE_NUMBER, session=session)
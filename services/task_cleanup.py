@@ -0,0 +1,268 @@
+"""
+Task cleanup - eliminazione dei task in blocco e rilascio dei loro ticket
+
+delete_task e delete_all_tasks leggevano ogni task_ticket e ogni ticket
+(TicketHeader.query.get uno alla volta) per rimettere Enviado = 0, poi
+cancellavano scansioni, notifiche, task_tickets e task con DELETE senza
+limite, in un'unica transazione che bloccava le tabelle per tutta la durata.
+
+Ora i task vengono eliminati a gruppi di TASK_BATCH_SIZE:
+- scansioni e notifiche dei task del gruppo sono cancellate a blocchi di
+  DELETE_BATCH_SIZE righe, ciascuno nella propria transazione breve
+- i ticket dei task senza DDT tornano in Giacenza con un solo
+  UPDATE ... WHERE IdTicket IN (SELECT ticket_id FROM task_tickets ...),
+  nella stessa transazione che cancella task_tickets e task del gruppo
+
+Sopra BACKGROUND_TICKET_THRESHOLD ticket (o TASK_BATCH_SIZE task)
+l'eliminazione gira in un thread (TaskCleanupJob); l'avanzamento è salvato in
+system_config, quindi lo legge anche un processo worker diverso da quello che
+ha avviato il job. Un lock tra processi (come per lo sweeper) impedisce due
+eliminazioni in blocco contemporanee; il job lo tiene finché non ha salvato lo
+stato finale, quindi uno stato 'running' senza lock è di un processo terminato
+a metà (riavvio del servizio) e viene riportato come 'interrupted'.
+"""
+
+import json
+import logging
+import threading
+from datetime import datetime
+
+from sqlalchemy import and_, func, select
+
+from app.models import db, SystemConfig, Task, TaskNotification, TaskTicket, TaskTicketScan, TicketHeader
+from services.audit_buffer import flush_audit_buffer
+from services.badge_counters import TICKETS, invalidate_counters
+from services.event_bus import publish_after_commit
+from services.notification_feed import TASKS
+from services.scan_resolution import invalidate_all_tickets
+from services.task_screen import TOPIC as SCREEN_TOPIC
+from services.ticket_summary import set_summary_status
+from services.ticket_sweeper import leader_lock
+
+logger = logging.getLogger(__name__)
+
+TASK_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+BACKGROUND_TICKET_THRESHOLD = 500
+JOB_KEY = 'task_cleanup_job'
+LOCK_NAME = 'dblogix_task_cleanup'
+# Lunghezza di system_config.config_value
+MAX_JOB_VALUE = 255
+
+
+def _has_ddt():
+    return and_(func.coalesce(Task.ddt_generated, False) == True, Task.ddt_id.isnot(None))
+
+
+def released_tickets_statement(task_ids):
+    """SELECT of the tickets of task_ids that go back in stock (tasks without a DDT)"""
+    return select(TaskTicket.ticket_id).join(
+        Task, Task.id_task == TaskTicket.task_id
+    ).where(TaskTicket.task_id.in_(task_ids), ~_has_ddt())
+
+
+def release_tickets(task_ids):
+    """Set Enviado = 0 on the tickets of task_ids without a DDT, in the current transaction.
+
+    Tickets of tasks with a DDT stay as they are (already processed).
+
+    Returns:
+        int: tickets released
+    """
+    released_ids = released_tickets_statement(task_ids)
+    released = db.session.query(TicketHeader).filter(
+        TicketHeader.IdTicket.in_(released_ids)
+    ).update({TicketHeader.Enviado: 0}, synchronize_session=False)
+    if released:
+        set_summary_status(released_ids, 0)
+        # L'update in blocco non passa dagli hook di flush
+        invalidate_counters(TICKETS)
+    return released
+
+
+def _delete_in_batches(model, id_column, condition, batch_size):
+    """Delete the rows matching condition, batch_size rows per committed transaction"""
+    total = 0
+    while True:
+        ids = [row[0] for row in db.session.query(id_column).filter(condition).limit(batch_size).all()]
+        if not ids:
+            break
+        total += db.session.query(model).filter(id_column.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        if len(ids) < batch_size:
+            break
+    return total
+
+
+def _delete_task_batch(task_ids, result, batch_size):
+    task_ticket_ids = select(TaskTicket.id).where(TaskTicket.task_id.in_(task_ids))
+    result['scans'] += _delete_in_batches(
+        TaskTicketScan, TaskTicketScan.id, TaskTicketScan.task_ticket_id.in_(task_ticket_ids), batch_size
+    )
+    result['notifications'] += _delete_in_batches(
+        TaskNotification, TaskNotification.id, TaskNotification.task_id.in_(task_ids), batch_size
+    )
+
+    # Rilascio dei ticket ed eliminazione del gruppo di task in una sola transazione
+    assignees = db.session.query(Task.assigned_to, Task.id_task).filter(
+        Task.id_task.in_(task_ids), Task.assigned_to.isnot(None)
+    ).all()
+    result['tickets_released'] += release_tickets(task_ids)
+    db.session.query(TaskTicket).filter(TaskTicket.task_id.in_(task_ids)).delete(synchronize_session=False)
+    result['tasks'] += db.session.query(Task).filter(Task.id_task.in_(task_ids)).delete(synchronize_session=False)
+
+    # Le DELETE in blocco non passano dagli hook: schermi e badge vengono avvisati qui
+    publish_after_commit(SCREEN_TOPIC, {'task_ids': sorted(task_ids)})
+    user_tasks = {}
+    for user_id, task_id in assignees:
+        user_tasks.setdefault(user_id, []).append(task_id)
+    for user_id, user_task_ids in user_tasks.items():
+        publish_after_commit(TASKS, {'task_ids': sorted(user_task_ids)}, user_id=user_id)
+    db.session.commit()
+
+
+def delete_tasks(task_ids=None, batch_size=DELETE_BATCH_SIZE, progress=None):
+    """Delete task_ids (every task with None) with their tickets, scans and notifications.
+
+    Args:
+        progress: callable(result) called after every group of tasks
+
+    Returns:
+        dict: tasks, tickets_released, scans, notifications
+    """
+    result = {'tasks': 0, 'tickets_released': 0, 'scans': 0, 'notifications': 0}
+    flush_audit_buffer()  # scansioni ancora nel buffer di scrittura
+
+    last_id = 0
+    while True:
+        query = db.session.query(Task.id_task).filter(Task.id_task > last_id)
+        if task_ids is not None:
+            query = query.filter(Task.id_task.in_(list(task_ids)))
+        batch = [row[0] for row in query.order_by(Task.id_task).limit(TASK_BATCH_SIZE).all()]
+        if not batch:
+            break
+
+        _delete_task_batch(batch, result, batch_size)
+        last_id = batch[-1]
+        if progress is not None:
+            progress(result)
+        if len(batch) < TASK_BATCH_SIZE:
+            break
+
+    if result['tickets_released']:
+        invalidate_all_tickets()
+    return result
+
+
+def deletion_size(task_ids=None):
+    """(tasks, task tickets) that a deletion of task_ids (all with None) would remove"""
+    tasks = db.session.query(func.count(Task.id_task))
+    tickets = db.session.query(func.count(TaskTicket.id))
+    if task_ids is not None:
+        tasks = tasks.filter(Task.id_task.in_(list(task_ids)))
+        tickets = tickets.filter(TaskTicket.task_id.in_(list(task_ids)))
+    return tasks.scalar() or 0, tickets.scalar() or 0
+
+
+def needs_background(task_count, ticket_count):
+    return task_count > TASK_BATCH_SIZE or ticket_count > BACKGROUND_TICKET_THRESHOLD
+
+
+def get_cleanup_job():
+    """Progress of the last background deletion (any worker), None if there never was one.
+
+    A 'running' job whose lock nobody holds belongs to a process that died
+    mid-job: it is reported as 'interrupted'.
+    """
+    value = SystemConfig.get_config(JOB_KEY)
+    if not value:
+        return None
+    try:
+        job = json.loads(value)
+    except (TypeError, ValueError):
+        return None
+    if job.get('state') == 'running' and not cleanup_running():
+        job['state'] = 'interrupted'
+    return job
+
+
+def _dump_job(job):
+    # ensure_ascii=False: le lettere accentate dell'errore non diventano \uXXXX
+    return json.dumps(job, separators=(',', ':'), ensure_ascii=False)
+
+
+def _save_job(job):
+    # config_value è String(255): solo numeri e un errore accorciato quanto serve
+    value = _dump_job(job)
+    excess = len(value) - MAX_JOB_VALUE
+    if excess > 0 and job.get('error'):
+        value = _dump_job(dict(job, error=job['error'][:max(len(job['error']) - excess, 0)]))
+    SystemConfig.set_config(JOB_KEY, value, description='Avanzamento eliminazione task in blocco')
+
+
+class TaskCleanupJob:
+    """Background deletion of tasks, with progress saved in system_config"""
+
+    def __init__(self, app, task_ids=None, total_tasks=0, requested_by=None):
+        self.app = app
+        self.task_ids = list(task_ids) if task_ids is not None else None
+        self.job = {
+            'state': 'running',
+            'total': total_tasks,
+            'tasks': 0,
+            'tickets_released': 0,
+            'scans': 0,
+            'notifications': 0,
+            'by': requested_by,
+            'started': datetime.utcnow().isoformat(timespec='seconds'),
+            'finished': None,
+            'error': None
+        }
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='task-cleanup', daemon=True)
+        self._thread.start()
+
+    def _progress(self, result):
+        self.job.update(result)
+        _save_job(self.job)
+
+    def _run(self):
+        with self.app.app_context():
+            try:
+                with leader_lock(LOCK_NAME) as acquired:
+                    if not acquired:
+                        # Avviata nel frattempo da un'altra richiesta
+                        logger.warning("Eliminazione task in blocco non avviata: un'altra è già in corso")
+                        return
+                    _save_job(self.job)
+                    try:
+                        self.job.update(delete_tasks(self.task_ids, progress=self._progress))
+                        self.job['state'] = 'completed'
+                        logger.info(f"Eliminazione task in blocco completata: {self.job['tasks']} task, "
+                                    f"{self.job['tickets_released']} ticket rilasciati")
+                    except Exception as e:
+                        db.session.rollback()
+                        self.job['state'] = 'error'
+                        self.job['error'] = str(e)
+                        logger.error(f"Errore nell'eliminazione task in blocco: {str(e)}")
+                    self.job['finished'] = datetime.utcnow().isoformat(timespec='seconds')
+                    _save_job(self.job)
+            finally:
+                db.session.remove()
+
+
+def cleanup_running():
+    """True while a bulk deletion holds the lock in any worker"""
+    with leader_lock(LOCK_NAME) as acquired:
+        return not acquired
+
+
+def start_cleanup_job(app, task_ids=None, total_tasks=0, requested_by=None):
+    """Start the background deletion unless one is already running; returns the job or None"""
+    if cleanup_running():
+        return None
+    job = TaskCleanupJob(app, task_ids, total_tasks=total_tasks, requested_by=requested_by)
+    job.start()
+    return job
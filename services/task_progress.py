@@ -0,0 +1,196 @@
+"""
+Task progress - contatori di avanzamento dei task mantenuti in modo incrementale
+
+tasks.total_tickets e tasks.completed_tickets venivano ricalcolati con due
+COUNT su task_tickets (più un commit) per ogni task mostrato in dashboard,
+schermo task e API di avanzamento.
+
+Ora vengono aggiornati nella stessa transazione delle modifiche a
+task_tickets, con UPDATE ... SET x = x + delta: un hook di flush raccoglie
+i TaskTicket inseriti, eliminati o passati da/a 'completed' (creazione task,
+scansioni, rimozione ticket) e aggiorna ogni task coinvolto con un solo
+UPDATE, che ricava anche lo stato (pending / in_progress / completed) come
+faceva Task.update_progress(). Le pagine leggono i contatori senza scrivere.
+
+Le cancellazioni in blocco di task_tickets (eliminazione dell'intero task)
+non passano dall'hook. Eventuali differenze vengono riparate da
+reconcile_task_progress(), eseguita dallo sweeper ticket e da
+`flask reconcile-task-progress`.
+"""
+
+import logging
+from datetime import datetime
+
+import click
+from sqlalchemy import and_, case, event, func, inspect, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from app.models import db, Task, TaskTicket
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_ATTRS = ('total_tickets', 'completed_tickets', 'status', 'completed_at')
+
+_listeners_registered = False
+
+
+def _is_completed(status):
+    return status == 'completed'
+
+
+def _collect_deltas(session):
+    """{task_id: [total_delta, completed_delta]} for the TaskTicket changes of this flush"""
+    deltas = {}
+
+    def add(task_id, total, completed):
+        if task_id is None or (not total and not completed):
+            return
+        delta = deltas.setdefault(task_id, [0, 0])
+        delta[0] += total
+        delta[1] += completed
+
+    for obj in session.new:
+        if isinstance(obj, TaskTicket):
+            add(obj.task_id, 1, 1 if _is_completed(obj.status) else 0)
+    for obj in session.deleted:
+        if isinstance(obj, TaskTicket):
+            add(obj.task_id, -1, -1 if _is_completed(obj.status) else 0)
+    for obj in session.dirty:
+        if not isinstance(obj, TaskTicket):
+            continue
+        # Con active_history il valore precedente è caricato anche se scaduto dal commit
+        history = inspect(obj).attrs.status.history
+        if not history.has_changes():
+            continue
+        was_completed = any(_is_completed(status) for status in history.deleted)
+        now_completed = _is_completed(obj.status)
+        if was_completed != now_completed:
+            add(obj.task_id, 0, 1 if now_completed else -1)
+
+    return {task_id: delta for task_id, delta in deltas.items() if delta != [0, 0]}
+
+
+def adjust_task_progress(conn, task_id, total_delta=0, completed_delta=0):
+    """Apply counter deltas to one task with a single UPDATE on conn (no commit).
+
+    The status is derived from the new counters as in Task.update_progress().
+    It is assigned first: MySQL evaluates SET left to right with the values
+    already assigned, other databases with the old ones, so the expressions
+    are written on the old values plus the deltas.
+    """
+    table = Task.__table__
+    new_total = func.coalesce(table.c.total_tickets, 0) + total_delta
+    new_completed = func.coalesce(table.c.completed_tickets, 0) + completed_delta
+
+    return conn.execute(update(table).where(table.c.id_task == task_id).ordered_values(
+        (table.c.status, case(
+            (new_total <= 0, 'pending'),
+            (new_completed >= new_total, 'completed'),
+            (new_completed > 0, 'in_progress'),
+            else_=table.c.status
+        )),
+        (table.c.completed_at, case(
+            (and_(new_total > 0, new_completed >= new_total, table.c.completed_at.is_(None)), datetime.utcnow()),
+            else_=table.c.completed_at
+        )),
+        (table.c.total_tickets, new_total),
+        (table.c.completed_tickets, new_completed)
+    )).rowcount
+
+
+def _adjust_after_flush(session, flush_context):
+    # new/dirty/deleted riflettono ancora lo stato pre-flush, le righe sono già scritte
+    # Un errore fa fallire il flush: contatori e task_tickets restano allineati
+    deltas = _collect_deltas(session)
+    if not deltas:
+        return
+    conn = session.connection()
+    for task_id in sorted(deltas):
+        adjust_task_progress(conn, task_id, *deltas[task_id])
+    session.info.setdefault('task_progress_ids', set()).update(deltas)
+
+
+def _expire_after_flush(session, flush_context):
+    # I Task già in sessione hanno i contatori letti prima dell'UPDATE
+    task_ids = session.info.pop('task_progress_ids', None)
+    if not task_ids:
+        return
+    for task_id in task_ids:
+        task = session.identity_map.get(session.identity_key(Task, task_id))
+        if task is not None:
+            session.expire(task, PROGRESS_ATTRS)
+
+
+def _discard_after_rollback(session):
+    session.info.pop('task_progress_ids', None)
+
+
+def reconcile_task_progress(task_ids=None):
+    """Recount task_tickets and repair the tasks whose counters drifted.
+
+    Drift is detected with one grouped query; each drifted task is then
+    locked and recounted in its own transaction, so concurrent scans are
+    not lost.
+
+    Returns:
+        list: ids of the repaired tasks
+    """
+    counts = select(
+        TaskTicket.task_id.label('task_id'),
+        func.count(TaskTicket.id).label('total'),
+        func.sum(case((TaskTicket.status == 'completed', 1), else_=0)).label('completed')
+    ).group_by(TaskTicket.task_id).subquery()
+
+    query = db.session.query(
+        Task.id_task,
+        Task.total_tickets,
+        Task.completed_tickets,
+        counts.c.total,
+        counts.c.completed
+    ).outerjoin(counts, counts.c.task_id == Task.id_task)
+    if task_ids is not None:
+        query = query.filter(Task.id_task.in_(list(task_ids)))
+
+    drifted = [
+        row.id_task for row in query.all()
+        if (row.total_tickets or 0) != (row.total or 0)
+        or (row.completed_tickets or 0) != int(row.completed or 0)
+    ]
+    # Nuova transazione: i conteggi vanno riletti dopo il lock
+    db.session.rollback()
+
+    repaired = []
+    for task_id in drifted:
+        try:
+            task = db.session.query(Task).filter(Task.id_task == task_id).with_for_update().first()
+            if task is None:
+                db.session.rollback()
+                continue
+            before = (task.total_tickets, task.completed_tickets)
+            task.update_progress(commit=False)
+            db.session.commit()
+            repaired.append(task_id)
+            logger.info(f"Avanzamento task {task.task_number} riparato: {before[1]}/{before[0]} -> "
+                        f"{task.completed_tickets}/{task.total_tickets}")
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            logger.error(f"Riconciliazione avanzamento task {task_id} fallita: {str(e)}")
+
+    return repaired
+
+
+def init_app(app):
+    """Register the flush hooks and the reconciliation CLI command"""
+    global _listeners_registered
+
+    if not _listeners_registered:
+        event.listen(db.session, 'after_flush', _adjust_after_flush)
+        event.listen(db.session, 'after_flush_postexec', _expire_after_flush)
+        event.listen(db.session, 'after_rollback', _discard_after_rollback)
+        _listeners_registered = True
+
+    @app.cli.command('reconcile-task-progress')
+    def reconcile_task_progress_command():
+        """Ricalcola i contatori di avanzamento dei task che non corrispondono a task_tickets."""
+        repaired = reconcile_task_progress()
+        click.echo(f"Avanzamento task: {len(repaired)} task riparati")
@@ -0,0 +1,250 @@
+"""
+Task scan - verifica dei prodotti scansionati per i ticket di un task
+
+/tasks/api/scan faceva per ogni scansione: lettura del task_ticket e del
+task, due COUNT (linee e scansioni riuscite) con commit, altre due COUNT con
+commit per l'avanzamento del task e, a ticket completato, la lettura di tutti
+i ticket del task per trovare il prossimo.
+
+Ora una scansione è una sola transazione con un numero limitato di
+istruzioni, indipendente dalle dimensioni di ticket e task:
+- il task_ticket è letto con SELECT ... FOR UPDATE: due scanner sullo stesso
+  ticket si mettono in fila e nessun incremento va perso
+- linee e prodotti vengono dalla cache dei ticket (services.scan_resolution):
+  total_items è il numero di linee, scanned_items viene incrementato
+- la scansione riuscita è scritta nella stessa transazione, quelle fallite
+  passano dal buffer dei log (services.audit_buffer)
+- a ticket completato: Enviado = 10 con un UPDATE (più riepilogo e
+  contatori), i contatori del task sono aggiornati al flush
+  (services.task_progress) e riletti; l'UPDATE dei contatori è serializzato
+  sulla riga del task, quindi con più scanner sullo stesso task uno solo vede
+  il task completato e crea la notifica
+- con dedupe (sincronizzazione offline, services.task_workspace) i
+  controlli dei doppioni sono fatti dopo il lock: una scansione con un
+  client_id già registrato o su una linea già verificata non viene contata
+  di nuovo, anche se due invii dello stesso gruppo arrivano insieme
+"""
+
+from datetime import datetime
+
+from sqlalchemy import or_
+
+from app.models import db, Task, TaskNotification, TaskTicket, TaskTicketScan, TicketHeader
+from services.audit_buffer import record_task_scan
+from services.badge_counters import TICKETS, invalidate_counters
+from services.scan_resolution import decode_qr, get_ticket_snapshot, invalidate_tickets
+from services.ticket_summary import set_summary_status
+
+# Enviado di un ticket verificato dentro un task
+ENVIADO_IN_TASK = 10
+
+INVALID_QR_MESSAGE = 'Formato QR code non valido - attesi 27 caratteri numerici'
+
+DUPLICATE_STATUS = 'duplicate'
+
+
+class ScanOutcome:
+    """Result of one scan, as needed by the scanner response"""
+
+    __slots__ = ('task', 'qr', 'status', 'message', 'scan_id', 'expected_ticket_num', 'line_id',
+                 'ticket_completed', 'task_completed', 'next_ticket_id')
+
+    def __init__(self, task):
+        self.task = task
+        self.qr = None
+        self.status = 'error'
+        self.message = None
+        self.scan_id = None
+        self.expected_ticket_num = None
+        self.line_id = None
+        self.ticket_completed = False
+        self.task_completed = False
+        self.next_ticket_id = None
+
+    @property
+    def success(self):
+        return self.status == 'success'
+
+    @property
+    def duplicate(self):
+        return self.status == DUPLICATE_STATUS
+
+
+def lock_task_ticket(task_ticket_id):
+    """(TaskTicket, Task) with the task_ticket row locked until the commit, or None"""
+    task_ticket = db.session.query(TaskTicket).filter(
+        TaskTicket.id == task_ticket_id
+    ).populate_existing().with_for_update().first()
+    if task_ticket is None:
+        return None
+    return task_ticket, db.session.get(Task, task_ticket.task_id)
+
+
+def _match(ticket, qr, ticket_line_id, verified=None):
+    """(status, matched line, error message) of a decoded QR code against the ticket.
+
+    verified: line ids already verified, given only when deduplicating
+    """
+    if qr.ticket_num != ticket.NumTicket:
+        return 'ticket_mismatch', None, (f'Ticket non corrispondente. Atteso: #{ticket.NumTicket}, '
+                                         f'Scansionato: #{qr.ticket_num}')
+
+    line = ticket.line_by_id(ticket_line_id) if ticket_line_id is not None else None
+    if line is not None:
+        # Linea scelta sullo scanner: deve essere esattamente quel prodotto
+        if line.IdArticulo == qr.product_id:
+            if verified is not None and line.IdLineaTicket in verified:
+                return DUPLICATE_STATUS, line, 'Linea già verificata'
+            return 'success', line, None
+        return 'product_mismatch', line, (f'Prodotto non corrispondente. Atteso: {line.IdArticulo}, '
+                                          f'Scansionato: {qr.product_id}')
+
+    line = ticket.line_for(qr.product_id)
+    if line is not None and verified is not None:
+        # Prima linea di quel prodotto non ancora verificata
+        line = next((candidate for candidate in ticket.lines if candidate.IdArticulo == qr.product_id
+                     and candidate.IdLineaTicket not in verified), None)
+        if line is None:
+            return DUPLICATE_STATUS, None, 'Linea già verificata'
+    if line is not None:
+        return 'success', line, None
+    return 'product_not_in_ticket', None, f'Prodotto {qr.product_id} non presente nel ticket #{qr.ticket_num}'
+
+
+def _complete_ticket(task_ticket):
+    # UPDATE diretto: riepilogo e contatori vanno allineati a mano (non passa dagli hook di flush)
+    db.session.query(TicketHeader).filter(
+        TicketHeader.IdTicket == task_ticket.ticket_id
+    ).update({TicketHeader.Enviado: ENVIADO_IN_TASK}, synchronize_session=False)
+    set_summary_status([task_ticket.ticket_id], ENVIADO_IN_TASK)
+    invalidate_counters(TICKETS)
+
+
+def _next_ticket_id(task_ticket):
+    return db.session.query(TaskTicket.id).filter(
+        TaskTicket.task_id == task_ticket.task_id,
+        TaskTicket.id != task_ticket.id,
+        or_(TaskTicket.status.is_(None), TaskTicket.status != 'completed')
+    ).order_by(TaskTicket.id).limit(1).scalar()
+
+
+def _advance(task_ticket, task, ticket, user, outcome):
+    """Count a successful scan; on ticket completion find the next ticket or complete the task"""
+    now = datetime.utcnow()
+    task_ticket.total_items = len(ticket.lines)
+    task_ticket.scanned_items = (task_ticket.scanned_items or 0) + 1
+
+    newly_completed = False
+    if task_ticket.is_scan_completed and task_ticket.status != 'completed':
+        task_ticket.status = 'completed'
+        task_ticket.completed_at = now
+        newly_completed = True
+        _complete_ticket(task_ticket)
+    elif task_ticket.status == 'pending':
+        task_ticket.status = 'in_progress'
+        task_ticket.started_at = now
+
+    if task_ticket.status != 'completed':
+        return
+    outcome.ticket_completed = True
+
+    # Il flush aggiorna i contatori del task; la rilettura vede anche i ticket completati da altri scanner
+    db.session.flush()
+    total = task.total_tickets or 0
+    if total > 0 and (task.completed_tickets or 0) >= total:
+        outcome.task_completed = True
+        if newly_completed:
+            db.session.add(TaskNotification(
+                task_id=task.id_task,
+                user_id=task.created_by,
+                notification_type='task_completed',
+                title=f'✅ Task Completato: {task.task_number}',
+                message=f'Il task "{task.title}" è stato completato al 100% da {user.username} alle {now.strftime("%H:%M")}.'
+            ))
+    else:
+        outcome.next_ticket_id = _next_ticket_id(task_ticket)
+
+
+def _verified_line_ids(task_ticket_id):
+    return {line_id for line_id, in db.session.query(TaskTicketScan.ticket_line_id).filter(
+        TaskTicketScan.task_ticket_id == task_ticket_id,
+        TaskTicketScan.status == 'success'
+    ).all()}
+
+
+def _client_id_recorded(client_id):
+    return db.session.query(TaskTicketScan.id).filter(TaskTicketScan.client_id == client_id).first() is not None
+
+
+def scan_task_ticket(task_ticket, task, scanned_code, ticket_line_id, user, client_id=None, dedupe=False):
+    """Verify scanned_code against the ticket of task_ticket and commit.
+
+    task_ticket and task come from lock_task_ticket(); the lock is released
+    by the commit. client_id identifies the scan row for retried requests
+    (services.task_workspace). With dedupe, a client_id already recorded or
+    an already verified line gives a DUPLICATE_STATUS outcome and nothing
+    is written; the checks run under the lock, so they see every scan
+    committed for this task ticket.
+
+    Returns:
+        ScanOutcome: outcome.qr is None when the code is not a valid QR code
+    """
+    outcome = ScanOutcome(task)
+    row_ids = {'client_id': client_id} if client_id else {}
+    if dedupe and client_id and _client_id_recorded(client_id):
+        outcome.status, outcome.message = DUPLICATE_STATUS, 'Già registrata'
+        db.session.commit()
+        return outcome
+
+    qr = decode_qr(scanned_code)
+    ticket = get_ticket_snapshot(task_ticket.ticket_id) if qr is not None else None
+
+    if qr is None or ticket is None:
+        # Scrittura differita, non conta per l'avanzamento
+        outcome.message = INVALID_QR_MESSAGE if qr is None else f'Ticket {task_ticket.ticket_id} non trovato'
+        outcome.scan_id = record_task_scan(
+            task_ticket_id=task_ticket.id,
+            ticket_line_id=ticket_line_id,
+            scanned_by=user.id,
+            scanned_code=scanned_code,
+            status='error',
+            error_message=outcome.message,
+            **row_ids
+        )
+        outcome.qr = qr
+        db.session.commit()
+        return outcome
+
+    outcome.qr = qr
+    outcome.expected_ticket_num = ticket.NumTicket
+    verified = _verified_line_ids(task_ticket.id) if dedupe else None
+    outcome.status, line, outcome.message = _match(ticket, qr, ticket_line_id, verified)
+    outcome.line_id = line.IdLineaTicket if line is not None else None
+    if outcome.duplicate:
+        db.session.commit()
+        return outcome
+
+    # Le scansioni riuscite restano nella transazione dell'avanzamento, le altre vanno nel buffer dei log
+    outcome.scan_id = record_task_scan(
+        durable=outcome.success,
+        task_ticket_id=task_ticket.id,
+        ticket_line_id=line.IdLineaTicket if outcome.success else ticket_line_id,
+        product_id=qr.product_id if outcome.success else None,
+        scanned_by=user.id,
+        scanned_code=scanned_code,
+        status=outcome.status,
+        error_message=outcome.message,
+        weight_scanned=qr.weight_kg,
+        expected_code=f"{ticket.NumTicket:04d}{line.IdArticulo if line else '????'}",
+        **row_ids
+    )
+
+    if outcome.success:
+        _advance(task_ticket, task, ticket, user, outcome)
+
+    db.session.commit()
+
+    if outcome.ticket_completed:
+        # Lo snapshot in cache ha ancora il vecchio Enviado
+        invalidate_tickets([task_ticket.ticket_id])
+    return outcome
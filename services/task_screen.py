@@ -0,0 +1,233 @@
+"""
+Task screen - dati dello schermo task (kiosk) e aggiornamenti in push
+
+Lo schermo ricaricava la pagina ogni 30 secondi e ogni caricamento leggeva i
+TaskTicket di ogni task e le linee di ogni ticket (N x M query per schermo).
+
+Lo snapshot è costruito con un numero costante di query (task attivi con
+assegnatario, ticket dei task, linee dei ticket, ultimi completati). Lo
+stream /tasks/task-screen/stream invia poi solo le differenze:
+- un hook di flush raccoglie i task modificati (task, ticket aggiunti,
+  rimossi o completati) e li pubblica sull'event bus dopo il commit
+- lo stream rilegge solo quei task e invia le card cambiate o rimosse
+- ogni RESYNC_SECONDS (e se lo stream perde eventi) confronta uno snapshot
+  completo, per le scadenze che cambiano con l'ora e le modifiche che non
+  passano dall'app
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import case, desc, event, inspect
+from sqlalchemy.orm import joinedload
+
+from app.models import db, Task, TaskTicket, TicketLine
+from services.event_bus import publish_after_commit
+
+logger = logging.getLogger(__name__)
+
+TOPIC = 'task_screen'
+ACTIVE_STATUSES = ('pending', 'assigned', 'in_progress')
+COMPLETED_LIMIT = 5
+RESYNC_SECONDS = 60
+HEARTBEAT_SECONDS = 15
+# Lo stream si chiude dopo questo tempo e il browser si ricollega (libera il thread)
+STREAM_MAX_SECONDS = 1800
+
+_TASK_FIELDS = ('status', 'priority', 'title', 'deadline', 'assigned_to', 'total_tickets',
+                'completed_tickets', 'completed_at')
+
+_listeners_registered = False
+
+
+def _priority_order():
+    return case(
+        (Task.priority == 'urgent', 1),
+        (Task.priority == 'high', 2),
+        (Task.priority == 'medium', 3),
+        (Task.priority == 'low', 4)
+    )
+
+
+def _load_articles(task_ids):
+    """{task_id: [article dicts]} with two queries for all the tasks"""
+    articles = {task_id: [] for task_id in task_ids}
+    if not task_ids:
+        return articles
+
+    task_tickets = db.session.query(TaskTicket.task_id, TaskTicket.ticket_id).filter(
+        TaskTicket.task_id.in_(list(task_ids))
+    ).order_by(TaskTicket.id).all()
+    ticket_ids = {row.ticket_id for row in task_tickets}
+    if not ticket_ids:
+        return articles
+
+    lines_by_ticket = {}
+    for line in db.session.query(
+        TicketLine.IdTicket,
+        TicketLine.IdArticulo,
+        TicketLine.Descripcion,
+        TicketLine.Peso,
+        TicketLine.comportamiento
+    ).filter(TicketLine.IdTicket.in_(ticket_ids)).order_by(TicketLine.IdTicket, TicketLine.IdLineaTicket):
+        lines_by_ticket.setdefault(line.IdTicket, []).append(line)
+
+    for row in task_tickets:
+        for line in lines_by_ticket.get(row.ticket_id, ()):
+            unit = 'u' if (line.comportamiento or 0) == 0 else 'kg'
+            articles[row.task_id].append({
+                'name': line.Descripcion or f'Articolo {line.IdArticulo}',
+                'weight': f'{line.Peso if line.Peso is not None else 1}{unit}',
+                'ticket_id': line.IdTicket
+            })
+    return articles
+
+
+def _task_card(task, articles):
+    return {
+        'id': task.id_task,
+        'task_number': task.task_number,
+        'title': task.title,
+        'assignee': task.assignee.username if task.assignee else 'Unassigned',
+        'deadline': task.deadline.strftime('%d/%m %H:%M') if task.deadline else 'No deadline',
+        'priority': task.priority if task.priority in ('urgent', 'high', 'medium') else 'low',
+        'status': task.status or 'pending',
+        'is_overdue': task.is_overdue,
+        'progress_percentage': task.progress_percentage,
+        'completed_tickets': task.completed_tickets or 0,
+        'total_tickets': task.total_tickets or 0,
+        'created_at': task.created_at.isoformat() if task.created_at else None,
+        'articles': articles
+    }
+
+
+def _completed_card(task):
+    return {
+        'id': task.id_task,
+        'task_number': task.task_number,
+        'title': task.title,
+        'assignee': task.assignee.username if task.assignee else 'Unassigned',
+        'completed_at': task.completed_at.strftime('%d/%m %H:%M') if task.completed_at else 'Completed'
+    }
+
+
+def load_task_cards(task_ids=None):
+    """Cards of the active tasks (all, or only task_ids) in display order"""
+    query = Task.query.options(joinedload(Task.assignee)).filter(Task.status.in_(ACTIVE_STATUSES))
+    if task_ids is not None:
+        if not task_ids:
+            return []
+        query = query.filter(Task.id_task.in_(list(task_ids)))
+    tasks = query.order_by(_priority_order(), desc(Task.created_at)).all()
+    articles = _load_articles([task.id_task for task in tasks])
+    return [_task_card(task, articles[task.id_task]) for task in tasks]
+
+
+def load_completed_cards(limit=COMPLETED_LIMIT):
+    tasks = Task.query.options(joinedload(Task.assignee)).filter_by(status='completed').order_by(
+        desc(Task.completed_at)
+    ).limit(limit).all()
+    return [_completed_card(task) for task in tasks]
+
+
+def build_snapshot():
+    """Everything the screen shows, in four queries"""
+    return {
+        'tasks': load_task_cards(),
+        'completed': load_completed_cards(),
+        'generated_at': datetime.now().isoformat(timespec='seconds')
+    }
+
+
+def snapshot_stats(snapshot):
+    tasks = snapshot['tasks']
+    return {
+        'total_assigned': len(tasks),
+        'total_completed': len(snapshot['completed']),
+        'total_urgent': sum(1 for task in tasks if task['priority'] == 'urgent'),
+        'total_high': sum(1 for task in tasks if task['priority'] == 'high'),
+        'total_medium': sum(1 for task in tasks if task['priority'] == 'medium'),
+        'total_low': sum(1 for task in tasks if task['priority'] == 'low'),
+        'total_overdue': sum(1 for task in tasks if task['is_overdue'])
+    }
+
+
+class ScreenState:
+    """What one connected screen currently shows, to send only the differences"""
+
+    def __init__(self, snapshot):
+        self.tasks = {card['id']: card for card in snapshot['tasks']}
+        self.completed = snapshot['completed']
+
+    def _diff_tasks(self, cards, checked_ids):
+        """(event, data) pairs for the tasks in checked_ids given their current cards"""
+        changes = []
+        current = {card['id']: card for card in cards}
+        for task_id in checked_ids:
+            card = current.get(task_id)
+            if card is None:
+                if self.tasks.pop(task_id, None) is not None:
+                    changes.append(('task_removed', {'id': task_id}))
+            elif self.tasks.get(task_id) != card:
+                self.tasks[task_id] = card
+                changes.append(('task', card))
+        return changes
+
+    def _diff_completed(self, completed):
+        if completed == self.completed:
+            return []
+        self.completed = completed
+        return [('completed', completed)]
+
+    def apply_changes(self, task_ids):
+        """Reload only task_ids (from an event) and return the changes"""
+        cards = load_task_cards(task_ids)
+        changes = self._diff_tasks(cards, task_ids)
+        # Un task uscito dagli attivi può essere appena stato completato
+        shown_completed = {card['id'] for card in self.completed}
+        if any(event_name == 'task_removed' for event_name, _ in changes) or shown_completed & set(task_ids):
+            changes.extend(self._diff_completed(load_completed_cards()))
+        return changes
+
+    def resync(self, snapshot):
+        """Compare with a full snapshot and return the changes"""
+        cards = snapshot['tasks']
+        checked_ids = set(self.tasks) | {card['id'] for card in cards}
+        changes = self._diff_tasks(cards, checked_ids)
+        changes.extend(self._diff_completed(snapshot['completed']))
+        return changes
+
+
+def _collect_task_ids(session):
+    task_ids = set()
+    for obj in list(session.new) + list(session.deleted):
+        if isinstance(obj, Task):
+            task_ids.add(obj.id_task)
+        elif isinstance(obj, TaskTicket):
+            task_ids.add(obj.task_id)
+    for obj in session.dirty:
+        if isinstance(obj, Task):
+            state = inspect(obj)
+            if any(state.attrs[field].history.has_changes() for field in _TASK_FIELDS):
+                task_ids.add(obj.id_task)
+        elif isinstance(obj, TaskTicket):
+            if inspect(obj).attrs.status.history.has_changes():
+                task_ids.add(obj.task_id)
+    task_ids.discard(None)
+    return task_ids
+
+
+def _publish_after_flush(session, flush_context):
+    task_ids = _collect_task_ids(session)
+    if task_ids:
+        # Consegnato agli schermi solo dopo il commit
+        publish_after_commit(TOPIC, {'task_ids': sorted(task_ids)}, session=session)
+
+
+def init_app(app):
+    """Register the hook that publishes task changes to the screens"""
+    global _listeners_registered
+
+    if not _listeners_registered:
+        event.listen(db.session, 'after_flush', _publish_after_flush)
+        _listeners_registered = True
@@ -0,0 +1,230 @@
+"""
+Task workspace - tutto il task in una risposta per gli scanner palmari
+
+Lo scanner passava da un ticket all'altro con una richiesta per le linee
+(/tasks/api/tickets/<id>/lines) e una per l'avanzamento
+(/tasks/api/tasks/<id>/progress), ciascuna in attesa sul Wi-Fi del magazzino.
+
+Ora:
+- build_workspace(): task, ticket, linee, prodotti attesi e linee già
+  verificate in tre query, indipendenti dal numero di ticket; lo scanner lo
+  scarica una volta e verifica i QR code in locale (numero ticket e articolo
+  sono nelle prime 8 cifre del codice)
+- workspace_delta(): stato dei ticket e linee verificate dopo un cursore
+  (id dell'ultima scansione riuscita vista), per restare allineati con gli
+  altri scanner dello stesso task
+- sync_scans(): le scansioni fatte in locale inviate a gruppi; ognuna è
+  verificata dal server con la stessa transazione di /tasks/api/scan
+  (services.task_scan). Gli elementi portano un client_id: se la scansione
+  con quel client_id esiste già (risposta persa, invio ripetuto) non viene
+  ripetuta; una linea già verificata, scelta sullo scanner o trovata dal
+  prodotto, non viene contata due volte. I controlli sono fatti da
+  scan_task_ticket dopo il lock del task_ticket, così due invii concorrenti
+  dello stesso gruppo non contano due volte la stessa scansione.
+
+Le scansioni riuscite sono scritte nella transazione che le verifica, ma due
+transazioni concorrenti possono rendere visibili gli id fuori ordine: il
+delta riporta sempre lo stato (scanned/total) di tutti i ticket, e se un
+ticket ne ha più di quelle note lo scanner ricarica il workspace.
+"""
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from app.models import db, Product, TaskTicket, TaskTicketScan, TicketHeader, TicketLine
+from services.task_scan import DUPLICATE_STATUS, lock_task_ticket, scan_task_ticket
+
+MAX_SYNC_ITEMS = 200
+
+SUCCESS_STATUS = 'success'
+
+
+def _task_dict(task):
+    return {
+        'id': task.id_task,
+        'number': task.task_number,
+        'title': task.title,
+        'status': task.status,
+        'deadline': task.deadline.isoformat() if task.deadline else None,
+        'total_tickets': task.total_tickets or 0,
+        'completed_tickets': task.completed_tickets or 0
+    }
+
+
+def _ticket_states(task_id):
+    """Task tickets of task_id with their ticket header, in scanning order"""
+    return db.session.execute(select(
+        TaskTicket.id,
+        TaskTicket.ticket_id,
+        TaskTicket.status,
+        TaskTicket.scanned_items,
+        TaskTicket.total_items,
+        TicketHeader.NumTicket
+    ).select_from(TaskTicket).outerjoin(
+        TicketHeader, TicketHeader.IdTicket == TaskTicket.ticket_id
+    ).where(TaskTicket.task_id == task_id).order_by(TaskTicket.id)).all()
+
+
+def _state_dict(row):
+    return {
+        'id': row.id,
+        'status': row.status,
+        'scanned': row.scanned_items or 0,
+        'total': row.total_items or 0
+    }
+
+
+def _scanned_lines(task_id, since=0):
+    """[(scan id, task_ticket id, line id)] of the successful scans of task_id after since"""
+    statement = select(
+        TaskTicketScan.id, TaskTicketScan.task_ticket_id, TaskTicketScan.ticket_line_id
+    ).join(
+        TaskTicket, TaskTicket.id == TaskTicketScan.task_ticket_id
+    ).where(
+        TaskTicket.task_id == task_id,
+        TaskTicketScan.status == SUCCESS_STATUS,
+        TaskTicketScan.id > since
+    )
+    return db.session.execute(statement.order_by(TaskTicketScan.id)).all()
+
+
+def build_workspace(task):
+    """Whole task for the handheld scanner, in three queries.
+
+    Returns:
+        dict: task, cursor, tickets (each with its lines and their scanned flag)
+    """
+    tickets = _ticket_states(task.id_task)
+
+    lines = {}
+    rows = db.session.execute(select(
+        TicketLine.IdTicket,
+        TicketLine.IdLineaTicket,
+        TicketLine.IdArticulo,
+        TicketLine.Descripcion,
+        TicketLine.Peso,
+        TicketLine.FechaCaducidad,
+        Product.Descripcion.label('producto_descripcion')
+    ).outerjoin(
+        Product, Product.IdArticulo == TicketLine.IdArticulo
+    ).where(
+        TicketLine.IdTicket.in_(select(TaskTicket.ticket_id).where(TaskTicket.task_id == task.id_task))
+    ).order_by(TicketLine.IdTicket, TicketLine.IdLineaTicket)).all()
+    for row in rows:
+        lines.setdefault(row.IdTicket, []).append(row)
+
+    cursor = 0
+    scanned = set()
+    for scan_id, task_ticket_id, line_id in _scanned_lines(task.id_task):
+        scanned.add((task_ticket_id, line_id))
+        cursor = max(cursor, scan_id)
+
+    workspace_tickets = []
+    for ticket in tickets:
+        item = _state_dict(ticket)
+        item.update({
+            'ticket_id': ticket.ticket_id,
+            'number': ticket.NumTicket,
+            'lines': [{
+                'id': line.IdLineaTicket,
+                'product_id': line.IdArticulo,
+                'description': line.Descripcion or line.producto_descripcion or '',
+                'weight': float(line.Peso or 0),
+                'expiry': line.FechaCaducidad.strftime('%Y-%m-%d') if line.FechaCaducidad else None,
+                'scanned': (ticket.id, line.IdLineaTicket) in scanned
+            } for line in lines.get(ticket.ticket_id, [])]
+        })
+        workspace_tickets.append(item)
+
+    return {
+        'task': _task_dict(task),
+        'cursor': cursor,
+        'tickets': workspace_tickets
+    }
+
+
+def workspace_delta(task, since=0):
+    """Ticket states and lines verified after the since cursor.
+
+    Returns:
+        dict: task, cursor, tickets (states of every ticket), scanned
+            ([task_ticket id, line id] pairs after since)
+    """
+    since = max(int(since or 0), 0)
+    scans = _scanned_lines(task.id_task, since=since)
+    return {
+        'task': _task_dict(task),
+        'cursor': max([since] + [scan_id for scan_id, _, _ in scans]),
+        'tickets': [_state_dict(row) for row in _ticket_states(task.id_task)],
+        'scanned': [[task_ticket_id, line_id] for _, task_ticket_id, line_id in scans]
+    }
+
+
+def _sync_item(index, raw):
+    """(item result dict, task_ticket id, line id, code) of one raw sync element"""
+    result = {'index': index, 'client_id': None, 'status': None, 'success': False, 'message': None}
+    if not isinstance(raw, dict):
+        result.update(status='invalid', message='Elemento non valido')
+        return result, None, None, None
+
+    result['client_id'] = str(raw['client_id'])[:32] if raw.get('client_id') else None
+    try:
+        task_ticket_id = int(raw.get('task_ticket_id'))
+        line_id = int(raw['ticket_line_id']) if raw.get('ticket_line_id') else None
+    except (TypeError, ValueError):
+        result.update(status='invalid', message='Ticket o linea non validi')
+        return result, None, None, None
+    code = str(raw.get('scanned_code') or '').strip()
+    if not code:
+        result.update(status='invalid', message='Codice scansionato mancante')
+    return result, task_ticket_id, line_id, code
+
+
+def sync_scans(task, raw_items, user, since=0):
+    """Verify and record the scans made offline by the handheld, one transaction each.
+
+    Args:
+        raw_items: dicts with task_ticket_id, scanned_code, optional
+            ticket_line_id and client_id, in scanning order
+
+    Returns:
+        dict: results (per item, input order) and the workspace_delta after since
+
+    Raises:
+        ValueError: too many items
+    """
+    if len(raw_items) > MAX_SYNC_ITEMS:
+        raise ValueError(f"Troppe scansioni: massimo {MAX_SYNC_ITEMS} per richiesta")
+
+    items = [_sync_item(index, raw) for index, raw in enumerate(raw_items)]
+
+    results = []
+    for result, task_ticket_id, line_id, code in items:
+        results.append(result)
+        if result['status'] is not None:
+            continue
+
+        locked = lock_task_ticket(task_ticket_id)
+        if locked is None or locked[0].task_id != task.id_task:
+            db.session.rollback()
+            result.update(status='not_found', message='Ticket non presente nel task')
+            continue
+        task_ticket, locked_task = locked
+
+        try:
+            outcome = scan_task_ticket(task_ticket, locked_task, code, line_id, user,
+                                       client_id=result['client_id'], dedupe=True)
+        except IntegrityError:
+            # client_id scritto nel frattempo da un altro invio (o dal buffer dei log)
+            db.session.rollback()
+            result.update(status=DUPLICATE_STATUS, success=True, message='Già registrata')
+            continue
+        if outcome.duplicate:
+            result.update(status=DUPLICATE_STATUS, success=True, message=outcome.message)
+            continue
+        result.update(status=outcome.status if outcome.qr is not None else 'invalid',
+                      success=outcome.success, message=outcome.message,
+                      ticket_completed=outcome.ticket_completed, task_completed=outcome.task_completed)
+
+    db.session.refresh(task)
+    return {'results': results, 'delta': workspace_delta(task, since)}
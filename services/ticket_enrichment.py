@@ -0,0 +1,143 @@
+"""
+Ticket enrichment - dati di riepilogo per liste di ticket
+
+Dato un elenco di ticket (id o oggetti TicketHeader) restituisce per ciascuno
+prodotto principale, numero di linee, scadenza più vicina e stato leggendo la
+tabella ticket_summary, con un numero costante di query invece di una per ticket.
+"""
+
+from datetime import datetime
+
+from app.models import db, TicketHeader, TicketSummary, TICKET_STATUS_META, TICKET_STATUS_UNKNOWN
+from services.ticket_summary import fold_line_aggregates, line_aggregates_statement
+
+# Giorni entro cui una scadenza è evidenziata come imminente
+EXPIRY_WARNING_DAYS = 7
+
+
+class TicketView:
+    """Read-only view of a ticket header with its line aggregates"""
+
+    __slots__ = ('IdTicket', 'NumTicket', 'Fecha', 'CodigoBarras', 'NumLineas', 'Enviado',
+                 'product_id', 'product_name', 'line_count', 'expiry_date')
+
+    def __init__(self, header):
+        self.IdTicket = header.IdTicket
+        self.NumTicket = header.NumTicket
+        self.Fecha = header.Fecha
+        self.CodigoBarras = header.CodigoBarras
+        self.NumLineas = header.NumLineas
+        self.Enviado = header.Enviado
+        self.product_id = None
+        self.product_name = None
+        self.line_count = 0
+        self.expiry_date = None
+
+    def __repr__(self):
+        return f'<TicketView {self.IdTicket}: Ticket #{self.NumTicket}>'
+
+    @property
+    def article_name(self):
+        return self.product_name
+
+    @property
+    def status_text(self):
+        return TICKET_STATUS_META.get(self.Enviado, TICKET_STATUS_UNKNOWN)[0]
+
+    @property
+    def status_class(self):
+        return TICKET_STATUS_META.get(self.Enviado, TICKET_STATUS_UNKNOWN)[1]
+
+    @property
+    def formatted_date(self):
+        return self.Fecha.strftime('%d/%m/%Y %H:%M') if self.Fecha else 'N/A'
+
+    @property
+    def formatted_day(self):
+        return self.Fecha.strftime('%d/%m/%Y') if self.Fecha else 'N/D'
+
+    @property
+    def formatted_expiry(self):
+        return self.expiry_date.strftime('%d/%m/%Y') if self.expiry_date else None
+
+    @property
+    def days_to_expire(self):
+        """Days between today and the earliest expiry (negative once expired)"""
+        if not self.expiry_date:
+            return None
+        return (self.expiry_date.date() - datetime.now().date()).days
+
+    @property
+    def expiry_class(self):
+        days = self.days_to_expire
+        if days is None:
+            return None
+        if days < 0:
+            return 'danger'
+        if days <= EXPIRY_WARNING_DAYS:
+            return 'warning'
+        return 'success'
+
+
+def enrich_tickets(tickets):
+    """Build TicketView objects for a list of ticket ids or TicketHeader objects.
+
+    Runs at most three queries regardless of the number of tickets: one for
+    the headers (skipped when header objects are passed in), one on
+    ticket_summary and, only for tickets not summarized yet, one grouped query
+    on their lines.
+
+    Returns:
+        list: TicketView objects in the input order (unknown ids are dropped)
+    """
+    by_id = enrich_tickets_by_id(tickets)
+    ordered_ids = [getattr(item, 'IdTicket', item) for item in tickets]
+    return [by_id[ticket_id] for ticket_id in dict.fromkeys(ordered_ids) if ticket_id in by_id]
+
+
+def enrich_tickets_by_id(tickets):
+    """Same as enrich_tickets but returns {IdTicket: TicketView}"""
+    if not tickets:
+        return {}
+
+    headers = [item for item in tickets if hasattr(item, 'IdTicket')]
+    ids = [item for item in tickets if not hasattr(item, 'IdTicket')]
+
+    if ids:
+        headers.extend(db.session.query(
+            TicketHeader.IdTicket,
+            TicketHeader.NumTicket,
+            TicketHeader.Fecha,
+            TicketHeader.CodigoBarras,
+            TicketHeader.NumLineas,
+            TicketHeader.Enviado
+        ).filter(TicketHeader.IdTicket.in_(set(ids))).all())
+
+    views = {header.IdTicket: TicketView(header) for header in headers}
+    if not views:
+        return {}
+
+    # Riepilogo materializzato; i ticket non ancora riepilogati (appena arrivati
+    # dalle bilance) vengono aggregati al volo sulle linee
+    summaries = db.session.query(TicketSummary).filter(
+        TicketSummary.IdTicket.in_(list(views.keys()))
+    ).all()
+
+    for summary in summaries:
+        view = views[summary.IdTicket]
+        view.line_count = summary.line_count or 0
+        view.expiry_date = summary.earliest_expiry
+        view.product_id = summary.main_product_id
+        view.product_name = summary.main_product_name
+
+    missing = set(views.keys()) - {summary.IdTicket for summary in summaries}
+    if missing:
+        rows = db.session.execute(line_aggregates_statement(missing)).all()
+        for ticket_id, row in fold_line_aggregates(rows).items():
+            view = views[ticket_id]
+            view.line_count = row.line_count
+            view.expiry_date = row.earliest_expiry
+            view.product_id = row.IdArticulo
+            view.product_name = row.producto_descripcion or row.linea_descripcion
+
+    return views
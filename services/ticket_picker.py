@@ -0,0 +1,235 @@
+"""
+Ticket picker - selezione dei ticket disponibili (Enviado = 0) per un nuovo task
+
+Il form di creazione task caricava tutti i ticket disponibili e poi le linee
+di ciascuno con una query per ticket (correggendo NumLineas come effetto
+collaterale); la verifica delle scadenze rispetto alla deadline faceva due
+query per ticket selezionato.
+
+Ora:
+- picker_page(): una pagina di ticket con numero di linee, quantità totale e
+  scadenza più vicina da una sola query raggruppata (più il COUNT per la
+  paginazione); ricerca, filtri e ordinamento sono applicati nella query
+- picker_lines(): le linee di un gruppo di ticket (quelli della pagina
+  mostrata) con una sola query, richieste dal browser dopo la pagina
+- expired_lines(): le linee dei ticket selezionati che scadono prima della
+  deadline, con una sola query
+"""
+
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, func, or_, select
+
+from app.models import db, Product, TicketHeader, TicketLine
+from services.search_index import ticket_search_clause
+
+PICKER_PAGE_SIZE = 48
+PICKER_MAX_PAGE_SIZE = 200
+LINES_BATCH_LIMIT = PICKER_MAX_PAGE_SIZE
+EXPIRING_DAYS = 7
+
+EXPIRY_FILTERS = ('expired', 'expiring', 'valid')
+SORT_FIELDS = ('id', 'date', 'quantity', 'expiry')
+
+
+def _day_start(day):
+    return datetime.combine(day, datetime.min.time())
+
+
+def _expiry_status(expiry, today):
+    """'expired', 'expiring' (within EXPIRING_DAYS) or 'valid' as shown by the picker"""
+    if expiry is None:
+        return 'valid'
+    expiry_date = expiry.date() if isinstance(expiry, datetime) else expiry
+    if expiry_date < today:
+        return 'expired'
+    if (expiry_date - today).days <= EXPIRING_DAYS:
+        return 'expiring'
+    return 'valid'
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+def _summary_statement(search=None, expiry=None, date_from=None, date_to=None,
+                       min_quantity=None, max_quantity=None, today=None):
+    """Grouped statement of the available tickets with their line aggregates"""
+    today = today or datetime.now().date()
+    line_count = func.count(TicketLine.IdTicket).label('line_count')
+    quantity = func.coalesce(func.sum(TicketLine.Peso), 0).label('quantity')
+    earliest_expiry = func.min(TicketLine.FechaCaducidad).label('earliest_expiry')
+
+    statement = select(
+        TicketHeader.IdTicket,
+        TicketHeader.NumTicket,
+        TicketHeader.Fecha,
+        TicketHeader.CodigoBarras,
+        line_count,
+        quantity,
+        earliest_expiry
+    ).select_from(TicketHeader).outerjoin(
+        TicketLine, TicketLine.IdTicket == TicketHeader.IdTicket
+    ).where(TicketHeader.Enviado == 0)
+
+    search = (search or '').strip()
+    if search.startswith('#'):
+        number = search[1:].strip()
+        if number.isdigit():
+            statement = statement.where(TicketHeader.NumTicket == int(number))
+    elif search:
+        # Id ticket esatto oppure barcode, numero, prodotto o descrizione (indice a trigrammi)
+        matches = ticket_search_clause(search)
+        statement = statement.where(or_(TicketHeader.IdTicket == int(search), matches) if search.isdigit() else matches)
+
+    start, end = _parse_date(date_from), _parse_date(date_to)
+    if start:
+        statement = statement.where(TicketHeader.Fecha >= start)
+    if end:
+        # Include the entire day
+        statement = statement.where(TicketHeader.Fecha < end + timedelta(days=1))
+
+    statement = statement.group_by(
+        TicketHeader.IdTicket, TicketHeader.NumTicket, TicketHeader.Fecha, TicketHeader.CodigoBarras
+    )
+
+    today_start = _day_start(today)
+    valid_from = today_start + timedelta(days=EXPIRING_DAYS + 1)
+    min_expiry = func.min(TicketLine.FechaCaducidad)
+    if expiry == 'expired':
+        statement = statement.having(min_expiry < today_start)
+    elif expiry == 'expiring':
+        statement = statement.having(and_(min_expiry >= today_start, min_expiry < valid_from))
+    elif expiry == 'valid':
+        statement = statement.having(or_(min_expiry.is_(None), min_expiry >= valid_from))
+
+    total_quantity = func.coalesce(func.sum(TicketLine.Peso), 0)
+    if min_quantity is not None:
+        statement = statement.having(total_quantity >= min_quantity)
+    if max_quantity is not None:
+        statement = statement.having(total_quantity <= max_quantity)
+    return statement, {'id': TicketHeader.IdTicket, 'date': TicketHeader.Fecha,
+                       'quantity': total_quantity, 'expiry': min_expiry}
+
+
+def picker_page(page=1, per_page=PICKER_PAGE_SIZE, sort='date_desc', today=None, **filters):
+    """One page of available tickets for the task form.
+
+    Args:
+        sort: '<field>_<asc|desc>' with field in SORT_FIELDS
+        filters: search, expiry (one of EXPIRY_FILTERS), date_from/date_to
+            (YYYY-MM-DD), min_quantity/max_quantity
+
+    Returns:
+        dict: items, page, per_page, total, pages
+    """
+    today = today or datetime.now().date()
+    page = max(page or 1, 1)
+    per_page = min(max(per_page or PICKER_PAGE_SIZE, 1), PICKER_MAX_PAGE_SIZE)
+    if filters.get('expiry') not in EXPIRY_FILTERS:
+        filters['expiry'] = None
+
+    statement, sort_columns = _summary_statement(today=today, **filters)
+    total = db.session.execute(select(func.count()).select_from(statement.subquery())).scalar() or 0
+
+    field, _, direction = (sort or '').partition('_')
+    if field not in SORT_FIELDS:
+        field, direction = 'date', 'desc'
+    column = sort_columns[field]
+    ordering = [column.desc() if direction == 'desc' else column.asc()]
+    if field == 'expiry':
+        # Ticket senza scadenza sempre in fondo
+        ordering.insert(0, column.is_(None))
+    ordering.append(TicketHeader.IdTicket.desc() if direction == 'desc' else TicketHeader.IdTicket.asc())
+
+    rows = db.session.execute(
+        statement.order_by(*ordering).offset((page - 1) * per_page).limit(per_page)
+    ).all()
+
+    items = []
+    for row in rows:
+        items.append({
+            'id': row.IdTicket,
+            'number': row.NumTicket,
+            'date': row.Fecha.isoformat() if row.Fecha else None,
+            'formatted_date': row.Fecha.strftime('%d/%m/%Y %H:%M') if row.Fecha else 'N/A',
+            'barcode': row.CodigoBarras,
+            'line_count': row.line_count,
+            'quantity': float(row.quantity or 0),
+            'earliest_expiry': row.earliest_expiry.strftime('%Y-%m-%d') if row.earliest_expiry else None,
+            'expiry_status': _expiry_status(row.earliest_expiry, today)
+        })
+    return {
+        'items': items,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': (total + per_page - 1) // per_page
+    }
+
+
+def picker_lines(ticket_ids, today=None):
+    """{IdTicket: [line dicts]} for at most LINES_BATCH_LIMIT tickets, in line order"""
+    today = today or datetime.now().date()
+    ticket_ids = list(dict.fromkeys(ticket_ids))[:LINES_BATCH_LIMIT]
+    lines = {ticket_id: [] for ticket_id in ticket_ids}
+    if not ticket_ids:
+        return lines
+
+    rows = db.session.execute(select(
+        TicketLine.IdTicket,
+        TicketLine.IdLineaTicket,
+        TicketLine.IdArticulo,
+        TicketLine.Descripcion,
+        TicketLine.Peso,
+        TicketLine.FechaCaducidad,
+        TicketLine.comportamiento,
+        Product.Descripcion.label('producto_descripcion')
+    ).outerjoin(
+        Product, TicketLine.IdArticulo == Product.IdArticulo
+    ).where(
+        TicketLine.IdTicket.in_(ticket_ids)
+    ).order_by(TicketLine.IdTicket, TicketLine.IdLineaTicket)).all()
+
+    for row in rows:
+        lines[row.IdTicket].append({
+            'line_id': row.IdLineaTicket,
+            'product_id': row.IdArticulo,
+            'description': row.Descripcion or row.producto_descripcion or '',
+            'quantity': float(row.Peso or 0),
+            'unit': 'kg' if row.comportamiento else 'unità',
+            'expiry': row.FechaCaducidad.strftime('%d/%m/%Y') if row.FechaCaducidad else None,
+            'expiry_status': _expiry_status(row.FechaCaducidad, today) if row.FechaCaducidad else None
+        })
+    return lines
+
+
+def expired_lines(ticket_ids, deadline):
+    """Lines of ticket_ids expiring before the day of deadline, as shown in the form error"""
+    ticket_ids = list(ticket_ids)
+    if not ticket_ids or deadline is None:
+        return []
+
+    deadline_day = _day_start(deadline.date())
+    rows = db.session.execute(select(
+        TicketHeader.NumTicket,
+        TicketLine.IdArticulo,
+        TicketLine.Descripcion,
+        TicketLine.FechaCaducidad
+    ).select_from(TicketLine).join(
+        TicketHeader, TicketHeader.IdTicket == TicketLine.IdTicket
+    ).where(
+        TicketLine.IdTicket.in_(ticket_ids),
+        TicketLine.FechaCaducidad < deadline_day
+    ).order_by(TicketHeader.NumTicket, TicketLine.IdLineaTicket)).all()
+
+    return [{
+        'ticket_num': row.NumTicket,
+        'product_id': row.IdArticulo,
+        'product_name': row.Descripcion,
+        'expiry_date': row.FechaCaducidad.strftime('%d/%m/%Y'),
+        'task_deadline': deadline.strftime('%d/%m/%Y')
+    } for row in rows]
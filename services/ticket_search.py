@@ -0,0 +1,206 @@
+"""
+Ticket search - ricerca ticket in tempo reale con cache dei risultati
+
+/warehouse/api/tickets/search viene chiamata ad ogni tasto premuto. I
+risultati (al più SEARCH_LIMIT ticket) sono letti con una sola query di
+proiezione su dat_ticket + ticket_summary, con le sole colonne mostrate, e
+tenuti in una cache LRU per (query normalizzata, intervallo di date) per
+SEARCH_CACHE_TTL_SECONDS.
+
+Una voce non è più valida quando:
+- arrivano nuovi ticket: MAX(IdTicket) viene controllato al più ogni
+  LATEST_TICKET_CHECK_SECONDS (i ticket delle bilance non passano dall'app)
+- cambia la generazione dei contatori ticket o catalogo
+  (services.badge_counters: stato dei ticket, nomi degli articoli)
+
+Ogni risultato ha un ETag calcolato sul contenuto: una richiesta ripetuta con
+If-None-Match riceve 304 senza toccare il database.
+"""
+
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from sqlalchemy import func
+
+from app.models import db, TicketHeader, TicketSummary
+from services.badge_counters import CATALOG, TICKETS, get_generations
+from services.search_index import normalize, ticket_search_clause
+from services.ticket_summary import fold_line_aggregates, line_aggregates_statement
+
+SEARCH_LIMIT = 10
+SEARCH_CACHE_TTL_SECONDS = 30
+SEARCH_CACHE_MAX_ENTRIES = 256
+LATEST_TICKET_CHECK_SECONDS = 2
+
+SEARCH_FIELDS = ('barcode', 'description', 'product')
+
+
+class SearchResult:
+    """Rows of a search with their ETag and the data version they were read at"""
+
+    __slots__ = ('items', 'etag', 'version', 'loaded_at')
+
+    def __init__(self, items, version):
+        self.items = items
+        self.version = version
+        self.loaded_at = time.monotonic()
+        payload = json.dumps(items, sort_keys=True, separators=(',', ':'))
+        self.etag = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class _SearchCache:
+    """Thread-safe LRU of SearchResult by search key, checked against the data version"""
+
+    def __init__(self, ttl=SEARCH_CACHE_TTL_SECONDS, max_entries=SEARCH_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        self._latest_id = 0
+        self._latest_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version):
+        with self._lock:
+            result = self._results.get(key)
+            if (result is not None and result.version == version
+                    and time.monotonic() - result.loaded_at <= self.ttl):
+                self._results.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+            return None
+
+    def put(self, key, result):
+        with self._lock:
+            self._results[key] = result
+            self._results.move_to_end(key)
+            while len(self._results) > self.max_entries:
+                self._results.popitem(last=False)
+
+    def latest_ticket_id(self):
+        """MAX(IdTicket), re-read at most every LATEST_TICKET_CHECK_SECONDS"""
+        now = time.monotonic()
+        with self._lock:
+            if now - self._latest_at <= LATEST_TICKET_CHECK_SECONDS:
+                return self._latest_id
+        latest = db.session.query(func.max(TicketHeader.IdTicket)).scalar() or 0
+        with self._lock:
+            self._latest_id = latest
+            self._latest_at = now
+        return latest
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+            self._latest_at = 0.0
+
+
+_cache = _SearchCache()
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+def search_key(query, start_date=None, end_date=None):
+    """Normalized (query, start, end) cache key, or None when there is nothing to search"""
+    query = ' '.join((query or '').split())
+    if query.startswith('#'):
+        # Ricerca per numero ticket
+        query = '#' + query[1:].strip()
+    else:
+        query = normalize(query)
+    start, end = _parse_date(start_date), _parse_date(end_date)
+    if not query and not (start or end):
+        return None
+    return query, start, end
+
+
+def _run_search(query, start, end):
+    ticket_query = db.session.query(
+        TicketHeader.IdTicket,
+        TicketHeader.NumTicket,
+        TicketHeader.Fecha,
+        TicketHeader.CodigoBarras,
+        TicketHeader.Enviado,
+        TicketSummary.IdTicket.label('summary_id'),
+        TicketSummary.main_product_id,
+        TicketSummary.main_product_name
+    ).outerjoin(TicketSummary, TicketSummary.IdTicket == TicketHeader.IdTicket)
+
+    if start:
+        ticket_query = ticket_query.filter(TicketHeader.Fecha >= start)
+    if end:
+        # Include the entire day
+        ticket_query = ticket_query.filter(TicketHeader.Fecha <= end + timedelta(days=1))
+
+    if query.startswith('#'):
+        ticket_number = query[1:]
+        if ticket_number.isdigit():
+            ticket_query = ticket_query.filter(TicketHeader.NumTicket == int(ticket_number))
+    elif query:
+        # Barcode, descrizione prodotto o descrizione linea (indice a trigrammi)
+        ticket_query = ticket_query.filter(ticket_search_clause(query, fields=SEARCH_FIELDS))
+
+    rows = ticket_query.order_by(TicketHeader.Fecha.desc()).limit(SEARCH_LIMIT).all()
+
+    # Ticket appena arrivati dalle bilance, non ancora riepilogati: prodotto della prima linea
+    missing = [row.IdTicket for row in rows if row.summary_id is None]
+    first_lines = {}
+    if missing:
+        first_lines = fold_line_aggregates(db.session.execute(line_aggregates_statement(missing)).all())
+
+    items = []
+    for row in rows:
+        product_id, product_name = row.main_product_id, row.main_product_name
+        line = first_lines.get(row.IdTicket)
+        if line is not None:
+            product_id = line.IdArticulo
+            product_name = line.producto_descripcion or line.linea_descripcion
+        items.append({
+            'id': row.IdTicket,
+            'number': row.NumTicket,
+            'formatted_date': row.Fecha.strftime('%d/%m/%Y %H:%M') if row.Fecha else 'N/A',
+            'barcode': row.CodigoBarras or 'N/A',
+            'product_name': product_name or 'N/A',
+            'product_id': product_id,
+            'is_processed': bool(row.Enviado)
+        })
+    return items
+
+
+def search_tickets(query, start_date=None, end_date=None):
+    """Latest SEARCH_LIMIT tickets matching query and the date range (YYYY-MM-DD strings).
+
+    Returns:
+        SearchResult: shared cached object, do not modify its items;
+        None when query and dates are all empty
+    """
+    key = search_key(query, start_date, end_date)
+    if key is None:
+        return None
+
+    version = (_cache.latest_ticket_id(),) + get_generations(TICKETS, CATALOG)
+    result = _cache.get(key, version)
+    if result is None:
+        result = SearchResult(_run_search(*key), version)
+        _cache.put(key, result)
+    return result
+
+
+def clear_search_cache():
+    _cache.clear()
+
+
+def get_search_cache_stats():
+    return {'entries': len(_cache._results), 'hits': _cache.hits, 'misses': _cache.misses,
+            'ttl_seconds': _cache.ttl}
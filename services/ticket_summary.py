@@ -0,0 +1,266 @@
+"""
+Ticket summary - riepilogo materializzato dei ticket (tabella ticket_summary)
+
+Per ogni ticket conserva numero di linee, scadenza più vicina, prodotto
+principale (prima linea) e stato, così liste, filtri e badge non devono
+aggregare dat_ticket_linea ad ogni richiesta.
+
+Il riepilogo viene aggiornato:
+- ad ogni flush della sessione che tocca TicketHeader/TicketLine (stessa transazione)
+- dallo sweeper, per le transizioni di stato in blocco e per i ticket nuovi
+  scritti direttamente dalle bilance (sync_new_tickets)
+- per intero con `flask rebuild-ticket-summary` per i disallineamenti dovuti
+  a scritture fuori dall'ORM
+
+Un errore nell'aggiornamento fa fallire il flush: su InnoDB un deadlock
+annulla tutta la transazione, e proseguire farebbe confermare al chiamante
+un commit che ha perso le modifiche già scritte.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import and_, delete, event, exists, func, insert, select
+from sqlalchemy.sql import Select
+
+from app.models import db, Product, SystemConfig, TicketHeader, TicketLine, TicketSummary
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+WATERMARK_KEY = 'ticket_summary_watermark'
+
+_listeners_registered = False
+
+
+def line_aggregates_statement(ticket_ids):
+    """Grouped line aggregates per ticket joined to the first line and its product.
+
+    Columns: IdTicket, line_count, earliest_expiry, IdArticulo,
+    linea_descripcion, producto_descripcion. Rows may repeat per ticket because
+    dat_ticket_linea has a composite key: use fold_line_aggregates().
+    """
+    line_stats = select(
+        TicketLine.IdTicket.label('IdTicket'),
+        func.count(TicketLine.IdTicket).label('line_count'),
+        func.min(TicketLine.FechaCaducidad).label('earliest_expiry'),
+        func.min(TicketLine.IdLineaTicket).label('first_line_id')
+    ).where(
+        TicketLine.IdTicket.in_(list(ticket_ids))
+    ).group_by(TicketLine.IdTicket).subquery()
+
+    return select(
+        line_stats.c.IdTicket,
+        line_stats.c.line_count,
+        line_stats.c.earliest_expiry,
+        TicketLine.IdArticulo,
+        TicketLine.Descripcion.label('linea_descripcion'),
+        Product.Descripcion.label('producto_descripcion')
+    ).select_from(line_stats).join(
+        TicketLine,
+        and_(
+            TicketLine.IdTicket == line_stats.c.IdTicket,
+            TicketLine.IdLineaTicket == line_stats.c.first_line_id
+        )
+    ).outerjoin(
+        Product, TicketLine.IdArticulo == Product.IdArticulo
+    )
+
+
+def expiring_conditions(warning_days, today=None):
+    """Filters on TicketSummary for in-task tickets expiring between today and
+    today + warning_days (both included). Range on earliest_expiry so the
+    (Enviado, earliest_expiry) index is used.
+    """
+    today = today or datetime.now().date()
+    window_start = datetime.combine(today, datetime.min.time())
+    window_end = window_start + timedelta(days=warning_days + 1)
+    return (
+        TicketSummary.Enviado == 10,
+        TicketSummary.earliest_expiry >= window_start,
+        TicketSummary.earliest_expiry < window_end
+    )
+
+
+def fold_line_aggregates(rows):
+    """Return {IdTicket: row} keeping the first row found for each ticket"""
+    folded = {}
+    for row in rows:
+        folded.setdefault(row.IdTicket, row)
+    return folded
+
+
+def _write_summaries(conn, ticket_ids):
+    """Recompute the summary rows of ticket_ids on conn (no commit).
+
+    Tickets that no longer exist lose their summary row.
+    """
+    ticket_ids = list(ticket_ids)
+    if not ticket_ids:
+        return 0
+
+    headers = conn.execute(select(
+        TicketHeader.IdTicket,
+        TicketHeader.Enviado,
+        TicketHeader.Fecha
+    ).where(TicketHeader.IdTicket.in_(ticket_ids))).all()
+
+    aggregates = fold_line_aggregates(conn.execute(line_aggregates_statement(ticket_ids)).all()) if headers else {}
+
+    now = datetime.utcnow()
+    rows = []
+    for header in headers:
+        stats = aggregates.get(header.IdTicket)
+        rows.append({
+            'IdTicket': header.IdTicket,
+            'Enviado': header.Enviado,
+            'Fecha': header.Fecha,
+            'line_count': stats.line_count if stats else 0,
+            'earliest_expiry': stats.earliest_expiry if stats else None,
+            'main_product_id': stats.IdArticulo if stats else None,
+            'main_product_name': (stats.producto_descripcion or stats.linea_descripcion) if stats else None,
+            'updated_at': now
+        })
+
+    summary_table = TicketSummary.__table__
+    conn.execute(delete(summary_table).where(summary_table.c.IdTicket.in_(ticket_ids)))
+    if rows:
+        conn.execute(insert(summary_table), rows)
+    return len(rows)
+
+
+def refresh_ticket_summaries(ticket_ids):
+    """Recompute the summary of the given tickets in the current transaction.
+
+    The caller is responsible for the commit.
+
+    Returns:
+        int: numero di righe di riepilogo scritte
+    """
+    return _write_summaries(db.session.connection(), set(ticket_ids))
+
+
+def set_summary_status(ticket_ids, new_status, from_status=None):
+    """Mirror a bulk Enviado update (query.update bypasses the flush hook).
+
+    ticket_ids may also be a SELECT of ticket ids, as used by the update.
+    """
+    if isinstance(ticket_ids, Select):
+        ticket_filter = TicketSummary.IdTicket.in_(ticket_ids)
+    else:
+        ticket_ids = list(ticket_ids)
+        if not ticket_ids:
+            return 0
+        ticket_filter = TicketSummary.IdTicket.in_(ticket_ids)
+    query = db.session.query(TicketSummary).filter(ticket_filter)
+    if from_status is not None:
+        query = query.filter(TicketSummary.Enviado == from_status)
+    return query.update({TicketSummary.Enviado: new_status}, synchronize_session=False)
+
+
+def sync_new_tickets(batch_size=DEFAULT_BATCH_SIZE):
+    """Summarize tickets written by the scales after the last sync.
+
+    The watermark (last IdTicket synced) is kept in system_config, separate
+    from the summary rows written by the flush hook, so an old ticket touched
+    by the app never makes the sync skip the tickets before it.
+
+    Returns:
+        int: ticket riepilogati
+    """
+    watermark = SystemConfig.get_config(WATERMARK_KEY, 0) or 0
+    total = 0
+
+    while True:
+        ticket_ids = [row[0] for row in db.session.query(TicketHeader.IdTicket).filter(
+            TicketHeader.IdTicket > watermark
+        ).order_by(TicketHeader.IdTicket.asc()).limit(batch_size).all()]
+
+        if not ticket_ids:
+            break
+
+        refresh_ticket_summaries(ticket_ids)
+        watermark = ticket_ids[-1]
+        # set_config esegue il commit del batch insieme al nuovo watermark
+        SystemConfig.set_config(WATERMARK_KEY, watermark,
+                                description='Ultimo IdTicket riepilogato in ticket_summary',
+                                data_type='integer')
+        total += len(ticket_ids)
+
+        if len(ticket_ids) < batch_size:
+            break
+
+    return total
+
+
+def rebuild_ticket_summaries(batch_size=DEFAULT_BATCH_SIZE):
+    """Rebuild the whole ticket_summary table, one committed batch at a time.
+
+    Returns:
+        dict: ticket riepilogati, righe orfane rimosse, batch
+    """
+    last_id = 0
+    total = 0
+    batches = 0
+
+    while True:
+        ticket_ids = [row[0] for row in db.session.query(TicketHeader.IdTicket).filter(
+            TicketHeader.IdTicket > last_id
+        ).order_by(TicketHeader.IdTicket.asc()).limit(batch_size).all()]
+
+        if not ticket_ids:
+            break
+
+        total += refresh_ticket_summaries(ticket_ids)
+        db.session.commit()
+        batches += 1
+        last_id = ticket_ids[-1]
+
+        if len(ticket_ids) < batch_size:
+            break
+
+    # Righe di ticket cancellati direttamente sul database della bilancia
+    orphaned = db.session.query(TicketSummary).filter(
+        ~exists().where(TicketHeader.IdTicket == TicketSummary.IdTicket)
+    ).delete(synchronize_session=False)
+
+    SystemConfig.set_config(WATERMARK_KEY, last_id,
+                            description='Ultimo IdTicket riepilogato in ticket_summary',
+                            data_type='integer')
+
+    return {'summarized': total, 'orphaned': orphaned, 'batches': batches}
+
+
+def _collect_ticket_ids(session):
+    ticket_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (TicketHeader, TicketLine)) and obj.IdTicket is not None:
+            ticket_ids.add(obj.IdTicket)
+    return ticket_ids
+
+
+def _refresh_after_flush(session, flush_context):
+    # new/dirty/deleted riflettono ancora lo stato pre-flush, le righe sono già scritte
+    ticket_ids = _collect_ticket_ids(session)
+    if not ticket_ids:
+        return
+    # Un errore fa fallire il flush: ticket e ticket_summary restano allineati
+    _write_summaries(session.connection(), ticket_ids)
+
+
+def init_app(app):
+    """Register the flush hook and the rebuild CLI command"""
+    global _listeners_registered
+
+    if not _listeners_registered:
+        event.listen(db.session, 'after_flush', _refresh_after_flush)
+        _listeners_registered = True
+
+    @app.cli.command('rebuild-ticket-summary')
+    @click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True, help='Ticket per transazione')
+    def rebuild_ticket_summary_command(batch_size):
+        """Ricostruisce da zero la tabella ticket_summary."""
+        result = rebuild_ticket_summaries(batch_size=batch_size)
+        click.echo(f"ticket_summary ricostruita: {result['summarized']} ticket in {result['batches']} batch, "
+                   f"{result['orphaned']} righe orfane rimosse")
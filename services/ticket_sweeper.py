@@ -0,0 +1,323 @@
+"""
+Ticket sweeper - transizioni di stato programmate per i ticket nei task
+
+Sostituisce gli aggiornamenti che prima venivano eseguiti ad ogni apertura
+della pagina tickets:
+- ticket nei task (Enviado=10) con prodotti scaduti -> Scaduto (Enviado=4)
+- ticket nei task (Enviado=10) non più associati a task attivi -> Giacenza (Enviado=0)
+
+Lo sweep gira in un thread in background ad intervalli configurabili e subito
+dopo la mezzanotte, riepiloga in ticket_summary i ticket nuovi arrivati dalle
+bilance e ripara i contatori di avanzamento dei task che non corrispondono più
+a task_tickets. Un lock MySQL (GET_LOCK) garantisce che un solo processo
+worker esegua lo sweep, e ogni esecuzione viene registrata in ticket_sweep_runs.
+"""
+
+import logging
+import os
+import socket
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import click
+from sqlalchemy import and_, exists, text
+
+from app.models import db, TicketHeader, TicketLine, Task, TaskTicket, TicketSweepRun
+from services.badge_counters import TICKETS, invalidate_counters
+from services.task_progress import reconcile_task_progress
+from services.ticket_summary import set_summary_status, sync_new_tickets
+
+logger = logging.getLogger(__name__)
+
+LOCK_NAME = 'dblogix_ticket_sweeper'
+ACTIVE_TASK_STATUSES = ('pending', 'assigned', 'in_progress')
+DEFAULT_BATCH_SIZE = 500
+
+# Fallback per database senza GET_LOCK (es. SQLite in sviluppo)
+_local_lock = threading.Lock()
+
+_sweeper = None
+
+
+def _worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+@contextmanager
+def leader_lock(name=LOCK_NAME):
+    """Acquire the cross-process sweeper lock without waiting.
+
+    Yields True if this process is the leader for the duration of the block.
+    On MySQL the lock is held by a dedicated connection, so it is released
+    automatically if the worker dies.
+    """
+    engine = db.engine
+    if engine.dialect.name != 'mysql':
+        acquired = _local_lock.acquire(blocking=False)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                _local_lock.release()
+        return
+
+    conn = engine.connect()
+    acquired = False
+    try:
+        acquired = conn.execute(text("SELECT GET_LOCK(:name, 0)"), {'name': name}).scalar() == 1
+        yield acquired
+    finally:
+        try:
+            if acquired:
+                conn.execute(text("SELECT RELEASE_LOCK(:name)"), {'name': name})
+        finally:
+            conn.close()
+
+
+def expire_tickets(today=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Marca come scaduti (Enviado = 4) i ticket nei task che hanno almeno un
+    prodotto con data di scadenza PASSATA. Un prodotto è considerato scaduto
+    solo dal giorno DOPO la sua data di scadenza, non lo stesso giorno.
+
+    Returns:
+        tuple: (ticket aggiornati, numero di batch)
+    """
+    today = today or datetime.now().date()
+    cutoff = datetime.combine(today, datetime.min.time())
+
+    has_expired_line = exists().where(and_(
+        TicketLine.IdTicket == TicketHeader.IdTicket,
+        TicketLine.FechaCaducidad < cutoff
+    ))
+
+    return _transition_in_batches(has_expired_line, 4, batch_size)
+
+
+def release_orphaned_tickets(batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Riporta in Giacenza (Enviado = 0) i ticket con Enviado = 10 che non sono
+    più associati a nessun task attivo. I ticket in task attivi non vengono
+    mai toccati, indipendentemente dalla scadenza dei prodotti.
+
+    Returns:
+        tuple: (ticket aggiornati, numero di batch)
+    """
+    in_active_task = exists().where(and_(
+        TaskTicket.ticket_id == TicketHeader.IdTicket,
+        Task.id_task == TaskTicket.task_id,
+        Task.status.in_(ACTIVE_TASK_STATUSES)
+    ))
+
+    return _transition_in_batches(~in_active_task, 0, batch_size)
+
+
+def _transition_in_batches(condition, new_status, batch_size):
+    """Move Enviado=10 tickets matching condition to new_status, one committed batch at a time"""
+    total = 0
+    batches = 0
+
+    while True:
+        ticket_ids = [row[0] for row in db.session.query(TicketHeader.IdTicket).filter(
+            TicketHeader.Enviado == 10,
+            condition
+        ).limit(batch_size).all()]
+
+        if not ticket_ids:
+            break
+
+        # Il filtro su Enviado evita di sovrascrivere ticket cambiati nel frattempo
+        updated = db.session.query(TicketHeader).filter(
+            TicketHeader.IdTicket.in_(ticket_ids),
+            TicketHeader.Enviado == 10
+        ).update({TicketHeader.Enviado: new_status}, synchronize_session=False)
+        set_summary_status(ticket_ids, new_status, from_status=10)
+        # L'update in blocco non passa dall'hook di flush dei contatori
+        invalidate_counters(TICKETS)
+        db.session.commit()
+
+        total += updated
+        batches += 1
+
+        if len(ticket_ids) < batch_size:
+            break
+
+    return total, batches
+
+
+def run_sweep(trigger='manual', batch_size=DEFAULT_BATCH_SIZE):
+    """Run one sweep if this process can take the leader lock.
+
+    Returns:
+        dict: run metrics, or None if another worker holds the lock
+    """
+    with leader_lock() as is_leader:
+        if not is_leader:
+            logger.debug("Ticket sweep skipped: another worker holds the lock")
+            return None
+
+        started_at = datetime.utcnow()
+        start = time.perf_counter()
+        summary = {
+            'trigger': trigger,
+            'worker': _worker_id(),
+            'status': 'success',
+            'expired_count': 0,
+            'released_count': 0,
+            'synced_count': 0,
+            'batches': 0,
+            'error_message': None
+        }
+        repaired_tasks = []
+
+        try:
+            # Prima i ticket nuovi, così anche il riepilogo dei ticket appena arrivati è aggiornato
+            summary['synced_count'] = sync_new_tickets(batch_size=batch_size)
+            expired, expired_batches = expire_tickets(batch_size=batch_size)
+            released, released_batches = release_orphaned_tickets(batch_size=batch_size)
+
+            summary['expired_count'] = expired
+            summary['released_count'] = released
+            summary['batches'] = expired_batches + released_batches
+            repaired_tasks = reconcile_task_progress()
+        except Exception as e:
+            db.session.rollback()
+            summary['status'] = 'error'
+            summary['error_message'] = str(e)
+            logger.error(f"Errore durante lo sweep dei ticket: {str(e)}")
+
+        summary['started_at'] = started_at
+        summary['finished_at'] = datetime.utcnow()
+        summary['duration_ms'] = int((time.perf_counter() - start) * 1000)
+
+        try:
+            if summary['synced_count']:
+                # Ticket nuovi dalle bilance: cambiano i conteggi per stato
+                invalidate_counters(TICKETS)
+            db.session.add(TicketSweepRun(**summary))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Impossibile registrare le metriche dello sweep: {str(e)}")
+
+        if summary['expired_count'] or summary['released_count'] or summary['synced_count']:
+            logger.info(f"Ticket sweep ({trigger}): {summary['expired_count']} scaduti, "
+                        f"{summary['released_count']} rimessi in giacenza, "
+                        f"{summary['synced_count']} nuovi riepilogati in {summary['duration_ms']} ms")
+        if repaired_tasks:
+            logger.warning(f"Ticket sweep ({trigger}): avanzamento riparato per {len(repaired_tasks)} task")
+
+        return summary
+
+
+class TicketSweeper:
+    """Background scheduler running the sweep at a fixed interval and at midnight"""
+
+    def __init__(self, app, interval_minutes=15, batch_size=DEFAULT_BATCH_SIZE):
+        self.app = app
+        self.interval_minutes = max(int(interval_minutes), 1)
+        self.batch_size = max(int(batch_size), 1)
+        self.last_run = None
+        self.next_run_at = None
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        with self._start_lock:
+            if self.is_running:
+                return
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run_loop, name='ticket-sweeper', daemon=True)
+            self._thread.start()
+            logger.info(f"Ticket sweeper avviato (intervallo {self.interval_minutes} min, batch {self.batch_size})")
+
+    def stop(self):
+        self._stop_event.set()
+
+    def next_wakeup(self, now):
+        """Return (when, trigger) for the next run: the interval or midnight, whichever comes first"""
+        next_interval = now + timedelta(minutes=self.interval_minutes)
+        next_midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+        if next_midnight <= next_interval:
+            return next_midnight, 'midnight'
+        return next_interval, 'interval'
+
+    def run_once(self, trigger):
+        with self.app.app_context():
+            try:
+                result = run_sweep(trigger=trigger, batch_size=self.batch_size)
+                if result is not None:
+                    self.last_run = result
+                return result
+            finally:
+                db.session.remove()
+
+    def _run_loop(self):
+        trigger = 'startup'
+        while not self._stop_event.is_set():
+            try:
+                self.run_once(trigger)
+            except Exception as e:
+                logger.error(f"Errore nel thread dello sweeper ticket: {str(e)}")
+
+            self.next_run_at, trigger = self.next_wakeup(datetime.now())
+            delay = (self.next_run_at - datetime.now()).total_seconds()
+            self._stop_event.wait(max(delay, 1))
+
+
+def get_sweeper():
+    """Return the sweeper of this process (None if disabled)"""
+    return _sweeper
+
+
+def get_sweeper_status(limit=10):
+    """Scheduler state plus the most recent recorded runs"""
+    recent_runs = TicketSweepRun.query.order_by(TicketSweepRun.started_at.desc()).limit(limit).all()
+    return {
+        'enabled': _sweeper is not None,
+        'running': _sweeper.is_running if _sweeper else False,
+        'interval_minutes': _sweeper.interval_minutes if _sweeper else None,
+        'next_run_at': _sweeper.next_run_at.isoformat() if _sweeper and _sweeper.next_run_at else None,
+        'recent_runs': [run.to_dict() for run in recent_runs]
+    }
+
+
+def init_app(app):
+    """Register the sweeper with the Flask app.
+
+    The background thread is started on the first request, so CLI commands
+    (flask db upgrade, flask sweep-tickets...) never spawn it.
+    """
+    global _sweeper
+    from app.config import get_sweeper_config_from_file
+
+    config = get_sweeper_config_from_file()
+
+    @app.cli.command('sweep-tickets')
+    def sweep_tickets_command():
+        """Esegue subito lo sweep delle scadenze ticket."""
+        result = run_sweep(trigger='cli', batch_size=config['batch_size'])
+        if result is None:
+            click.echo('Sweep non eseguito: un altro processo detiene il lock.')
+        else:
+            click.echo(f"Sweep {result['status']}: {result['expired_count']} scaduti, "
+                       f"{result['released_count']} rimessi in giacenza, "
+                       f"{result['synced_count']} nuovi riepilogati ({result['duration_ms']} ms)")
+
+    if not config['enabled']:
+        logger.info("Ticket sweeper disabilitato da configurazione")
+        return
+
+    _sweeper = TicketSweeper(app, config['interval_minutes'], config['batch_size'])
+
+    @app.before_request
+    def start_ticket_sweeper():
+        if not _sweeper.is_running:
+            _sweeper.start()
@@ -0,0 +1,219 @@
+"""
+Ticket transitions - cambi di stato (Enviado) di più ticket in una richiesta
+
+Usato da /warehouse/api/checkout/bulk: un bancale si chiude scansionando
+decine di ticket di fila, anche accodati dallo scanner mentre era offline.
+Per ogni richiesta:
+- i QR code vengono risolti con una sola query (services.scan_resolution)
+- gli stati attuali si leggono con una SELECT ... FOR UPDATE
+- la transizione è applicata con un solo UPDATE
+- i log di scan_log sono scritti con un solo INSERT multi-riga, nello stesso commit
+- ticket_summary, contatori e cache delle scansioni vengono allineati
+  (l'UPDATE in blocco non passa dagli hook di flush)
+
+Gli elementi possono portare un client_id: se esiste già una riga di
+scan_log con quel client_id la richiesta era già stata applicata (risposta
+persa, coda offline inviata due volte) e l'elemento non viene ripetuto.
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy import insert
+
+from app.models import db, ScanLog, TicketHeader
+from services.audit_buffer import new_client_id
+from services.badge_counters import TICKETS, invalidate_counters
+from services.scan_resolution import QR_CODE_LENGTH, invalidate_tickets, resolve_tickets
+from services.ticket_summary import set_summary_status
+
+logger = logging.getLogger(__name__)
+
+MAX_BULK_ITEMS = 500
+
+# azione -> (nuovo Enviado, stati di partenza ammessi)
+TRANSITIONS = {
+    'checkout': (1, frozenset({0, 10})),
+    'assign_ddt1': (2, frozenset({0, 3, 4, 10})),
+    'assign_ddt2': (3, frozenset({0, 2, 4, 10}))
+}
+
+_SUCCESS_MESSAGES = {
+    'checkout': 'Ticket processato',
+    'assign_ddt1': 'Ticket assegnato a DDT1',
+    'assign_ddt2': 'Ticket assegnato a DDT2'
+}
+
+_REJECT_MESSAGES = {
+    1: 'Ticket già processato',
+    2: 'Ticket già assegnato a DDT1',
+    3: 'Ticket già assegnato a DDT2',
+    4: 'Non è possibile processare un ticket scaduto',
+    10: 'Ticket dentro un task'
+}
+
+
+class BulkItem:
+    """One element of a bulk request and its outcome"""
+
+    __slots__ = ('index', 'client_id', 'qr_code', 'qr', 'ticket_id', 'status', 'message',
+                 'previous_status', 'enviado')
+
+    def __init__(self, index, raw):
+        self.index = index
+        self.client_id = None
+        self.qr_code = None
+        self.qr = None
+        self.ticket_id = None
+        self.status = None
+        self.message = None
+        self.previous_status = None
+        self.enviado = None
+
+        if isinstance(raw, dict):
+            self.client_id = str(raw['client_id'])[:32] if raw.get('client_id') else None
+            value = raw.get('qr_code') or raw.get('ticket_id')
+        else:
+            value = raw
+
+        value = str(value).strip() if value is not None else ''
+        if len(value) == QR_CODE_LENGTH and value.isdigit():
+            self.qr_code = value
+        elif value.isdigit():
+            self.ticket_id = int(value)
+        else:
+            self.fail('invalid', 'Elemento non valido: atteso id ticket o QR code a 27 cifre')
+
+    def fail(self, status, message):
+        self.status = status
+        self.message = message
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'client_id': self.client_id,
+            'ticket_id': self.ticket_id,
+            'qr_code': self.qr_code,
+            'status': self.status,
+            'success': self.status in ('ok', 'unchanged', 'duplicate'),
+            'message': self.message,
+            'enviado': self.enviado
+        }
+
+
+def _log_row(item, action, user_id, now):
+    qr = item.qr
+    return {
+        'client_id': item.client_id or new_client_id(),
+        'user_id': user_id,
+        'ticket_id': item.ticket_id,
+        'action': action,
+        'timestamp': now,
+        'raw_code': item.qr_code or f'ticket_id:{item.ticket_id},prev_enviado:{item.previous_status}',
+        'product_code': qr.product_id if qr else None,
+        'scan_date': qr.scan_date if qr else None,
+        'scan_time': qr.scan_time if qr else None
+    }
+
+
+def apply_bulk_transition(raw_items, action, user_id):
+    """Apply action to every ticket in raw_items and commit.
+
+    Args:
+        raw_items: ticket ids, 27-digit QR codes, or dicts with ticket_id or
+            qr_code and an optional client_id
+        action: key of TRANSITIONS
+
+    Returns:
+        list: per-item result dicts, in the input order
+
+    Raises:
+        ValueError: unknown action or too many items
+    """
+    if action not in TRANSITIONS:
+        raise ValueError(f"Azione non valida: {action}")
+    if len(raw_items) > MAX_BULK_ITEMS:
+        raise ValueError(f"Troppi elementi: massimo {MAX_BULK_ITEMS} per richiesta")
+
+    new_status, allowed_from = TRANSITIONS[action]
+    items = [BulkItem(index, raw) for index, raw in enumerate(raw_items)]
+
+    # 1. QR code -> ticket (cache + una query per tutti i codici non in cache)
+    qr_codes = {item.qr_code for item in items if item.qr_code and item.status is None}
+    resolved = resolve_tickets(qr_codes) if qr_codes else {}
+    for item in items:
+        if item.qr_code and item.status is None:
+            item.qr, ticket = resolved.get(item.qr_code, (None, None))
+            if item.qr is None:
+                item.fail('invalid', 'Formato QR code non valido')
+            elif ticket is None:
+                item.fail('not_found', f'Ticket {item.qr.ticket_num} non trovato')
+            else:
+                item.ticket_id = ticket.IdTicket
+
+    # 2. Elementi già applicati da una richiesta precedente
+    client_ids = [item.client_id for item in items if item.client_id and item.status is None]
+    if client_ids:
+        applied = {row[0] for row in db.session.query(ScanLog.client_id).filter(
+            ScanLog.client_id.in_(client_ids)
+        ).all()}
+        for item in items:
+            if item.client_id in applied and item.status is None:
+                item.fail('duplicate', 'Già registrato')
+            elif item.client_id:
+                # Stesso client_id ripetuto nella richiesta: vale solo il primo
+                applied.add(item.client_id)
+
+    # 3. Stato attuale dei ticket, bloccati fino al commit
+    ticket_ids = {item.ticket_id for item in items if item.status is None}
+    current = {}
+    if ticket_ids:
+        current = dict(db.session.query(TicketHeader.IdTicket, TicketHeader.Enviado).filter(
+            TicketHeader.IdTicket.in_(ticket_ids)
+        ).with_for_update().all())
+
+    to_update = set()
+    for item in items:
+        if item.status is not None:
+            continue
+        if item.ticket_id not in current:
+            item.fail('not_found', f'Ticket {item.ticket_id} non trovato')
+            continue
+        item.previous_status = current[item.ticket_id]
+        if item.ticket_id in to_update or item.previous_status == new_status:
+            # Stesso ticket scansionato più volte (un QR per prodotto) o già nello stato finale
+            item.status = 'unchanged'
+            item.message = _SUCCESS_MESSAGES[action]
+            item.enviado = new_status
+        elif item.previous_status in allowed_from:
+            item.status = 'ok'
+            item.message = _SUCCESS_MESSAGES[action]
+            item.enviado = new_status
+            to_update.add(item.ticket_id)
+        else:
+            item.fail('rejected', _REJECT_MESSAGES.get(item.previous_status,
+                                                       f'Stato ticket non riconosciuto: {item.previous_status}'))
+            item.enviado = item.previous_status
+
+    # 4. Un UPDATE, un INSERT multi-riga, un commit
+    if to_update:
+        db.session.query(TicketHeader).filter(
+            TicketHeader.IdTicket.in_(to_update)
+        ).update({TicketHeader.Enviado: new_status}, synchronize_session=False)
+        set_summary_status(to_update, new_status)
+        invalidate_counters(TICKETS)
+
+        now = datetime.utcnow()
+        db.session.execute(insert(ScanLog.__table__), [
+            _log_row(item, action, user_id, now) for item in items if item.status == 'ok'
+        ])
+
+    db.session.commit()
+
+    if to_update:
+        # I TicketHeader già in sessione e le risoluzioni in cache hanno il vecchio Enviado
+        db.session.expire_all()
+        invalidate_tickets(to_update)
+        logger.info(f"Transizione in blocco '{action}': {len(to_update)} ticket -> Enviado {new_status}")
+
+    return [item.to_dict() for item in items]
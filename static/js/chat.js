@@ -12,6 +12,9 @@ class ChatWidget {
         this.isMobile = this.isAndroid || this.isIOS;
         this.keyboardVisible = false;
         this.originalViewportHeight = window.innerHeight;
+        this.feed = window.liveFeed || null;
+        this.onlineUsers = new Map();
+        this.onlineRefreshInterval = null;
         
         this.init();
     }
@@ -19,10 +22,16 @@ class ChatWidget {
     init() {
         this.createChatWidget();
         this.bindEvents();
-        this.startPolling();
         this.loadInitialMessages();
-        this.updateOnlineUsers();
-        this.updateUnreadCount();
+        
+        if (this.feed) {
+            // Messaggi, letture, utenti online e non letti arrivano dal canale push
+            this.connectFeed();
+        } else {
+            this.startPolling();
+            this.updateOnlineUsers();
+            this.updateUnreadCount();
+        }
         
         // Setup mobile keyboard detection for both Android and iOS
         if (this.isMobile) {
@@ -30,6 +39,71 @@ class ChatWidget {
         }
     }
     
+    connectFeed() {
+        this.feed.on('chat_message', (message) => {
+            // Il proprio messaggio è già mostrato dalla risposta dell'invio
+            if (document.querySelector(`#chatMessages [data-message-id="${message.id}"]`)) return;
+            
+            this.displayMessages([message]);
+            this.lastMessageTimestamp = message.timestamp;
+            if (this.isOpen && this.isScrolledToBottom()) {
+                this.scrollToBottom();
+            }
+        });
+        
+        this.feed.on('chat_read', (data) => this.markOwnMessagesRead(data.ids));
+        
+        this.feed.on('counters', (counters) => {
+            this.unreadCount = counters.chat;
+            this.updateUnreadBadge();
+            this.lastUnreadUpdate = Date.now();
+        });
+        
+        this.feed.on('online', (data) => {
+            this.onlineUsers = new Map(data.users.map(user => [user.id, user]));
+            this.renderOnlineUsers();
+        });
+        
+        this.feed.on('presence', (user) => {
+            this.onlineUsers.set(user.id, user);
+            this.renderOnlineUsers();
+        });
+        
+        // Eventi persi (stream saturo o disconnessione lunga): recupera i messaggi mancanti
+        this.feed.on('resync', () => this.pollForNewMessages());
+        
+        // Polling solo mentre il canale è giù
+        this.feed.on('open', () => this.stopPolling());
+        this.feed.on('error', () => {
+            if (!this.pollInterval) {
+                this.startPolling();
+            }
+        });
+        this.feed.on('unavailable', () => {
+            this.startPolling();
+            this.updateOnlineUsers();
+            this.updateUnreadCount();
+        });
+        
+        // Gli utenti non più attivi escono dalla lista senza richieste al server
+        this.onlineRefreshInterval = setInterval(() => this.renderOnlineUsers(), 60000);
+    }
+    
+    renderOnlineUsers() {
+        const cutoff = Date.now() - 5 * 60 * 1000;
+        const currentUserId = this.getCurrentUserId();
+        const users = [];
+        this.onlineUsers.forEach((user, userId) => {
+            // last_activity è in UTC senza fuso
+            if (Date.parse(user.last_activity + 'Z') < cutoff) {
+                this.onlineUsers.delete(userId);
+            } else {
+                users.push({ ...user, is_current: user.id === currentUserId });
+            }
+        });
+        this.displayOnlineUsers(users, users.length);
+    }
+    
     setupMobileKeyboardDetection() {
         // Method 1: Visual Viewport API (modern browsers)
         if (window.visualViewport) {
@@ -620,6 +694,18 @@ class ChatWidget {
         }
     }
     
+    markOwnMessagesRead(messageIds) {
+        messageIds.forEach(messageId => {
+            const messageElement = document.querySelector(`.message.own[data-message-id="${messageId}"]`);
+            const readStatusElement = messageElement ? messageElement.querySelector('.message-read-status') : null;
+            if (readStatusElement && readStatusElement.classList.contains('fa-check')) {
+                readStatusElement.className = 'fas fa-check-double message-read-status';
+                readStatusElement.style.color = '#4fc3f7';
+                readStatusElement.title = 'Letto';
+            }
+        });
+    }
+    
     updateOwnMessagesReadStatus() {
         // Update all own messages to show as read (double check)
         const ownMessages = document.querySelectorAll('.message.own');
@@ -650,7 +736,7 @@ class ChatWidget {
         
         // Update unread count every 15 seconds, but only if chat is closed
         // and we haven't updated recently to avoid badge flicker
-        setInterval(() => {
+        this.unreadInterval = setInterval(() => {
             if (!this.isOpen) {
                 const now = Date.now();
                 if (!this.lastUnreadUpdate || (now - this.lastUnreadUpdate) > 10000) {
@@ -670,6 +756,11 @@ class ChatWidget {
             clearInterval(this.onlineUsersInterval);
             this.onlineUsersInterval = null;
         }
+        
+        if (this.unreadInterval) {
+            clearInterval(this.unreadInterval);
+            this.unreadInterval = null;
+        }
     }
     
     scrollToBottom() {
@@ -730,6 +821,11 @@ class ChatWidget {
     destroy() {
         this.stopPolling();
         
+        if (this.onlineRefreshInterval) {
+            clearInterval(this.onlineRefreshInterval);
+            this.onlineRefreshInterval = null;
+        }
+        
         // Remove elements
         const toggle = document.getElementById('chatToggle');
         const widget = document.getElementById('chatWidget');
@@ -0,0 +1,219 @@
+/**
+ * Canale push unico (server-sent events) per campanella, badge task e chat
+ * Una sola connessione per browser a /tasks/api/notifications/stream al posto del polling:
+ * all'apertura arrivano contatori e utenti online, poi solo le novità.
+ * Alla riconnessione il browser invia Last-Event-ID e il server ripete gli eventi persi.
+ *
+ * Le schede dello stesso utente condividono lo stream: la scheda che ottiene il lock
+ * (navigator.locks) apre l'EventSource e inoltra gli eventi alle altre con un
+ * BroadcastChannel; quando viene chiusa il lock passa a un'altra scheda, che si ricollega
+ * dall'ultimo id ricevuto. Una scheda che si apre dopo riceve dalla principale l'ultimo
+ * stato (contatori, utenti online). Senza BroadcastChannel o lock ogni scheda apre il
+ * proprio stream.
+ */
+
+const LIVE_FEED_EVENTS = ['counters', 'online', 'notification', 'chat_message', 'chat_read', 'presence', 'resync'];
+
+class LiveFeed {
+    constructor(url, channelName) {
+        this.url = url;
+        this.channelName = channelName;
+        this.source = null;
+        this.channel = null;
+        this.handlers = {};
+        this.lastEventId = null;
+        this.connected = false;
+        this.leader = false;
+        this.releaseLeadership = null;
+        this.retryTimer = null;
+        this.retryDelay = 10000; // Se il server rifiuta lo stream il browser non riprova da solo
+        // Ultimo stato, per le schede che si aprono dopo la connessione
+        this.counters = null;
+        this.onlineUsers = null;
+    }
+
+    get available() {
+        return typeof window.EventSource !== 'undefined';
+    }
+
+    get shared() {
+        return Boolean(this.channelName) && typeof window.BroadcastChannel !== 'undefined'
+            && Boolean(navigator.locks);
+    }
+
+    on(eventName, handler) {
+        if (!this.handlers[eventName]) {
+            this.handlers[eventName] = [];
+        }
+        this.handlers[eventName].push(handler);
+    }
+
+    emit(eventName, data) {
+        (this.handlers[eventName] || []).forEach(handler => {
+            try {
+                handler(data);
+            } catch (error) {
+                console.error(`Errore nel gestore evento ${eventName}:`, error);
+            }
+        });
+    }
+
+    remember(eventName, data, eventId) {
+        if (eventId) {
+            this.lastEventId = eventId;
+        }
+        if (eventName === 'counters') {
+            this.counters = data;
+        } else if (eventName === 'online') {
+            this.onlineUsers = new Map(data.users.map(user => [user.id, user]));
+        } else if (eventName === 'presence' && this.onlineUsers) {
+            this.onlineUsers.set(data.id, data);
+        }
+    }
+
+    setConnected(connected) {
+        this.connected = connected;
+        this.emit(connected ? 'open' : 'error');
+    }
+
+    post(message) {
+        if (this.channel) {
+            this.channel.postMessage(message);
+        }
+    }
+
+    connect() {
+        if (!this.available) {
+            this.emit('unavailable');
+            return;
+        }
+        if (!this.shared) {
+            this.open();
+            return;
+        }
+
+        this.channel = new BroadcastChannel(this.channelName);
+        this.channel.onmessage = (event) => this.receive(event.data);
+        // Se c'è già una scheda principale risponde con lo stato attuale
+        this.post({type: 'hello'});
+
+        navigator.locks.request(this.channelName, () => new Promise(resolve => {
+            this.releaseLeadership = resolve;
+            this.leader = true;
+            this.open();
+        })).catch(error => console.error('Lock dello stream notifiche non disponibile:', error));
+    }
+
+    receive(message) {
+        if (!message) return;
+
+        if (message.type === 'hello') {
+            if (this.leader) {
+                this.post({
+                    type: 'snapshot',
+                    connected: this.connected,
+                    lastEventId: this.lastEventId,
+                    counters: this.counters,
+                    online: this.onlineUsers ? Array.from(this.onlineUsers.values()) : null
+                });
+            }
+            return;
+        }
+        if (this.leader) return;
+
+        if (message.type === 'event') {
+            this.remember(message.name, message.data, message.id);
+            this.emit(message.name, message.data);
+        } else if (message.type === 'status') {
+            this.setConnected(message.connected);
+        } else if (message.type === 'snapshot') {
+            if (message.lastEventId) {
+                this.lastEventId = message.lastEventId;
+            }
+            if (message.counters) {
+                this.remember('counters', message.counters);
+                this.emit('counters', message.counters);
+            }
+            if (message.online) {
+                const online = {users: message.online};
+                this.remember('online', online);
+                this.emit('online', online);
+            }
+            if (message.connected) {
+                this.setConnected(true);
+            }
+        }
+    }
+
+    open() {
+        const url = this.lastEventId
+            ? `${this.url}?last_event_id=${encodeURIComponent(this.lastEventId)}`
+            : this.url;
+        this.source = new EventSource(url);
+
+        LIVE_FEED_EVENTS.forEach(eventName => {
+            this.source.addEventListener(eventName, (event) => {
+                let data;
+                try {
+                    data = JSON.parse(event.data);
+                } catch (error) {
+                    console.error(`Evento ${eventName} non valido:`, error);
+                    return;
+                }
+                this.remember(eventName, data, event.lastEventId);
+                this.post({type: 'event', name: eventName, data: data, id: event.lastEventId || null});
+                this.emit(eventName, data);
+            });
+        });
+
+        this.source.onopen = () => {
+            this.setConnected(true);
+            this.post({type: 'status', connected: true});
+        };
+
+        this.source.onerror = () => {
+            this.setConnected(false);
+            this.post({type: 'status', connected: false});
+            if (this.source.readyState === EventSource.CLOSED) {
+                this.source.close();
+                this.retryTimer = setTimeout(() => this.open(), this.retryDelay);
+            }
+        };
+    }
+
+    close() {
+        if (this.retryTimer) {
+            clearTimeout(this.retryTimer);
+            this.retryTimer = null;
+        }
+        if (this.source) {
+            this.source.close();
+            this.source = null;
+        }
+        if (this.releaseLeadership) {
+            // Il lock passa a un'altra scheda, che riapre lo stream
+            this.releaseLeadership();
+            this.releaseLeadership = null;
+            this.leader = false;
+        }
+        if (this.channel) {
+            this.channel.close();
+            this.channel = null;
+        }
+        this.connected = false;
+    }
+}
+
+// Creato subito, collegato quando campanella e chat hanno registrato i gestori
+const liveFeedUser = document.querySelector('meta[name="current-user-id"]');
+if (liveFeedUser) {
+    window.liveFeed = new LiveFeed('/tasks/api/notifications/stream', `dblogix-live-feed-${liveFeedUser.content}`);
+
+    document.addEventListener('DOMContentLoaded', function() {
+        setTimeout(() => window.liveFeed.connect(), 0);
+    });
+
+    window.addEventListener('beforeunload', function() {
+        window.liveFeed.close();
+    });
+}
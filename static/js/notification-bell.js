@@ -9,7 +9,8 @@ class NotificationBell {
         this.isLoading = false;
         this.currentNotifications = [];
         this.pollInterval = null;
-        this.pollFrequency = 10000; // 10 secondi per aggiornamenti più veloci dei task completati
+        this.pollFrequency = 10000; // Solo se il canale push non è disponibile
+        this.feed = window.liveFeed || null;
         
         this.init();
     }
@@ -24,15 +25,49 @@ class NotificationBell {
         // Inizializza event listeners
         this.initEventListeners();
         
-        // Carica il conteggio iniziale
-        this.updateNotificationCount();
-        
-        // Inizia il polling automatico
-        this.startPolling();
+        if (this.feed) {
+            // Contatori e nuove notifiche arrivano dal canale push
+            this.connectFeed();
+        } else {
+            // Carica il conteggio iniziale
+            this.updateNotificationCount();
+            
+            // Inizia il polling automatico
+            this.startPolling();
+        }
         
         console.log('NotificationBell initialized');
     }
     
+    connectFeed() {
+        this.feed.on('counters', (counters) => {
+            this.renderNotificationBadges(counters.notifications);
+            this.renderTaskBadge(counters.completed || counters.active_tasks);
+        });
+        
+        this.feed.on('notification', (notification) => {
+            if (window.showInfo) {
+                window.showInfo(notification.title);
+            }
+            // Lista aperta: si ricarica con la nuova notifica
+            if (this.modal && this.modal.classList.contains('show')) {
+                this.loadNotifications();
+            }
+        });
+        
+        // Polling solo mentre il canale è giù
+        this.feed.on('open', () => this.stopPolling());
+        this.feed.on('error', () => {
+            if (!this.pollInterval) {
+                this.startPolling();
+            }
+        });
+        this.feed.on('unavailable', () => {
+            this.updateNotificationCount();
+            this.startPolling();
+        });
+    }
+    
     initEventListeners() {
         // Campanelle (mobile e desktop)
         const bellButtons = document.querySelectorAll('#mobile-notification-bell, #sidebar-notification-bell');
@@ -94,7 +129,9 @@ class NotificationBell {
             if (data.success) {
                 this.currentNotifications = data.notifications;
                 this.renderNotifications(data.notifications);
-                this.updateNotificationCount(data.unread_count);
+                if (!this.feed || !this.feed.connected) {
+                    this.updateNotificationCount(data.unread_count);
+                }
             } else {
                 throw new Error(data.error || 'Errore nel caricamento delle notifiche');
             }
@@ -310,7 +347,15 @@ class NotificationBell {
             }
         }
         
-        // Aggiorna i badge
+        this.renderNotificationBadges(count);
+        
+        // Con il canale push attivo il contatore dei task arriva già aggiornato
+        if (!this.feed || !this.feed.connected) {
+            this.updateTaskCompletedCount();
+        }
+    }
+    
+    renderNotificationBadges(count) {
         const badges = document.querySelectorAll('#mobile-notification-badge, #sidebar-notification-badge');
         badges.forEach(badge => {
             if (count > 0) {
@@ -320,38 +365,32 @@ class NotificationBell {
                 badge.style.display = 'none';
             }
         });
+    }
+    
+    renderTaskBadge(count) {
+        // Badge del link Task nella sidebar: task attivi (utenti) o completati da vedere (admin)
+        const badge = document.getElementById('sidebar-task-badge');
+        if (!badge) return;
         
-        // Aggiorna anche il contatore dei task completati per gli admin
-        this.updateTaskCompletedCount();
+        if (count > 0) {
+            badge.textContent = count > 99 ? '99+' : count.toString();
+            badge.style.display = 'flex';
+        } else {
+            badge.style.display = 'none';
+        }
     }
     
     async updateTaskCompletedCount() {
+        // Solo per gli admin: per gli utenti il badge mostra i task attivi
+        const badge = document.getElementById('sidebar-task-badge');
+        if (!badge || !badge.classList.contains('bg-success')) return;
+        
         try {
             const response = await fetch('/tasks/api/notifications/completed-count');
             if (response.ok) {
                 const data = await response.json();
                 if (data.success) {
-                    const completedCount = data.completed_count;
-                    
-                    // Trova il badge nel link dei task nella sidebar
-                    const taskLink = document.querySelector('a[href*="tasks.index"]');
-                    if (taskLink) {
-                        let badge = taskLink.querySelector('.badge.bg-success');
-                        
-                        if (completedCount > 0) {
-                            if (!badge) {
-                                // Crea il badge se non esiste
-                                badge = document.createElement('span');
-                                badge.className = 'badge bg-success position-absolute';
-                                badge.style.cssText = 'top: 8px; right: 15px; font-size: 0.7rem; padding: 3px 6px; border-radius: 10px; min-width: 18px; height: 18px; display: flex; align-items: center; justify-content: center;';
-                                taskLink.appendChild(badge);
-                            }
-                            badge.textContent = completedCount > 99 ? '99+' : completedCount.toString();
-                            badge.style.display = 'flex';
-                        } else if (badge) {
-                            badge.style.display = 'none';
-                        }
-                    }
+                    this.renderTaskBadge(data.completed_count);
                 }
             }
         } catch (error) {
@@ -421,6 +460,9 @@ class NotificationBell {
     }
     
     onModalHidden() {
+        // Con il canale push attivo il conteggio arriva già aggiornato
+        if (this.feed && this.feed.connected) return;
+        
         // Aggiorna il conteggio quando il modale viene chiuso
         setTimeout(() => {
             this.updateNotificationCount();